@@ -8,6 +8,9 @@ function Get-SecretCatalog {
         @{ EnvVar = "MAERSK_PASS";             KeyVaultName = "maersk-pass";              JobSecretName = "mkpass" }
         @{ EnvVar = "CMA_USER";                KeyVaultName = "cma-user";                 JobSecretName = "cmauser" }
         @{ EnvVar = "CMA_PASS";                KeyVaultName = "cma-pass";                 JobSecretName = "cmapass" }
+        @{ EnvVar = "HL_ACCOUNTS";             KeyVaultName = "hl-accounts";              JobSecretName = "hlaccounts" }
+        @{ EnvVar = "MAERSK_ACCOUNTS";         KeyVaultName = "maersk-accounts";          JobSecretName = "mkaccounts" }
+        @{ EnvVar = "CMA_ACCOUNTS";            KeyVaultName = "cma-accounts";             JobSecretName = "cmaaccounts" }
         @{ EnvVar = "SHAREPOINT_TENANT_ID";    KeyVaultName = "sharepoint-tenant-id";     JobSecretName = "sptenant" }
         @{ EnvVar = "SHAREPOINT_CLIENT_ID";    KeyVaultName = "sharepoint-client-id";     JobSecretName = "spclient" }
         @{ EnvVar = "SHAREPOINT_CLIENT_SECRET";KeyVaultName = "sharepoint-client-secret"; JobSecretName = "spsecret" }
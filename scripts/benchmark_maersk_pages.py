@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRAPER_SCRIPT = PROJECT_ROOT / "src" / "scrapers" / "maersk_instant_quote.py"
+INPUT_XLSX = PROJECT_ROOT / "artifacts" / "input" / "maersk_jobs.xlsx"
+DEFAULT_HISTORY_DB = PROJECT_ROOT / "artifacts" / "runtime" / "run_history.sqlite"
+
+
+def first_routes(limit: int) -> list[dict]:
+    """Primeiras N rotas validas do XLSX do Maersk (mesmas para todas as medicoes)."""
+    df = pd.read_excel(INPUT_XLSX, engine="openpyxl")
+    cols = {str(c).strip().lower(): c for c in df.columns}
+    col_o = cols.get("origem") or cols.get("origin")
+    col_d = cols.get("porto de destino") or cols.get("destino") or cols.get("destination")
+    if col_o is None or col_d is None:
+        raise ValueError(f"colunas de origem/destino nao encontradas em {INPUT_XLSX}")
+    routes = []
+    for _, row in df.iterrows():
+        if pd.isna(row[col_o]) or pd.isna(row[col_d]):
+            continue
+        routes.append({"origin": str(row[col_o]).strip(), "destination": str(row[col_d]).strip()})
+        if len(routes) >= limit:
+            break
+    return routes
+
+
+def history_db() -> Path:
+    raw = os.getenv("RUN_HISTORY_DB")
+    if not raw:
+        return DEFAULT_HISTORY_DB
+    candidate = Path(raw).expanduser()
+    return candidate if candidate.is_absolute() else PROJECT_ROOT / candidate
+
+
+def run_attempts(run_id: str) -> list[sqlite3.Row]:
+    path = history_db()
+    if not path.exists():
+        return []
+    conn = sqlite3.connect(str(path))
+    conn.row_factory = sqlite3.Row
+    try:
+        return conn.execute(
+            "SELECT status, latency_sec, retries FROM route_attempts WHERE run_id = ? AND carrier = 'maersk'",
+            (run_id,),
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def run_scraper(pages: int, routes_file: Path, run_id: str, log_path: Path) -> tuple[float, int]:
+    env = os.environ.copy()
+    env.update(
+        MAERSK_PAGES=str(pages),
+        RUN_ID=run_id,
+        PIPELINE_STAGE="benchmark",
+        SCRAPER_ROUTES_FILE=str(routes_file),
+        KEEP_OPEN_SECS="0",
+    )
+    started = time.perf_counter()
+    with log_path.open("w", encoding="utf-8") as log_file:
+        proc = subprocess.run(
+            [sys.executable, str(SCRAPER_SCRIPT)],
+            cwd=str(PROJECT_ROOT),
+            env=env,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+    return time.perf_counter() - started, proc.returncode
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Mede o scraper do Maersk com 1 ou mais abas no mesmo contexto logado (MAERSK_PAGES)."
+    )
+    parser.add_argument("--pages", default="1,2,4", help="Quantidades de abas a medir, separadas por virgula.")
+    parser.add_argument("--routes", type=int, default=12, help="Rotas do XLSX usadas em cada medicao.")
+    parser.add_argument("--keep-logs", action="store_true", help="Guarda os logs de cada medicao em artifacts/logs.")
+    args = parser.parse_args()
+
+    page_counts = [int(p) for p in args.pages.split(",") if p.strip()]
+    if not page_counts or min(page_counts) < 1:
+        parser.error("--pages precisa de inteiros >= 1")
+    routes = first_routes(max(1, args.routes))
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    print(f"[bench] {len(routes)} rotas; abas={page_counts}; historico em {history_db()}")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        routes_file = Path(tmp) / "routes.json"
+        routes_file.write_text(json.dumps(routes, ensure_ascii=False), encoding="utf-8")
+        log_dir = PROJECT_ROOT / "artifacts" / "logs" if args.keep_logs else Path(tmp)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        for pages in page_counts:
+            run_id = f"bench_maersk_pages{pages}_{stamp}"
+            log_path = log_dir / f"{run_id}.log"
+            wall, rc = run_scraper(pages, routes_file, run_id, log_path)
+            attempts = run_attempts(run_id)
+            ok = sum(1 for a in attempts if a["status"] == "ok")
+            latencies = [a["latency_sec"] for a in attempts if a["latency_sec"] is not None]
+            retries = sum(a["retries"] or 0 for a in attempts)
+            rows.append((pages, wall, rc, len(attempts), ok, statistics.median(latencies) if latencies else None, retries))
+            print(f"[bench] abas={pages}: {wall:.1f}s rc={rc} ({len(attempts)} rotas gravadas)")
+
+    print(f"{'abas':>4} {'parede':>9} {'rotas':>6} {'ok':>4} {'rotas/min':>10} {'lat.med':>8} {'retry':>6}  obs")
+    base_wall = rows[0][1] if rows else None
+    for pages, wall, rc, total, ok, median_lat, retries in rows:
+        per_min = total / wall * 60 if wall > 0 else 0.0
+        lat = f"{median_lat:.1f}s" if median_lat is not None else "-"
+        note = "" if rc == 0 else f"rc={rc} (ver log)"
+        if base_wall and pages != rows[0][0]:
+            note = f"{base_wall / wall:.2f}x vs {rows[0][0]} aba(s) {note}".strip()
+        print(f"{pages:>4} {wall:>8.1f}s {total:>6} {ok:>4} {per_min:>10.1f} {lat:>8} {retries:>6}  {note}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+WORKER_SCRIPT = PROJECT_ROOT / "src" / "orchestration" / "stage_worker.py"
+
+# Scripts das etapas (mesmos do runner). So o import do modulo e medido: nada de scraping/upload.
+STAGE_SCRIPTS = {
+    "hapag": PROJECT_ROOT / "src" / "scrapers" / "hapag_instant_quote.py",
+    "maersk": PROJECT_ROOT / "src" / "scrapers" / "maersk_instant_quote.py",
+    "comparison": PROJECT_ROOT / "src" / "processing" / "quote_comparison.py",
+    "upload": PROJECT_ROOT / "src" / "export" / "upload_fretes.py",
+    "shard_merge": PROJECT_ROOT / "src" / "orchestration" / "shard_merge.py",
+}
+
+COLD_IMPORT_CODE = (
+    "import importlib.util, sys\n"
+    "path = sys.argv[1]\n"
+    "sys.path.insert(0, __import__('os').path.dirname(path))\n"
+    "spec = importlib.util.spec_from_file_location('__bench_stage__', path)\n"
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+)
+
+
+def bench_env() -> dict:
+    env = os.environ.copy()
+    # os scrapers exigem credenciais em tempo de import; valores ficticios bastam para medir.
+    env.setdefault("HL_USER", "benchmark")
+    env.setdefault("HL_PASS", "benchmark")
+    env["PIPELINE_STAGE"] = "benchmark"
+    return env
+
+
+def cold_start_sec(script: Path, env: dict) -> tuple[float, bool]:
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", COLD_IMPORT_CODE, str(script)],
+        cwd=str(PROJECT_ROOT),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - started, proc.returncode == 0
+
+
+def start_worker(env: dict) -> tuple[subprocess.Popen, float, dict]:
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, str(WORKER_SCRIPT)],
+        cwd=str(PROJECT_ROOT),
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+    )
+    ready = json.loads(proc.stdout.readline() or "{}")
+    return proc, time.perf_counter() - started, ready
+
+
+def warm_start_sec(proc: subprocess.Popen, stage: str, script: Path, env: dict, log_path: Path) -> tuple[float, bool]:
+    request = {
+        "id": stage,
+        "stage": stage,
+        "script": str(script),
+        "args": [],
+        "env": env,
+        "cwd": str(PROJECT_ROOT),
+        "log_path": str(log_path),
+        "import_only": True,
+    }
+    started = time.perf_counter()
+    proc.stdin.write(json.dumps(request) + "\n")
+    proc.stdin.flush()
+    reply = json.loads(proc.stdout.readline() or "{}")
+    return time.perf_counter() - started, reply.get("rc") == 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Compara o startup de cada etapa: subprocess novo x worker Python persistente."
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Medicoes por etapa (usa a mediana).")
+    parser.add_argument("--stages", default=",".join(STAGE_SCRIPTS), help="Etapas separadas por virgula.")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGE_SCRIPTS]
+    if unknown:
+        parser.error(f"etapas desconhecidas: {unknown} (use {list(STAGE_SCRIPTS)})")
+
+    env = bench_env()
+    proc, worker_boot_sec, ready = start_worker(env)
+    print(
+        f"[worker] boot={worker_boot_sec:.2f}s preload={ready.get('preload_sec')}s "
+        f"modulos={sorted(ready.get('modules', {}))}"
+    )
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = Path(tmp) / "benchmark_stage.log"
+        for stage in stages:
+            script = STAGE_SCRIPTS[stage]
+            cold, warm = [], []
+            cold_ok = warm_ok = True
+            for _ in range(max(1, args.repeat)):
+                sec, ok = cold_start_sec(script, env)
+                cold.append(sec)
+                cold_ok = cold_ok and ok
+                sec, ok = warm_start_sec(proc, stage, script, env, log_path)
+                warm.append(sec)
+                warm_ok = warm_ok and ok
+            rows.append((stage, statistics.median(cold), statistics.median(warm), cold_ok and warm_ok))
+
+    proc.stdin.close()
+    proc.wait(timeout=10)
+
+    print(f"{'etapa':<12} {'subprocess':>11} {'worker':>9} {'economia':>9}  obs")
+    for stage, cold, warm, ok in rows:
+        note = "" if ok else "import falhou (dependencia/credencial ausente?)"
+        print(f"{stage:<12} {cold:>10.2f}s {warm:>8.2f}s {cold - warm:>8.2f}s  {note}")
+    total_saving = sum(cold - warm for _, cold, warm, _ in rows)
+    print(f"economia total por run (uma vez cada etapa): {total_saving:.2f}s; boot unico do worker: {worker_boot_sec:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -10,6 +10,9 @@ from dotenv import load_dotenv
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 load_dotenv(PROJECT_ROOT / ".env", override=False)
 
+sys.path.append(str(PROJECT_ROOT / "src" / "orchestration"))
+import account_pool  # noqa: E402
+
 
 def resolve_env_path(env_name: str, default_path: Path) -> Path:
     raw = os.getenv(env_name)
@@ -80,7 +83,20 @@ def main() -> int:
         failures += 1
         print_fail(f"UPLOAD_MODE invalido: {upload_mode} (validos: {sorted(valid_upload_mode)})")
 
-    base_missing = check_required_env(["HL_USER", "HL_PASS", "MAERSK_USER", "MAERSK_PASS"])
+    # cada carrier precisa do par USER/PASS ou da lista <X>_ACCOUNTS (pool de contas)
+    base_missing = []
+    for carrier in ("hapag", "maersk"):
+        list_env, user_env, pass_env = account_pool.CARRIER_ENV[carrier]
+        try:
+            accounts = account_pool.load_accounts(carrier)
+        except RuntimeError as e:
+            failures += 1
+            print_fail(str(e))
+            continue
+        if not accounts:
+            base_missing.append(f"{user_env}/{pass_env} ou {list_env}")
+        elif len(accounts) > 1:
+            print_ok(f"{list_env}: {len(accounts)} contas no pool")
     if base_missing:
         failures += 1
         print_fail(f"Credenciais obrigatorias ausentes: {base_missing}")
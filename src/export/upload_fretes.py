@@ -39,6 +39,8 @@ def resolve_env_path(env_name: str, default_path: Path) -> Path:
 
 # Arquivos locais (onde o pipeline ja grava o CSV)
 CSV_INPUT = PROJECT_ROOT / "artifacts" / "output" / "comparacao_carriers.csv"
+# Copias tipadas gravadas pelo quote_comparison.py junto com o CSV (lidas sem parse).
+TYPED_INPUTS = [CSV_INPUT.with_suffix(".parquet"), CSV_INPUT.with_suffix(".pkl")]
 XLSX_OUTPUT = PROJECT_ROOT / "artifacts" / "output" / "comparacao_carriers_cliente.xlsx"
 XLSX_OUTPUT_SPECIALS = (
     PROJECT_ROOT / "artifacts" / "output" / "comparacao_carriers_cliente_special.xlsx"
@@ -794,21 +796,60 @@ def _salvar_planilha_cliente(
 # 2) GERA A PLANILHA PARA O CLIENTE
 # =========================================
 
-def gerar_planilha_cliente():
-    print("Lendo CSV interno...")
-    if not CSV_INPUT.exists():
-        raise FileNotFoundError(f"CSV de entrada nao encontrado: {CSV_INPUT}")
+def _free_time_cell(value):
+    """free_time vem como texto na copia tipada; numeros voltam a ser numero no Excel."""
+    if pd.isna(value):
+        return pd.NA
+    parsed = pd.to_numeric(value, errors="coerce")
+    if pd.isna(parsed):
+        return value
+    number = float(parsed)
+    return int(number) if number.is_integer() else number
 
+
+def _typed_input() -> Path | None:
+    """Copia tipada mais nova, desde que nao seja mais velha que o CSV."""
+    csv_mtime = CSV_INPUT.stat().st_mtime_ns
+    candidates = [p for p in TYPED_INPUTS if p.exists() and p.stat().st_mtime_ns >= csv_mtime]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda p: p.stat().st_mtime_ns)
+
+
+def ler_comparacao() -> pd.DataFrame:
+    typed_path = _typed_input()
+    if typed_path is not None:
+        try:
+            if typed_path.suffix == ".parquet":
+                df = pd.read_parquet(typed_path)
+            else:
+                df = pd.read_pickle(typed_path)
+        except Exception as e:
+            print(f"AVISO: falha ao ler {typed_path.name} ({e!r}); usando o CSV.")
+        else:
+            print(f"Lendo comparacao tipada: {typed_path.name}")
+            if "free_time" in df.columns:
+                df["free_time"] = df["free_time"].astype("object").map(_free_time_cell)
+            return df
+
+    print("Lendo CSV interno...")
     # Le o CSV usando ; como separador e , como decimal.
     # Mantemos transit_time como texto para evitar interpretacao de "26.0"
     # como 260 quando thousands="." estiver ativo.
-    df = pd.read_csv(
+    return pd.read_csv(
         CSV_INPUT,
         sep=";",
         decimal=",",
         thousands=".",
         dtype={"transit_time": "string"},
     )
+
+
+def gerar_planilha_cliente():
+    if not CSV_INPUT.exists():
+        raise FileNotFoundError(f"CSV de entrada nao encontrado: {CSV_INPUT}")
+
+    df = ler_comparacao()
     df["winner_dthc"] = resolve_winner_dthc_series(df)
 
     # Novas colunas relacionadas ao vencedor (vindas do quote_comparison.py):
@@ -1154,10 +1195,15 @@ def copiar_para_pasta_sincronizada():
 # 4) MAIN
 # =========================================
 
-if __name__ == "__main__":
+def main() -> int:
     check_config()
     gerar_planilha_cliente()
     if UPLOAD_MODE in {"SYNC", "BOTH"}:
         copiar_para_pasta_sincronizada()
     if UPLOAD_MODE in {"SHAREPOINT", "BOTH"}:
         upload_para_sharepoint_direto()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
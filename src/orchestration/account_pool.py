@@ -0,0 +1,484 @@
+"""
+Pool de contas por armador para sessoes autenticadas em paralelo.
+
+Cada scraper lia um unico par de credenciais (`HL_USER`/`HL_PASS`,
+`MAERSK_USER`/`MAERSK_PASS`, `CMA_USER`/`CMA_PASS`). Com `HL_ACCOUNTS`,
+`MAERSK_ACCOUNTS` ou `CMA_ACCOUNTS` (lista JSON, normalmente vinda do Key
+Vault) cada processo de scraper (shard, replica, daemon do browser pool) pega
+uma conta do pool ao subir:
+
+    [{"id": "ops1", "user": "a@x.com", "pass": "..."}, {"user": "b@x.com", "pass": "..."}]
+
+(`id` e opcional: sem ele vale um hash curto do usuario.) Sem a lista, o par
+antigo vira a conta unica `default`, com o comportamento de sempre.
+
+- Escolha justa: conta nao bloqueada com menos sessoes ativas e, no empate, a
+  usada ha mais tempo. `ACCOUNT_MAX_SESSIONS` (0 = sem limite) limita sessoes
+  simultaneas por conta; sem vaga, o processo espera ate
+  `ACCOUNT_ACQUIRE_WAIT_SEC`. As abas de um processo dividem a mesma sessao
+  logada, entao a conta e por processo/contexto, nao por aba.
+- Perfil por conta: `profile_dir` acrescenta `_<id>` ao perfil do navegador
+  (a conta `default` continua no perfil antigo), entao cookies de contas
+  diferentes nao se misturam.
+- Saude: cada rota conta ok/falha por conta. `ACCOUNT_LOCKOUT_AFTER` falhas
+  seguidas (ou login recusado) bloqueiam a conta por `ACCOUNT_COOLDOWN_MIN`.
+  Com a fila de rotas (`SCRAPER_JOB_QUEUE`) o processo da conta bloqueada para
+  de pegar rotas e o restante fica para os processos das outras contas. Bloqueio
+  so vale com mais de uma conta no pool.
+- A sessao (lease) vale `ACCOUNT_LEASE_SEC` sem heartbeat; processo que morre
+  libera a conta sozinho.
+
+Backend: SQLite (WAL) em `artifacts/runtime/account_pool.sqlite` (ou
+`ACCOUNT_POOL_DB`), com `BEGIN IMMEDIATE` como a fila de rotas.
+
+CLI:
+  python src/orchestration/account_pool.py status
+  python src/orchestration/account_pool.py unlock --carrier hapag --account ops1
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import sqlite_state
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+DEFAULT_DB_PATH = PROJECT_ROOT / "artifacts" / "runtime" / "account_pool.sqlite"
+DEFAULT_ACCOUNT_ID = "default"
+
+# carrier -> (lista do pool, usuario legado, senha legada)
+CARRIER_ENV = {
+    "hapag": ("HL_ACCOUNTS", "HL_USER", "HL_PASS"),
+    "maersk": ("MAERSK_ACCOUNTS", "MAERSK_USER", "MAERSK_PASS"),
+    "cma": ("CMA_ACCOUNTS", "CMA_USER", "CMA_PASS"),
+}
+
+OK_STATUSES = {"success", "ok", "no_quote"}
+FAILED_STATUSES = {"error", "timeout"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS account_leases (
+    carrier TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    holder TEXT NOT NULL,
+    heartbeat REAL NOT NULL,
+    started_at TEXT,
+    PRIMARY KEY (carrier, account_id, holder)
+);
+CREATE TABLE IF NOT EXISTS account_health (
+    carrier TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    jobs_ok INTEGER NOT NULL DEFAULT 0,
+    jobs_failed INTEGER NOT NULL DEFAULT 0,
+    consecutive_failures INTEGER NOT NULL DEFAULT 0,
+    locked_until REAL,
+    lock_reason TEXT,
+    last_used_at TEXT,
+    last_error TEXT,
+    PRIMARY KEY (carrier, account_id)
+);
+"""
+
+
+def db_path() -> Path:
+    return sqlite_state.env_path("ACCOUNT_POOL_DB", DEFAULT_DB_PATH)
+
+
+def lease_sec() -> float:
+    return max(60.0, float(os.getenv("ACCOUNT_LEASE_SEC", "1800")))
+
+
+def lockout_after() -> int:
+    return max(0, int(os.getenv("ACCOUNT_LOCKOUT_AFTER", "5")))
+
+
+def cooldown_sec() -> float:
+    return max(0.0, float(os.getenv("ACCOUNT_COOLDOWN_MIN", "30")) * 60)
+
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def connect(path: Optional[Path] = None) -> sqlite3.Connection:
+    # autocommit: transacoes explicitas com BEGIN IMMEDIATE (sqlite_state.transaction)
+    return sqlite_state.connect(path or db_path(), SCHEMA)
+
+
+def _account_id(raw_id, user: str) -> str:
+    if raw_id:
+        return re.sub(r"[^A-Za-z0-9_-]+", "_", str(raw_id).strip()) or DEFAULT_ACCOUNT_ID
+    return "a" + hashlib.sha1(user.strip().lower().encode("utf-8")).hexdigest()[:8]
+
+
+def load_accounts(carrier: str) -> List[dict]:
+    """Contas do carrier: lista `<X>_ACCOUNTS` ou, sem ela, o par legado como `default`."""
+    list_env, user_env, pass_env = CARRIER_ENV[carrier]
+    raw = (os.getenv(list_env) or "").strip()
+    if raw:
+        try:
+            entries = json.loads(raw)
+        except ValueError as e:
+            raise RuntimeError(f"{list_env} nao e um JSON valido: {e}") from None
+        if not isinstance(entries, list):
+            raise RuntimeError(f"{list_env} precisa ser uma lista JSON de contas.")
+        accounts = []
+        for pos, entry in enumerate(entries, start=1):
+            entry = entry if isinstance(entry, dict) else {}
+            user = str(entry.get("user") or entry.get("username") or "").strip()
+            password = str(entry.get("pass") or entry.get("password") or "")
+            if not user or not password:
+                raise RuntimeError(f"{list_env}: conta {pos} sem user/pass.")
+            accounts.append({"carrier": carrier, "id": _account_id(entry.get("id"), user), "user": user, "password": password})
+        ids = [a["id"] for a in accounts]
+        if len(set(ids)) != len(ids):
+            raise RuntimeError(f"{list_env}: ids de conta repetidos ({', '.join(ids)}).")
+        if accounts:
+            return accounts
+    user = os.getenv(user_env)
+    password = os.getenv(pass_env)
+    if not user or not password:
+        return []
+    return [{"carrier": carrier, "id": DEFAULT_ACCOUNT_ID, "user": user, "password": password}]
+
+
+def _expire_leases(conn: sqlite3.Connection, carrier: str, now: float) -> None:
+    conn.execute("DELETE FROM account_leases WHERE carrier = ? AND heartbeat < ?", (carrier, now - lease_sec()))
+
+
+def _pick(conn: sqlite3.Connection, carrier: str, accounts: List[dict], prefer: Optional[str], now: float):
+    """Devolve (conta, sessoes ativas, motivo do bloqueio) ou None se nao ha vaga."""
+    _expire_leases(conn, carrier, now)
+    active = {
+        r["account_id"]: r["n"]
+        for r in conn.execute(
+            "SELECT account_id, COUNT(*) AS n FROM account_leases WHERE carrier = ? GROUP BY account_id", (carrier,)
+        )
+    }
+    health = {r["account_id"]: r for r in conn.execute("SELECT * FROM account_health WHERE carrier = ?", (carrier,))}
+
+    def locked(account_id: str) -> Optional[str]:
+        row = health.get(account_id)
+        if row is None or not row["locked_until"] or row["locked_until"] <= now:
+            return None
+        until = datetime.fromtimestamp(row["locked_until"]).isoformat(timespec="minutes")
+        return f"{row['lock_reason'] or 'bloqueio manual'} ate {until}"
+
+    by_id = {a["id"]: a for a in accounts}
+    if prefer in by_id:
+        # sessao ja logada por outro processo (browser pool): segue na mesma conta
+        return by_id[prefer], active.get(prefer, 0), locked(prefer)
+
+    max_sessions = max(0, int(os.getenv("ACCOUNT_MAX_SESSIONS", "0")))
+    candidates = [a for a in accounts if locked(a["id"]) is None]
+    if not candidates:
+        if len(accounts) > 1:
+            reasons = "; ".join(f"{a['id']}: {locked(a['id'])}" for a in accounts)
+            raise RuntimeError(f"Todas as contas {carrier} estao bloqueadas ({reasons}).")
+        # conta unica: bloqueio so informativo (nao ha para onde desviar)
+        candidates = accounts
+    if max_sessions:
+        candidates = [a for a in candidates if active.get(a["id"], 0) < max_sessions]
+    if not candidates:
+        return None
+    order = {a["id"]: pos for pos, a in enumerate(accounts)}
+
+    def last_used(account_id: str) -> str:
+        row = health.get(account_id)
+        return (row["last_used_at"] or "") if row is not None else ""
+
+    best = min(candidates, key=lambda a: (active.get(a["id"], 0), last_used(a["id"]), order[a["id"]]))
+    return best, active.get(best["id"], 0), locked(best["id"])
+
+
+def acquire(carrier: str, log_fn: Callable[[str], None] = print, prefer: Optional[str] = None,
+            holder: Optional[str] = None) -> dict:
+    """
+    Reserva uma conta para este processo. `prefer` forca a conta de uma sessao
+    ja logada (estado do browser pool). O chamador libera com `release`.
+    """
+    accounts = load_accounts(carrier)
+    if not accounts:
+        list_env, user_env, pass_env = CARRIER_ENV[carrier]
+        raise RuntimeError(f"Defina {user_env} e {pass_env} (ou {list_env}) no .env")
+    holder = holder or sqlite_state.holder_id()
+    wait_sec = max(0.0, float(os.getenv("ACCOUNT_ACQUIRE_WAIT_SEC", "600")))
+    deadline = time.monotonic() + wait_sec
+    waiting_logged = False
+    while True:
+        conn = connect()
+        try:
+            def take():
+                now = time.time()
+                picked = _pick(conn, carrier, accounts, prefer, now)
+                if picked is None:
+                    return None
+                account, _, _ = picked
+                conn.execute(
+                    "INSERT OR REPLACE INTO account_leases (carrier, account_id, holder, heartbeat, started_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (carrier, account["id"], holder, now, now_iso()),
+                )
+                conn.execute(
+                    "INSERT INTO account_health (carrier, account_id, last_used_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (carrier, account_id) DO UPDATE SET last_used_at = excluded.last_used_at",
+                    (carrier, account["id"], now_iso()),
+                )
+                return picked
+
+            picked = sqlite_state.transaction(conn, take)
+        finally:
+            conn.close()
+        if picked is not None:
+            break
+        if time.monotonic() >= deadline:
+            raise RuntimeError(
+                f"Nenhuma conta {carrier} livre apos {wait_sec:.0f}s "
+                f"(ACCOUNT_MAX_SESSIONS={os.getenv('ACCOUNT_MAX_SESSIONS')})."
+            )
+        if not waiting_logged:
+            log_fn(f"[contas] {carrier}: todas as contas no limite de sessoes; aguardando vaga.")
+            waiting_logged = True
+        time.sleep(5.0)
+
+    account, others, lock_note = picked
+    account = dict(account, holder=holder, pooled=len(accounts) > 1, locked=None)
+    if len(accounts) > 1:
+        log_fn(f"[contas] {carrier}: conta {account['id']} ({len(accounts)} no pool; sessoes ativas nela antes desta: {others}).")
+    if lock_note:
+        log_fn(f"[contas] aviso: conta {carrier}/{account['id']} bloqueada ({lock_note}); seguindo mesmo assim.")
+    return account
+
+
+def release(account: Optional[dict]) -> None:
+    if not account:
+        return
+    conn = connect()
+    try:
+        conn.execute(
+            "DELETE FROM account_leases WHERE carrier = ? AND account_id = ? AND holder = ?",
+            (account["carrier"], account["id"], account["holder"]),
+        )
+    finally:
+        conn.close()
+
+
+def heartbeat(account: Optional[dict]) -> None:
+    """Mantem a sessao contada como ativa (processos longos, ex.: daemon do pool)."""
+    if not account:
+        return
+    conn = connect()
+    try:
+        conn.execute(
+            "UPDATE account_leases SET heartbeat = ? WHERE carrier = ? AND account_id = ? AND holder = ?",
+            (time.time(), account["carrier"], account["id"], account["holder"]),
+        )
+    finally:
+        conn.close()
+
+
+def _lock(conn: sqlite3.Connection, account: dict, reason: str) -> None:
+    conn.execute(
+        "UPDATE account_health SET locked_until = ?, lock_reason = ? WHERE carrier = ? AND account_id = ?",
+        (time.time() + cooldown_sec(), reason, account["carrier"], account["id"]),
+    )
+
+
+def record_job(account: Optional[dict], status: str, message: str = "") -> Optional[str]:
+    """
+    Conta o resultado da rota na saude da conta. Devolve o motivo se a conta
+    acabou de ser bloqueada (o mesmo fica em `account["locked"]`).
+    """
+    if not account or (status not in OK_STATUSES and status not in FAILED_STATUSES):
+        return None
+    failed = status in FAILED_STATUSES
+    conn = connect()
+    try:
+        def update() -> Optional[str]:
+            conn.execute(
+                "INSERT OR IGNORE INTO account_health (carrier, account_id) VALUES (?, ?)",
+                (account["carrier"], account["id"]),
+            )
+            if failed:
+                conn.execute(
+                    "UPDATE account_health SET jobs_failed = jobs_failed + 1, "
+                    "consecutive_failures = consecutive_failures + 1, last_error = ?, last_used_at = ? "
+                    "WHERE carrier = ? AND account_id = ?",
+                    ((message or status)[:300], now_iso(), account["carrier"], account["id"]),
+                )
+            else:
+                conn.execute(
+                    "UPDATE account_health SET jobs_ok = jobs_ok + 1, consecutive_failures = 0, last_used_at = ? "
+                    "WHERE carrier = ? AND account_id = ?",
+                    (now_iso(), account["carrier"], account["id"]),
+                )
+            conn.execute(
+                "UPDATE account_leases SET heartbeat = ? WHERE carrier = ? AND account_id = ? AND holder = ?",
+                (time.time(), account["carrier"], account["id"], account["holder"]),
+            )
+            streak = conn.execute(
+                "SELECT consecutive_failures FROM account_health WHERE carrier = ? AND account_id = ?",
+                (account["carrier"], account["id"]),
+            ).fetchone()["consecutive_failures"]
+            limit = lockout_after()
+            if not failed or not account.get("pooled") or not limit or streak < limit:
+                return None
+            reason = f"{streak} falhas seguidas"
+            _lock(conn, account, reason)
+            return reason
+
+        reason = sqlite_state.transaction(conn, update)
+    finally:
+        conn.close()
+    if reason:
+        account["locked"] = reason
+    return reason
+
+
+def report_lockout(account: Optional[dict], reason: str, log_fn: Callable[[str], None] = print) -> None:
+    """Bloqueia a conta na hora (login recusado, conta suspensa...)."""
+    if not account:
+        return
+    conn = connect()
+    try:
+        def update() -> None:
+            conn.execute(
+                "INSERT OR IGNORE INTO account_health (carrier, account_id) VALUES (?, ?)",
+                (account["carrier"], account["id"]),
+            )
+            conn.execute(
+                "UPDATE account_health SET last_error = ? WHERE carrier = ? AND account_id = ?",
+                (reason[:300], account["carrier"], account["id"]),
+            )
+            if account.get("pooled"):
+                _lock(conn, account, reason)
+
+        sqlite_state.transaction(conn, update)
+    finally:
+        conn.close()
+    if account.get("pooled"):
+        account["locked"] = reason
+        log_fn(
+            f"[contas] {account['carrier']}/{account['id']} bloqueada por {cooldown_sec() / 60:.0f} min: {reason}"
+        )
+
+
+def until_locked(jobs: Iterable[dict], account: Optional[dict], log_fn: Callable[[str], None] = print) -> Iterator[dict]:
+    """
+    Repassa as rotas enquanto a conta nao for bloqueada. Usado com a fila de
+    rotas: as que sobram voltam para os processos das outras contas.
+    """
+    for job in jobs:
+        yield job
+        if account and account.get("locked"):
+            log_fn(
+                f"[contas] {account['carrier']}/{account['id']} bloqueada ({account['locked']}); "
+                "parando de pegar rotas (as restantes ficam na fila para as outras contas)."
+            )
+            return
+
+
+def profile_dir(base: Path, account: Optional[dict]) -> Path:
+    """Perfil do navegador da conta (`default` usa o perfil de sempre)."""
+    if not account or account["id"] == DEFAULT_ACCOUNT_ID:
+        return base
+    return base.with_name(f"{base.name}_{account['id']}")
+
+
+def account_status(carrier: Optional[str] = None) -> List[Dict]:
+    path = db_path()
+    if not path.exists():
+        return []
+    conn = connect(path)
+    try:
+        now = time.time()
+        sql = (
+            "SELECT h.*, (SELECT COUNT(*) FROM account_leases l WHERE l.carrier = h.carrier "
+            "AND l.account_id = h.account_id AND l.heartbeat >= ?) AS sessions FROM account_health h"
+        )
+        params: tuple = (now - lease_sec(),)
+        if carrier:
+            sql += " WHERE h.carrier = ?"
+            params += (carrier,)
+        rows = conn.execute(sql + " ORDER BY h.carrier, h.account_id", params).fetchall()
+    finally:
+        conn.close()
+    result = []
+    for r in rows:
+        row = dict(r)
+        row["locked"] = bool(r["locked_until"] and r["locked_until"] > now)
+        row["locked_until"] = (
+            datetime.fromtimestamp(r["locked_until"]).isoformat(timespec="seconds") if row["locked"] else None
+        )
+        result.append(row)
+    return result
+
+
+def unlock(carrier: str, account_id: str) -> bool:
+    conn = connect()
+    try:
+        cur = conn.execute(
+            "UPDATE account_health SET locked_until = NULL, lock_reason = NULL, consecutive_failures = 0 "
+            "WHERE carrier = ? AND account_id = ?",
+            (carrier, account_id),
+        )
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+
+def cmd_status(args: argparse.Namespace) -> None:
+    rows = account_status(args.carrier)
+    if not rows:
+        print("(sem dados)")
+        return
+    headers = ["carrier", "conta", "sessoes", "ok", "falhas", "seguidas", "bloqueada_ate", "motivo", "ultimo_uso"]
+    table = [
+        [
+            r["carrier"], r["account_id"], str(r["sessions"]), str(r["jobs_ok"]), str(r["jobs_failed"]),
+            str(r["consecutive_failures"]), r["locked_until"] or "-", (r["lock_reason"] if r["locked"] else None) or "-",
+            r["last_used_at"] or "-",
+        ]
+        for r in rows
+    ]
+    widths = [len(h) for h in headers]
+    for row in table:
+        widths = [max(w, len(v)) for w, v in zip(widths, row)]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for row in table:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Saude e bloqueios do pool de contas dos scrapers.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("status", help="Sessoes ativas, contagens e bloqueios por conta.")
+    p.add_argument("--carrier", choices=sorted(CARRIER_ENV), default=None)
+
+    p = sub.add_parser("unlock", help="Libera uma conta bloqueada antes do fim do cooldown.")
+    p.add_argument("--carrier", choices=sorted(CARRIER_ENV), required=True)
+    p.add_argument("--account", required=True)
+
+    args = parser.parse_args()
+    if args.cmd == "status":
+        cmd_status(args)
+        return 0
+    if unlock(args.carrier, args.account):
+        print(f"[contas] {args.carrier}/{args.account} liberada.")
+        return 0
+    print(f"[contas] {args.carrier}/{args.account} sem registro no pool.")
+    return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
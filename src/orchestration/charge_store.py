@@ -0,0 +1,363 @@
+"""
+Tabela longa de charges (uma linha por rota x cotacao x charge), particionada
+por data da cotacao.
+
+Os breakdowns wide (`hapag_breakdowns.csv` etc.) ganham uma coluna por
+`grupo | item | tamanho` (+ gemea `| Curr`) e ficam quase todos vazios. Aqui as
+mesmas cotacoes saem no formato longo:
+
+  carrier, route_key, origin, destination, quote_time, quote_date,
+  charge_group, charge, equipment, currency, amount, amount_usd
+
+Fonte: tentativas com sucesso do store de cotacoes (`quote_store`). Ao fim de
+cada batch o scraper reexporta as particoes dos ultimos `CHARGE_STORE_DAYS`
+dias do seu carrier (cobre um batch anterior que caiu antes de exportar):
+`artifacts/output/charges/quote_date=AAAA-MM-DD/<carrier>.parquet`.
+Parquet precisa de `pyarrow`; sem ele (ou com `CHARGE_STORE_FORMAT=csv`) as
+particoes saem em `.csv` no mesmo layout.
+
+Leitura com filtro (`read_charges`): com Parquet usa `pyarrow.dataset` com
+pushdown de data/carrier/charge; com CSV le so as particoes do periodo.
+
+CLI:
+  python src/orchestration/charge_store.py export --carrier hapag --days 0
+  python src/orchestration/charge_store.py query --carrier maersk --since 2026-01-01 --charge "Basic Ocean Freight"
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+import quote_store
+from sqlite_state import parse_env_bool
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+DEFAULT_DIR = PROJECT_ROOT / "artifacts" / "output" / "charges"
+
+COLUMNS = [
+    "carrier",
+    "route_key",
+    "origin",
+    "destination",
+    "quote_time",
+    "quote_date",
+    "charge_group",
+    "charge",
+    "equipment",
+    "currency",
+    "amount",
+    "amount_usd",
+]
+
+MAERSK_OFFER_FIELDS = {"offer_departure_date", "offer_arrival_date", "offer_transit_time", "offer_transit_time_hours"}
+MAERSK_CHARGE_RE = re.compile(r"^([A-Z]{3}) (.+)$")
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+TEXT_COLUMNS = [c for c in COLUMNS if c not in {"amount", "amount_usd"}]
+
+ToUsd = Callable[[float, str], Optional[float]]
+
+
+def store_enabled() -> bool:
+    return parse_env_bool("CHARGE_STORE_ENABLED", default=True) and quote_store.store_enabled()
+
+
+def base_dir() -> Path:
+    raw = os.getenv("CHARGE_STORE_DIR")
+    if not raw:
+        return DEFAULT_DIR
+    candidate = Path(raw).expanduser()
+    if not candidate.is_absolute():
+        candidate = PROJECT_ROOT / candidate
+    return candidate
+
+
+def has_pyarrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ModuleNotFoundError:
+        return False
+    return True
+
+
+def output_format() -> str:
+    """`parquet` se pedido/possivel, senao `csv`."""
+    wanted = (os.getenv("CHARGE_STORE_FORMAT") or "auto").strip().lower()
+    if wanted == "csv":
+        return "csv"
+    return "parquet" if has_pyarrow() else "csv"
+
+
+def _amount(value) -> Optional[float]:
+    try:
+        return float(str(value).replace(",", ""))
+    except (TypeError, ValueError):
+        return None
+
+
+# ----------------------------------------------------------------------
+# Colunas wide -> linhas longas, por carrier
+# ----------------------------------------------------------------------
+def hapag_charges(charges: Dict[str, str]) -> List[dict]:
+    """`grupo | item | tamanho` com a gemea `... | Curr`; totais/compat sem `|` ficam de fora."""
+    out = []
+    for name, value in charges.items():
+        if name.endswith(" | Curr") or f"{name} | Curr" not in charges:
+            continue
+        parts = [p.strip() for p in name.split(" | ")]
+        if len(parts) < 3:
+            continue
+        amount = _amount(value)
+        if amount is None:
+            continue
+        out.append({
+            "charge_group": parts[0],
+            "charge": " | ".join(parts[1:-1]),
+            "equipment": parts[-1],
+            "currency": (charges.get(f"{name} | Curr") or "").strip().upper(),
+            "amount": amount,
+        })
+    return out
+
+
+def maersk_charges(charges: Dict[str, str]) -> List[dict]:
+    """Colunas `MOEDA nome` (o scraper ja converte quase tudo para USD)."""
+    out = []
+    for name, value in charges.items():
+        if name in MAERSK_OFFER_FIELDS:
+            continue
+        match = MAERSK_CHARGE_RE.match(name)
+        amount = _amount(value)
+        if not match or amount is None:
+            continue
+        out.append({
+            "charge_group": "",
+            "charge": match.group(2).strip(),
+            "equipment": "",
+            "currency": match.group(1),
+            "amount": amount,
+        })
+    return out
+
+
+def cma_charges(charges: Dict[str, str]) -> List[dict]:
+    """
+    Uma coluna por cobranca + total all-in com moeda. A moeda de cada cobranca
+    vem da gemea `<cobranca> | Curr` (linhas antigas nao tem: moeda vazia).
+    """
+    out = []
+    for name, value in charges.items():
+        amount = _amount(value)
+        if name in ("total_currency", "transit_time_days") or name.endswith(" | Curr") or amount is None:
+            continue
+        if name == "total_all_in":
+            out.append({
+                "charge_group": "Total",
+                "charge": "All In",
+                "equipment": "",
+                "currency": (charges.get("total_currency") or "").strip().upper(),
+                "amount": amount,
+            })
+            continue
+        currency = (charges.get(f"{name} | Curr") or "").strip().upper()
+        out.append({"charge_group": "", "charge": name, "equipment": "", "currency": currency, "amount": amount})
+    return out
+
+
+PARSERS = {"hapag": hapag_charges, "maersk": maersk_charges, "cma": cma_charges}
+
+
+# ----------------------------------------------------------------------
+# Exportacao
+# ----------------------------------------------------------------------
+def long_rows(carrier: str, since_date: str, to_usd: Optional[ToUsd] = None) -> List[dict]:
+    """Linhas longas de todas as cotacoes com sucesso do carrier desde `since_date` (AAAA-MM-DD)."""
+    conn = quote_store.connect()
+    try:
+        cur = conn.execute(
+            """
+            SELECT a.id, a.route_key, a.origin, a.destination, a.quoted_at, c.name, c.value
+            FROM quote_attempts a
+            JOIN quote_charges c ON c.attempt_id = a.id
+            WHERE a.carrier = ? AND a.quoted_at >= ?
+            ORDER BY a.id
+            """,
+            (carrier, since_date),
+        )
+        attempts: Dict[int, dict] = {}
+        for r in cur:
+            item = attempts.get(r["id"])
+            if item is None:
+                item = attempts[r["id"]] = {"head": r, "charges": {}}
+            item["charges"][r["name"]] = r["value"]
+    finally:
+        conn.close()
+
+    rows = []
+    parser = PARSERS[carrier]
+    for item in attempts.values():
+        head = item["head"]
+        quote_time = head["quoted_at"] or ""
+        for charge in parser(item["charges"]):
+            currency = charge["currency"]
+            amount_usd = None
+            if currency == "USD":
+                amount_usd = charge["amount"]
+            elif currency and to_usd is not None:
+                try:
+                    amount_usd = to_usd(charge["amount"], currency)
+                except Exception:
+                    amount_usd = None
+            rows.append({
+                "carrier": carrier,
+                "route_key": head["route_key"],
+                "origin": head["origin"] or "",
+                "destination": head["destination"] or "",
+                "quote_time": quote_time,
+                "quote_date": quote_time[:10],
+                **charge,
+                "amount_usd": amount_usd,
+            })
+    return rows
+
+
+def partition_path(quote_date: str, carrier: str, fmt: str) -> Path:
+    return base_dir() / f"quote_date={quote_date}" / f"{carrier}.{fmt}"
+
+
+def _write_partition(df: pd.DataFrame, path: Path, fmt: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    if fmt == "parquet":
+        # quote_date vem do nome da particao (hive)
+        df.drop(columns=["quote_date"]).to_parquet(tmp_path, index=False)
+    else:
+        df.to_csv(tmp_path, index=False, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def export_partitions(carrier: str, days: Optional[int] = None, to_usd: Optional[ToUsd] = None,
+                      log_fn: Callable[[str], None] = print) -> int:
+    """
+    Regrava as particoes do carrier dos ultimos `days` dias (padrao
+    `CHARGE_STORE_DAYS`; 0 = historico inteiro do store). Best-effort: falha
+    so gera aviso. Devolve o numero de linhas exportadas.
+    """
+    if not store_enabled():
+        return 0
+    if days is None:
+        days = int(os.getenv("CHARGE_STORE_DAYS", "2"))
+    since_date = "" if days <= 0 else (datetime.now() - timedelta(days=days - 1)).date().isoformat()
+    fmt = output_format()
+    try:
+        rows = long_rows(carrier, since_date, to_usd=to_usd)
+        df = pd.DataFrame(rows, columns=COLUMNS)
+        df["amount"] = df["amount"].astype("float64")
+        df["amount_usd"] = df["amount_usd"].astype("float64")
+        for quote_date, part in df.groupby("quote_date", sort=True):
+            if DATE_RE.match(quote_date):
+                _write_partition(part, partition_path(quote_date, carrier, fmt), fmt)
+    except Exception as e:
+        log_fn(f"[charges] aviso: falha ao exportar charges de {carrier}: {e!r}")
+        return 0
+    log_fn(
+        f"[charges] {carrier}: {len(df)} linhas em {df['quote_date'].nunique()} particao(oes) "
+        f"{fmt} em {base_dir()}."
+    )
+    return len(df)
+
+
+# ----------------------------------------------------------------------
+# Leitura com filtro
+# ----------------------------------------------------------------------
+def read_charges(carriers: Optional[List[str]] = None, since: Optional[str] = None,
+                 charges: Optional[List[str]] = None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Le a tabela longa filtrando por carrier, data minima (AAAA-MM-DD) e nome
+    de charge. Parquet: filtros empurrados para o `pyarrow.dataset`; CSV: so as
+    particoes a partir de `since` sao lidas.
+    """
+    root = base_dir()
+    wanted = columns or COLUMNS
+    if not root.exists():
+        return pd.DataFrame(columns=wanted)
+
+    parquet_files = sorted(str(p) for p in root.glob("quote_date=*/*.parquet"))
+    if parquet_files and has_pyarrow():
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        partitioning = ds.partitioning(pa.schema([("quote_date", pa.string())]), flavor="hive")
+        dataset = ds.dataset(
+            parquet_files, format="parquet", partitioning=partitioning, partition_base_dir=str(root)
+        )
+        expr = None
+        for clause in (
+            ds.field("carrier").isin(carriers) if carriers else None,
+            ds.field("quote_date") >= since if since else None,
+            ds.field("charge").isin(charges) if charges else None,
+        ):
+            if clause is not None:
+                expr = clause if expr is None else expr & clause
+        table = dataset.to_table(columns=[c for c in wanted if c in dataset.schema.names], filter=expr)
+        return table.to_pandas()
+
+    frames = []
+    for part_dir in sorted(root.glob("quote_date=*")):
+        quote_date = part_dir.name.split("=", 1)[1]
+        if since and quote_date < since:
+            continue
+        for path in sorted(part_dir.glob("*.csv")):
+            if carriers and path.stem not in carriers:
+                continue
+            df = pd.read_csv(path, usecols=lambda c: c in wanted, dtype={c: str for c in TEXT_COLUMNS})
+            text_cols = [c for c in TEXT_COLUMNS if c in df.columns]
+            df[text_cols] = df[text_cols].fillna("")
+            if charges:
+                df = df[df["charge"].isin(charges)]
+            frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=wanted)
+    return pd.concat(frames, ignore_index=True)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Tabela longa de charges particionada por data.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("export", help="Regrava as particoes a partir do store de cotacoes.")
+    p.add_argument("--carrier", choices=sorted(PARSERS), action="append", help="Padrao: todos.")
+    p.add_argument("--days", type=int, default=None, help="Ultimos N dias (0 = historico inteiro).")
+
+    p = sub.add_parser("query", help="Le charges com filtro e imprime/grava.")
+    p.add_argument("--carrier", choices=sorted(PARSERS), action="append")
+    p.add_argument("--since", default=None, help="Data minima AAAA-MM-DD.")
+    p.add_argument("--charge", action="append", help="Nome exato da charge (repetivel).")
+    p.add_argument("--out", default=None, help="CSV de saida (padrao: imprime as primeiras linhas).")
+
+    args = parser.parse_args()
+    if args.cmd == "export":
+        for carrier in args.carrier or sorted(PARSERS):
+            export_partitions(carrier, days=args.days)
+        return 0
+
+    df = read_charges(carriers=args.carrier, since=args.since, charges=args.charge)
+    if args.out:
+        df.to_csv(args.out, index=False, encoding="utf-8")
+        print(f"[charges] {len(df)} linhas gravadas em {args.out}")
+    else:
+        with pd.option_context("display.width", 200, "display.max_columns", 20):
+            print(df.head(50).to_string(index=False))
+        print(f"[charges] {len(df)} linhas.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
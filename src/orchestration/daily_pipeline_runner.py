@@ -1,29 +1,346 @@
 ﻿from __future__ import annotations
 
 import argparse
+import importlib.util
+import json
 import os
+import queue
 import shutil
 import subprocess
 import sys
+import threading
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
+
+import job_queue
+import run_history
+from memory_admission import MB, check_admission, new_admission, stage_estimate
+from progress_events import (
+    EVENTS_FILE_ENV,
+    carrier_progress,
+    format_progress_line,
+    new_stage_progress,
+    poll_events,
+    write_progress_json,
+)
+from shard_merge import shard_output_path
+from sqlite_state import parse_env_bool
+from stage_cache import cache_hit_reason, forget_stage, load_manifest, record_stage, stage_fingerprint
+from stage_metrics import (
+    finalize_stage_metrics,
+    format_metrics_line,
+    new_stage_metrics,
+    sample_stage_metrics,
+    write_metrics_json,
+)
 
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 LOG_DIR = PROJECT_ROOT / "artifacts" / "logs"
-SCREENS_DIR = PROJECT_ROOT / "artifacts" / "runtime" / "screens"
+RUNTIME_DIR = PROJECT_ROOT / "artifacts" / "runtime"
+SCREENS_DIR = RUNTIME_DIR / "screens"
+LAST_GOOD_DIR = RUNTIME_DIR / "last_good"
+INPUT_DIR = PROJECT_ROOT / "artifacts" / "input"
+OUTPUT_DIR = PROJECT_ROOT / "artifacts" / "output"
+
+
+def resolve_env_path(env_name: str, default_path: Path) -> Path:
+    raw = os.getenv(env_name)
+    if not raw:
+        return default_path
+
+    candidate = Path(raw).expanduser()
+    if not candidate.is_absolute():
+        candidate = PROJECT_ROOT / candidate
+    return candidate
 
-PARALLEL_STAGE = {
-    "hapag": PROJECT_ROOT / "src" / "scrapers" / "hapag_instant_quote.py",
-    "maersk": PROJECT_ROOT / "src" / "scrapers" / "maersk_instant_quote.py",
-}
 
-SEQUENTIAL_STAGE = {
-    "comparison": PROJECT_ROOT / "src" / "processing" / "quote_comparison.py",
-    "upload": PROJECT_ROOT / "src" / "export" / "upload_fretes.py",
+CMA_COTATIONS_FILE = resolve_env_path("CMA_COTATIONS_FILE", INPUT_DIR / "cma_cotations.xlsx")
+ONE_COTATIONS_FILE = resolve_env_path("ONE_COTATIONS_FILE", CMA_COTATIONS_FILE.parent / "one_cotations.xlsx")
+ZIM_COTATIONS_FILE = resolve_env_path("ZIM_COTATIONS_FILE", CMA_COTATIONS_FILE.parent / "zim_cotations.xlsx")
+COMPARISON_SCRIPT = PROJECT_ROOT / "src" / "processing" / "quote_comparison.py"
+PREFETCH_CACHE_FILE = RUNTIME_DIR / "comparison_prefetch.pkl"
+# Copia tipada que a comparacao grava para o export (Parquet com pyarrow, senao pickle).
+COMPARISON_TYPED_FILE = OUTPUT_DIR / (
+    "comparacao_carriers.parquet" if importlib.util.find_spec("pyarrow") else "comparacao_carriers.pkl"
+)
+# Codigo que roda a etapa in_process alem do proprio script.
+IN_PROCESS_CODE = [PROJECT_ROOT / "src" / "orchestration" / "stage_worker.py"]
+# A comparacao descarta quotes mais velhas que MAX_QUOTE_AGE_DAYS contra o relogio:
+# com os mesmos breakdowns, o resultado muda com a hora. Cache vale dentro da hora.
+QUOTE_AGE_CACHE_CLOCK = "%Y-%m-%dT%H"
+
+# Grafo de etapas do pipeline.
+# - depends_on: etapas que precisam terminar antes (a etapa inicia assim que todas terminam).
+# - inputs/outputs: artefatos declarados da etapa.
+# - fallback_last_good: se a etapa falhar, os dependentes podem seguir com o ultimo
+#   artefato bom (outputs) e o run fica marcado como degradado.
+# - args (opcional): argumentos extras do script.
+# - stop_after (opcional): etapa de longa duracao que inicia junto e recebe sinal
+#   de parada (stop file) quando essas etapas terminam.
+# - env (opcional): variaveis extras para o processo da etapa.
+# - runs_on_failed_deps (opcional): roda mesmo se dependencias falharem (ex.: merge de
+#   shards); termina como degradado quando alguma dependencia nao terminou ok.
+# - cacheable (opcional): etapa deterministica; e pulada quando script, inputs e
+#   `cache_env` nao mudaram desde a ultima execucao ok (ver stage_cache.py).
+# - cache_env (opcional): variaveis de ambiente que alteram o resultado da etapa.
+# - code (opcional): arquivos alem do script que entram na versao do codigo da etapa.
+# - cache_clock (opcional): formato strftime; o cache expira quando o relogio muda
+#   nessa granularidade (etapas cujo resultado depende da data, ver stage_cache.py).
+# - in_process (opcional): com PIPELINE_EXECUTION_MODE=worker, roda no worker Python
+#   persistente chamando o `main()` do script (ver stage_worker.py).
+# - optional (opcional): falha da etapa nao bloqueia dependentes nem falha o run
+#   (ex.: prefetch; sem o cache a comparacao le as entradas sozinha).
+# - browser (opcional): etapa hospeda um browser; so inicia quando cabe no orcamento
+#   de memoria (ver memory_admission.py). Shards herdam a flag.
+STAGES: Dict[str, dict] = {
+    "hapag": {
+        "script": PROJECT_ROOT / "src" / "scrapers" / "hapag_instant_quote.py",
+        "depends_on": [],
+        "inputs": [INPUT_DIR / "hapag_jobs.xlsx"],
+        "outputs": [OUTPUT_DIR / "hapag_breakdowns.csv"],
+        "fallback_last_good": True,
+        "browser": True,
+    },
+    "maersk": {
+        "script": PROJECT_ROOT / "src" / "scrapers" / "maersk_instant_quote.py",
+        "depends_on": [],
+        "inputs": [INPUT_DIR / "maersk_jobs.xlsx"],
+        "outputs": [OUTPUT_DIR / "maersk_breakdowns.csv"],
+        "fallback_last_good": True,
+        "browser": True,
+    },
+    "prefetch": {
+        "script": COMPARISON_SCRIPT,
+        "args": ["--prefetch", "--prefetch-cache", str(PREFETCH_CACHE_FILE)],
+        "depends_on": [],
+        "inputs": [
+            INPUT_DIR / "hapag_jobs.xlsx",
+            INPUT_DIR / "maersk_jobs.xlsx",
+            INPUT_DIR / "destination_charges.xlsx",
+            CMA_COTATIONS_FILE,
+            ONE_COTATIONS_FILE,
+            ZIM_COTATIONS_FILE,
+        ],
+        "outputs": [PREFETCH_CACHE_FILE],
+        "fallback_last_good": False,
+        "optional": True,
+        "in_process": True,
+    },
+    "comparison": {
+        "script": COMPARISON_SCRIPT,
+        "args": ["--prefetch-cache", str(PREFETCH_CACHE_FILE)],
+        "depends_on": ["hapag", "maersk", "prefetch"],
+        "inputs": [
+            OUTPUT_DIR / "hapag_breakdowns.csv",
+            OUTPUT_DIR / "maersk_breakdowns.csv",
+            INPUT_DIR / "hapag_jobs.xlsx",
+            INPUT_DIR / "maersk_jobs.xlsx",
+            INPUT_DIR / "destination_charges.xlsx",
+            CMA_COTATIONS_FILE,
+            ONE_COTATIONS_FILE,
+            ZIM_COTATIONS_FILE,
+        ],
+        "outputs": [OUTPUT_DIR / "comparacao_carriers.csv", COMPARISON_TYPED_FILE],
+        "fallback_last_good": False,
+        "cacheable": True,
+        "code": IN_PROCESS_CODE,
+        "cache_clock": QUOTE_AGE_CACHE_CLOCK,
+        "in_process": True,
+        # env lidas por quote_comparison.py (CMA_PRICE_SOURCE tambem vem do `env` no modo CMA scraper)
+        "cache_env": [
+            "CMA_PRICE_SOURCE",
+            "CMA_COTATIONS_FILE",
+            "ONE_COTATIONS_FILE",
+            "ZIM_COTATIONS_FILE",
+            "SYNC_BEFORE_CMA_READ",
+            "SYNC_WAIT_TIMEOUT_SEC",
+            "SYNC_START_TIMEOUT_SEC",
+        ],
+    },
+    "upload": {
+        "script": PROJECT_ROOT / "src" / "export" / "upload_fretes.py",
+        "depends_on": ["comparison"],
+        "inputs": [
+            OUTPUT_DIR / "comparacao_carriers.csv",
+            COMPARISON_TYPED_FILE,
+            OUTPUT_DIR / "hapag_breakdowns.csv",
+            OUTPUT_DIR / "maersk_breakdowns.csv",
+            INPUT_DIR / "hapag_jobs.xlsx",
+            INPUT_DIR / "maersk_jobs.xlsx",
+            INPUT_DIR / "destination_charges.xlsx",
+            CMA_COTATIONS_FILE,
+            ONE_COTATIONS_FILE,
+            ZIM_COTATIONS_FILE,
+        ],
+        "outputs": [
+            OUTPUT_DIR / "comparacao_carriers_cliente.xlsx",
+            OUTPUT_DIR / "comparacao_carriers_cliente_special.xlsx",
+            OUTPUT_DIR / "comparacao_carriers_cliente_granito.xlsx",
+        ],
+        "fallback_last_good": False,
+        "cacheable": True,
+        # le a copia tipada no formato gravado pela comparacao
+        "code": [*IN_PROCESS_CODE, COMPARISON_SCRIPT],
+        "cache_clock": QUOTE_AGE_CACHE_CLOCK,
+        "in_process": True,
+        "cache_env": [
+            "UPLOAD_MODE",
+            "SYNC_FOLDER",
+            "PLANILHA_CLIENTE_SENHA",
+            "DEFAULT_CLIENT_MARKUP_USD",
+            "GRANITO_DEFAULT_MARKUP_USD",
+            "SHAREPOINT_SITE_ID",
+            "SHAREPOINT_HOSTNAME",
+            "SHAREPOINT_SITE_PATH",
+            "SHAREPOINT_DRIVE_ID",
+            "SHAREPOINT_FOLDER_PATH",
+        ],
+    },
 }
 
 
+def apply_cma_scraper(stages: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Modo PIPELINE_CMA_SCRAPER: a CMA vira um scraper como hapag/maersk. A etapa
+    `cma` grava cma_breakdowns.csv e a comparacao (e o prefetch) passam a ler o
+    preco CMA dele (CMA_PRICE_SOURCE=scraper) em vez da planilha manual.
+    """
+    out = {name: dict(spec) for name, spec in stages.items()}
+    out["cma"] = {
+        "script": PROJECT_ROOT / "src" / "scrapers" / "cma_instant_quote.py",
+        "depends_on": [],
+        "inputs": [INPUT_DIR / "cma_jobs.xlsx"],
+        "outputs": [OUTPUT_DIR / "cma_breakdowns.csv"],
+        "fallback_last_good": True,
+        "browser": True,
+    }
+    for name in ("prefetch", "comparison"):
+        spec = out[name]
+        spec["env"] = {**spec.get("env", {}), "CMA_PRICE_SOURCE": "scraper"}
+        inputs = [p for p in spec.get("inputs", []) if p != CMA_COTATIONS_FILE]
+        inputs.append(INPUT_DIR / "cma_jobs.xlsx")
+        if name == "comparison":
+            inputs.insert(0, OUTPUT_DIR / "cma_breakdowns.csv")
+            spec["depends_on"] = [*spec.get("depends_on", []), "cma"]
+        spec["inputs"] = inputs
+    return out
+
+
+def apply_streaming_comparison(stages: Dict[str, dict], run_id: str) -> Dict[str, dict]:
+    """
+    Modo PIPELINE_STREAMING_COMPARISON: a comparacao sobe junto com os scrapers
+    em --watch e recalcula as rotas conforme os breakdowns sao atualizados.
+    Recebe o stop file quando os scrapers (hapag/maersk, e cma se ativo) terminam
+    e faz a passada final.
+    """
+    # a comparacao em --watch ja le as entradas estaticas ao subir: prefetch nao ajuda
+    streamed = {name: dict(spec) for name, spec in stages.items() if name != "prefetch"}
+    comparison = streamed["comparison"]
+    stop_file = RUNTIME_DIR / f"{run_id}_comparison.stop"
+    comparison["stop_after"] = [d for d in comparison.get("depends_on", []) if d != "prefetch"]
+    comparison["depends_on"] = []
+    comparison["args"] = ["--watch", "--stop-file", str(stop_file)]
+    comparison["stop_file"] = stop_file
+    # inputs mudam durante a execucao: nao faz sentido reaproveitar por cache
+    comparison["cacheable"] = False
+    # o --watch so enxerga o CSV de breakdown: scrapers exportam o store a cada rota
+    for spec in streamed.values():
+        if spec.get("browser"):
+            spec["env"] = {**spec.get("env", {}), "QUOTE_STORE_EXPORT_EVERY": "1"}
+    return streamed
+
+
+SHARDABLE_STAGES = ("hapag", "maersk", "cma")
+SHARD_MERGE_SCRIPT = PROJECT_ROOT / "src" / "orchestration" / "shard_merge.py"
+
+
+def parse_shards_arg(raw: str) -> Dict[str, int]:
+    """
+    Aceita `N` (mesmo numero para todos os scrapers) ou `hapag=2,maersk=3`.
+    """
+    raw = (raw or "").strip()
+    if not raw:
+        return {}
+
+    if "=" not in raw:
+        count = int(raw)
+        return {name: count for name in SHARDABLE_STAGES}
+
+    out: Dict[str, int] = {}
+    for part in raw.split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        name = name.strip().lower()
+        if name not in SHARDABLE_STAGES:
+            raise ValueError(f"Etapa sem suporte a shards: {name} (use {list(SHARDABLE_STAGES)})")
+        out[name] = int(value)
+    return out
+
+
+def apply_shards(stages: Dict[str, dict], shard_counts: Dict[str, int]) -> Dict[str, dict]:
+    """
+    Expande cada scraper em N etapas `<carrier>_s<i>` (uma fatia deterministica
+    da fila priorizada por processo, ou a fila com lease de job_queue.py com
+    SCRAPER_JOB_QUEUE; cada uma com perfil de browser proprio) e
+    transforma a etapa `<carrier>` no merge dos shards no CSV canonico.
+    Dependentes continuam apontando para `<carrier>`.
+    """
+    sharded: Dict[str, dict] = {}
+    for name, spec in stages.items():
+        count = shard_counts.get(name, 1)
+        if name not in SHARDABLE_STAGES or count <= 1:
+            sharded[name] = spec
+            continue
+
+        shard_names = []
+        for index in range(count):
+            shard_name = f"{name}_s{index}"
+            shard_names.append(shard_name)
+            sharded[shard_name] = {
+                **spec,
+                "env": {
+                    **spec.get("env", {}),
+                    "SCRAPER_SHARD_INDEX": str(index),
+                    "SCRAPER_SHARD_COUNT": str(count),
+                },
+                "outputs": [shard_output_path(output, index) for output in spec.get("outputs", [])],
+            }
+
+        sharded[name] = {
+            "script": SHARD_MERGE_SCRIPT,
+            "args": ["--carrier", name, "--shards", str(count)],
+            "depends_on": shard_names + list(spec.get("depends_on", [])),
+            "inputs": [o for shard in shard_names for o in sharded[shard]["outputs"]],
+            "outputs": list(spec.get("outputs", [])),
+            "fallback_last_good": True,
+            "runs_on_failed_deps": True,
+            "in_process": True,
+        }
+    return sharded
+
+
+# Status finais de etapa.
+STATUS_OK = "ok"
+STATUS_DEGRADED = "degraded"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+USABLE_STATUSES = {STATUS_OK, STATUS_DEGRADED}
+
+SCHEDULER_POLL_SEC = 1.0
+
+# Progresso ao vivo dos scrapers (eventos JSONL por etapa).
+PROGRESS_LOG_SEC = float(os.getenv("PIPELINE_PROGRESS_LOG_SEC", "60"))
+STALL_AFTER_SEC = float(os.getenv("PIPELINE_STALL_SEC", "600"))
+
+# Modos de execucao das etapas `in_process` (PIPELINE_EXECUTION_MODE).
+EXECUTION_MODES = ("subprocess", "worker")
+STAGE_WORKER_SCRIPT = PROJECT_ROOT / "src" / "orchestration" / "stage_worker.py"
+STAGE_WORKER_READY_TIMEOUT_SEC = 120.0
+
+
 def now_ts() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -58,7 +375,7 @@ def cleanup_old_logs(summary_log: Path, keep_days: int) -> None:
     failed = 0
 
     for path in LOG_DIR.iterdir():
-        if not path.is_file() or path.suffix.lower() != ".log":
+        if not path.is_file() or path.suffix.lower() not in {".log", ".jsonl"}:
             continue
         if path == summary_log:
             continue
@@ -77,105 +394,581 @@ def cleanup_old_logs(summary_log: Path, keep_days: int) -> None:
     )
 
 
-def run_blocking(
+def validate_stage_graph(stages: Dict[str, dict]) -> List[str]:
+    """
+    Valida dependencias e devolve uma ordem topologica (estavel pela ordem de declaracao).
+    """
+    for name, spec in stages.items():
+        for dep in spec.get("depends_on", []):
+            if dep not in stages:
+                raise ValueError(f"Etapa '{name}' depende de etapa inexistente: {dep}")
+
+    order: List[str] = []
+    pending = list(stages.keys())
+    while pending:
+        ready = [n for n in pending if all(d in order for d in stages[n].get("depends_on", []))]
+        if not ready:
+            raise ValueError(f"Ciclo de dependencias entre etapas: {pending}")
+        for name in ready:
+            order.append(name)
+            pending.remove(name)
+    return order
+
+
+def artifact_is_usable(path: Path) -> bool:
+    try:
+        return path.is_file() and path.stat().st_size > 0
+    except OSError:
+        return False
+
+
+def save_last_good(name: str, spec: dict, summary_log: Path) -> None:
+    """
+    Guarda copia dos outputs de uma etapa bem-sucedida para uso em modo degradado.
+    """
+    if not spec.get("fallback_last_good"):
+        return
+
+    target_dir = LAST_GOOD_DIR / name
+    target_dir.mkdir(parents=True, exist_ok=True)
+    for output in spec.get("outputs", []):
+        if not artifact_is_usable(output):
+            continue
+        try:
+            shutil.copy2(output, target_dir / output.name)
+        except Exception as e:
+            log(f"[{name}] aviso: falha ao salvar last-good de {output.name}: {e}", summary_log)
+
+
+def restore_last_good(name: str, spec: dict, summary_log: Path) -> bool:
+    """
+    Garante que os outputs de uma etapa que falhou estejam utilizaveis.
+
+    O CSV atual e preservado quando legivel (tem as rotas ja atualizadas neste run);
+    se estiver ausente/vazio, restaura a copia last-good.
+    """
+    if not spec.get("fallback_last_good"):
+        return False
+
+    for output in spec.get("outputs", []):
+        if artifact_is_usable(output):
+            log(f"[{name}] usando artefato existente: {output}", summary_log)
+            continue
+
+        snapshot = LAST_GOOD_DIR / name / output.name
+        if not artifact_is_usable(snapshot):
+            log(f"[{name}] sem last-good disponivel para {output.name}.", summary_log)
+            return False
+
+        output.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(snapshot, output)
+        log(f"[{name}] last-good restaurado: {snapshot} -> {output}", summary_log)
+
+    return True
+
+
+def stage_command(spec: dict) -> List[str]:
+    script_path = spec["script"]
+    if not script_path.exists():
+        raise FileNotFoundError(f"Script nao encontrado: {script_path}")
+    return [sys.executable, str(script_path), *[str(a) for a in spec.get("args", [])]]
+
+
+def stage_events_path(name: str, run_id: str) -> Path:
+    return LOG_DIR / f"{run_id}_{name}.events.jsonl"
+
+
+def stage_env(name: str, spec: dict, run_id: str) -> Dict[str, str]:
+    run_env = os.environ.copy()
+    run_env["RUN_ID"] = run_id
+    run_env["PIPELINE_STAGE"] = name
+    run_env[EVENTS_FILE_ENV] = str(stage_events_path(name, run_id))
+    run_env.update({k: str(v) for k, v in spec.get("env", {}).items()})
+    return run_env
+
+
+def open_stage_log(name: str, cmd: List[str], summary_log: Path, run_id: str, mode: str = "") -> Tuple[Path, object]:
+    log_path = LOG_DIR / f"{run_id}_{name}.log"
+    suffix = f" [{mode}]" if mode else ""
+    log(f"[{name}] iniciando (run_id={run_id}){suffix}: {' '.join(cmd)}", summary_log)
+
+    lf = log_path.open("a", encoding="utf-8")
+    lf.write(f"[{now_ts()}] CMD: {' '.join(cmd)}\n")
+    lf.write(f"[{now_ts()}] RUN_ID: {run_id}\n")
+    lf.flush()
+    return log_path, lf
+
+
+def launch_stage(
     name: str,
-    script_path: Path,
-    log_path: Path,
+    spec: dict,
     summary_log: Path,
     run_id: str,
-    dry_run: bool = False,
-) -> int:
-    if not script_path.exists():
-        raise FileNotFoundError(f"Script nao encontrado: {script_path}")
+) -> Tuple[subprocess.Popen[str], object]:
+    cmd = stage_command(spec)
+    _, lf = open_stage_log(name, cmd, summary_log, run_id)
+    run_env = stage_env(name, spec, run_id)
+    creationflags = getattr(subprocess, "CREATE_NO_WINDOW", 0)
 
-    cmd = [sys.executable, str(script_path)]
-    log(f"[{name}] iniciando (run_id={run_id}): {' '.join(cmd)}", summary_log)
+    proc = subprocess.Popen(
+        cmd,
+        cwd=str(PROJECT_ROOT),
+        stdout=lf,
+        stderr=subprocess.STDOUT,
+        text=True,
+        env=run_env,
+        creationflags=creationflags,
+    )
+    return proc, lf
 
-    if dry_run:
-        log(f"[{name}] dry-run: nao executado.", summary_log)
-        return 0
 
+def start_stage_worker(summary_log: Path) -> Optional[dict]:
+    """
+    Sobe o worker persistente e espera ele pre-importar as dependencias.
+    Devolve None se o worker nao subir (as etapas seguem em subprocess).
+    """
     creationflags = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+    proc = subprocess.Popen(
+        [sys.executable, str(STAGE_WORKER_SCRIPT)],
+        cwd=str(PROJECT_ROOT),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+        creationflags=creationflags,
+    )
+    replies: "queue.Queue[dict]" = queue.Queue()
 
-    with log_path.open("a", encoding="utf-8") as lf:
-        lf.write(f"[{now_ts()}] CMD: {' '.join(cmd)}\n")
-        lf.write(f"[{now_ts()}] RUN_ID: {run_id}\n")
-        lf.flush()
-
-        run_env = os.environ.copy()
-        run_env["RUN_ID"] = run_id
-        run_env["PIPELINE_STAGE"] = name
-
-        completed = subprocess.run(
-            cmd,
-            cwd=str(PROJECT_ROOT),
-            stdout=lf,
-            stderr=subprocess.STDOUT,
-            check=False,
-            text=True,
-            env=run_env,
-            creationflags=creationflags,
-        )
+    def read_replies() -> None:
+        for line in proc.stdout:
+            line = line.strip()
+            if line:
+                try:
+                    replies.put(json.loads(line))
+                except ValueError:
+                    continue
+        replies.put({"eof": True})
 
-    log(f"[{name}] finalizado com codigo {completed.returncode}", summary_log)
-    return int(completed.returncode)
+    threading.Thread(target=read_replies, name="stage-worker-replies", daemon=True).start()
+    try:
+        ready = replies.get(timeout=STAGE_WORKER_READY_TIMEOUT_SEC)
+    except queue.Empty:
+        ready = {}
+    if not ready.get("ready"):
+        log("[worker] nao subiu; etapas seguem em subprocess.", summary_log)
+        proc.kill()
+        return None
 
+    log(
+        f"[worker] pronto pid={proc.pid} preload={ready.get('preload_sec')}s "
+        f"modulos={sorted(ready.get('modules', {}))}",
+        summary_log,
+    )
+    return {"proc": proc, "pid": proc.pid, "replies": replies, "results": {}, "busy": None, "dead": False, "next_id": 0}
 
-def run_parallel_stage(summary_log: Path, run_id: str, dry_run: bool = False) -> Dict[str, int]:
-    processes: Dict[str, Tuple[subprocess.Popen[str], object]] = {}
-    results: Dict[str, int] = {}
 
-    for name, script_path in PARALLEL_STAGE.items():
-        if not script_path.exists():
-            raise FileNotFoundError(f"Script nao encontrado: {script_path}")
+def stop_stage_worker(worker: Optional[dict]) -> None:
+    if worker is None:
+        return
+    proc = worker["proc"]
+    try:
+        if proc.poll() is None:
+            proc.stdin.write(json.dumps({"shutdown": True}) + "\n")
+            proc.stdin.flush()
+            proc.stdin.close()
+            proc.wait(timeout=10)
+    except Exception:
+        pass
+    if proc.poll() is None:
+        proc.kill()
 
-        cmd = [sys.executable, str(script_path)]
-        log_path = LOG_DIR / f"{run_id}_{name}.log"
 
-        log(f"[{name}] iniciando em paralelo (run_id={run_id}): {' '.join(cmd)}", summary_log)
+def launch_stage_in_worker(
+    worker: dict,
+    name: str,
+    spec: dict,
+    summary_log: Path,
+    run_id: str,
+) -> Tuple[dict, object]:
+    cmd = stage_command(spec)
+    log_path, lf = open_stage_log(name, cmd, summary_log, run_id, mode="worker")
+    worker["next_id"] += 1
+    job = {"worker": worker, "id": worker["next_id"], "pid": worker["pid"], "stage": name}
+    request = {
+        "id": job["id"],
+        "stage": name,
+        "script": str(spec["script"]),
+        "args": [str(a) for a in spec.get("args", [])],
+        "env": stage_env(name, spec, run_id),
+        "cwd": str(PROJECT_ROOT),
+        "log_path": str(log_path),
+        "entry": spec.get("entry", "main"),
+    }
+    worker["proc"].stdin.write(json.dumps(request) + "\n")
+    worker["proc"].stdin.flush()
+    worker["busy"] = name
+    return job, lf
 
-        if dry_run:
-            results[name] = 0
-            log(f"[{name}] dry-run: nao executado.", summary_log)
-            continue
 
-        creationflags = getattr(subprocess, "CREATE_NO_WINDOW", 0)
-        lf = log_path.open("a", encoding="utf-8")
-        lf.write(f"[{now_ts()}] CMD: {' '.join(cmd)}\n")
-        lf.write(f"[{now_ts()}] RUN_ID: {run_id}\n")
-        lf.flush()
-
-        run_env = os.environ.copy()
-        run_env["RUN_ID"] = run_id
-        run_env["PIPELINE_STAGE"] = name
-
-        proc = subprocess.Popen(
-            cmd,
-            cwd=str(PROJECT_ROOT),
-            stdout=lf,
-            stderr=subprocess.STDOUT,
-            text=True,
-            env=run_env,
-            creationflags=creationflags,
+def poll_stage(handle) -> Optional[int]:
+    """Exit code da etapa (None se ainda rodando); aceita Popen ou job do worker."""
+    if not isinstance(handle, dict):
+        return handle.poll()
+
+    worker = handle["worker"]
+    while True:
+        try:
+            reply = worker["replies"].get_nowait()
+        except queue.Empty:
+            break
+        if reply.get("eof"):
+            worker["dead"] = True
+        elif "id" in reply:
+            worker["results"][reply["id"]] = reply
+
+    reply = worker["results"].pop(handle["id"], None)
+    if reply is not None:
+        worker["busy"] = None
+        return int(reply.get("rc", 1))
+    if worker["dead"]:
+        worker["busy"] = None
+        rc = worker["proc"].poll()
+        return rc if rc not in (None, 0) else 1
+    return None
+
+
+def resolve_stage_result(name: str, spec: dict, rc: int, summary_log: Path) -> str:
+    if rc == 0:
+        save_last_good(name, spec, summary_log)
+        return STATUS_OK
+
+    if spec.get("optional"):
+        log(f"[{name}] falhou (codigo {rc}); etapa opcional, dependentes seguem sem ela.", summary_log)
+        return STATUS_FAILED
+
+    if restore_last_good(name, spec, summary_log):
+        log(f"[{name}] falhou (codigo {rc}); dependentes seguem com last-good (degradado).", summary_log)
+        return STATUS_DEGRADED
+
+    log(f"[{name}] falhou (codigo {rc}).", summary_log)
+    return STATUS_FAILED
+
+
+def signal_stop_if_ready(name: str, spec: dict, statuses: Dict[str, str], summary_log: Path) -> None:
+    stop_after = spec.get("stop_after")
+    stop_file = spec.get("stop_file")
+    if not stop_after or stop_file is None or stop_file.exists():
+        return
+    if not all(d in statuses for d in stop_after):
+        return
+
+    stop_file.parent.mkdir(parents=True, exist_ok=True)
+    stop_file.write_text(now_ts(), encoding="utf-8")
+    log(f"[{name}] etapas {stop_after} finalizadas; sinal de parada enviado.", summary_log)
+
+
+def check_stage_cache(name: str, spec: dict, force: bool, summary_log: Path) -> Tuple[bool, Optional[str]]:
+    """
+    Devolve (reaproveitar, fingerprint). Etapas nao cacheaveis devolvem (False, None).
+    """
+    if not spec.get("cacheable"):
+        return False, None
+
+    fingerprint = str(stage_fingerprint(spec)["fingerprint"])
+    if force:
+        log(f"[{name}] [cache] ignorado (--force).", summary_log)
+        return False, fingerprint
+
+    reason = cache_hit_reason(name, spec, fingerprint, load_manifest())
+    if reason is None:
+        log(f"[{name}] [cache] inputs e codigo inalterados; outputs reaproveitados (fingerprint={fingerprint[:12]}).", summary_log)
+        return True, fingerprint
+
+    log(f"[{name}] [cache] executando: {reason}.", summary_log)
+    return False, fingerprint
+
+
+def admit_browser_stage(
+    admission: Optional[dict],
+    name: str,
+    stages: Dict[str, dict],
+    running: Dict[str, Tuple[object, object]],
+    metrics: Dict[str, dict],
+    summary_log: Path,
+) -> bool:
+    """
+    Etapas com browser so iniciam se couberem no orcamento de memoria; as demais
+    ficam na fila (log uma vez por etapa) ate outra etapa com browser terminar.
+    """
+    if admission is None or not stages[name].get("browser"):
+        return True
+    running_rss_mb = {
+        other: metrics[other].get("_rss_bytes", 0) / MB
+        for other in running
+        if stages[other].get("browser") and other in metrics
+    }
+    admitted, detail = check_admission(admission, name, running_rss_mb)
+    if not admitted:
+        if name not in admission["waiting"]:
+            admission["waiting"].add(name)
+            log(f"[memoria] {name} na fila: {detail}; em execucao={sorted(running_rss_mb)}", summary_log)
+        return False
+
+    _, source = stage_estimate(admission, name)
+    waited = " (saiu da fila)" if name in admission["waiting"] else ""
+    admission["waiting"].discard(name)
+    log(f"[memoria] {name} admitida{waited}: {detail} [{source}]", summary_log)
+    return True
+
+
+def log_deferred_routes(run_id: str, summary_log: Path) -> None:
+    """Resume as rotas adiadas pelo agendamento por deadline (relatorios dos scrapers)."""
+    for path in sorted(LOG_DIR.glob(f"{run_id}_*_deferred.json")):
+        try:
+            report = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        deferred = report.get("deferred") or []
+        if not deferred:
+            continue
+        keys = ", ".join(str(item.get("key")) for item in deferred[:20])
+        more = f" (+{len(deferred) - 20})" if len(deferred) > 20 else ""
+        log(
+            f"[deadline] {report.get('stage')}: {len(deferred)} rotas adiadas ate {report.get('deadline')}: "
+            f"{keys}{more}. Relatorio: {path}",
+            summary_log,
         )
-        processes[name] = (proc, lf)
 
-    for name, pair in processes.items():
-        proc, lf = pair
-        rc = proc.wait()
-        lf.flush()
-        lf.close()
-        results[name] = int(rc)
-        log(f"[{name}] finalizado com codigo {rc}", summary_log)
 
-    return results
+def log_queue_summary(run_id: str, summary_log: Path) -> None:
+    """Resumo da fila compartilhada dos scrapers (SCRAPER_JOB_QUEUE)."""
+    if not job_queue.queue_enabled():
+        return
+    queue = (os.getenv("SCRAPER_QUEUE_NAME") or "").strip() or run_id
+    for carrier in SHARDABLE_STAGES:
+        stats = job_queue.queue_stats(carrier, queue=queue)
+        if not stats:
+            continue
+        left = stats.get(job_queue.STATUS_PENDING, 0) + stats.get(job_queue.STATUS_LEASED, 0)
+        suffix = f" AVISO: {left} rota(s) nao concluidas." if left else ""
+        log(f"[fila] {carrier} ({queue}): {stats}.{suffix}", summary_log)
+
+
+def update_progress(
+    progress: Dict[str, dict],
+    running_names: List[str],
+    summary_log: Path,
+    run_id: str,
+    last_report: Dict[str, float],
+) -> None:
+    """
+    Le os eventos novos das etapas em execucao, marca travamento (sem eventos
+    ha PIPELINE_STALL_SEC) e loga vazao/ETA por carrier a cada PIPELINE_PROGRESS_LOG_SEC.
+    """
+    changed = False
+    for name in running_names:
+        state = progress.get(name)
+        if state is None:
+            continue
+        if poll_events(state):
+            changed = True
+        idle = time.monotonic() - state["last_event_mono"]
+        if state["offset"] > 0 and not state["finished"] and not state["stalled"] and idle >= STALL_AFTER_SEC:
+            state["stalled"] = True
+            changed = True
+            log(
+                f"[progress] ALERTA: {name} sem eventos ha {idle:.0f}s "
+                f"(rota atual={state['current']} etapa={state['current_step']}); possivel travamento.",
+                summary_log,
+            )
+
+    active = {name: state for name, state in progress.items() if state["offset"] > 0}
+    if not active:
+        return
+    if changed:
+        write_progress_json(LOG_DIR / f"{run_id}_progress.json", run_id, active)
+    now = time.monotonic()
+    if now - last_report.get("at", 0.0) >= PROGRESS_LOG_SEC:
+        last_report["at"] = now
+        for summary in carrier_progress({n: s for n, s in active.items() if n in running_names}).values():
+            log(format_progress_line(summary), summary_log)
+
+
+def run_stage_graph(
+    summary_log: Path,
+    run_id: str,
+    dry_run: bool = False,
+    stages: Dict[str, dict] = STAGES,
+    metrics: Optional[Dict[str, dict]] = None,
+    force: bool = False,
+    execution_mode: str = "subprocess",
+) -> Dict[str, str]:
+    """
+    Executa as etapas respeitando dependencias: cada etapa inicia assim que
+    todas as suas dependencias terminam (sem barreira entre "fases").
+
+    Etapas `cacheable` sao puladas quando inputs/codigo batem com a ultima
+    execucao ok registrada (a menos de `force`).
+
+    Com `execution_mode="worker"`, etapas `in_process` rodam uma de cada vez no
+    worker persistente; se ele estiver ocupado (ou cair), a etapa vai para
+    subprocess como no modo padrao.
+
+    Etapas `browser` passam pela admissao por memoria (PIPELINE_MEMORY_BUDGET_MB):
+    so iniciam quando a estimativa (pico historico de RSS) cabe no orcamento.
+
+    A cada tick amostra CPU/RSS da arvore de processos de cada etapa em
+    execucao; o resultado final de cada etapa vai para `metrics` e para
+    `artifacts/logs/<run_id>_metrics.json`.
+    """
+    order = validate_stage_graph(stages)
+    statuses: Dict[str, str] = {}
+    running: Dict[str, Tuple[object, object]] = {}
+    fingerprints: Dict[str, Optional[str]] = {}
+    # Worker persistente: sobe sob demanda na primeira etapa in_process. Se o runner
+    # morrer, o worker recebe EOF no stdin e encerra sozinho.
+    worker: Optional[dict] = None
+    worker_enabled = execution_mode == "worker" and not dry_run
+    progress: Dict[str, dict] = {}
+    last_progress_report: Dict[str, float] = {"at": time.monotonic()}
+    if metrics is None:
+        metrics = {}
+    metrics_path = LOG_DIR / f"{run_id}_metrics.json"
+    admission = None
+    if not dry_run and any(spec.get("browser") for spec in stages.values()):
+        admission = new_admission(LOG_DIR)
+        if admission is None:
+            log("[memoria] admissao por memoria desativada; etapas com browser sobem juntas.", summary_log)
+        else:
+            log(f"[memoria] orcamento={admission['budget_mb']:.0f}MB ({admission['source']}).", summary_log)
+
+    while len(statuses) < len(order):
+        for name in order:
+            if name in statuses or name in running:
+                continue
+
+            deps = stages[name].get("depends_on", [])
+            if not all(d in statuses for d in deps):
+                continue
+
+            blocked = [d for d in deps if statuses[d] not in USABLE_STATUSES and not stages[d].get("optional")]
+            if blocked and not stages[name].get("runs_on_failed_deps"):
+                statuses[name] = STATUS_SKIPPED
+                log(f"[{name}] ignorada: dependencias sem artefato utilizavel {blocked}", summary_log)
+                continue
+
+            if dry_run:
+                cmd = stage_command(stages[name])
+                log(f"[{name}] iniciando (run_id={run_id}): {' '.join(cmd)}", summary_log)
+                log(f"[{name}] dry-run: nao executado.", summary_log)
+                statuses[name] = STATUS_OK
+                continue
+
+            reuse, fingerprints[name] = check_stage_cache(name, stages[name], force, summary_log)
+            if reuse:
+                statuses[name] = STATUS_OK
+                cached = new_stage_metrics(name)
+                cached["execution"] = "cache"
+                run_history.record_stage(run_id, finalize_stage_metrics(cached, exit_code=None, status=STATUS_OK))
+                continue
+
+            if not admit_browser_stage(admission, name, stages, running, metrics, summary_log):
+                continue
+
+            use_worker = worker_enabled and stages[name].get("in_process")
+            if use_worker and worker is None:
+                worker = start_stage_worker(summary_log)
+                worker_enabled = worker is not None
+            if use_worker and worker is not None and not worker["dead"] and worker["busy"] is None:
+                running[name] = launch_stage_in_worker(worker, name, stages[name], summary_log, run_id)
+                metrics[name] = new_stage_metrics(name, root_pid=worker["pid"], shared_root=True)
+                metrics[name]["execution"] = "worker"
+            else:
+                running[name] = launch_stage(name, stages[name], summary_log, run_id)
+                metrics[name] = new_stage_metrics(name, root_pid=running[name][0].pid)
+            progress[name] = new_stage_progress(name, stage_events_path(name, run_id))
+
+        update_progress(progress, list(running), summary_log, run_id, last_progress_report)
+
+        finished: List[str] = []
+        for name, (handle, lf) in running.items():
+            sample_stage_metrics(metrics[name])
+            rc = poll_stage(handle)
+            if rc is None:
+                continue
+            lf.flush()
+            lf.close()
+            if isinstance(handle, dict) and handle["worker"]["dead"]:
+                log(f"[worker] encerrou inesperadamente durante '{name}'; proximas etapas em subprocess.", summary_log)
+            log(f"[{name}] finalizado com codigo {rc}", summary_log)
+            statuses[name] = resolve_stage_result(name, stages[name], int(rc), summary_log)
+            if fingerprints.get(name):
+                # fingerprint calculado no inicio: se um input mudou durante a execucao,
+                # o proximo run simplesmente nao acerta o cache.
+                if statuses[name] == STATUS_OK:
+                    record_stage(name, stages[name], fingerprints[name], run_id)
+                else:
+                    forget_stage(name)
+            not_ok_deps = [d for d in stages[name].get("depends_on", []) if statuses.get(d) != STATUS_OK]
+            if stages[name].get("runs_on_failed_deps") and not_ok_deps and statuses[name] == STATUS_OK:
+                statuses[name] = STATUS_DEGRADED
+                log(f"[{name}] concluida com dependencias degradadas/falhas {not_ok_deps} (degradado).", summary_log)
+            blocked = [d for d in stages[name].get("stop_after", []) if statuses.get(d) not in USABLE_STATUSES]
+            if blocked and statuses[name] in USABLE_STATUSES:
+                statuses[name] = STATUS_SKIPPED
+                log(f"[{name}] resultado descartado: etapas sem artefato utilizavel {blocked}", summary_log)
+            state = progress.get(name)
+            if state is not None:
+                poll_events(state)
+                if state["offset"] > 0:
+                    for item in carrier_progress({name: state}).values():
+                        log(f"[{name}] final: {format_progress_line(item)}", summary_log)
+                    write_progress_json(
+                        LOG_DIR / f"{run_id}_progress.json",
+                        run_id,
+                        {n: p for n, p in progress.items() if p["offset"] > 0},
+                    )
+            finalize_stage_metrics(metrics[name], exit_code=int(rc), status=statuses[name])
+            log(format_metrics_line(metrics[name]), summary_log)
+            write_metrics_json(metrics_path, run_id, metrics)
+            run_history.record_stage(run_id, metrics[name])
+            finished.append(name)
+
+        for name in finished:
+            running.pop(name, None)
+
+        for name in running:
+            signal_stop_if_ready(name, stages[name], statuses, summary_log)
+
+        if running and not finished:
+            time.sleep(SCHEDULER_POLL_SEC)
+
+    stop_stage_worker(worker)
+    return statuses
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="Executa pipeline diario de cotacoes.")
     parser.add_argument("--dry-run", action="store_true", help="Mostra a orquestracao sem executar scripts.")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Ignora o cache de etapas e executa todas (o cache e atualizado ao final).",
+    )
+    parser.add_argument(
+        "--execution-mode",
+        choices=EXECUTION_MODES,
+        default=(os.getenv("PIPELINE_EXECUTION_MODE") or "subprocess").strip().lower(),
+        help="subprocess (padrao) ou worker (etapas in_process num interpretador Python persistente).",
+    )
+    parser.add_argument(
+        "--shards",
+        default=os.getenv("PIPELINE_SHARDS", ""),
+        help="Processos por scraper: N para todos ou por carrier (ex.: hapag=2,maersk=3).",
+    )
     args = parser.parse_args()
     log_retention_days = int(os.getenv("LOG_RETENTION_DAYS", "14"))
+    degraded_exit_code = int(os.getenv("PIPELINE_DEGRADED_EXIT_CODE", "0"))
 
     LOG_DIR.mkdir(parents=True, exist_ok=True)
     run_id = build_run_id()
@@ -185,30 +978,107 @@ def main() -> int:
     reset_screens_dir(summary_log)
     cleanup_old_logs(summary_log, keep_days=log_retention_days)
 
-    parallel_results = run_parallel_stage(summary_log=summary_log, run_id=run_id, dry_run=args.dry_run)
-    parallel_failed = {k: v for k, v in parallel_results.items() if v != 0}
+    stages = STAGES
+    if parse_env_bool("PIPELINE_CMA_SCRAPER", False):
+        stages = apply_cma_scraper(stages)
+        log("[cma] PIPELINE_CMA_SCRAPER ativo: etapa cma no grafo; comparacao usa o preco do scraper.", summary_log)
+    shard_counts = {k: v for k, v in parse_shards_arg(args.shards).items() if v > 1 and k in stages}
+    if shard_counts:
+        stages = apply_shards(stages, shard_counts)
+        log(f"[shards] scrapers particionados: {shard_counts}", summary_log)
+    if job_queue.queue_enabled():
+        log(f"[fila] SCRAPER_JOB_QUEUE ativo: scrapers pegam rotas da fila com lease ({job_queue.db_path()}).", summary_log)
+    if args.execution_mode != "subprocess":
+        log(f"[worker] modo de execucao: {args.execution_mode} (etapas in_process no worker persistente).", summary_log)
+    deadline = (os.getenv("PIPELINE_DEADLINE") or "").strip()
+    if deadline:
+        log(f"[deadline] PIPELINE_DEADLINE={deadline}: scrapers escolhem as rotas que cabem ate o prazo.", summary_log)
+    if parse_env_bool("PIPELINE_STREAMING_COMPARISON", False):
+        stages = apply_streaming_comparison(stages, run_id)
+        log("[comparison] modo streaming ativo (--watch junto com os scrapers).", summary_log)
 
-    if parallel_failed:
-        log(f"Falha na etapa paralela: {parallel_failed}", summary_log)
-        log("Pipeline encerrado com erro.", summary_log)
-        return 1
+    if not args.dry_run:
+        run_history.record_run_start(
+            run_id,
+            options={
+                "shards": shard_counts,
+                "execution_mode": args.execution_mode,
+                "force": args.force,
+                "streaming_comparison": parse_env_bool("PIPELINE_STREAMING_COMPARISON", False),
+                "cma_scraper": parse_env_bool("PIPELINE_CMA_SCRAPER", False),
+                "deadline": deadline or None,
+            },
+        )
 
-    for name, script_path in SEQUENTIAL_STAGE.items():
-        script_log = LOG_DIR / f"{run_id}_{name}.log"
-        rc = run_blocking(
-            name=name,
-            script_path=script_path,
-            log_path=script_log,
+    metrics: Dict[str, dict] = {}
+    try:
+        statuses = run_stage_graph(
             summary_log=summary_log,
             run_id=run_id,
             dry_run=args.dry_run,
+            stages=stages,
+            metrics=metrics,
+            force=args.force,
+            execution_mode=args.execution_mode,
+        )
+    finally:
+        for spec in stages.values():
+            stop_file = spec.get("stop_file")
+            if stop_file is not None and stop_file.exists():
+                stop_file.unlink()
+
+    # Falha coberta por etapa tolerante (ex.: shard que falhou mas o merge rodou) vira degradado.
+    covered = {
+        dep
+        for name, spec in stages.items()
+        if spec.get("runs_on_failed_deps") and statuses.get(name) in USABLE_STATUSES
+        for dep in spec.get("depends_on", [])
+    }
+    for name in covered:
+        if statuses.get(name) == STATUS_FAILED:
+            statuses[name] = STATUS_DEGRADED
+
+    log(f"Status das etapas: {statuses}", summary_log)
+    log_deferred_routes(run_id, summary_log)
+    log_queue_summary(run_id, summary_log)
+    comparison_csv = OUTPUT_DIR / "comparacao_carriers.csv"
+    if not args.dry_run and statuses.get("comparison") in USABLE_STATUSES and artifact_is_usable(comparison_csv):
+        run_history.record_route_winners(run_id, comparison_csv)
+
+    if metrics:
+        total_wall = sum(m.get("wall_sec", 0) for m in metrics.values())
+        total_cpu = sum(m.get("cpu_sec", 0) for m in metrics.values())
+        peak_rss = max(m.get("peak_rss_mb", 0) for m in metrics.values())
+        log(
+            f"[metrics] resumo: etapas={len(metrics)} wall_somado={total_wall:.1f}s "
+            f"cpu_somado={total_cpu:.1f}s maior_peak_rss={peak_rss:.1f}MB "
+            f"arquivo={LOG_DIR / f'{run_id}_metrics.json'}",
+            summary_log,
         )
-        if rc != 0:
-            log(f"Falha na etapa {name}.", summary_log)
-            log("Pipeline encerrado com erro.", summary_log)
-            return 1
+
+    optional_failed = [k for k, v in statuses.items() if v == STATUS_FAILED and stages[k].get("optional")]
+    if optional_failed:
+        log(f"Aviso: etapas opcionais falharam (nao afetam o status do run): {optional_failed}", summary_log)
+    not_ok = {
+        k: v for k, v in statuses.items() if v in {STATUS_FAILED, STATUS_SKIPPED} and not stages[k].get("optional")
+    }
+    if not_ok:
+        log(f"Falha nas etapas: {not_ok}", summary_log)
+        log("Pipeline encerrado com erro.", summary_log)
+        if not args.dry_run:
+            run_history.record_run_end(run_id, "failed", 1)
+        return 1
+
+    degraded = [k for k, v in statuses.items() if v == STATUS_DEGRADED]
+    if degraded:
+        log(f"Pipeline concluido em modo DEGRADADO (last-good em {degraded}). run_id={run_id}", summary_log)
+        if not args.dry_run:
+            run_history.record_run_end(run_id, "degraded", degraded_exit_code)
+        return degraded_exit_code
 
     log(f"Pipeline concluido com sucesso. run_id={run_id}", summary_log)
+    if not args.dry_run:
+        run_history.record_run_end(run_id, "ok", 0)
     return 0
 
 
@@ -0,0 +1,315 @@
+"""
+Fila de rotas com lease para scrapers em varios processos/replicas.
+
+Com `SCRAPER_JOB_QUEUE=1`, cada processo do scraper monta a fila priorizada como
+antes e a publica na fila `SCRAPER_QUEUE_NAME` (padrao: RUN_ID). A publicacao e
+idempotente (a primeira ordem gravada vale). Depois cada processo pega rotas uma
+a uma (`lease`), em ordem de prioridade, e confirma o resultado (`ack`). Assim
+shards/replicas dividem o trabalho dinamicamente, em vez da fatia fixa
+round-robin.
+
+- Lease vale `SCRAPER_QUEUE_LEASE_SEC`: processo que morre (ou trava alem disso)
+  perde a rota, que volta para a fila e e pega por outro (ate
+  `SCRAPER_QUEUE_MAX_ATTEMPTS` leases; depois fica `failed`).
+- Sem rota pendente mas com leases ativos de outros processos, o worker espera
+  (`SCRAPER_QUEUE_POLL_SEC`) ate eles terminarem ou expirarem. Leases do proprio
+  processo (outras abas) nao entram na espera: a aba livre recebe "nada agora"
+  e o loop conclui as abas ocupadas.
+- `ack` de quem perdeu o lease e ignorado (outro processo ja refez a rota).
+- Rota em curso renova o lease (`renew_if_due`, chamado dos loops de abas);
+  processo que encerra com rotas em curso as devolve a fila (`release`).
+
+Os resultados continuam saindo pelos CSVs de shard (`SCRAPER_SHARD_INDEX`) e
+sao unidos pelo merge de shards do runner (ponto unico de escrita no CSV
+canonico). Replicas em hosts diferentes precisam de indices de shard distintos.
+
+Backend de referencia: SQLite (WAL) em `artifacts/runtime/job_queue.sqlite`
+(ou `SCRAPER_QUEUE_DB`), com `BEGIN IMMEDIATE` para o lease ser atomico entre
+processos. Filas com mais de `SCRAPER_QUEUE_RETENTION_DAYS` dias sao apagadas
+ao publicar uma nova.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+
+import sqlite_state
+from sqlite_state import parse_env_bool
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+DEFAULT_DB_PATH = PROJECT_ROOT / "artifacts" / "runtime" / "job_queue.sqlite"
+
+STATUS_PENDING = "pending"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue_jobs (
+    queue TEXT NOT NULL,
+    carrier TEXT NOT NULL,
+    route_key TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (queue, carrier, route_key)
+);
+CREATE INDEX IF NOT EXISTS idx_queue_jobs_next ON queue_jobs (queue, carrier, status, priority);
+"""
+
+
+def queue_enabled() -> bool:
+    return parse_env_bool("SCRAPER_JOB_QUEUE", default=False)
+
+
+def db_path() -> Path:
+    return sqlite_state.env_path("SCRAPER_QUEUE_DB", DEFAULT_DB_PATH)
+
+
+_MANUAL_QUEUE = f"manual_{datetime.now():%Y%m%d_%H%M%S}"
+
+
+def queue_name() -> str:
+    """Replicas do mesmo run precisam do mesmo nome (runner: RUN_ID)."""
+    return (
+        (os.getenv("SCRAPER_QUEUE_NAME") or "").strip()
+        or (os.getenv("RUN_ID") or "").strip()
+        or _MANUAL_QUEUE
+    )
+
+
+def worker_id() -> str:
+    return sqlite_state.holder_id()
+
+
+def lease_sec() -> float:
+    return max(30.0, float(os.getenv("SCRAPER_QUEUE_LEASE_SEC", "900")))
+
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def connect(path: Optional[Path] = None) -> sqlite3.Connection:
+    # autocommit: transacoes explicitas com BEGIN IMMEDIATE (sqlite_state.transaction)
+    return sqlite_state.connect(path or db_path(), SCHEMA)
+
+
+def enqueue(carrier: str, jobs: list, key_fn: Callable[[dict], str], queue: Optional[str] = None) -> int:
+    """
+    Publica a fila priorizada (posicao = prioridade). Rotas ja publicadas nesta
+    fila nao mudam. Devolve quantas rotas novas entraram.
+    """
+    queue = queue or queue_name()
+    retention_days = float(os.getenv("SCRAPER_QUEUE_RETENTION_DAYS", "7"))
+    cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat(timespec="seconds")
+    stamp = now_iso()
+    rows = [
+        (queue, carrier, key_fn(job), priority, json.dumps(job, ensure_ascii=False, default=str), STATUS_PENDING, stamp, stamp)
+        for priority, job in enumerate(jobs)
+    ]
+    conn = connect()
+    try:
+        def publish() -> int:
+            if retention_days > 0:
+                conn.execute("DELETE FROM queue_jobs WHERE queue <> ? AND created_at < ?", (queue, cutoff))
+            before = conn.total_changes
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO queue_jobs
+                    (queue, carrier, route_key, priority, payload, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+            return conn.total_changes - before
+
+        return sqlite_state.transaction(conn, publish)
+    finally:
+        conn.close()
+
+
+def _expire_leases(conn: sqlite3.Connection, queue: str, carrier: str, now: float) -> None:
+    max_attempts = max(1, int(os.getenv("SCRAPER_QUEUE_MAX_ATTEMPTS", "2")))
+    stamp = now_iso()
+    conn.execute(
+        """
+        UPDATE queue_jobs SET status = ?, result = 'lease_expired', worker = NULL, lease_until = NULL, updated_at = ?
+        WHERE queue = ? AND carrier = ? AND status = ? AND lease_until < ? AND attempts >= ?
+        """,
+        (STATUS_FAILED, stamp, queue, carrier, STATUS_LEASED, now, max_attempts),
+    )
+    conn.execute(
+        """
+        UPDATE queue_jobs SET status = ?, worker = NULL, lease_until = NULL, updated_at = ?
+        WHERE queue = ? AND carrier = ? AND status = ? AND lease_until < ?
+        """,
+        (STATUS_PENDING, stamp, queue, carrier, STATUS_LEASED, now),
+    )
+
+
+def lease(carrier: str, worker: Optional[str] = None, queue: Optional[str] = None) -> Optional[dict]:
+    """
+    Reserva a proxima rota pendente de maior prioridade. Devolve
+    {"key", "job", "attempts"} ou None se nao ha rota pendente agora.
+    """
+    queue = queue or queue_name()
+    worker = worker or worker_id()
+    conn = connect()
+    try:
+        def take() -> Optional[dict]:
+            now = time.time()
+            _expire_leases(conn, queue, carrier, now)
+            row = conn.execute(
+                """
+                SELECT route_key, payload, attempts FROM queue_jobs
+                WHERE queue = ? AND carrier = ? AND status = ?
+                ORDER BY priority
+                LIMIT 1
+                """,
+                (queue, carrier, STATUS_PENDING),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                """
+                UPDATE queue_jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+                WHERE queue = ? AND carrier = ? AND route_key = ?
+                """,
+                (STATUS_LEASED, worker, now + lease_sec(), now_iso(), queue, carrier, row["route_key"]),
+            )
+            return {"key": row["route_key"], "job": json.loads(row["payload"]), "attempts": row["attempts"] + 1}
+
+        return sqlite_state.transaction(conn, take)
+    finally:
+        conn.close()
+
+
+def _update_own_lease(carrier: str, key: str, worker: Optional[str], queue: Optional[str], sql_set: str, params: tuple) -> bool:
+    conn = connect()
+    try:
+        cur = conn.execute(
+            f"UPDATE queue_jobs SET {sql_set}, updated_at = ? "
+            "WHERE queue = ? AND carrier = ? AND route_key = ? AND status = ? AND worker = ?",
+            (*params, now_iso(), queue or queue_name(), carrier, key, STATUS_LEASED, worker or worker_id()),
+        )
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+
+def renew(carrier: str, key: str, worker: Optional[str] = None, queue: Optional[str] = None) -> bool:
+    """Estende o lease (rota longa); False se o lease ja foi perdido."""
+    return _update_own_lease(carrier, key, worker, queue, "lease_until = ?", (time.time() + lease_sec(),))
+
+
+def renew_if_due(carrier: str, key: str, renewed_at: float, log_fn: Callable[[str], None]) -> float:
+    """
+    Renova o lease de uma rota em curso quando ja passou 1/3 dele desde a ultima
+    renovacao (abas esperando enquanto outras sao atendidas). Devolve o instante
+    da ultima renovacao.
+    """
+    now = time.time()
+    if now - renewed_at < lease_sec() / 3:
+        return renewed_at
+    if not renew(carrier, key):
+        log_fn(f"[fila] {key}: lease perdido durante a rota (outro processo pode refazer a rota).")
+    return now
+
+
+def ack(carrier: str, key: str, result: str, worker: Optional[str] = None, queue: Optional[str] = None) -> bool:
+    """Conclui a rota com o status do scraper; False se o lease ja foi perdido."""
+    return _update_own_lease(
+        carrier, key, worker, queue, "status = ?, result = ?, lease_until = NULL", (STATUS_DONE, result)
+    )
+
+
+def release(carrier: str, key: str, worker: Optional[str] = None, queue: Optional[str] = None) -> bool:
+    """Devolve a rota para a fila sem contar a tentativa (ex.: processo encerrando)."""
+    return _update_own_lease(
+        carrier, key, worker, queue, "status = ?, worker = NULL, lease_until = NULL, attempts = attempts - 1",
+        (STATUS_PENDING,),
+    )
+
+
+def queue_stats(carrier: str, queue: Optional[str] = None) -> Dict[str, int]:
+    queue = queue or queue_name()
+    path = db_path()
+    if not path.exists():
+        return {}
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            "SELECT status, COUNT(*) AS n FROM queue_jobs WHERE queue = ? AND carrier = ? GROUP BY status",
+            (queue, carrier),
+        ).fetchall()
+    finally:
+        conn.close()
+    return {r["status"]: r["n"] for r in rows}
+
+
+def leased_by_others(carrier: str, worker: Optional[str] = None, queue: Optional[str] = None) -> int:
+    """Leases ativos de outros workers (os deste processo nao entram na espera)."""
+    path = db_path()
+    if not path.exists():
+        return 0
+    conn = connect(path)
+    try:
+        row = conn.execute(
+            "SELECT COUNT(*) AS n FROM queue_jobs WHERE queue = ? AND carrier = ? AND status = ? AND worker <> ?",
+            (queue or queue_name(), carrier, STATUS_LEASED, worker or worker_id()),
+        ).fetchone()
+    finally:
+        conn.close()
+    return int(row["n"])
+
+
+def leased_jobs(
+    carrier: str,
+    log_fn: Callable[[str], None],
+    worker: Optional[str] = None,
+    busy_fn: Optional[Callable[[], bool]] = None,
+) -> Iterator[Optional[dict]]:
+    """
+    Gera as rotas reservadas por este processo ate a fila esvaziar. Sem rota
+    pendente, espera enquanto outros processos seguram leases (podem expirar e
+    voltar); leases do proprio processo nao entram na espera.
+
+    Com `busy_fn` (abas/paginas do mesmo processo): enquanto ela indicar rotas
+    em curso, gera None ("nada agora") em vez de esperar, para o chamador
+    concluir as abas ocupadas e pedir de novo depois.
+    O chamador confirma cada rota com `ack`.
+    """
+    poll_sec = max(1.0, float(os.getenv("SCRAPER_QUEUE_POLL_SEC", "5")))
+    worker = worker or worker_id()
+    waiting_logged = False
+    while True:
+        item = lease(carrier, worker=worker)
+        if item is not None:
+            waiting_logged = False
+            if item["attempts"] > 1:
+                log_fn(f"[fila] {item['key']}: lease expirado de outro processo; tentativa {item['attempts']}.")
+            yield item["job"]
+            continue
+        if busy_fn is not None and busy_fn():
+            yield None
+            continue
+        others = leased_by_others(carrier, worker=worker)
+        if not others:
+            return
+        if not waiting_logged:
+            log_fn(f"[fila] sem rota pendente; aguardando {others} lease(s) de outros processos.")
+            waiting_logged = True
+        time.sleep(poll_sec)
@@ -0,0 +1,210 @@
+"""
+Admissao de etapas com browser (scrapers e shards) por orcamento de memoria.
+
+Cada etapa `browser` e estimada pelo maior pico de RSS das ultimas execucoes
+(historico SQLite; sem ele, `<run_id>_metrics.json` em artifacts/logs; sem
+nenhum, `PIPELINE_MEMORY_DEFAULT_STAGE_MB`). O runner so inicia a etapa se a
+soma das etapas em execucao (o maior entre estimativa e RSS atual de cada uma)
+mais a estimativa couber no orcamento e a memoria livre do host/container
+comportar o crescimento ainda esperado. O resto fica na fila ate liberar
+espaco. A primeira etapa com browser sempre entra (sem deadlock quando a
+estimativa sozinha passa do orcamento).
+
+Orcamento (`PIPELINE_MEMORY_BUDGET_MB`):
+- `auto` (padrao): `PIPELINE_MEMORY_BUDGET_FRACTION` do limite do cgroup
+  (container) ou da RAM total;
+- numero em MB: orcamento fixo;
+- `0`: desativa a admissao (todas as etapas sobem juntas, como antes).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import run_history
+
+try:
+    import psutil  # opcional
+except Exception:
+    psutil = None
+
+MB = 1024 * 1024
+HISTORY_RUNS = 5
+CGROUP_V2_DIR = Path("/sys/fs/cgroup")
+CGROUP_V1_DIR = Path("/sys/fs/cgroup/memory")
+MEMINFO_PATH = Path("/proc/meminfo")
+# cgroup v1 sem limite reporta um valor enorme (~2^63).
+_UNLIMITED_BYTES = 1 << 60
+
+SHARD_SUFFIX_RE = re.compile(r"_s\d+$")
+
+
+def _read_int(path: Path) -> Optional[int]:
+    try:
+        raw = path.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    if not raw or raw == "max":
+        return None
+    try:
+        value = int(raw)
+    except ValueError:
+        return None
+    return value if 0 < value < _UNLIMITED_BYTES else None
+
+
+def _meminfo_bytes(field: str) -> Optional[int]:
+    try:
+        for line in MEMINFO_PATH.read_text(encoding="utf-8").splitlines():
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    return None
+
+
+def _cgroup_limit_and_usage() -> Tuple[Optional[int], Optional[int]]:
+    limit = _read_int(CGROUP_V2_DIR / "memory.max")
+    if limit is not None:
+        return limit, _read_int(CGROUP_V2_DIR / "memory.current")
+    limit = _read_int(CGROUP_V1_DIR / "memory.limit_in_bytes")
+    if limit is not None:
+        return limit, _read_int(CGROUP_V1_DIR / "memory.usage_in_bytes")
+    return None, None
+
+
+def host_memory_total_bytes() -> Optional[int]:
+    """Menor entre o limite do cgroup e a RAM total (None se nao der para saber)."""
+    candidates = []
+    cgroup_limit, _ = _cgroup_limit_and_usage()
+    if cgroup_limit is not None:
+        candidates.append(cgroup_limit)
+    if psutil is not None:
+        try:
+            candidates.append(int(psutil.virtual_memory().total))
+        except Exception:
+            pass
+    else:
+        total = _meminfo_bytes("MemTotal")
+        if total is not None:
+            candidates.append(total)
+    return min(candidates) if candidates else None
+
+
+def available_memory_bytes() -> Optional[int]:
+    """Memoria livre agora: menor entre a folga do cgroup e o MemAvailable do host."""
+    candidates = []
+    cgroup_limit, cgroup_usage = _cgroup_limit_and_usage()
+    if cgroup_limit is not None and cgroup_usage is not None:
+        candidates.append(max(0, cgroup_limit - cgroup_usage))
+    if psutil is not None:
+        try:
+            candidates.append(int(psutil.virtual_memory().available))
+        except Exception:
+            pass
+    else:
+        available = _meminfo_bytes("MemAvailable")
+        if available is not None:
+            candidates.append(available)
+    return min(candidates) if candidates else None
+
+
+def resolve_budget_mb() -> Tuple[Optional[float], str]:
+    """Devolve (orcamento em MB ou None = desativado, descricao da origem)."""
+    raw = (os.getenv("PIPELINE_MEMORY_BUDGET_MB") or "auto").strip().lower()
+    if raw != "auto":
+        value = float(raw)
+        if value <= 0:
+            return None, "desativado (PIPELINE_MEMORY_BUDGET_MB<=0)"
+        return value, "PIPELINE_MEMORY_BUDGET_MB"
+
+    total = host_memory_total_bytes()
+    if total is None:
+        return None, "desativado (memoria do host desconhecida)"
+    fraction = float(os.getenv("PIPELINE_MEMORY_BUDGET_FRACTION", "0.85"))
+    return round(total / MB * fraction, 1), f"auto ({fraction:.0%} de {total / MB:.0f}MB)"
+
+
+def stage_group(name: str) -> str:
+    """`hapag_s1` -> `hapag`: shards compartilham o historico do scraper."""
+    return SHARD_SUFFIX_RE.sub("", name)
+
+
+def _peaks_from_metrics_files(log_dir: Path, group: str, limit: int) -> List[float]:
+    peaks: List[float] = []
+    files = sorted(log_dir.glob("*_metrics.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in files:
+        try:
+            stages = json.loads(path.read_text(encoding="utf-8")).get("stages", {})
+        except (OSError, ValueError):
+            continue
+        for name, item in stages.items():
+            if stage_group(name) != group or item.get("execution") == "cache":
+                continue
+            peak = item.get("peak_rss_mb")
+            if isinstance(peak, (int, float)) and peak > 0:
+                peaks.append(float(peak))
+        if len(peaks) >= limit:
+            break
+    return peaks[:limit]
+
+
+def estimate_stage_mb(name: str, log_dir: Path) -> Tuple[float, str]:
+    """Maior pico recente da etapa (ou dos shards do mesmo scraper)."""
+    group = stage_group(name)
+    peaks = run_history.recent_peak_rss_mb(group, HISTORY_RUNS)
+    source = "historico"
+    if not peaks:
+        peaks = _peaks_from_metrics_files(log_dir, group, HISTORY_RUNS)
+        source = "metrics.json"
+    if not peaks:
+        return float(os.getenv("PIPELINE_MEMORY_DEFAULT_STAGE_MB", "1024")), "default"
+    return max(peaks), f"{source}, max de {len(peaks)} execucoes"
+
+
+def new_admission(log_dir: Path) -> Optional[dict]:
+    budget_mb, source = resolve_budget_mb()
+    if budget_mb is None:
+        return None
+    return {"budget_mb": budget_mb, "source": source, "log_dir": log_dir, "estimates": {}, "waiting": set()}
+
+
+def stage_estimate(admission: dict, name: str) -> Tuple[float, str]:
+    if name not in admission["estimates"]:
+        admission["estimates"][name] = estimate_stage_mb(name, admission["log_dir"])
+    return admission["estimates"][name]
+
+
+def check_admission(admission: dict, name: str, running_rss_mb: Dict[str, float]) -> Tuple[bool, str]:
+    """
+    `running_rss_mb`: RSS atual (MB) de cada etapa com browser em execucao.
+    Devolve (admitida, detalhe para log).
+    """
+    estimate, _ = stage_estimate(admission, name)
+    committed = 0.0
+    pending_growth = 0.0
+    for other, rss_mb in running_rss_mb.items():
+        other_estimate, _ = stage_estimate(admission, other)
+        committed += max(other_estimate, rss_mb)
+        pending_growth += max(0.0, other_estimate - rss_mb)
+
+    detail = (
+        f"estimativa={estimate:.0f}MB em_uso={committed:.0f}MB "
+        f"orcamento={admission['budget_mb']:.0f}MB"
+    )
+    if not running_rss_mb:
+        return True, detail
+    if committed + estimate > admission["budget_mb"]:
+        return False, detail
+
+    available = available_memory_bytes()
+    if available is not None:
+        free_mb = available / MB - pending_growth
+        detail += f" livre={free_mb:.0f}MB"
+        if free_mb < estimate:
+            return False, detail
+    return True, detail
@@ -0,0 +1,265 @@
+"""
+Eventos de progresso (JSONL) dos scrapers para o runner.
+
+Lado do scraper: `emit(...)` acrescenta uma linha JSON no arquivo indicado em
+`PIPELINE_EVENTS_FILE` (o runner define um por etapa). Sem a env, nao faz nada.
+Eventos usados:
+- `batch_start` (total de rotas desta execucao/shard, adiadas pelo deadline)
+- `job_start` (idx, total, key)
+- `step` (etapa/status da linha estruturada do terminal)
+- `job_end` (status, duration_sec)
+- `job_deferred` (rota adiada durante o batch por falta de tempo ate o deadline)
+- `batch_end`
+
+Lado do runner: `poll_events` le so o que foi acrescentado desde a ultima
+leitura e atualiza o estado da etapa; `carrier_progress` agrega shards por
+carrier (vazao em rotas/min, ETA e tempo sem eventos para detectar travamento).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+EVENTS_FILE_ENV = "PIPELINE_EVENTS_FILE"
+# Janela de duracoes recentes usada na vazao/ETA (reage a mudanca de ritmo).
+RECENT_JOBS_WINDOW = 10
+
+_events_handle = None
+
+
+def emit(event: str, **fields) -> None:
+    """Grava um evento (best-effort: erro de IO nunca interrompe o scraper)."""
+    global _events_handle
+    path = os.getenv(EVENTS_FILE_ENV)
+    if not path:
+        return
+    record = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "event": event,
+        "stage": os.getenv("PIPELINE_STAGE") or None,
+        **fields,
+    }
+    try:
+        if _events_handle is None or _events_handle.name != path:
+            _events_handle = open(path, "a", encoding="utf-8", buffering=1)
+        _events_handle.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except Exception:
+        pass
+
+
+# ----------------------------------------------------------------------
+# Lado do runner
+# ----------------------------------------------------------------------
+def new_stage_progress(stage: str, events_path: Path) -> dict:
+    return {
+        "stage": stage,
+        "path": events_path,
+        "offset": 0,
+        "partial": "",
+        "carrier": None,
+        "total": None,
+        "started": 0,
+        "done": 0,
+        "ok": 0,
+        "errors": 0,
+        "deferred": 0,
+        "current": None,
+        "current_step": None,
+        "durations": [],
+        "started_mono": time.monotonic(),
+        "last_event_mono": time.monotonic(),
+        "finished": False,
+        "stalled": False,
+    }
+
+
+def poll_events(progress: dict) -> List[dict]:
+    """Le os eventos novos do arquivo da etapa e aplica no estado."""
+    path = progress["path"]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            f.seek(progress["offset"])
+            chunk = f.read()
+            progress["offset"] = f.tell()
+    except FileNotFoundError:
+        return []
+
+    if not chunk:
+        return []
+    data = progress["partial"] + chunk
+    lines = data.split("\n")
+    progress["partial"] = lines.pop()  # linha incompleta fica para a proxima leitura
+
+    events = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        apply_event(progress, event)
+        events.append(event)
+    if events:
+        progress["last_event_mono"] = time.monotonic()
+        progress["stalled"] = False
+    return events
+
+
+def apply_event(progress: dict, event: dict) -> None:
+    kind = event.get("event")
+    if event.get("carrier"):
+        progress["carrier"] = event["carrier"]
+    if kind == "batch_start":
+        progress["total"] = event.get("total")
+        progress["deferred"] = int(event.get("deferred") or 0)
+    elif kind == "job_start":
+        progress["started"] += 1
+        progress["current"] = event.get("key")
+        progress["current_step"] = None
+        if progress["total"] is None and event.get("total") is not None:
+            progress["total"] = event.get("total")
+    elif kind == "step":
+        progress["current_step"] = event.get("step")
+    elif kind == "job_end":
+        progress["done"] += 1
+        if str(event.get("status")) in {"ok", "success"}:
+            progress["ok"] += 1
+        else:
+            progress["errors"] += 1
+        duration = event.get("duration_sec")
+        if isinstance(duration, (int, float)):
+            progress["durations"].append(float(duration))
+            del progress["durations"][:-RECENT_JOBS_WINDOW]
+        progress["current"] = None
+    elif kind == "job_deferred":
+        progress["deferred"] += 1
+        if progress["total"] is not None:
+            progress["total"] = max(0, int(progress["total"]) - 1)
+    elif kind == "batch_end":
+        progress["finished"] = True
+
+
+def stage_rate_per_min(progress: dict) -> Optional[float]:
+    durations = progress["durations"]
+    if durations:
+        avg = sum(durations) / len(durations)
+        return 60.0 / avg if avg > 0 else None
+    return None
+
+
+def stage_eta_sec(progress: dict) -> Optional[float]:
+    total = progress.get("total")
+    if total is None or progress["finished"]:
+        return 0.0 if progress["finished"] else None
+    remaining = max(0, int(total) - progress["done"])
+    rate = stage_rate_per_min(progress)
+    if remaining == 0:
+        return 0.0
+    if not rate:
+        return None
+    return remaining * 60.0 / rate
+
+
+def carrier_of(progress: dict) -> str:
+    if progress.get("carrier"):
+        return progress["carrier"]
+    return progress["stage"].split("_s")[0]
+
+
+def carrier_progress(progresses: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Agrega por carrier. Shards rodam em paralelo: vazao soma e ETA e o maior
+    ETA entre os shards.
+    """
+    now = time.monotonic()
+    out: Dict[str, dict] = {}
+    for progress in progresses.values():
+        carrier = carrier_of(progress)
+        agg = out.setdefault(
+            carrier,
+            {
+                "carrier": carrier,
+                "stages": [],
+                "total": 0,
+                "total_known": True,
+                "done": 0,
+                "ok": 0,
+                "errors": 0,
+                "deferred": 0,
+                "rate_per_min": 0.0,
+                "eta_sec": 0.0,
+                "idle_sec": 0.0,
+                "stalled_stages": [],
+            },
+        )
+        agg["stages"].append(progress["stage"])
+        if progress["total"] is None:
+            agg["total_known"] = False
+        else:
+            agg["total"] += int(progress["total"])
+        agg["done"] += progress["done"]
+        agg["ok"] += progress["ok"]
+        agg["errors"] += progress["errors"]
+        agg["deferred"] += progress["deferred"]
+        rate = stage_rate_per_min(progress)
+        if rate and not progress["finished"]:
+            agg["rate_per_min"] += rate
+        eta = stage_eta_sec(progress)
+        agg["eta_sec"] = None if eta is None or agg["eta_sec"] is None else max(agg["eta_sec"], eta)
+        if not progress["finished"]:
+            agg["idle_sec"] = max(agg["idle_sec"], now - progress["last_event_mono"])
+        if progress["stalled"]:
+            agg["stalled_stages"].append(progress["stage"])
+    return out
+
+
+def format_progress_line(summary: dict) -> str:
+    total = summary["total"] if summary["total_known"] else "?"
+    eta = summary["eta_sec"]
+    if eta is None:
+        eta_txt = "?"
+    elif eta >= 60:
+        eta_txt = f"{eta / 60:.0f}min"
+    else:
+        eta_txt = f"{eta:.0f}s"
+    line = (
+        f"[progress] {summary['carrier']}: {summary['done']}/{total} rotas "
+        f"(ok={summary['ok']} erro={summary['errors']}) "
+        f"{summary['rate_per_min']:.2f} rotas/min ETA={eta_txt} "
+        f"sem_eventos={summary['idle_sec']:.0f}s"
+    )
+    if summary["deferred"]:
+        line += f" adiadas={summary['deferred']}"
+    if len(summary["stages"]) > 1:
+        line += f" shards={len(summary['stages'])}"
+    if summary["stalled_stages"]:
+        line += f" TRAVADO={summary['stalled_stages']}"
+    return line
+
+
+def write_progress_json(path: Path, run_id: str, progresses: Dict[str, dict]) -> None:
+    summaries = carrier_progress(progresses)
+    payload = {
+        "run_id": run_id,
+        "written_at": datetime.now().isoformat(timespec="seconds"),
+        "carriers": summaries,
+        "stages": {
+            name: {
+                k: v
+                for k, v in p.items()
+                if k not in {"path", "offset", "partial", "started_mono", "last_event_mono"}
+            }
+            for name, p in progresses.items()
+        },
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_path, path)
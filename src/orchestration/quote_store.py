@@ -0,0 +1,492 @@
+"""
+Store transacional das cotacoes dos scrapers (SQLite WAL).
+
+Cada tentativa de rota vira uma linha em `quote_attempts`; numa tentativa com
+sucesso, as colunas de charge (tudo que nao e campo base) vao para
+`quote_charges`. `quote_routes` aponta para a ultima tentativa e o ultimo
+sucesso de cada rota: gravar um job e um INSERT + upsert numa transacao,
+custo constante independente do numero de rotas/colunas, e uma queda no meio
+nao corrompe nada.
+
+Os CSVs de breakdown (`hapag_breakdowns.csv`, `maersk_breakdowns.csv`,
+`cma_breakdowns.csv`) viram exportacao do store, no layout de sempre:
+- status/message/last_attempt_at da ultima tentativa;
+- quoted_at e colunas de charge do ultimo sucesso (mesma regra do merge de
+  shards).
+
+Os scrapers gravam a tentativa no store a cada job e reexportam o CSV do store
+(`export_view`, replace atomico) a cada `QUOTE_STORE_EXPORT_EVERY` jobs e no
+fim; a Hapag converte as colunas com moeda para USD na mesma exportacao. Ao
+iniciar, `sync_csv` reexporta o CSV a partir do store quando ele esta atrasado
+(processo anterior caiu antes de exportar) ou, com o store vazio para o
+carrier, importa o CSV existente. Com `QUOTE_STORE_ENABLED=0` (ou erro no
+store) os scrapers voltam a reescrever o CSV das linhas em memoria a cada job.
+
+Banco em `artifacts/runtime/quotes.sqlite` (ou `QUOTE_STORE_DB`). Tentativas
+antigas (`QUOTE_STORE_RETENTION_DAYS`) que nao sao a ultima tentativa/sucesso
+de nenhuma rota sao apagadas no `sync_csv`.
+
+CLI:
+  python src/orchestration/quote_store.py export --carrier hapag
+  python src/orchestration/quote_store.py import --carrier maersk --csv artifacts/output/maersk_breakdowns.csv
+  python src/orchestration/quote_store.py history --carrier hapag --key "SANTOS-HAMBURG"
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import sqlite_state
+from sqlite_state import parse_env_bool
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+OUTPUT_DIR = PROJECT_ROOT / "artifacts" / "output"
+DEFAULT_DB_PATH = PROJECT_ROOT / "artifacts" / "runtime" / "quotes.sqlite"
+
+BASE_FIELDS = ("key", "origin", "destination", "last_attempt_at", "quoted_at", "status", "message")
+
+# Layout do CSV de cada scraper (igual ao que cada um grava).
+CARRIERS = {
+    "hapag": {
+        "csv": OUTPUT_DIR / "hapag_breakdowns.csv",
+        "encoding": "utf-8",
+        "fixed": list(BASE_FIELDS),
+        "sort_rows": True,
+        "sort_extras": True,
+        "success": "success",
+    },
+    "maersk": {
+        "csv": OUTPUT_DIR / "maersk_breakdowns.csv",
+        "encoding": "utf-8-sig",
+        "fixed": list(BASE_FIELDS)
+        + ["offer_departure_date", "offer_arrival_date", "offer_transit_time", "offer_transit_time_hours"],
+        "sort_rows": False,
+        "sort_extras": False,
+        "success": "ok",
+    },
+    "cma": {
+        "csv": OUTPUT_DIR / "cma_breakdowns.csv",
+        "encoding": "utf-8",
+        "fixed": list(BASE_FIELDS) + ["total_all_in", "total_currency", "transit_time_days"],
+        "sort_rows": True,
+        "sort_extras": True,
+        "success": "success",
+    },
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quote_attempts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    carrier TEXT NOT NULL,
+    route_key TEXT NOT NULL,
+    origin TEXT,
+    destination TEXT,
+    attempted_at TEXT,
+    quoted_at TEXT,
+    status TEXT,
+    message TEXT,
+    run_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_quote_attempts_route ON quote_attempts (carrier, route_key);
+CREATE TABLE IF NOT EXISTS quote_charges (
+    attempt_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (attempt_id, name)
+);
+CREATE TABLE IF NOT EXISTS quote_routes (
+    carrier TEXT NOT NULL,
+    route_key TEXT NOT NULL,
+    last_attempt_id INTEGER,
+    last_success_id INTEGER,
+    PRIMARY KEY (carrier, route_key)
+);
+"""
+
+
+def store_enabled() -> bool:
+    return parse_env_bool("QUOTE_STORE_ENABLED", default=True)
+
+
+def export_every() -> int:
+    """Jobs entre reescritas do CSV; 0 = so no fim do batch."""
+    return max(0, int(os.getenv("QUOTE_STORE_EXPORT_EVERY", "25")))
+
+
+def db_path() -> Path:
+    return sqlite_state.env_path("QUOTE_STORE_DB", DEFAULT_DB_PATH)
+
+
+def connect(path: Optional[Path] = None) -> sqlite3.Connection:
+    return sqlite_state.connect(path or db_path(), SCHEMA, autocommit=False)
+
+
+_warned = False
+
+
+def _warn(action: str, e: Exception) -> None:
+    global _warned
+    if not _warned:
+        print(f"[quote_store] aviso: falha ao {action} em {db_path()}: {e!r}", file=sys.stderr, flush=True)
+        _warned = True
+
+
+def _text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value != value:  # NaN
+        return ""
+    text = str(value)
+    return "" if text in {"nan", "NaN", "<NA>", "None", "NaT"} else text
+
+
+def _is_success(carrier: str, status: str) -> bool:
+    return status == CARRIERS[carrier]["success"]
+
+
+def _insert_attempt(conn: sqlite3.Connection, carrier: str, row: dict, attempted_at: str, quoted_at: str,
+                    status: str, message: str, with_charges: bool, run_id: str) -> int:
+    key = _text(row.get("key"))
+    cur = conn.execute(
+        """
+        INSERT INTO quote_attempts
+            (carrier, route_key, origin, destination, attempted_at, quoted_at, status, message, run_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            carrier,
+            key,
+            _text(row.get("origin")),
+            _text(row.get("destination")),
+            attempted_at,
+            quoted_at,
+            status,
+            message,
+            run_id,
+        ),
+    )
+    attempt_id = cur.lastrowid
+    if with_charges:
+        conn.executemany(
+            "INSERT OR REPLACE INTO quote_charges (attempt_id, name, value) VALUES (?, ?, ?)",
+            [
+                (attempt_id, str(name), _text(value))
+                for name, value in row.items()
+                if name not in BASE_FIELDS and _text(value) != ""
+            ],
+        )
+    conn.execute(
+        """
+        INSERT INTO quote_routes (carrier, route_key, last_attempt_id, last_success_id)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (carrier, route_key) DO UPDATE SET
+            last_attempt_id = excluded.last_attempt_id,
+            last_success_id = COALESCE(excluded.last_success_id, quote_routes.last_success_id)
+        """,
+        (carrier, key, attempt_id, attempt_id if with_charges else None),
+    )
+    return attempt_id
+
+
+def record_attempt(carrier: str, row: dict) -> bool:
+    """
+    Grava a tentativa de uma rota. `row` e a linha da rota como o scraper a
+    mantem em memoria apos o job (campos base + charges); as charges so sao
+    gravadas quando o status e de sucesso. Devolve False se o store estiver
+    desligado ou falhar (o chamador volta a gravar o CSV na hora).
+    """
+    if not store_enabled():
+        return False
+    status = _text(row.get("status"))
+    success = _is_success(carrier, status)
+    run_id = (os.getenv("RUN_ID") or "").strip()
+    try:
+        conn = connect()
+        try:
+            with conn:
+                _insert_attempt(
+                    conn,
+                    carrier,
+                    row,
+                    attempted_at=_text(row.get("last_attempt_at")),
+                    quoted_at=_text(row.get("quoted_at")) if success else "",
+                    status=status,
+                    message=_text(row.get("message")),
+                    with_charges=success,
+                    run_id=run_id,
+                )
+        finally:
+            conn.close()
+        return True
+    except Exception as e:
+        _warn("gravar tentativa", e)
+        return False
+
+
+def import_rows(conn: sqlite3.Connection, carrier: str, rows: List[dict]) -> int:
+    """Carga inicial a partir do CSV: ultimo sucesso (se houver) e ultima tentativa de cada linha."""
+    imported = 0
+    for row in rows:
+        if not _text(row.get("key")):
+            continue
+        status = _text(row.get("status"))
+        quoted_at = _text(row.get("quoted_at"))
+        attempted_at = _text(row.get("last_attempt_at"))
+        if _is_success(carrier, status):
+            _insert_attempt(conn, carrier, row, attempted_at, quoted_at, status, _text(row.get("message")), True, "import")
+        else:
+            if quoted_at:
+                _insert_attempt(conn, carrier, row, quoted_at, quoted_at, CARRIERS[carrier]["success"], "", True, "import")
+            if attempted_at or status:
+                _insert_attempt(conn, carrier, row, attempted_at, "", status, _text(row.get("message")), False, "import")
+        imported += 1
+    return imported
+
+
+def read_csv_rows(path: Path) -> List[dict]:
+    if not path.exists() or path.stat().st_size == 0:
+        return []
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        return [dict(r) for r in csv.DictReader(f)]
+
+
+def latest_rows(conn: sqlite3.Connection, carrier: str) -> Dict[str, dict]:
+    """Visao "uma linha por rota" (layout dos CSVs), na ordem de insercao das rotas."""
+    routes = conn.execute(
+        """
+        SELECT r.route_key, a.origin, a.destination, a.attempted_at, a.status, a.message, s.quoted_at,
+               r.last_success_id
+        FROM quote_routes r
+        JOIN quote_attempts a ON a.id = r.last_attempt_id
+        LEFT JOIN quote_attempts s ON s.id = r.last_success_id
+        WHERE r.carrier = ?
+        ORDER BY r.rowid
+        """,
+        (carrier,),
+    ).fetchall()
+    rows: Dict[str, dict] = {}
+    by_success: Dict[int, dict] = {}
+    for r in routes:
+        row = {
+            "key": r["route_key"],
+            "origin": r["origin"] or "",
+            "destination": r["destination"] or "",
+            "last_attempt_at": r["attempted_at"] or "",
+            "quoted_at": r["quoted_at"] or "",
+            "status": r["status"] or "",
+            "message": r["message"] or "",
+        }
+        rows[r["route_key"]] = row
+        if r["last_success_id"] is not None:
+            by_success[r["last_success_id"]] = row
+    charges = conn.execute(
+        """
+        SELECT c.attempt_id, c.name, c.value
+        FROM quote_charges c
+        JOIN quote_routes r ON c.attempt_id = r.last_success_id
+        WHERE r.carrier = ?
+        ORDER BY c.rowid
+        """,
+        (carrier,),
+    )
+    for c in charges:
+        row = by_success.get(c["attempt_id"])
+        if row is not None:
+            row[c["name"]] = c["value"]
+    return rows
+
+
+def replace_file(path: Path, write_fn: Callable[[Path], None]) -> None:
+    """
+    Grava o arquivo via `write_fn(tmp)` e troca com `os.replace`: uma queda no
+    meio da escrita nao corrompe o arquivo. Tmp por processo: shards podem
+    reexportar o mesmo CSV ao mesmo tempo.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        write_fn(tmp_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_csv(carrier: str, rows: Dict[str, dict], path: Path) -> None:
+    """Grava as linhas no layout do carrier (replace atomico)."""
+    layout = CARRIERS[carrier]
+    fixed = list(layout["fixed"])
+    extras: List[str] = []
+    seen = set(fixed)
+    for row in rows.values():
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                extras.append(name)
+    fieldnames = fixed + (sorted(extras) if layout["sort_extras"] else extras)
+    keys = sorted(rows) if layout["sort_rows"] else list(rows)
+
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open("w", encoding=layout["encoding"], newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            writer.writeheader()
+            for key in keys:
+                writer.writerow({field: rows[key].get(field, "") for field in fieldnames})
+
+    replace_file(path, write)
+
+
+def export_csv(carrier: str, path: Optional[Path] = None) -> int:
+    path = path or CARRIERS[carrier]["csv"]
+    conn = connect()
+    try:
+        rows = latest_rows(conn, carrier)
+    finally:
+        conn.close()
+    write_csv(carrier, rows, path)
+    return len(rows)
+
+
+def export_view(carrier: str, path: Optional[Path] = None) -> Optional[int]:
+    """
+    Reescreve o CSV do carrier a partir do store (scrapers: a cada
+    `QUOTE_STORE_EXPORT_EVERY` jobs e no fim do batch). Devolve as rotas
+    exportadas, ou None se o store estiver desligado/falhar (o chamador grava o
+    CSV a partir das linhas em memoria).
+    """
+    if not store_enabled():
+        return None
+    try:
+        return export_csv(carrier, path)
+    except Exception as e:
+        _warn("exportar o CSV", e)
+        return None
+
+
+def _prune(conn: sqlite3.Connection, carrier: str) -> int:
+    days = float(os.getenv("QUOTE_STORE_RETENTION_DAYS", "90"))
+    if days <= 0:
+        return 0
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+    keep = (
+        "SELECT last_attempt_id FROM quote_routes WHERE last_attempt_id IS NOT NULL "
+        "UNION SELECT last_success_id FROM quote_routes WHERE last_success_id IS NOT NULL"
+    )
+    old = f"SELECT id FROM quote_attempts WHERE carrier = ? AND attempted_at < ? AND id NOT IN ({keep})"
+    conn.execute(f"DELETE FROM quote_charges WHERE attempt_id IN ({old})", (carrier, cutoff))
+    return conn.execute(f"DELETE FROM quote_attempts WHERE id IN ({old})", (carrier, cutoff)).rowcount
+
+
+def sync_csv(carrier: str, csv_path: Optional[Path] = None, log_fn=print) -> Optional[str]:
+    """
+    Chamado no inicio do scraper: store vazio para o carrier -> importa o CSV;
+    store com tentativas mais novas que o CSV (processo anterior caiu antes de
+    exportar) -> reexporta o CSV. Devolve "import"/"export"/"current" ou None
+    (store desligado/falhou; o scraper segue so com o CSV).
+    """
+    if not store_enabled():
+        return None
+    csv_path = csv_path or CARRIERS[carrier]["csv"]
+    try:
+        csv_rows = read_csv_rows(csv_path)
+        conn = connect()
+        try:
+            with conn:
+                # IMMEDIATE: shards iniciando juntos nao importam o CSV duas vezes
+                conn.execute("BEGIN IMMEDIATE")
+                has_rows = conn.execute(
+                    "SELECT 1 FROM quote_routes WHERE carrier = ? LIMIT 1", (carrier,)
+                ).fetchone()
+                if not has_rows:
+                    imported = import_rows(conn, carrier, csv_rows)
+                    log_fn(f"[quote_store] {carrier}: store vazio; {imported} rota(s) importadas de {csv_path}.")
+                    return "import"
+                pruned = _prune(conn, carrier)
+            store_latest = conn.execute(
+                "SELECT MAX(attempted_at) FROM quote_attempts WHERE carrier = ?", (carrier,)
+            ).fetchone()[0] or ""
+            csv_latest = max((_text(r.get("last_attempt_at")) for r in csv_rows), default="")
+            # CSV em dia: nao reescreve (o Hapag grava valores ja convertidos para USD)
+            if csv_latest >= store_latest:
+                return "current"
+            rows = latest_rows(conn, carrier)
+        finally:
+            conn.close()
+        write_csv(carrier, rows, csv_path)
+        log_fn(
+            f"[quote_store] {carrier}: CSV atrasado em relacao ao store; reexportado ({len(rows)} rotas"
+            + (f", {pruned} tentativas antigas removidas" if pruned else "")
+            + f") em {csv_path}."
+        )
+        return "export"
+    except Exception as e:
+        _warn("sincronizar o CSV", e)
+        return None
+
+
+def cmd_history(conn: sqlite3.Connection, args: argparse.Namespace) -> None:
+    rows = conn.execute(
+        """
+        SELECT a.id, a.attempted_at, a.status, a.quoted_at, a.run_id, a.message,
+               (SELECT COUNT(*) FROM quote_charges c WHERE c.attempt_id = a.id) AS charges
+        FROM quote_attempts a
+        WHERE a.carrier = ? AND a.route_key = ?
+        ORDER BY a.id DESC
+        LIMIT ?
+        """,
+        (args.carrier, args.key, args.limit),
+    ).fetchall()
+    for r in rows:
+        print(
+            f"{r['attempted_at'] or '-':<26} {r['status'] or '-':<10} charges={r['charges']:<4} "
+            f"run={r['run_id'] or '-'} {(r['message'] or '')[:80]}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Store transacional das cotacoes dos scrapers.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("export", help="Gera o CSV do carrier a partir do store.")
+    p.add_argument("--carrier", choices=sorted(CARRIERS), required=True)
+    p.add_argument("--out", default=None, help="Arquivo de saida (padrao: CSV do carrier em artifacts/output).")
+
+    p = sub.add_parser("import", help="Importa um CSV de breakdown para o store.")
+    p.add_argument("--carrier", choices=sorted(CARRIERS), required=True)
+    p.add_argument("--csv", default=None)
+
+    p = sub.add_parser("history", help="Tentativas de uma rota.")
+    p.add_argument("--carrier", choices=sorted(CARRIERS), required=True)
+    p.add_argument("--key", required=True)
+    p.add_argument("--limit", type=int, default=20)
+
+    args = parser.parse_args()
+    if args.cmd == "export":
+        out = Path(args.out) if args.out else CARRIERS[args.carrier]["csv"]
+        total = export_csv(args.carrier, out)
+        print(f"[quote_store] {args.carrier}: {total} rotas exportadas para {out}")
+        return 0
+
+    conn = connect()
+    try:
+        if args.cmd == "import":
+            path = Path(args.csv) if args.csv else CARRIERS[args.carrier]["csv"]
+            with conn:
+                total = import_rows(conn, args.carrier, read_csv_rows(path))
+            print(f"[quote_store] {args.carrier}: {total} linhas importadas de {path}")
+        else:
+            cmd_history(conn, args)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,456 @@
+"""
+Controle adaptativo de ritmo e concorrencia por carrier (AIMD + token bucket).
+
+Com `RATE_CONTROL_ENABLED=1`, cada busca dos scrapers passa pelo controlador
+do carrier antes de comecar (`try_start`/`wait_start`) e devolve o resultado ao
+terminar (`finish`). O estado e compartilhado por todos os processos do carrier
+(abas, shards, replicas, contas do pool), entao o limite vale para o conjunto:
+
+- Token bucket: no maximo `RATE_CONTROL_PER_MIN` buscas por minuto
+  (`RATE_CONTROL_PER_MIN_<CARRIER>` por carrier), com rajada de
+  `RATE_CONTROL_BURST`.
+- Concorrencia: buscas simultaneas do carrier (comeca em `RATE_CONTROL_START`,
+  ate `RATE_CONTROL_MAX`). Aba/processo sem vaga espera; abas
+  (`HAPAG_TABS`/`MAERSK_PAGES`) e shards passam a ser so a capacidade maxima.
+- A cada `RATE_CONTROL_WINDOW` buscas a janela e avaliada: taxa de sucesso >=
+  `RATE_CONTROL_MIN_SUCCESS` e latencia media ate `RATE_CONTROL_LATENCY_FACTOR`
+  x a referencia (menor media recente) -> aumento aditivo (+1 de concorrencia;
+  se o ritmo estava cortado, ele volta primeiro).
+- Pressao (Security Check da Hapag, Retry da Maersk, timeout do watchdog) em
+  `RATE_CONTROL_PRESSURE_RATE` da janela corta na hora: concorrencia x
+  `RATE_CONTROL_DECREASE`; ja em 1, corta o ritmo por minuto. Buscas que ja
+  estavam em curso no corte nao geram um segundo corte.
+
+O estado persiste entre runs (o proximo run comeca do ultimo ponto sustentavel).
+Cada decisao vai para o log do scraper e para a tabela `rate_decisions`.
+
+Backend: SQLite (WAL) em `artifacts/runtime/rate_control.sqlite` (ou
+`RATE_CONTROL_DB`), com `BEGIN IMMEDIATE` como a fila de rotas.
+
+CLI:
+  python src/orchestration/rate_control.py status
+  python src/orchestration/rate_control.py reset --carrier hapag
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import sqlite_state
+from sqlite_state import parse_env_bool
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+DEFAULT_DB_PATH = PROJECT_ROOT / "artifacts" / "runtime" / "rate_control.sqlite"
+SLOT_POLL_SEC = 1.0
+
+OK_STATUSES = {"success", "ok", "no_quote"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_state (
+    carrier TEXT PRIMARY KEY,
+    concurrency INTEGER NOT NULL,
+    per_min REAL NOT NULL,
+    tokens REAL NOT NULL,
+    refill_at REAL NOT NULL,
+    win_n INTEGER NOT NULL DEFAULT 0,
+    win_ok INTEGER NOT NULL DEFAULT 0,
+    win_pressure INTEGER NOT NULL DEFAULT 0,
+    win_latency REAL NOT NULL DEFAULT 0,
+    latency_ref REAL,
+    hold INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS rate_inflight (
+    carrier TEXT NOT NULL,
+    holder TEXT NOT NULL,
+    slot TEXT NOT NULL,
+    started REAL NOT NULL,
+    PRIMARY KEY (carrier, holder, slot)
+);
+CREATE TABLE IF NOT EXISTS rate_decisions (
+    at TEXT NOT NULL,
+    carrier TEXT NOT NULL,
+    action TEXT NOT NULL,
+    concurrency INTEGER NOT NULL,
+    per_min REAL NOT NULL,
+    reason TEXT
+);
+"""
+
+
+def control_enabled() -> bool:
+    return parse_env_bool("RATE_CONTROL_ENABLED", default=False)
+
+
+def db_path() -> Path:
+    return sqlite_state.env_path("RATE_CONTROL_DB", DEFAULT_DB_PATH)
+
+
+def max_per_min(carrier: str) -> float:
+    raw = os.getenv(f"RATE_CONTROL_PER_MIN_{carrier.upper()}") or os.getenv("RATE_CONTROL_PER_MIN", "12")
+    return max(0.1, float(raw))
+
+
+def min_per_min(carrier: str) -> float:
+    return min(max_per_min(carrier), max(0.1, float(os.getenv("RATE_CONTROL_MIN_PER_MIN", "1"))))
+
+
+def burst() -> float:
+    return max(1.0, float(os.getenv("RATE_CONTROL_BURST", "2")))
+
+
+def start_concurrency() -> int:
+    return max(1, int(os.getenv("RATE_CONTROL_START", "1")))
+
+
+def max_concurrency() -> int:
+    return max(start_concurrency(), int(os.getenv("RATE_CONTROL_MAX", "8")))
+
+
+def window() -> int:
+    return max(2, int(os.getenv("RATE_CONTROL_WINDOW", "8")))
+
+
+def slot_sec() -> float:
+    return max(60.0, float(os.getenv("RATE_CONTROL_SLOT_SEC", "900")))
+
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def connect(path: Optional[Path] = None) -> sqlite3.Connection:
+    # autocommit: transacoes explicitas com BEGIN IMMEDIATE (sqlite_state.transaction)
+    return sqlite_state.connect(path or db_path(), SCHEMA)
+
+
+def _load_state(conn: sqlite3.Connection, carrier: str, now: float) -> dict:
+    row = conn.execute("SELECT * FROM rate_state WHERE carrier = ?", (carrier,)).fetchone()
+    if row is None:
+        state = {
+            "carrier": carrier,
+            "concurrency": start_concurrency(),
+            "per_min": max_per_min(carrier),
+            "tokens": burst(),
+            "refill_at": now,
+            "win_n": 0,
+            "win_ok": 0,
+            "win_pressure": 0,
+            "win_latency": 0.0,
+            "latency_ref": None,
+            "hold": 0,
+        }
+    else:
+        state = dict(row)
+    # limites do env valem sobre o estado salvo (env mudou entre runs)
+    state["concurrency"] = min(max(1, state["concurrency"]), max_concurrency())
+    state["per_min"] = min(max(min_per_min(carrier), state["per_min"]), max_per_min(carrier))
+    # refill do bucket
+    elapsed = max(0.0, now - state["refill_at"])
+    state["tokens"] = min(burst(), state["tokens"] + elapsed * state["per_min"] / 60)
+    state["refill_at"] = now
+    return state
+
+
+def _save_state(conn: sqlite3.Connection, state: dict) -> None:
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO rate_state
+            (carrier, concurrency, per_min, tokens, refill_at, win_n, win_ok, win_pressure, win_latency,
+             latency_ref, hold, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            state["carrier"], state["concurrency"], state["per_min"], state["tokens"], state["refill_at"],
+            state["win_n"], state["win_ok"], state["win_pressure"], state["win_latency"], state["latency_ref"],
+            state["hold"], now_iso(),
+        ),
+    )
+
+
+def try_start(carrier: str, slot, holder: Optional[str] = None) -> float:
+    """
+    Reserva vaga + token para uma busca. Devolve 0 se pode comecar agora, senao
+    quantos segundos esperar (sem vaga de concorrencia ou sem token).
+    """
+    holder = holder or sqlite_state.holder_id()
+    conn = connect()
+    try:
+        def take() -> float:
+            now = time.time()
+            conn.execute("DELETE FROM rate_inflight WHERE carrier = ? AND started < ?", (carrier, now - slot_sec()))
+            # a mesma aba nao segura duas vagas (busca anterior sem finish)
+            conn.execute(
+                "DELETE FROM rate_inflight WHERE carrier = ? AND holder = ? AND slot = ?", (carrier, holder, str(slot))
+            )
+            state = _load_state(conn, carrier, now)
+            active = conn.execute("SELECT COUNT(*) AS n FROM rate_inflight WHERE carrier = ?", (carrier,)).fetchone()["n"]
+            if active >= state["concurrency"]:
+                wait = SLOT_POLL_SEC
+            elif state["tokens"] < 1:
+                wait = (1 - state["tokens"]) * 60 / state["per_min"]
+            else:
+                wait = 0.0
+                state["tokens"] -= 1
+                conn.execute(
+                    "INSERT INTO rate_inflight (carrier, holder, slot, started) VALUES (?, ?, ?, ?)",
+                    (carrier, holder, str(slot), now),
+                )
+            _save_state(conn, state)
+            return wait
+
+        return sqlite_state.transaction(conn, take)
+    finally:
+        conn.close()
+
+
+def wait_start(carrier: str, slot, log_fn: Callable[[str], None] = print, holder: Optional[str] = None) -> float:
+    """Bloqueia ate poder comecar a busca; devolve os segundos esperados."""
+    waited = 0.0
+    logged = False
+    while True:
+        wait = try_start(carrier, slot, holder=holder)
+        if wait <= 0:
+            return waited
+        if not logged and wait >= 5:
+            log_fn(f"[ritmo] {carrier}: aguardando vaga/token ({wait:.0f}s).")
+            logged = True
+        time.sleep(min(wait, 5.0))
+        waited += min(wait, 5.0)
+
+
+def cancel(carrier: str, slot, holder: Optional[str] = None) -> None:
+    """Devolve vaga e token de uma busca que nao aconteceu (ex.: fila vazia)."""
+    holder = holder or sqlite_state.holder_id()
+    conn = connect()
+    try:
+        def give_back() -> None:
+            cur = conn.execute(
+                "DELETE FROM rate_inflight WHERE carrier = ? AND holder = ? AND slot = ?", (carrier, holder, str(slot))
+            )
+            if cur.rowcount:
+                state = _load_state(conn, carrier, time.time())
+                state["tokens"] = min(burst(), state["tokens"] + 1)
+                _save_state(conn, state)
+
+        sqlite_state.transaction(conn, give_back)
+    finally:
+        conn.close()
+
+
+def release_holder(carrier: str, holder: Optional[str] = None) -> None:
+    """Solta as vagas que o processo ainda segura (fim do batch, inclusive com erro)."""
+    conn = connect()
+    try:
+        conn.execute("DELETE FROM rate_inflight WHERE carrier = ? AND holder = ?", (carrier, holder or sqlite_state.holder_id()))
+    finally:
+        conn.close()
+
+
+def _decide(state: dict) -> Optional[tuple]:
+    """AIMD sobre a janela; devolve (acao, motivo) ou None se a janela nao fechou."""
+    n = state["win_n"]
+    pressure_limit = max(1, math.ceil(window() * float(os.getenv("RATE_CONTROL_PRESSURE_RATE", "0.25"))))
+    if state["win_pressure"] >= pressure_limit:
+        reason = f"{state['win_pressure']} sinais de pressao em {n} buscas"
+        decrease = min(0.9, max(0.1, float(os.getenv("RATE_CONTROL_DECREASE", "0.5"))))
+        if state["concurrency"] > 1:
+            state["concurrency"] = max(1, int(state["concurrency"] * decrease))
+        else:
+            state["per_min"] = max(min_per_min(state["carrier"]), state["per_min"] * decrease)
+        return "corte", reason
+    if n < window():
+        return None
+
+    avg_latency = state["win_latency"] / n
+    ref = state["latency_ref"]
+    success_rate = state["win_ok"] / n
+    factor = float(os.getenv("RATE_CONTROL_LATENCY_FACTOR", "1.5"))
+    min_success = float(os.getenv("RATE_CONTROL_MIN_SUCCESS", "0.8"))
+    # referencia = menor media recente (sobe devagar para nao travar num valor atipico)
+    state["latency_ref"] = avg_latency if ref is None else min(avg_latency, ref * 1.1)
+    summary = f"sucesso {success_rate:.0%}, latencia media {avg_latency:.1f}s (ref {state['latency_ref']:.1f}s)"
+    if success_rate < min_success:
+        return "mantem", summary
+    if ref is not None and avg_latency > ref * factor:
+        return "mantem", summary
+    top = max_per_min(state["carrier"])
+    if state["per_min"] < top:
+        state["per_min"] = min(top, state["per_min"] + max(1.0, top / 4))
+        return "aumento", summary
+    if state["concurrency"] < max_concurrency():
+        state["concurrency"] += 1
+        return "aumento", summary
+    return "teto", summary
+
+
+def finish(carrier: str, slot, status: str, latency_sec: float, pressure: bool = False,
+           log_fn: Callable[[str], None] = print, holder: Optional[str] = None) -> Optional[str]:
+    """
+    Libera a vaga e soma o resultado na janela. `pressure`: a busca viu Security
+    Check/Retry/timeout. Devolve a acao quando a janela gerou decisao.
+    """
+    holder = holder or sqlite_state.holder_id()
+    conn = connect()
+    try:
+        def update():
+            now = time.time()
+            conn.execute(
+                "DELETE FROM rate_inflight WHERE carrier = ? AND holder = ? AND slot = ?", (carrier, holder, str(slot))
+            )
+            state = _load_state(conn, carrier, now)
+            counted = pressure
+            if state["hold"] > 0:
+                # busca iniciada antes do ultimo corte: a pressao dela ja foi respondida
+                state["hold"] -= 1
+                counted = False
+            state["win_n"] += 1
+            state["win_ok"] += 1 if status in OK_STATUSES else 0
+            state["win_pressure"] += 1 if counted else 0
+            state["win_latency"] += max(0.0, float(latency_sec or 0.0))
+            before = (state["concurrency"], state["per_min"])
+            decision = _decide(state)
+            if decision is not None:
+                state.update(win_n=0, win_ok=0, win_pressure=0, win_latency=0.0)
+                if decision[0] == "corte":
+                    state["hold"] = conn.execute(
+                        "SELECT COUNT(*) AS n FROM rate_inflight WHERE carrier = ?", (carrier,)
+                    ).fetchone()["n"]
+            if decision is not None and decision[0] != "teto":
+                conn.execute(
+                    "INSERT INTO rate_decisions (at, carrier, action, concurrency, per_min, reason) VALUES (?, ?, ?, ?, ?, ?)",
+                    (now_iso(), carrier, decision[0], state["concurrency"], state["per_min"], decision[1]),
+                )
+            _save_state(conn, state)
+            return decision, before, (state["concurrency"], state["per_min"])
+
+        decision, before, after = sqlite_state.transaction(conn, update)
+    finally:
+        conn.close()
+    if decision is None or decision[0] == "teto":
+        return None
+    action, reason = decision
+    log_fn(
+        f"[ritmo] {carrier}: {action} -> concorrencia {before[0]}->{after[0]}, "
+        f"buscas/min {before[1]:.1f}->{after[1]:.1f} ({reason})."
+    )
+    return action
+
+
+def describe(carrier: str) -> str:
+    """Linha de log com o ponto de partida do controlador no batch."""
+    conn = connect()
+    try:
+        state = _load_state(conn, carrier, time.time())
+    finally:
+        conn.close()
+    return (
+        f"[ritmo] {carrier}: controle adaptativo ativo; concorrencia {state['concurrency']} "
+        f"(max {max_concurrency()}), {state['per_min']:.1f} buscas/min (teto {max_per_min(carrier):.1f})."
+    )
+
+
+def current_concurrency(carrier: str) -> int:
+    """Concorrencia em vigor do carrier (ponto de partida do proximo batch)."""
+    conn = connect()
+    try:
+        return int(_load_state(conn, carrier, time.time())["concurrency"])
+    finally:
+        conn.close()
+
+
+def control_status(carrier: Optional[str] = None, decisions: int = 10) -> Dict[str, List[dict]]:
+    path = db_path()
+    if not path.exists():
+        return {"state": [], "decisions": []}
+    conn = connect(path)
+    try:
+        where, params = ("WHERE carrier = ?", (carrier,)) if carrier else ("", ())
+        states = [dict(r) for r in conn.execute(f"SELECT * FROM rate_state {where} ORDER BY carrier", params)]
+        for state in states:
+            state["inflight"] = conn.execute(
+                "SELECT COUNT(*) AS n FROM rate_inflight WHERE carrier = ? AND started >= ?",
+                (state["carrier"], time.time() - slot_sec()),
+            ).fetchone()["n"]
+        rows = conn.execute(
+            f"SELECT * FROM rate_decisions {where} ORDER BY rowid DESC LIMIT ?", params + (decisions,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return {"state": states, "decisions": [dict(r) for r in reversed(rows)]}
+
+
+def reset(carrier: str) -> None:
+    conn = connect()
+    try:
+        conn.execute("DELETE FROM rate_state WHERE carrier = ?", (carrier,))
+        conn.execute("DELETE FROM rate_inflight WHERE carrier = ?", (carrier,))
+    finally:
+        conn.close()
+
+
+def _print_table(headers: List[str], rows: List[List[str]]) -> None:
+    widths = [len(h) for h in headers]
+    for row in rows:
+        widths = [max(w, len(v)) for w, v in zip(widths, row)]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def cmd_status(args: argparse.Namespace) -> None:
+    status = control_status(args.carrier, decisions=args.decisions)
+    if not status["state"]:
+        print("(sem dados)")
+        return
+    _print_table(
+        ["carrier", "concorrencia", "em_curso", "buscas/min", "janela", "ref_latencia", "atualizado"],
+        [
+            [
+                s["carrier"], str(s["concurrency"]), str(s["inflight"]), f"{s['per_min']:.1f}",
+                f"{s['win_n']}/{window()}", f"{s['latency_ref']:.1f}s" if s["latency_ref"] is not None else "-",
+                s["updated_at"] or "-",
+            ]
+            for s in status["state"]
+        ],
+    )
+    if status["decisions"]:
+        print()
+        _print_table(
+            ["quando", "carrier", "acao", "concorrencia", "buscas/min", "motivo"],
+            [
+                [d["at"], d["carrier"], d["action"], str(d["concurrency"]), f"{d['per_min']:.1f}", d["reason"] or "-"]
+                for d in status["decisions"]
+            ],
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Estado e decisoes do controle adaptativo de ritmo dos scrapers.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("status", help="Concorrencia, ritmo e ultimas decisoes por carrier.")
+    p.add_argument("--carrier", default=None)
+    p.add_argument("--decisions", type=int, default=10, help="Quantas decisoes recentes mostrar.")
+
+    p = sub.add_parser("reset", help="Volta o carrier para RATE_CONTROL_START e o ritmo maximo.")
+    p.add_argument("--carrier", required=True)
+
+    args = parser.parse_args()
+    if args.cmd == "status":
+        cmd_status(args)
+        return 0
+    reset(args.carrier)
+    print(f"[ritmo] {args.carrier}: estado reiniciado.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,378 @@
+"""
+Modo continuo de atualizacao: recota as rotas conforme a cotacao envelhece, em
+vez de um unico burst diario.
+
+A cada ciclo (`REFRESH_POLL_MIN`), para cada scraper:
+- idade da rota (XLSX de jobs) = agora - `quoted_at` do ultimo sucesso no
+  breakdown; rota nunca cotada conta como vencida;
+- a rota vence com idade >= `REFRESH_MAX_STALE_HOURS - REFRESH_LEAD_HOURS`;
+  rota tentada ha menos de `REFRESH_RETRY_MIN` espera (nao insiste em erro);
+- as mais velhas entram no batch, ate `REFRESH_BATCH_SIZE` e ate o limite de
+  `REFRESH_MAX_ROUTES_PER_HOUR` por carrier (janela movel de 1h).
+
+O batch roda pelo grafo do runner diario (admissao por memoria, progresso,
+metricas, historico, last-good) so com os scrapers que tem rotas vencidas, cada
+um restrito as rotas escolhidas (`SCRAPER_ROUTES_FILE`): a sessao de browser
+dura so o batch. Em seguida prefetch, comparacao e upload publicam a planilha.
+Sem rota vencida nao ha batch.
+
+Estado (idade maxima por carrier, rotas vencidas, ultimo batch) em
+`artifacts/runtime/refresh_daemon.json`. Rota acima de `REFRESH_MAX_STALE_HOURS`
+gera ALERTA no log; taxa insuficiente para a meta gera aviso ao iniciar.
+
+Uso:
+  python src/orchestration/refresh_daemon.py
+  python src/orchestration/refresh_daemon.py --once --dry-run
+  python src/orchestration/refresh_daemon.py --stop-file artifacts/runtime/refresh.stop
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+import run_history
+from daily_pipeline_runner import (
+    LOG_DIR,
+    RUNTIME_DIR,
+    STAGES,
+    STATUS_DEGRADED,
+    STATUS_FAILED,
+    STATUS_SKIPPED,
+    USABLE_STATUSES,
+    artifact_is_usable,
+    build_run_id,
+    cleanup_old_logs,
+    log,
+    run_stage_graph,
+)
+
+SCRAPERS = ("hapag", "maersk")
+PUBLISH_STAGES = ("prefetch", "comparison", "upload")
+STATE_FILE = RUNTIME_DIR / "refresh_daemon.json"
+ROUTES_DIR = RUNTIME_DIR / "refresh"
+RATE_WINDOW_SEC = 3600.0
+
+
+def refresh_settings() -> dict:
+    max_stale_hours = float(os.getenv("REFRESH_MAX_STALE_HOURS", "12"))
+    lead_hours = min(max_stale_hours, float(os.getenv("REFRESH_LEAD_HOURS", "3")))
+    return {
+        "max_stale_hours": max_stale_hours,
+        "due_after_hours": max(0.0, max_stale_hours - lead_hours),
+        "batch_size": max(1, int(os.getenv("REFRESH_BATCH_SIZE", "10"))),
+        "max_per_hour": max(1, int(os.getenv("REFRESH_MAX_ROUTES_PER_HOUR", "30"))),
+        "retry_min": float(os.getenv("REFRESH_RETRY_MIN", "30")),
+        "poll_sec": max(10.0, float(os.getenv("REFRESH_POLL_MIN", "5")) * 60),
+    }
+
+
+def _parse_ts(value) -> Optional[datetime]:
+    ts = pd.to_datetime(value, errors="coerce")
+    if pd.isna(ts):
+        return None
+    dt = ts.to_pydatetime()
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def read_job_routes(xlsx_path: Path) -> List[tuple]:
+    """(origem, destino) unicos do XLSX de jobs, na ordem do arquivo."""
+    df = pd.read_excel(xlsx_path)
+    col_o = next((c for c in df.columns if str(c).strip().lower() in {"origem", "origin"}), None)
+    col_d = next(
+        (c for c in df.columns if str(c).strip().lower() in {"porto de destino", "destino", "destination"}),
+        None,
+    )
+    if col_o is None or col_d is None:
+        raise ValueError(f"{xlsx_path.name}: colunas ORIGEM/PORTO DE DESTINO nao encontradas.")
+    routes: List[tuple] = []
+    seen = set()
+    for origin, destination in zip(df[col_o], df[col_d]):
+        if pd.isna(origin) or pd.isna(destination):
+            continue
+        route = (str(origin).strip(), str(destination).strip())
+        if route[0] and route[1] and route not in seen:
+            seen.add(route)
+            routes.append(route)
+    return routes
+
+
+def read_quote_times(csv_path: Path) -> Dict[tuple, dict]:
+    """`quoted_at`/`last_attempt_at` por (origem, destino) do breakdown do scraper."""
+    if not artifact_is_usable(csv_path):
+        return {}
+    try:
+        df = pd.read_csv(csv_path, usecols=lambda c: c in {"origin", "destination", "quoted_at", "last_attempt_at"})
+    except Exception:
+        return {}
+    if "origin" not in df.columns or "destination" not in df.columns:
+        return {}
+    out: Dict[tuple, dict] = {}
+    for record in df.to_dict("records"):
+        route = (str(record.get("origin")).strip(), str(record.get("destination")).strip())
+        out[route] = {
+            "quoted_at": _parse_ts(record.get("quoted_at")),
+            "last_attempt_at": _parse_ts(record.get("last_attempt_at")),
+        }
+    return out
+
+
+def route_ages(carrier: str, now: datetime) -> List[dict]:
+    spec = STAGES[carrier]
+    times = read_quote_times(spec["outputs"][0])
+    routes = []
+    for origin, destination in read_job_routes(spec["inputs"][0]):
+        info = times.get((origin, destination), {})
+        quoted_at = info.get("quoted_at")
+        routes.append(
+            {
+                "origin": origin,
+                "destination": destination,
+                "age_hours": None if quoted_at is None else (now - quoted_at).total_seconds() / 3600,
+                "last_attempt_at": info.get("last_attempt_at"),
+            }
+        )
+    return routes
+
+
+def select_due(routes: List[dict], settings: dict, allowance: int, now: datetime) -> List[dict]:
+    """Rotas vencidas, mais velhas primeiro (nunca cotadas na frente), ate `allowance`."""
+    due = []
+    for route in routes:
+        age = route["age_hours"]
+        if age is not None and age < settings["due_after_hours"]:
+            continue
+        last_attempt = route["last_attempt_at"]
+        if last_attempt is not None and (now - last_attempt).total_seconds() < settings["retry_min"] * 60:
+            continue
+        due.append(route)
+    due.sort(key=lambda r: -(r["age_hours"] if r["age_hours"] is not None else float("inf")))
+    return due[: max(0, allowance)]
+
+
+def staleness_summary(routes: List[dict], settings: dict) -> dict:
+    ages = [r["age_hours"] for r in routes if r["age_hours"] is not None]
+    return {
+        "routes": len(routes),
+        "never_quoted": sum(1 for r in routes if r["age_hours"] is None),
+        "max_age_hours": round(max(ages), 2) if ages else None,
+        "over_target": sum(1 for r in routes if r["age_hours"] is None or r["age_hours"] > settings["max_stale_hours"]),
+        "due": sum(1 for r in routes if r["age_hours"] is None or r["age_hours"] >= settings["due_after_hours"]),
+    }
+
+
+def build_batch_stages(route_files: Dict[str, Path]) -> Dict[str, dict]:
+    """Grafo do runner reduzido aos scrapers do batch, cada um restrito as suas rotas."""
+    stages: Dict[str, dict] = {}
+    for carrier, routes_file in route_files.items():
+        spec = dict(STAGES[carrier])
+        # o batch ja foi escolhido por idade: sem planejamento por deadline aqui
+        spec["env"] = {**spec.get("env", {}), "SCRAPER_ROUTES_FILE": str(routes_file), "PIPELINE_DEADLINE": ""}
+        stages[carrier] = spec
+    for name in PUBLISH_STAGES:
+        spec = dict(STAGES[name])
+        spec["depends_on"] = [d for d in spec.get("depends_on", []) if d in stages]
+        stages[name] = spec
+    return stages
+
+
+def write_state(state: dict) -> None:
+    STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = STATE_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+    os.replace(tmp, STATE_FILE)
+
+
+def check_capacity(settings: dict, summary_log: Path) -> None:
+    """Avisa quando a taxa configurada nao sustenta a meta de idade maxima."""
+    window_hours = max(0.1, settings["due_after_hours"] or settings["max_stale_hours"])
+    for carrier in SCRAPERS:
+        try:
+            total = len(read_job_routes(STAGES[carrier]["inputs"][0]))
+        except Exception as e:
+            log(f"[refresh] aviso: nao consegui ler os jobs de {carrier}: {e}", summary_log)
+            continue
+        needed = total / window_hours
+        line = (
+            f"[refresh] {carrier}: {total} rotas, necessario ~{needed:.1f} rotas/h para "
+            f"idade maxima de {settings['max_stale_hours']:g}h; limite {settings['max_per_hour']}/h."
+        )
+        if needed > settings["max_per_hour"]:
+            line += " AVISO: limite abaixo do necessario, a meta nao sera cumprida."
+        log(line, summary_log)
+
+
+def run_batch(route_files: Dict[str, Path], run_id: str, summary_log: Path, execution_mode: str) -> str:
+    """Executa o batch pelo grafo do runner e devolve o status do run (ok/degraded/failed)."""
+    stages = build_batch_stages(route_files)
+    run_history.record_run_start(
+        run_id,
+        options={"mode": "refresh", "routes": {c: str(p) for c, p in route_files.items()}},
+    )
+    statuses = run_stage_graph(
+        summary_log=summary_log,
+        run_id=run_id,
+        stages=stages,
+        execution_mode=execution_mode,
+    )
+    log(f"[refresh] {run_id}: status das etapas {statuses}", summary_log)
+    comparison_csv = STAGES["comparison"]["outputs"][0]
+    if statuses.get("comparison") in USABLE_STATUSES and artifact_is_usable(comparison_csv):
+        run_history.record_route_winners(run_id, comparison_csv)
+
+    if any(v in {STATUS_FAILED, STATUS_SKIPPED} and not stages[k].get("optional") for k, v in statuses.items()):
+        status, exit_code = "failed", 1
+    elif any(v == STATUS_DEGRADED for v in statuses.values()):
+        status, exit_code = "degraded", 0
+    else:
+        status, exit_code = "ok", 0
+    run_history.record_run_end(run_id, status, exit_code)
+    return status
+
+
+def run_cycle(settings: dict, launched: Dict[str, List[float]], state: dict, summary_log: Path,
+              dry_run: bool, execution_mode: str) -> None:
+    now = datetime.now()
+    mono = time.monotonic()
+    route_files: Dict[str, Path] = {}
+    run_id = f"refresh_{build_run_id()}"
+
+    for carrier in SCRAPERS:
+        try:
+            routes = route_ages(carrier, now)
+        except Exception as e:
+            log(f"[refresh] {carrier}: falha ao calcular idade das rotas: {e!r}", summary_log)
+            continue
+
+        summary = staleness_summary(routes, settings)
+        launched[carrier] = [t for t in launched.get(carrier, []) if mono - t < RATE_WINDOW_SEC]
+        allowance = min(settings["batch_size"], settings["max_per_hour"] - len(launched[carrier]))
+        batch = select_due(routes, settings, allowance, now)
+        summary["batch"] = len(batch)
+        state["carriers"][carrier] = summary
+
+        max_age = summary["max_age_hours"]
+        log(
+            f"[refresh] {carrier}: rotas={summary['routes']} vencidas={summary['due']} "
+            f"idade_max={'n/a' if max_age is None else f'{max_age:.1f}h'} "
+            f"nunca_cotadas={summary['never_quoted']} batch={len(batch)} "
+            f"(limite restante na hora={max(0, settings['max_per_hour'] - len(launched[carrier]))})",
+            summary_log,
+        )
+        if summary["over_target"]:
+            log(
+                f"[refresh] ALERTA: {carrier} tem {summary['over_target']} rota(s) sem cotacao "
+                f"ha mais de {settings['max_stale_hours']:g}h.",
+                summary_log,
+            )
+        if not batch:
+            continue
+
+        routes_file = ROUTES_DIR / f"{run_id}_{carrier}_routes.json"
+        route_files[carrier] = routes_file
+        if dry_run:
+            continue
+        routes_file.parent.mkdir(parents=True, exist_ok=True)
+        routes_file.write_text(
+            json.dumps([{"origin": r["origin"], "destination": r["destination"]} for r in batch], ensure_ascii=False),
+            encoding="utf-8",
+        )
+        launched[carrier].extend([mono] * len(batch))
+
+    state["last_cycle_at"] = now.isoformat(timespec="seconds")
+    if not route_files:
+        log("[refresh] nenhuma rota vencida; sem batch neste ciclo.", summary_log)
+    elif dry_run:
+        log(f"[refresh] dry-run: batch {run_id} nao executado ({', '.join(route_files)}).", summary_log)
+    else:
+        started = time.monotonic()
+        status = run_batch(route_files, run_id, summary_log, execution_mode)
+        state["last_batch"] = {
+            "run_id": run_id,
+            "carriers": sorted(route_files),
+            "status": status,
+            "wall_sec": round(time.monotonic() - started, 1),
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        for routes_file in route_files.values():
+            routes_file.unlink(missing_ok=True)
+    state["heartbeat_at"] = datetime.now().isoformat(timespec="seconds")
+    write_state(state)
+
+
+def _sleep_until_next_cycle(poll_sec: float, stop_file: Optional[Path]) -> bool:
+    """Dorme ate o proximo ciclo; retorna False se pediram parada."""
+    deadline = time.monotonic() + poll_sec
+    while time.monotonic() < deadline:
+        if stop_file is not None and stop_file.exists():
+            return False
+        time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+    return not (stop_file is not None and stop_file.exists())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Atualizacao continua das cotacoes por idade.")
+    parser.add_argument("--once", action="store_true", help="Executa um unico ciclo e sai.")
+    parser.add_argument("--dry-run", action="store_true", help="So mostra idades e batches, sem rodar scrapers.")
+    parser.add_argument("--stop-file", default=None, help="Encerra o daemon quando este arquivo existir.")
+    parser.add_argument(
+        "--execution-mode",
+        choices=("subprocess", "worker"),
+        default=(os.getenv("PIPELINE_EXECUTION_MODE") or "subprocess").strip().lower(),
+        help="Como o runner executa as etapas in_process do batch.",
+    )
+    args = parser.parse_args()
+
+    settings = refresh_settings()
+    stop_file = Path(args.stop_file) if args.stop_file else None
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    log_day = datetime.now().strftime("%Y%m%d")
+    summary_log = LOG_DIR / f"refresh_{log_day}_daemon.log"
+    keep_days = int(os.getenv("LOG_RETENTION_DAYS", "14"))
+
+    log(
+        f"[refresh] iniciado (idade maxima={settings['max_stale_hours']:g}h, vence com "
+        f"{settings['due_after_hours']:g}h, batch={settings['batch_size']}, "
+        f"limite={settings['max_per_hour']} rotas/h por carrier, ciclo={settings['poll_sec'] / 60:g}min).",
+        summary_log,
+    )
+    cleanup_old_logs(summary_log, keep_days=keep_days)
+    check_capacity(settings, summary_log)
+
+    state = {
+        "pid": os.getpid(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "settings": settings,
+        "carriers": {},
+        "last_batch": None,
+    }
+    launched: Dict[str, List[float]] = {}
+    try:
+        while True:
+            today = datetime.now().strftime("%Y%m%d")
+            if today != log_day:
+                log_day = today
+                summary_log = LOG_DIR / f"refresh_{log_day}_daemon.log"
+                cleanup_old_logs(summary_log, keep_days=keep_days)
+            run_cycle(settings, launched, state, summary_log, args.dry_run, args.execution_mode)
+            if args.once:
+                break
+            if not _sleep_until_next_cycle(settings["poll_sec"], stop_file):
+                log("[refresh] stop file encontrado; encerrando.", summary_log)
+                break
+    except KeyboardInterrupt:
+        log("[refresh] interrompido; encerrando.", summary_log)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,649 @@
+"""
+Historico de execucoes do pipeline em SQLite (WAL).
+
+Quem grava:
+- runner: inicio/fim do run, duracao/CPU/RSS/status de cada etapa e o carrier
+  vencedor por rota (lido de `comparacao_carriers.csv`);
+- scrapers: uma linha por rota processada (status, latencia, retries, mensagem).
+
+Os logs `.log` continuam com retencao (`LOG_RETENTION_DAYS`); o banco fica em
+`artifacts/runtime/run_history.sqlite` (ou `RUN_HISTORY_DB`) e nao e limpo.
+Gravacao e best-effort: erro no historico nunca derruba etapa/scraper.
+
+CLI (tendencias):
+  python src/orchestration/run_history.py runs
+  python src/orchestration/run_history.py routes --carrier maersk --last-runs 10
+  python src/orchestration/run_history.py slowest --run latest
+  python src/orchestration/run_history.py regressions
+  python src/orchestration/run_history.py winners --last-runs 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import socket
+import sqlite3
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import sqlite_state
+from sqlite_state import parse_env_bool
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+DEFAULT_DB_PATH = PROJECT_ROOT / "artifacts" / "runtime" / "run_history.sqlite"
+BUSY_TIMEOUT_MS = 10000
+
+SUCCESS_STATUSES = {"ok", "success"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started_at TEXT,
+    finished_at TEXT,
+    status TEXT,
+    exit_code INTEGER,
+    host TEXT,
+    options TEXT
+);
+CREATE TABLE IF NOT EXISTS stage_runs (
+    run_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    wall_sec REAL,
+    cpu_sec REAL,
+    peak_rss_mb REAL,
+    status TEXT,
+    exit_code INTEGER,
+    execution TEXT,
+    PRIMARY KEY (run_id, stage)
+);
+CREATE TABLE IF NOT EXISTS route_attempts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    stage TEXT,
+    carrier TEXT NOT NULL,
+    route_key TEXT NOT NULL,
+    origin TEXT,
+    destination TEXT,
+    status TEXT,
+    latency_sec REAL,
+    retries INTEGER,
+    message TEXT,
+    started_at TEXT,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_route_attempts_route ON route_attempts (carrier, route_key);
+CREATE INDEX IF NOT EXISTS idx_route_attempts_run ON route_attempts (run_id);
+CREATE TABLE IF NOT EXISTS route_winners (
+    run_id TEXT NOT NULL,
+    route_key TEXT NOT NULL,
+    indexador TEXT,
+    best_carrier TEXT,
+    best_price REAL,
+    PRIMARY KEY (run_id, route_key)
+);
+"""
+
+
+def history_enabled() -> bool:
+    return parse_env_bool("RUN_HISTORY_ENABLED", default=True)
+
+
+def db_path() -> Path:
+    return sqlite_state.env_path("RUN_HISTORY_DB", DEFAULT_DB_PATH)
+
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def connect(path: Optional[Path] = None) -> sqlite3.Connection:
+    return sqlite_state.connect(path or db_path(), SCHEMA, autocommit=False, busy_timeout_ms=BUSY_TIMEOUT_MS)
+
+
+@contextmanager
+def _writer():
+    """Conexao curta para gravacao: commit no fim e fecha (varios processos gravam juntos)."""
+    conn = connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+_warned = False
+
+
+def _best_effort(fn, *args, **kwargs) -> bool:
+    """Executa uma gravacao; falhas viram um aviso unico em stderr."""
+    global _warned
+    if not history_enabled():
+        return False
+    try:
+        fn(*args, **kwargs)
+        return True
+    except Exception as e:
+        if not _warned:
+            print(f"[history] aviso: falha ao gravar historico em {db_path()}: {e!r}", file=sys.stderr, flush=True)
+            _warned = True
+        return False
+
+
+def _record_run_start(run_id: str, options: Optional[dict]) -> None:
+    with _writer() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO runs (run_id, started_at, host, options) VALUES (?, ?, ?, ?)",
+            (run_id, now_iso(), socket.gethostname(), json.dumps(options or {}, ensure_ascii=False)),
+        )
+
+
+def record_run_start(run_id: str, options: Optional[dict] = None) -> bool:
+    return _best_effort(_record_run_start, run_id, options)
+
+
+def _record_run_end(run_id: str, status: str, exit_code: int) -> None:
+    with _writer() as conn:
+        conn.execute(
+            "UPDATE runs SET finished_at = ?, status = ?, exit_code = ? WHERE run_id = ?",
+            (now_iso(), status, int(exit_code), run_id),
+        )
+
+
+def record_run_end(run_id: str, status: str, exit_code: int) -> bool:
+    return _best_effort(_record_run_end, run_id, status, exit_code)
+
+
+def _record_stage(run_id: str, metrics: dict) -> None:
+    with _writer() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO stage_runs
+                (run_id, stage, started_at, finished_at, wall_sec, cpu_sec, peak_rss_mb, status, exit_code, execution)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                run_id,
+                metrics.get("stage"),
+                metrics.get("started_at"),
+                metrics.get("finished_at"),
+                metrics.get("wall_sec"),
+                metrics.get("cpu_sec"),
+                metrics.get("peak_rss_mb"),
+                metrics.get("status"),
+                metrics.get("exit_code"),
+                metrics.get("execution", "subprocess"),
+            ),
+        )
+
+
+def record_stage(run_id: str, metrics: dict) -> bool:
+    """Grava uma etapa a partir do dict de stage_metrics (finalizado)."""
+    return _best_effort(_record_stage, run_id, metrics)
+
+
+def _record_route_attempt(
+    run_id: str,
+    carrier: str,
+    route_key: str,
+    origin: str,
+    destination: str,
+    status: str,
+    latency_sec: Optional[float],
+    retries: Optional[int],
+    message: str,
+    started_at: Optional[str],
+    stage: Optional[str],
+) -> None:
+    with _writer() as conn:
+        conn.execute(
+            """
+            INSERT INTO route_attempts
+                (run_id, stage, carrier, route_key, origin, destination, status,
+                 latency_sec, retries, message, started_at, finished_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                run_id,
+                stage,
+                carrier,
+                route_key,
+                origin,
+                destination,
+                status,
+                None if latency_sec is None else round(float(latency_sec), 3),
+                retries,
+                (message or "")[:500],
+                started_at,
+                now_iso(),
+            ),
+        )
+
+
+def record_route_attempt(
+    carrier: str,
+    route_key: str,
+    origin: str,
+    destination: str,
+    status: str,
+    latency_sec: Optional[float] = None,
+    retries: Optional[int] = None,
+    message: str = "",
+    started_at: Optional[str] = None,
+) -> bool:
+    """
+    Chamado pelos scrapers ao fim de cada rota. run_id/etapa vem das envs do
+    runner (RUN_ID/PIPELINE_STAGE); execucao avulsa grava como `manual_<data>`.
+    """
+    run_id = (os.getenv("RUN_ID") or "").strip() or f"manual_{datetime.now():%Y%m%d}"
+    stage = (os.getenv("PIPELINE_STAGE") or "").strip() or None
+    return _best_effort(
+        _record_route_attempt,
+        run_id,
+        carrier,
+        route_key,
+        origin,
+        destination,
+        status,
+        latency_sec,
+        retries,
+        message,
+        started_at,
+        stage,
+    )
+
+
+def _parse_decimal(value: str) -> Optional[float]:
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return float(value.replace(".", "").replace(",", ".")) if "," in value else float(value)
+    except ValueError:
+        return None
+
+
+def _record_route_winners(run_id: str, comparison_csv: Path) -> None:
+    rows = []
+    with comparison_csv.open("r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f, delimiter=";"):
+            key = (row.get("key") or "").strip()
+            if not key:
+                continue
+            rows.append(
+                (
+                    run_id,
+                    key,
+                    (row.get("indexador") or "").strip(),
+                    (row.get("best_carrier") or "").strip() or None,
+                    _parse_decimal(row.get("best_price", "")),
+                )
+            )
+    with _writer() as conn:
+        conn.execute("DELETE FROM route_winners WHERE run_id = ?", (run_id,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO route_winners (run_id, route_key, indexador, best_carrier, best_price) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+def record_route_winners(run_id: str, comparison_csv: Path) -> bool:
+    """Le o CSV da comparacao (sep `;`, decimal `,`) e grava o vencedor de cada rota."""
+    return _best_effort(_record_route_winners, run_id, comparison_csv)
+
+
+# ----------------------------------------------------------------------
+# Consultas (CLI)
+# ----------------------------------------------------------------------
+def recent_peak_rss_mb(stage: str, limit: int = 5) -> List[float]:
+    """
+    Picos de RSS (MB) das ultimas execucoes reais da etapa e dos seus shards
+    (`<etapa>_s<i>`), mais recentes primeiro. Sem historico, devolve lista vazia.
+    """
+    path = db_path()
+    if not history_enabled() or not path.exists():
+        return []
+    try:
+        conn = connect(path)
+        try:
+            rows = conn.execute(
+                """
+                SELECT peak_rss_mb FROM stage_runs
+                WHERE (stage = ? OR stage GLOB ?)
+                  AND peak_rss_mb > 0
+                  AND COALESCE(execution, 'subprocess') != 'cache'
+                ORDER BY started_at DESC
+                LIMIT ?
+                """,
+                (stage, f"{stage}_s[0-9]*", limit),
+            ).fetchall()
+        finally:
+            conn.close()
+    except Exception:
+        return []
+    return [float(r["peak_rss_mb"]) for r in rows]
+
+
+def recent_route_latencies(carrier: str, route_key: Optional[str] = None, limit: int = 20) -> List[float]:
+    """
+    Latencias (s) das ultimas tentativas concluidas (ok/success/no_quote) da rota,
+    ou do carrier inteiro sem `route_key`. Sem historico, devolve lista vazia.
+    """
+    path = db_path()
+    if not history_enabled() or not path.exists():
+        return []
+    where = "carrier = ? AND status IN ('ok', 'success', 'no_quote') AND latency_sec > 0"
+    params: list = [carrier]
+    if route_key is not None:
+        where += " AND route_key = ?"
+        params.append(route_key)
+    try:
+        conn = connect(path)
+        try:
+            rows = conn.execute(
+                f"SELECT latency_sec FROM route_attempts WHERE {where} ORDER BY id DESC LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+    except Exception:
+        return []
+    return [float(r["latency_sec"]) for r in rows]
+
+
+def recent_route_outcomes(carrier: str, per_route: int = 10, scan_limit: int = 5000) -> Dict[str, List[tuple]]:
+    """
+    (status, latency_sec) das ultimas tentativas de cada rota do carrier, mais
+    recentes primeiro; base do modelo de custo do agendador por deadline.
+    """
+    path = db_path()
+    if not history_enabled() or not path.exists():
+        return {}
+    try:
+        conn = connect(path)
+        try:
+            rows = conn.execute(
+                """
+                SELECT route_key, status, latency_sec FROM route_attempts
+                WHERE carrier = ?
+                ORDER BY id DESC
+                LIMIT ?
+                """,
+                (carrier, scan_limit),
+            ).fetchall()
+        finally:
+            conn.close()
+    except Exception:
+        return {}
+    out: Dict[str, List[tuple]] = {}
+    for r in rows:
+        attempts = out.setdefault(r["route_key"], [])
+        if len(attempts) < per_route:
+            attempts.append((r["status"], r["latency_sec"]))
+    return out
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil com interpolacao linear (mesma regra do numpy default)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    pos = (len(ordered) - 1) * pct / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def recent_run_ids(conn: sqlite3.Connection, limit: int, with_routes: bool = False) -> List[str]:
+    if with_routes:
+        rows = conn.execute(
+            "SELECT run_id, MIN(finished_at) AS first_at FROM route_attempts GROUP BY run_id ORDER BY first_at DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+    else:
+        rows = conn.execute("SELECT run_id FROM runs ORDER BY started_at DESC LIMIT ?", (limit,)).fetchall()
+    return [r["run_id"] for r in rows]
+
+
+def resolve_run(conn: sqlite3.Connection, run: Optional[str], offset: int = 0) -> Optional[str]:
+    if run and run != "latest":
+        return run
+    ids = recent_run_ids(conn, offset + 1, with_routes=True)
+    return ids[offset] if len(ids) > offset else None
+
+
+def _fmt(value, digits: int = 1) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.{digits}f}"
+    return str(value)
+
+
+def print_table(headers: List[str], rows: Iterable[Iterable]) -> None:
+    rows = [[_fmt(v) for v in row] for row in rows]
+    widths = [len(h) for h in headers]
+    for row in rows:
+        widths = [max(w, len(v)) for w, v in zip(widths, row)]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+    if not rows:
+        print("(sem dados)")
+
+
+def _route_filter(carrier: Optional[str], run_ids: Optional[List[str]]) -> tuple:
+    clauses, params = [], []
+    if carrier:
+        clauses.append("carrier = ?")
+        params.append(carrier)
+    if run_ids is not None:
+        clauses.append(f"run_id IN ({','.join('?' for _ in run_ids) or 'NULL'})")
+        params.extend(run_ids)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def cmd_runs(conn: sqlite3.Connection, args: argparse.Namespace) -> None:
+    runs = conn.execute(
+        "SELECT run_id, started_at, finished_at, status, exit_code FROM runs ORDER BY started_at DESC LIMIT ?",
+        (args.limit,),
+    ).fetchall()
+    rows = []
+    for run in runs:
+        stages = conn.execute(
+            "SELECT stage, wall_sec, status FROM stage_runs WHERE run_id = ? ORDER BY started_at",
+            (run["run_id"],),
+        ).fetchall()
+        wall = None
+        if run["started_at"] and run["finished_at"]:
+            wall = (
+                datetime.fromisoformat(run["finished_at"]) - datetime.fromisoformat(run["started_at"])
+            ).total_seconds()
+        stage_txt = " ".join(f"{s['stage']}={_fmt(s['wall_sec'], 0)}s/{s['status']}" for s in stages)
+        rows.append([run["run_id"], run["status"] or "em andamento", wall, stage_txt])
+    print_table(["run_id", "status", "wall_sec", "etapas"], rows)
+
+
+def cmd_routes(conn: sqlite3.Connection, args: argparse.Namespace) -> None:
+    run_ids = recent_run_ids(conn, args.last_runs, with_routes=True) if args.last_runs else None
+    where, params = _route_filter(args.carrier, run_ids)
+    data: Dict[tuple, dict] = {}
+    for row in conn.execute(
+        f"SELECT carrier, route_key, status, latency_sec, retries FROM route_attempts {where}", params
+    ):
+        item = data.setdefault((row["carrier"], row["route_key"]), {"lat": [], "ok": 0, "n": 0, "retries": 0})
+        item["n"] += 1
+        item["ok"] += 1 if row["status"] in SUCCESS_STATUSES else 0
+        item["retries"] += row["retries"] or 0
+        if row["latency_sec"] is not None:
+            item["lat"].append(row["latency_sec"])
+
+    rows = []
+    for (carrier, route_key), item in data.items():
+        rows.append(
+            [
+                carrier,
+                route_key,
+                item["n"],
+                100.0 * item["ok"] / item["n"],
+                percentile(item["lat"], 50),
+                percentile(item["lat"], 95),
+                sum(item["lat"]),
+                item["retries"],
+            ]
+        )
+    sort_index = {"p95": 5, "p50": 4, "total": 6, "sucesso": 3}[args.sort]
+    # sucesso: piores primeiro; latencias: mais lentas primeiro. Sem latencia vai pro fim.
+    sign = 1 if args.sort == "sucesso" else -1
+    rows.sort(key=lambda r: (r[sort_index] is None, sign * (r[sort_index] or 0)))
+    print_table(
+        ["carrier", "rota", "tentativas", "sucesso_%", "p50_s", "p95_s", "total_s", "retries"],
+        rows[: args.limit],
+    )
+
+
+def cmd_slowest(conn: sqlite3.Connection, args: argparse.Namespace) -> None:
+    run_id = resolve_run(conn, args.run)
+    if run_id is None:
+        print("(sem dados)")
+        return
+    where, params = _route_filter(args.carrier, [run_id])
+    rows = conn.execute(
+        f"""
+        SELECT carrier, route_key, status, latency_sec, retries, message
+        FROM route_attempts {where}
+        ORDER BY latency_sec DESC LIMIT ?
+        """,
+        [*params, args.limit],
+    ).fetchall()
+    total = conn.execute(
+        f"SELECT COUNT(*) AS n, SUM(latency_sec) AS s FROM route_attempts {where}", params
+    ).fetchone()
+    print(f"run_id={run_id} rotas={total['n']} tempo_total={_fmt(total['s'])}s")
+    print_table(
+        ["carrier", "rota", "status", "latencia_s", "retries", "mensagem"],
+        [[r["carrier"], r["route_key"], r["status"], r["latency_sec"], r["retries"], (r["message"] or "")[:60]] for r in rows],
+    )
+
+
+def _last_attempt_by_route(conn: sqlite3.Connection, run_id: str, carrier: Optional[str]) -> Dict[tuple, sqlite3.Row]:
+    where, params = _route_filter(carrier, [run_id])
+    out = {}
+    for row in conn.execute(
+        f"SELECT carrier, route_key, status, latency_sec FROM route_attempts {where} ORDER BY id", params
+    ):
+        out[(row["carrier"], row["route_key"])] = row
+    return out
+
+
+def cmd_regressions(conn: sqlite3.Connection, args: argparse.Namespace) -> None:
+    current = resolve_run(conn, args.run)
+    base = args.base or resolve_run(conn, None, offset=1 if not args.run or args.run == "latest" else 0)
+    if current is None or base is None or base == current:
+        print("Precisa de pelo menos dois runs com rotas registradas (use --base/--run).")
+        return
+
+    before = _last_attempt_by_route(conn, base, args.carrier)
+    after = _last_attempt_by_route(conn, current, args.carrier)
+    rows = []
+    for key, new in after.items():
+        old = before.get(key)
+        if old is None:
+            continue
+        old_ok = old["status"] in SUCCESS_STATUSES
+        new_ok = new["status"] in SUCCESS_STATUSES
+        if old_ok and not new_ok:
+            rows.append([key[0], key[1], "status", f"{old['status']} -> {new['status']}", old["latency_sec"], new["latency_sec"]])
+            continue
+        if old["latency_sec"] and new["latency_sec"]:
+            delta = new["latency_sec"] - old["latency_sec"]
+            if delta >= args.min_delta_sec and new["latency_sec"] >= old["latency_sec"] * args.ratio:
+                rows.append([key[0], key[1], "latencia", f"+{delta:.1f}s", old["latency_sec"], new["latency_sec"]])
+
+    winners_before = {
+        r["route_key"]: r["best_carrier"]
+        for r in conn.execute("SELECT route_key, best_carrier FROM route_winners WHERE run_id = ?", (base,))
+    }
+    for r in conn.execute("SELECT route_key, best_carrier FROM route_winners WHERE run_id = ?", (current,)):
+        old_winner = winners_before.get(r["route_key"])
+        if old_winner and r["best_carrier"] and old_winner != r["best_carrier"]:
+            rows.append(["-", r["route_key"], "vencedor", f"{old_winner} -> {r['best_carrier']}", None, None])
+
+    print(f"base={base} atual={current}")
+    print_table(["carrier", "rota", "tipo", "mudanca", "antes_s", "depois_s"], rows[: args.limit])
+
+
+def cmd_winners(conn: sqlite3.Connection, args: argparse.Namespace) -> None:
+    run_ids = recent_run_ids(conn, args.last_runs)
+    rows = []
+    for run_id in run_ids:
+        counts = conn.execute(
+            "SELECT COALESCE(best_carrier, '-') AS carrier, COUNT(*) AS n FROM route_winners WHERE run_id = ? GROUP BY carrier ORDER BY n DESC",
+            (run_id,),
+        ).fetchall()
+        rows.append([run_id, " ".join(f"{c['carrier']}={c['n']}" for c in counts)])
+    print_table(["run_id", "rotas vencidas por carrier"], rows)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Consulta o historico de runs (SQLite).")
+    parser.add_argument("--db", default=None, help="Caminho do banco (default RUN_HISTORY_DB ou artifacts/runtime).")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("runs", help="Ultimos runs com duracao por etapa.")
+    p.add_argument("--limit", type=int, default=10)
+
+    p = sub.add_parser("routes", help="p50/p95 de latencia e taxa de sucesso por rota.")
+    p.add_argument("--carrier", default=None)
+    p.add_argument("--last-runs", type=int, default=10, help="Janela de runs (0 = todos).")
+    p.add_argument("--sort", choices=["p95", "p50", "total", "sucesso"], default="p95")
+    p.add_argument("--limit", type=int, default=20)
+
+    p = sub.add_parser("slowest", help="Rotas mais lentas de um run.")
+    p.add_argument("--run", default="latest")
+    p.add_argument("--carrier", default=None)
+    p.add_argument("--limit", type=int, default=20)
+
+    p = sub.add_parser("regressions", help="Rotas que pioraram entre dois runs (status, latencia, vencedor).")
+    p.add_argument("--base", default=None, help="run_id de referencia (default: run anterior).")
+    p.add_argument("--run", default="latest")
+    p.add_argument("--carrier", default=None)
+    p.add_argument("--min-delta-sec", type=float, default=10.0)
+    p.add_argument("--ratio", type=float, default=1.5)
+    p.add_argument("--limit", type=int, default=50)
+
+    p = sub.add_parser("winners", help="Quantidade de rotas vencidas por carrier em cada run.")
+    p.add_argument("--last-runs", type=int, default=5)
+
+    args = parser.parse_args()
+    path = Path(args.db) if args.db else db_path()
+    if not path.exists():
+        print(f"Banco de historico nao encontrado: {path}")
+        return 1
+
+    conn = connect(path)
+    try:
+        {
+            "runs": cmd_runs,
+            "routes": cmd_routes,
+            "slowest": cmd_slowest,
+            "regressions": cmd_regressions,
+            "winners": cmd_winners,
+        }[args.command](conn, args)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,241 @@
+"""
+Run logs append-only (CSV) com rotacao por tamanho/idade e indice de resumo.
+
+Cada job acrescenta uma linha ao fim do arquivo (abre em modo append, escreve,
+fecha): custo constante, independente do historico acumulado. O cabecalho so
+e escrito quando o arquivo e novo (com BOM, como o `to_csv(utf-8-sig)` antigo).
+
+Rotacao (`rotate_if_needed`, uma vez por processo, antes do batch): quando o
+arquivo passa de `RUN_LOG_MAX_MB` ou o primeiro registro tem mais de
+`RUN_LOG_MAX_AGE_DAYS` dias, ele e movido para `run_logs/<stem>_<ts>.csv` ao
+lado do log e ganha uma linha em `run_logs/<stem>_index.jsonl` com as contagens
+por dia/status. Ficam os `RUN_LOG_KEEP_ARCHIVES` arquivos mais novos; o indice
+nao e podado, entao o resumo cobre todo o historico sem reler arquivos.
+
+CLI:
+  python src/orchestration/run_logs.py summary --log artifacts/output/maersk_run_log.csv --days 30
+  python src/orchestration/run_logs.py rotate --log artifacts/output/maersk_run_log.csv
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+ARCHIVE_DIR_NAME = "run_logs"
+TIME_FIELD = "when"
+
+
+def max_bytes() -> int:
+    return int(float(os.getenv("RUN_LOG_MAX_MB", "5")) * 1024 * 1024)
+
+
+def max_age_days() -> float:
+    return float(os.getenv("RUN_LOG_MAX_AGE_DAYS", "30"))
+
+
+def keep_archives() -> int:
+    return max(0, int(os.getenv("RUN_LOG_KEEP_ARCHIVES", "24")))
+
+
+def archive_dir(path: Path) -> Path:
+    return path.parent / ARCHIVE_DIR_NAME
+
+
+def index_path(path: Path) -> Path:
+    return archive_dir(path) / f"{path.stem}_index.jsonl"
+
+
+def append_rows(path: Path, fields: List[str], rows: Iterable[dict]) -> int:
+    """Acrescenta linhas ao fim do log (cabecalho so em arquivo novo)."""
+    rows = list(rows)
+    if not rows:
+        return 0
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_header = not path.exists() or path.stat().st_size == 0
+    with path.open("a", encoding="utf-8-sig" if write_header else "utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+def append_row(path: Path, fields: List[str], row: dict) -> None:
+    append_rows(path, fields, [row])
+
+
+def _parse_when(value) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(str(value).strip()).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+
+def first_record_time(path: Path) -> Optional[datetime]:
+    """Le so o cabecalho e a primeira linha."""
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            return _parse_when(row.get(TIME_FIELD))
+    return None
+
+
+def summarize_file(path: Path) -> dict:
+    """Contagens por dia/status de um log (uma passada, em streaming)."""
+    days: Dict[str, Dict[str, int]] = {}
+    rows = 0
+    first = last = None
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            rows += 1
+            when = _parse_when(row.get(TIME_FIELD))
+            day = when.date().isoformat() if when else "-"
+            if when:
+                first = when if first is None or when < first else first
+                last = when if last is None or when > last else last
+            status = (row.get("status") or "").strip() or "-"
+            counts = days.setdefault(day, {})
+            counts[status] = counts.get(status, 0) + 1
+    return {
+        "rows": rows,
+        "first": first.isoformat(timespec="seconds") if first else None,
+        "last": last.isoformat(timespec="seconds") if last else None,
+        "days": days,
+    }
+
+
+def rotation_reason(path: Path, now: Optional[datetime] = None) -> Optional[str]:
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    size = path.stat().st_size
+    if size >= max_bytes():
+        return f"tamanho {size / 1024 / 1024:.1f}MB"
+    age_days = max_age_days()
+    first = first_record_time(path)
+    if age_days > 0 and first is not None:
+        age = ((now or datetime.now()) - first).total_seconds() / 86400
+        if age >= age_days:
+            return f"primeiro registro com {age:.0f} dias"
+    return None
+
+
+def rotate(path: Path, reason: str, now: Optional[datetime] = None) -> Path:
+    """Move o log para o arquivo morto, registra o resumo no indice e poda arquivos antigos."""
+    now = now or datetime.now()
+    summary = summarize_file(path)
+    target_dir = archive_dir(path)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    archived = target_dir / f"{path.stem}_{now:%Y%m%d_%H%M%S}{path.suffix}"
+    n = 1
+    while archived.exists():
+        archived = target_dir / f"{path.stem}_{now:%Y%m%d_%H%M%S}_{n}{path.suffix}"
+        n += 1
+    os.replace(path, archived)
+
+    entry = {"archive": archived.name, "rotated_at": now.isoformat(timespec="seconds"), "reason": reason, **summary}
+    with index_path(path).open("a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    keep = keep_archives()
+    archives = sorted(target_dir.glob(f"{path.stem}_*{path.suffix}"))
+    for old in archives[: max(0, len(archives) - keep)]:
+        old.unlink()
+    return archived
+
+
+def rotate_if_needed(path: Path, log_fn: Callable[[str], None] = print) -> Optional[Path]:
+    """Chamado uma vez por processo, antes do batch. Erro aqui nao derruba o scraper."""
+    try:
+        reason = rotation_reason(path)
+        if reason is None:
+            return None
+        archived = rotate(path, reason)
+    except OSError as e:
+        log_fn(f"[run_log] aviso: falha ao rotacionar {path}: {e!r}")
+        return None
+    log_fn(f"[run_log] {path.name} rotacionado ({reason}) para {archived}.")
+    return archived
+
+
+def read_index(path: Path) -> List[dict]:
+    idx = index_path(path)
+    if not idx.exists():
+        return []
+    entries = []
+    with idx.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+def summary_by_day(path: Path) -> Dict[str, Dict[str, int]]:
+    """Indice dos arquivos rotacionados + log atual (so o atual e relido)."""
+    days: Dict[str, Dict[str, int]] = {}
+    sources = [entry["days"] for entry in read_index(path)]
+    if path.exists() and path.stat().st_size > 0:
+        sources.append(summarize_file(path)["days"])
+    for source in sources:
+        for day, counts in source.items():
+            merged = days.setdefault(day, {})
+            for status, n in counts.items():
+                merged[status] = merged.get(status, 0) + int(n)
+    return days
+
+
+def cmd_summary(args: argparse.Namespace) -> None:
+    path = Path(args.log)
+    days = summary_by_day(path)
+    if args.days:
+        cutoff = (datetime.now() - timedelta(days=args.days)).date().isoformat()
+        days = {day: counts for day, counts in days.items() if day >= cutoff}
+    statuses = sorted({status for counts in days.values() for status in counts})
+    headers = ["dia", "total"] + statuses
+    rows = [
+        [day, str(sum(counts.values()))] + [str(counts.get(status, 0)) for status in statuses]
+        for day, counts in sorted(days.items())
+    ]
+    widths = [len(h) for h in headers]
+    for row in rows:
+        widths = [max(w, len(v)) for w, v in zip(widths, row)]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+    if not rows:
+        print("(sem dados)")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Resumo e rotacao dos run logs append-only.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("summary", help="Contagens por dia/status (indice + log atual).")
+    p.add_argument("--log", required=True)
+    p.add_argument("--days", type=int, default=0, help="So os ultimos N dias (0 = tudo).")
+
+    p = sub.add_parser("rotate", help="Rotaciona o log agora.")
+    p.add_argument("--log", required=True)
+
+    args = parser.parse_args()
+    if args.cmd == "summary":
+        cmd_summary(args)
+        return 0
+
+    path = Path(args.log)
+    if not path.exists() or path.stat().st_size == 0:
+        print(f"[run_log] {path} vazio; nada a rotacionar.")
+        return 0
+    archived = rotate(path, "manual")
+    print(f"[run_log] {path.name} rotacionado para {archived}.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,216 @@
+"""
+Merge dos CSVs de shards de scraper no arquivo canonico do carrier.
+
+Com `--shards N`, o runner sobe N processos do mesmo scraper. Cada shard le o
+historico do CSV canonico (para priorizar), processa so a sua fatia da fila e
+grava em `artifacts/output/shards/<csv>.shard<i>.csv`. Esta etapa junta tudo
+de volta por `key`, com a mesma regra do `load_rows_cache` da Hapag:
+- tentativa mais recente (last_attempt_at) define status/message;
+- sucesso mais recente (quoted_at) define quoted_at e todas as colunas de charge.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import run_logs
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+OUTPUT_DIR = PROJECT_ROOT / "artifacts" / "output"
+SHARDS_DIR = OUTPUT_DIR / "shards"
+
+ATTEMPT_FIELDS = ("last_attempt_at", "status", "message")
+IDENTITY_FIELDS = ("key", "origin", "destination")
+
+# Layout de saida por carrier (igual ao que cada scraper grava).
+CARRIERS = {
+    "hapag": {
+        "csv": OUTPUT_DIR / "hapag_breakdowns.csv",
+        "encoding": "utf-8",
+        "sort_rows": True,
+        "sort_extras": True,
+        "run_log": None,
+    },
+    "maersk": {
+        "csv": OUTPUT_DIR / "maersk_breakdowns.csv",
+        "encoding": "utf-8-sig",
+        "sort_rows": False,
+        "sort_extras": False,
+        "run_log": OUTPUT_DIR / "maersk_run_log.csv",
+    },
+    "cma": {
+        "csv": OUTPUT_DIR / "cma_breakdowns.csv",
+        "encoding": "utf-8",
+        "sort_rows": True,
+        "sort_extras": True,
+        "run_log": None,
+    },
+}
+
+
+def shard_output_path(canonical: Path, shard_index: int) -> Path:
+    """Convencao de nome compartilhada com os scrapers (SCRAPER_SHARD_INDEX)."""
+    return SHARDS_DIR / f"{canonical.stem}.shard{shard_index}{canonical.suffix}"
+
+
+def _parse_iso_or_none(value) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).strip())
+    except Exception:
+        return None
+    # Comparacao entre shards: ignora timezone se vier misturado.
+    return parsed.replace(tzinfo=None)
+
+
+def read_csv_rows(path: Path) -> Tuple[List[str], List[dict]]:
+    if not path.exists() or path.stat().st_size == 0:
+        return [], []
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        return list(reader.fieldnames or []), [dict(r) for r in reader]
+
+
+def _row_key(row: dict) -> str:
+    key = (row.get("key") or "").strip()
+    if key:
+        return key
+    return f"{(row.get('origin') or '').strip()}-{(row.get('destination') or '').strip()}"
+
+
+def merge_row(existing: dict, row: dict) -> dict:
+    merged = existing
+    curr_attempt = _parse_iso_or_none(existing.get("last_attempt_at"))
+    new_attempt = _parse_iso_or_none(row.get("last_attempt_at"))
+    curr_success = _parse_iso_or_none(existing.get("quoted_at"))
+    new_success = _parse_iso_or_none(row.get("quoted_at"))
+
+    if new_attempt and (not curr_attempt or new_attempt > curr_attempt):
+        for field in ATTEMPT_FIELDS:
+            merged[field] = row.get(field) or ""
+
+    # sucesso mais recente -> copia quoted_at + TODAS as colunas de charge
+    if new_success and (not curr_success or new_success > curr_success):
+        for k, v in row.items():
+            if k in ATTEMPT_FIELDS or k in IDENTITY_FIELDS:
+                continue
+            merged[k] = v
+        # colunas que so existiam na linha antiga ficam vazias (breakdown novo substitui)
+        for k in list(merged.keys()):
+            if k not in row and k not in ATTEMPT_FIELDS and k not in IDENTITY_FIELDS:
+                merged[k] = ""
+    return merged
+
+
+def merge_shard_csvs(
+    canonical: Path,
+    shard_paths: List[Path],
+    encoding: str = "utf-8",
+    sort_rows: bool = False,
+    sort_extras: bool = False,
+) -> Tuple[int, int]:
+    """
+    Junta canonico + shards e grava o canonico com replace atomico.
+    Retorna (linhas_finais, shards_lidos).
+    """
+    fieldnames, base_rows = read_csv_rows(canonical)
+    rows: Dict[str, dict] = {}
+    for row in base_rows:
+        rows[_row_key(row)] = row
+
+    seen_fields = list(fieldnames)
+    shards_read = 0
+    for shard_path in shard_paths:
+        shard_fields, shard_rows = read_csv_rows(shard_path)
+        if not shard_fields:
+            continue
+        shards_read += 1
+        for field in shard_fields:
+            if field not in seen_fields:
+                seen_fields.append(field)
+        for row in shard_rows:
+            key = _row_key(row)
+            existing = rows.get(key)
+            rows[key] = dict(row) if existing is None else merge_row(existing, row)
+
+    if sort_extras:
+        base = [f for f in seen_fields if f in IDENTITY_FIELDS or f in ATTEMPT_FIELDS or f == "quoted_at"]
+        base_order = ["key", "origin", "destination", "last_attempt_at", "quoted_at", "status", "message"]
+        base = [f for f in base_order if f in base]
+        fieldnames_out = base + sorted(f for f in seen_fields if f not in base)
+    else:
+        fieldnames_out = seen_fields
+
+    keys = sorted(rows.keys()) if sort_rows else list(rows.keys())
+
+    canonical.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = canonical.with_name(f"{canonical.name}.tmp")
+    with tmp_path.open("w", encoding=encoding, newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames_out, extrasaction="ignore")
+        writer.writeheader()
+        for key in keys:
+            writer.writerow({field: rows[key].get(field, "") for field in fieldnames_out})
+    os.replace(tmp_path, canonical)
+    return len(keys), shards_read
+
+
+def append_shard_run_logs(run_log: Path, shard_logs: List[Path]) -> int:
+    run_logs.rotate_if_needed(run_log, log_fn=lambda msg: print(f"[shards] {msg}", flush=True))
+    appended = 0
+    for shard_log in shard_logs:
+        fields, rows = read_csv_rows(shard_log)
+        if not fields:
+            continue
+        appended += run_logs.append_rows(run_log, fields, rows)
+        shard_log.unlink()
+    return appended
+
+
+def merge_carrier(carrier: str, shard_count: int) -> int:
+    cfg = CARRIERS[carrier]
+    canonical: Path = cfg["csv"]
+    shard_paths = [shard_output_path(canonical, i) for i in range(shard_count)]
+    missing = [p.name for p in shard_paths if not p.exists()]
+    if missing:
+        print(f"[shards] aviso: shards sem arquivo (ignorados): {missing}", flush=True)
+
+    total, shards_read = merge_shard_csvs(
+        canonical,
+        [p for p in shard_paths if p.exists()],
+        encoding=cfg["encoding"],
+        sort_rows=cfg["sort_rows"],
+        sort_extras=cfg["sort_extras"],
+    )
+    print(
+        f"[shards] {carrier}: {shards_read}/{shard_count} shard(s) mesclados em {canonical} ({total} linhas).",
+        flush=True,
+    )
+
+    run_log = cfg.get("run_log")
+    if run_log is not None:
+        shard_logs = [shard_output_path(run_log, i) for i in range(shard_count)]
+        appended = append_shard_run_logs(run_log, [p for p in shard_logs if p.exists()])
+        print(f"[shards] {carrier}: {appended} linha(s) de run log anexadas em {run_log}", flush=True)
+
+    for path in shard_paths:
+        if path.exists():
+            path.unlink()
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mescla CSVs de shards no arquivo canonico do carrier.")
+    parser.add_argument("--carrier", required=True, choices=sorted(CARRIERS))
+    parser.add_argument("--shards", required=True, type=int)
+    args = parser.parse_args()
+    return merge_carrier(args.carrier, max(1, args.shards))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,81 @@
+"""
+Base comum dos bancos SQLite de estado em `artifacts/runtime/` (fila de rotas,
+pool de contas, controle de ritmo, historico de runs, store de cotacoes).
+
+Todos abrem em WAL com busy_timeout, porque varios processos (abas, shards,
+replicas, daemons do browser pool) gravam no mesmo arquivo. Os modulos de
+lease (fila, contas, ritmo) abrem em autocommit e gravam com `transaction`
+(`BEGIN IMMEDIATE`), para o lock de escrita ser pego antes da leitura; os de
+historico usam a transacao implicita do sqlite3 (`with conn`).
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+import sqlite3
+from pathlib import Path
+from typing import Callable, TypeVar
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+BUSY_TIMEOUT_MS = 30000
+
+T = TypeVar("T")
+
+
+def parse_env_bool(name: str, default: bool = False) -> bool:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    value = raw.strip().lower()
+    if value in {"1", "true", "t", "yes", "y", "on"}:
+        return True
+    if value in {"0", "false", "f", "no", "n", "off"}:
+        return False
+    return default
+
+
+def env_path(name: str, default: Path) -> Path:
+    """Caminho da variavel `name` (relativo a raiz do projeto) ou `default`."""
+    raw = os.getenv(name)
+    if not raw:
+        return default
+    candidate = Path(raw).expanduser()
+    if not candidate.is_absolute():
+        candidate = PROJECT_ROOT / candidate
+    return candidate
+
+
+def holder_id() -> str:
+    """Identifica o processo entre hosts: host:pid:s<shard>."""
+    shard = os.getenv("SCRAPER_SHARD_INDEX", "0")
+    return f"{socket.gethostname()}:{os.getpid()}:s{shard}"
+
+
+def connect(
+    path: Path,
+    schema: str,
+    autocommit: bool = True,
+    busy_timeout_ms: int = BUSY_TIMEOUT_MS,
+) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    kwargs = {"isolation_level": None} if autocommit else {}
+    conn = sqlite3.connect(str(path), timeout=busy_timeout_ms / 1000, **kwargs)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout={busy_timeout_ms}")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    return conn
+
+
+def transaction(conn: sqlite3.Connection, fn: Callable[[], T]) -> T:
+    """Executa `fn` entre BEGIN IMMEDIATE e COMMIT (conexao em autocommit)."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn()
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return result
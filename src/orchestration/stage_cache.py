@@ -0,0 +1,134 @@
+"""
+Cache por conteudo das etapas do pipeline.
+
+Para etapas com `cacheable=True`, o runner calcula uma impressao digital com:
+- hash do script da etapa (e de `code`, se declarado) = versao do codigo;
+- args e env extras da etapa;
+- valores das variaveis de ambiente listadas em `cache_env`;
+- hash do conteudo de cada arquivo em `inputs`;
+- com `cache_clock` (formato strftime, ex. `%Y-%m-%dT%H`), o relogio nessa
+  granularidade: etapas cujo resultado depende da hora (a comparacao invalida
+  quotes mais velhas que MAX_QUOTE_AGE_DAYS) expiram quando a janela vira.
+
+Se a impressao digital bate com a ultima execucao bem-sucedida registrada em
+`artifacts/runtime/stage_cache.json` e os outputs continuam iguais aos gravados
+naquela execucao, a etapa e pulada e os outputs sao reaproveitados.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+CACHE_MANIFEST = PROJECT_ROOT / "artifacts" / "runtime" / "stage_cache.json"
+MANIFEST_VERSION = 1
+MISSING = "missing"
+
+
+def file_digest(path: Path) -> str:
+    """sha256 do conteudo do arquivo (ou `missing` se nao existir)."""
+    h = hashlib.sha256()
+    try:
+        with Path(path).open("rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    except FileNotFoundError:
+        return MISSING
+    return h.hexdigest()
+
+
+def _display_path(path: Path) -> str:
+    try:
+        return str(Path(path).resolve().relative_to(PROJECT_ROOT))
+    except ValueError:
+        return str(path)
+
+
+def cache_clock(spec: dict) -> Optional[str]:
+    fmt = spec.get("cache_clock")
+    return datetime.now().strftime(fmt) if fmt else None
+
+
+def stage_fingerprint(spec: dict) -> Dict[str, object]:
+    """
+    Impressao digital da etapa. Devolve o hash final e as partes (para log/debug).
+    Valores de env entram so como hash (podem conter segredos).
+    """
+    code_files = [spec["script"], *spec.get("code", [])]
+    parts = {
+        "code": {_display_path(p): file_digest(p) for p in code_files},
+        "args": [str(a) for a in spec.get("args", [])],
+        "env": {k: str(v) for k, v in sorted(spec.get("env", {}).items())},
+        "cache_env": {
+            name: hashlib.sha256((os.getenv(name) or "").encode("utf-8")).hexdigest()
+            for name in sorted(spec.get("cache_env", []))
+        },
+        "inputs": {_display_path(p): file_digest(p) for p in spec.get("inputs", [])},
+    }
+    clock = cache_clock(spec)
+    if clock is not None:
+        parts["clock"] = clock
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=True)
+    return {"fingerprint": hashlib.sha256(payload.encode("utf-8")).hexdigest(), "parts": parts}
+
+
+def load_manifest(path: Path = CACHE_MANIFEST) -> dict:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError, OSError):
+        return {"version": MANIFEST_VERSION, "stages": {}}
+    if data.get("version") != MANIFEST_VERSION or not isinstance(data.get("stages"), dict):
+        return {"version": MANIFEST_VERSION, "stages": {}}
+    return data
+
+
+def save_manifest(manifest: dict, path: Path = CACHE_MANIFEST) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def cache_hit_reason(name: str, spec: dict, fingerprint: str, manifest: dict) -> Optional[str]:
+    """
+    None quando a etapa pode ser reaproveitada; senao o motivo do cache miss.
+    """
+    entry = manifest.get("stages", {}).get(name)
+    if not entry:
+        return "sem execucao anterior registrada"
+    if spec.get("cache_clock") and entry.get("clock") != cache_clock(spec):
+        return f"janela de validade expirou (gravado em {entry.get('recorded_at')})"
+    if entry.get("fingerprint") != fingerprint:
+        return "inputs/codigo mudaram"
+    recorded = entry.get("outputs", {})
+    for output in spec.get("outputs", []):
+        digest = file_digest(output)
+        if digest == MISSING:
+            return f"output ausente: {output.name}"
+        if recorded.get(_display_path(output)) != digest:
+            return f"output alterado desde o cache: {output.name}"
+    return None
+
+
+def record_stage(name: str, spec: dict, fingerprint: str, run_id: str, path: Path = CACHE_MANIFEST) -> None:
+    """Registra uma execucao bem-sucedida (fingerprint dos inputs + hash dos outputs)."""
+    manifest = load_manifest(path)
+    manifest["stages"][name] = {
+        "fingerprint": fingerprint,
+        "clock": cache_clock(spec),
+        "outputs": {_display_path(o): file_digest(o) for o in spec.get("outputs", [])},
+        "run_id": run_id,
+        "recorded_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    save_manifest(manifest, path)
+
+
+def forget_stage(name: str, path: Path = CACHE_MANIFEST) -> None:
+    manifest = load_manifest(path)
+    if manifest["stages"].pop(name, None) is not None:
+        save_manifest(manifest, path)
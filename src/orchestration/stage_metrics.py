@@ -0,0 +1,214 @@
+"""
+Contabilidade de recursos por etapa do pipeline.
+
+Amostra a arvore de processos inteira de cada etapa (scraper + filhos
+Chromium/Camoufox) e acumula: tempo de parede, tempo de CPU, pico de RSS e
+quantidade de processos filhos. Usa `psutil` quando instalado; sem ele, le
+`/proc` (Linux/container). Em ambiente sem nenhum dos dois, registra apenas
+o tempo de parede.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+try:
+    import psutil  # opcional
+except Exception:
+    psutil = None
+
+PROC_DIR = Path("/proc")
+
+# pid -> (cpu_seconds, rss_bytes)
+TreeSnapshot = Dict[int, Tuple[float, int]]
+
+
+def metrics_backend() -> str:
+    if psutil is not None:
+        return "psutil"
+    if PROC_DIR.is_dir():
+        return "procfs"
+    return "none"
+
+
+def _snapshot_with_psutil(root_pid: int) -> TreeSnapshot:
+    out: TreeSnapshot = {}
+    try:
+        root = psutil.Process(root_pid)
+        procs = [root] + root.children(recursive=True)
+    except Exception:
+        return out
+
+    for proc in procs:
+        try:
+            cpu = proc.cpu_times()
+            mem = proc.memory_info()
+            out[proc.pid] = (float(cpu.user + cpu.system), int(mem.rss))
+        except Exception:
+            continue
+    return out
+
+
+def _read_proc_stat(pid_dir: Path) -> Optional[Tuple[int, float]]:
+    try:
+        raw = (pid_dir / "stat").read_text(encoding="utf-8", errors="ignore")
+    except OSError:
+        return None
+
+    # O nome do processo (campo 2) pode ter espacos: corta no ultimo ')'.
+    fields = raw[raw.rfind(")") + 2:].split()
+    if len(fields) < 13:
+        return None
+
+    ppid = int(fields[1])
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    return ppid, cpu
+
+
+def _read_proc_rss(pid_dir: Path) -> int:
+    try:
+        pages = int((pid_dir / "statm").read_text(encoding="utf-8").split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    return pages * page_size
+
+
+def _snapshot_with_procfs(root_pid: int) -> TreeSnapshot:
+    stats: Dict[int, Tuple[int, float]] = {}
+    for pid_dir in PROC_DIR.iterdir():
+        if not pid_dir.name.isdigit():
+            continue
+        stat = _read_proc_stat(pid_dir)
+        if stat is not None:
+            stats[int(pid_dir.name)] = stat
+
+    if root_pid not in stats:
+        return {}
+
+    children: Dict[int, list] = {}
+    for pid, (ppid, _) in stats.items():
+        children.setdefault(ppid, []).append(pid)
+
+    out: TreeSnapshot = {}
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        if pid in out or pid not in stats:
+            continue
+        out[pid] = (stats[pid][1], _read_proc_rss(PROC_DIR / str(pid)))
+        pending.extend(children.get(pid, []))
+    return out
+
+
+def snapshot_process_tree(root_pid: int) -> TreeSnapshot:
+    if psutil is not None:
+        return _snapshot_with_psutil(root_pid)
+    if PROC_DIR.is_dir():
+        return _snapshot_with_procfs(root_pid)
+    return {}
+
+
+def new_stage_metrics(name: str, root_pid: Optional[int] = None, shared_root: bool = False) -> dict:
+    """
+    `shared_root=True` quando o processo raiz ja existia antes da etapa (worker
+    persistente): o CPU acumulado ate aqui vira baseline e e descontado no fim.
+    """
+    cpu_base_by_pid = {}
+    if shared_root and root_pid is not None:
+        cpu_base_by_pid = {pid: cpu for pid, (cpu, _) in snapshot_process_tree(int(root_pid)).items()}
+    return {
+        "stage": name,
+        "root_pid": root_pid,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "_t0": time.monotonic(),
+        "_cpu_by_pid": dict(cpu_base_by_pid),
+        "_cpu_base_by_pid": cpu_base_by_pid,
+        "peak_rss_bytes": 0,
+        "_rss_bytes": 0,
+        "max_concurrent_processes": 0,
+        "samples": 0,
+    }
+
+
+def sample_stage_metrics(metrics: dict) -> None:
+    """
+    Acumula uma amostra da arvore de processos. O CPU de cada pid e
+    cumulativo no SO, entao guardamos o maior valor visto por pid; processos
+    que nascem e morrem entre duas amostras ficam de fora (aproximacao).
+    """
+    root_pid = metrics.get("root_pid")
+    if root_pid is None:
+        return
+
+    snap = snapshot_process_tree(int(root_pid))
+    if not snap:
+        return
+
+    cpu_by_pid = metrics["_cpu_by_pid"]
+    for pid, (cpu, _) in snap.items():
+        if cpu > cpu_by_pid.get(pid, 0.0):
+            cpu_by_pid[pid] = cpu
+
+    rss_total = sum(rss for _, rss in snap.values())
+    metrics["peak_rss_bytes"] = max(metrics["peak_rss_bytes"], rss_total)
+    metrics["_rss_bytes"] = rss_total
+    metrics["max_concurrent_processes"] = max(metrics["max_concurrent_processes"], len(snap))
+    metrics["samples"] += 1
+
+
+def finalize_stage_metrics(metrics: dict, exit_code: Optional[int], status: str) -> dict:
+    cpu_by_pid = metrics.pop("_cpu_by_pid", {})
+    cpu_base_by_pid = metrics.pop("_cpu_base_by_pid", {})
+    t0 = metrics.pop("_t0", time.monotonic())
+    metrics.pop("_rss_bytes", None)
+    root_pid = metrics.get("root_pid")
+
+    metrics["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    metrics["wall_sec"] = round(time.monotonic() - t0, 3)
+    metrics["cpu_sec"] = round(
+        sum(max(0.0, cpu - cpu_base_by_pid.get(pid, 0.0)) for pid, cpu in cpu_by_pid.items()), 3
+    )
+    metrics["peak_rss_mb"] = round(metrics.pop("peak_rss_bytes", 0) / (1024 * 1024), 1)
+    metrics["child_count"] = len([pid for pid in cpu_by_pid if pid != root_pid])
+    metrics["exit_code"] = exit_code
+    metrics["status"] = status
+    return metrics
+
+
+def format_metrics_line(metrics: dict) -> str:
+    return (
+        f"[metrics] {metrics['stage']}: wall={metrics.get('wall_sec', 0):.1f}s "
+        f"cpu={metrics.get('cpu_sec', 0):.1f}s "
+        f"peak_rss={metrics.get('peak_rss_mb', 0):.1f}MB "
+        f"filhos={metrics.get('child_count', 0)} "
+        f"max_proc={metrics.get('max_concurrent_processes', 0)} "
+        f"status={metrics.get('status')}"
+    )
+
+
+def public_metrics(metrics: dict) -> dict:
+    """Sem as chaves internas (`_t0`, `_cpu_by_pid`...) de etapas ainda em curso."""
+    return {key: value for key, value in metrics.items() if not str(key).startswith("_")}
+
+
+def write_metrics_json(path: Path, run_id: str, stage_metrics: Dict[str, dict], extra: Optional[dict] = None) -> None:
+    payload = {
+        "run_id": run_id,
+        "written_at": datetime.now().isoformat(timespec="seconds"),
+        "backend": metrics_backend(),
+        "stages": {name: public_metrics(metrics) for name, metrics in stage_metrics.items()},
+    }
+    if extra:
+        payload.update(extra)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_path, path)
@@ -0,0 +1,175 @@
+"""
+Worker Python persistente para executar etapas do pipeline em processo.
+
+O runner (`PIPELINE_EXECUTION_MODE=worker`) sobe este processo uma vez; ele
+pre-importa as dependencias pesadas (pandas, openpyxl, dotenv, Playwright) e
+fica aguardando pedidos em stdin (uma linha JSON por etapa). Para cada pedido:
+- troca `os.environ`, `sys.argv`, `sys.path[0]` e cwd pelos da etapa;
+- redireciona stdout/stderr (nivel de file descriptor, pega tambem filhos)
+  para o log da etapa;
+- carrega o script da etapa do zero e chama o entry point (`main` por padrao);
+- descarrega os modulos do projeto (eles leem env em tempo de import) e
+  restaura o ambiente base.
+A resposta vai por um descritor separado do stdout (que pertence aos logs).
+
+Protocolo (JSON por linha):
+  pedido:   {"id", "stage", "script", "args", "env", "cwd", "log_path", "entry", "import_only"}
+  resposta: {"id", "rc", "elapsed_sec"}   (na subida: {"ready": true, "preload_sec"})
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import json
+import os
+import sys
+import time
+import traceback
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+PROJECT_SRC = PROJECT_ROOT / "src"
+
+# Modulos de terceiros mantidos quentes entre etapas (falha de import e ignorada:
+# a etapa que precisar do modulo vai reportar o erro no proprio log).
+PRELOAD_MODULES = (
+    "pandas",
+    "openpyxl",
+    "dotenv",
+    "requests",
+    "playwright.sync_api",
+)
+
+
+def preload() -> dict:
+    loaded = {}
+    for name in PRELOAD_MODULES:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception:
+            continue
+        loaded[name] = round(time.perf_counter() - started, 3)
+    return loaded
+
+
+def _project_module_names() -> list:
+    names = []
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, "__file__", None)
+        if not module_file:
+            continue
+        try:
+            Path(module_file).resolve().relative_to(PROJECT_SRC)
+        except ValueError:
+            continue
+        names.append(name)
+    return names
+
+
+def _exit_code(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+    # SystemExit("mensagem") -> codigo 1, como o interpretador faz
+    print(value, file=sys.stderr)
+    return 1
+
+
+def run_stage(request: dict) -> int:
+    """Executa uma etapa com ambiente, argv e saida isolados; devolve o exit code."""
+    script = Path(request["script"])
+    entry = request.get("entry") or "main"
+    base_env = dict(os.environ)
+    base_argv = list(sys.argv)
+    base_path = list(sys.path)
+    base_cwd = os.getcwd()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_out, saved_err = os.dup(1), os.dup(2)
+    log_file = open(request["log_path"], "a", encoding="utf-8")
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+    try:
+        os.environ.clear()
+        os.environ.update(request.get("env") or base_env)
+        sys.argv = [str(script), *[str(a) for a in request.get("args", [])]]
+        sys.path.insert(0, str(script.parent))
+        os.chdir(request.get("cwd") or base_cwd)
+
+        module_name = f"__pipeline_stage_{request.get('stage', script.stem)}__"
+        spec = importlib.util.spec_from_file_location(module_name, script)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        try:
+            spec.loader.exec_module(module)
+            # import_only: so carrega o modulo (usado pelo benchmark de startup)
+            rc = 0 if request.get("import_only") else _exit_code(getattr(module, entry)())
+        except SystemExit as e:
+            rc = _exit_code(e.code)
+        except BaseException:
+            traceback.print_exc()
+            rc = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_out, 1)
+        os.dup2(saved_err, 2)
+        os.close(saved_out)
+        os.close(saved_err)
+        log_file.close()
+
+        for name in _project_module_names():
+            sys.modules.pop(name, None)
+        sys.modules.pop(f"__pipeline_stage_{request.get('stage', script.stem)}__", None)
+        os.environ.clear()
+        os.environ.update(base_env)
+        sys.argv = base_argv
+        sys.path[:] = base_path
+        os.chdir(base_cwd)
+    return rc
+
+
+def main() -> int:
+    # stdout/stderr passam a ser dos logs das etapas; respostas vao por uma copia do stdout.
+    reply = os.fdopen(os.dup(1), "w", encoding="utf-8", buffering=1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    started = time.perf_counter()
+    loaded = preload()
+    reply.write(
+        json.dumps(
+            {
+                "ready": True,
+                "pid": os.getpid(),
+                "preload_sec": round(time.perf_counter() - started, 3),
+                "modules": loaded,
+            }
+        )
+        + "\n"
+    )
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        request = json.loads(line)
+        if request.get("shutdown"):
+            break
+        started = time.perf_counter()
+        rc = run_stage(request)
+        reply.write(
+            json.dumps(
+                {"id": request.get("id"), "rc": rc, "elapsed_sec": round(time.perf_counter() - started, 3)}
+            )
+            + "\n"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
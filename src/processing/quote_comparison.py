@@ -1,9 +1,12 @@
+import argparse
 import math
 import os
+import pickle
 import re
 import subprocess
 import time
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pandas as pd
@@ -33,10 +36,17 @@ def resolve_env_path(env_name: str, default_path: Path) -> Path:
 # Breakdowns
 HAPAG_BREAKDOWNS  = PROJECT_ROOT / "artifacts" / "output" / "hapag_breakdowns.csv"
 MAERSK_BREAKDOWNS = PROJECT_ROOT / "artifacts" / "output" / "maersk_breakdowns.csv"
+CMA_BREAKDOWNS    = PROJECT_ROOT / "artifacts" / "output" / "cma_breakdowns.csv"
 
 # Jobs
 HAPAG_JOBS  = PROJECT_ROOT / "artifacts" / "input" / "hapag_jobs.xlsx"
 MAERSK_JOBS = PROJECT_ROOT / "artifacts" / "input" / "maersk_jobs.xlsx"
+CMA_JOBS    = PROJECT_ROOT / "artifacts" / "input" / "cma_jobs.xlsx"
+
+# Fonte do preco CMA: "manual" (planilha cma_cotations) ou "scraper"
+# (cma_breakdowns.csv do scraper, com o indexador de cma_jobs.xlsx).
+CMA_PRICE_SOURCE = (os.getenv("CMA_PRICE_SOURCE") or "manual").strip().lower()
+CMA_FROM_SCRAPER = CMA_PRICE_SOURCE == "scraper"
 
 # CMA cotations (fonte final de preco)
 CMA_COTATIONS_FILE = resolve_env_path(
@@ -56,6 +66,8 @@ MANUAL_COTATION_FILES = {
     "one": ONE_COTATIONS_FILE,
     "zim": ZIM_COTATIONS_FILE,
 }
+if CMA_FROM_SCRAPER:
+    del MANUAL_COTATION_FILES["cma"]
 PRICE_CARRIERS = ["hapag", "cma", "one", "zim", "maersk"]
 CMA_REQUIRED_COLUMNS = {
     "INDEXADOR",
@@ -78,6 +90,9 @@ USA_FLAG_COL_INTERNAL = "use_usa_import"
 
 # Saída
 OUTPUT_FILE = PROJECT_ROOT / "artifacts" / "output" / "comparacao_carriers.csv"
+# Copia tipada para o export, mesmo nome com outra extensao
+# (Parquet com pyarrow; senao pickle do DataFrame).
+TYPED_OUTPUT_SUFFIXES = {"parquet": ".parquet", "pickle": ".pkl"}
 
 
 # ----------------------------------------------------------------------
@@ -416,13 +431,38 @@ def ensure_quotes_file_synced(file_path: Path) -> None:
         print(f"[sync] aviso: nao consegui confirmar sincronizacao completa: {file_path}")
 
 
+def ensure_manual_files_synced(file_paths: list[Path]) -> None:
+    """
+    Mesma verificacao de ensure_quotes_file_synced para varios arquivos, mas com
+    uma unica checagem do sincronizador e as esperas em paralelo (o pior caso
+    vira um SYNC_WAIT_TIMEOUT_SEC, nao um por arquivo).
+    """
+    if not SYNC_BEFORE_CMA_READ or not file_paths:
+        return
+
+    provider = ensure_cloud_sync_running()
+    if provider:
+        print(f"[sync] sincronizador detectado/iniciado: {provider}.")
+    else:
+        print("[sync] aviso: nao foi possivel detectar/iniciar Google Drive/OneDrive.")
+
+    with ThreadPoolExecutor(max_workers=len(file_paths)) as pool:
+        results = list(pool.map(wait_file_stable, file_paths))
+    for file_path, ok in zip(file_paths, results):
+        if ok:
+            print(f"[sync] arquivo pronto para leitura: {file_path}")
+        else:
+            print(f"[sync] aviso: nao consegui confirmar sincronizacao completa: {file_path}")
+
+
 def ensure_cma_file_synced(file_path: Path) -> None:
     """Compatibilidade retroativa: mantido para chamadas legadas."""
     ensure_quotes_file_synced(file_path)
 
 
-def load_manual_carrier_prices(file_path: Path, carrier_slug: str) -> pd.DataFrame:
-    ensure_quotes_file_synced(file_path)
+def load_manual_carrier_prices(file_path: Path, carrier_slug: str, sync: bool = True) -> pd.DataFrame:
+    if sync:
+        ensure_quotes_file_synced(file_path)
 
     if not file_path.exists():
         raise FileNotFoundError(f"Arquivo de cotacoes do carrier '{carrier_slug}' nao encontrado: {file_path}")
@@ -697,111 +737,208 @@ def invalidate_old_quotes(df: pd.DataFrame, value_col: str, max_age_days: int =
 
 
 # ----------------------------------------------------------------------
-# 1) Ler jobs e criar base canônica de rotas (usando MAERSK)
+# 1) Entradas estaticas: jobs, flags de destino e cotacoes manuais
 # ----------------------------------------------------------------------
-maersk_jobs = pd.read_excel(MAERSK_JOBS)
-if "indexador" in maersk_jobs.columns:
-    maersk_jobs["indexador"] = normalize_indexador_series(maersk_jobs["indexador"])
+def _clip_flag(series: pd.Series) -> pd.Series:
+    return (
+        pd.to_numeric(series, errors="coerce")
+        .fillna(0)
+        .astype(int)
+        .clip(0, 1)
+    )
 
 
-# ----------------------------------------------------------------------
-# 1.1) Ler flags (destination charges + USA) e anexar na base
-# ----------------------------------------------------------------------
-dest_df = pd.read_excel(DESTINATION_CHARGES_FILE)
-
-required = {"indexador", "ORIGEM", "PORTO DE DESTINO", USA_FLAG_COL_IN_FILE}
-missing = required - set(dest_df.columns)
-if missing:
-    raise ValueError(
-        f"O arquivo {DESTINATION_CHARGES_FILE} precisa ter as colunas: {required}. "
-        f"Faltando: {missing}"
-    )
+def load_static_inputs() -> dict:
+    """
+    Le as entradas que nao mudam durante o run (jobs, destination_charges e
+    planilhas manuais cma/one/zim) e devolve um contexto reutilizavel.
+    Com CMA_PRICE_SOURCE=scraper a CMA sai das planilhas manuais e entra
+    cma_jobs.xlsx (indexador das rotas do scraper).
+    """
+    # Base canonica de rotas (usando MAERSK)
+    maersk_jobs = pd.read_excel(MAERSK_JOBS)
+    if "indexador" in maersk_jobs.columns:
+        maersk_jobs["indexador"] = normalize_indexador_series(maersk_jobs["indexador"])
 
-dest_df = dest_df[["indexador", "ORIGEM", "PORTO DE DESTINO", USA_FLAG_COL_IN_FILE]].copy()
-dest_df["indexador"] = normalize_indexador_series(dest_df["indexador"])
-routes_base = dest_df[["indexador", "ORIGEM", "PORTO DE DESTINO"]].drop_duplicates()
+    # Flags (destination charges + USA)
+    dest_df = pd.read_excel(DESTINATION_CHARGES_FILE)
 
-dest_df[USA_FLAG_COL_INTERNAL] = (
-    pd.to_numeric(dest_df[USA_FLAG_COL_IN_FILE], errors="coerce")
-    .fillna(0)
-    .astype(int)
-    .clip(0, 1)
-)
+    required = {"indexador", "ORIGEM", "PORTO DE DESTINO", USA_FLAG_COL_IN_FILE}
+    missing = required - set(dest_df.columns)
+    if missing:
+        raise ValueError(
+            f"O arquivo {DESTINATION_CHARGES_FILE} precisa ter as colunas: {required}. "
+            f"Faltando: {missing}"
+        )
 
-dest_flags = dest_df.groupby("indexador", as_index=False)[[USA_FLAG_COL_INTERNAL]].max()
+    dest_df = dest_df[["indexador", "ORIGEM", "PORTO DE DESTINO", USA_FLAG_COL_IN_FILE]].copy()
+    dest_df["indexador"] = normalize_indexador_series(dest_df["indexador"])
+    routes_base = dest_df[["indexador", "ORIGEM", "PORTO DE DESTINO"]].drop_duplicates()
+
+    dest_df[USA_FLAG_COL_INTERNAL] = _clip_flag(dest_df[USA_FLAG_COL_IN_FILE])
+    dest_flags = dest_df.groupby("indexador", as_index=False)[[USA_FLAG_COL_INTERNAL]].max()
+
+    routes_base = routes_base.merge(dest_flags, on="indexador", how="left")
+    routes_base[USA_FLAG_COL_INTERNAL] = _clip_flag(routes_base[USA_FLAG_COL_INTERNAL])
+
+    hapag_jobs = pd.read_excel(HAPAG_JOBS)
+    if "indexador" in hapag_jobs.columns:
+        hapag_jobs["indexador"] = normalize_indexador_series(hapag_jobs["indexador"])
+    hapag_jobs2 = hapag_jobs.rename(columns={"ORIGEM": "ORIGEM_CODE", "PORTO DE DESTINO": "DEST_CODE"})
+
+    # Cotacoes manuais (preco final direto das planilhas dedicadas)
+    ensure_manual_files_synced(list(MANUAL_COTATION_FILES.values()))
+    manual_prices = {
+        carrier: load_manual_carrier_prices(path, carrier, sync=False)
+        for carrier, path in MANUAL_COTATION_FILES.items()
+    }
+    manual_groups = {}
+    for carrier, frame in manual_prices.items():
+        manual_groups[carrier] = frame.groupby("indexador", as_index=False).agg(
+            **{
+                carrier: (carrier, "max"),
+                f"{carrier}_transit_time": (f"{carrier}_transit_time", first_non_empty),
+                f"{carrier}_free_time": (f"{carrier}_free_time", first_non_empty),
+            }
+        )
+
+    ctx = {
+        "maersk_jobs": maersk_jobs,
+        "hapag_jobs": hapag_jobs2,
+        "dest_flags": dest_flags,
+        "routes_base": routes_base,
+        "manual_groups": manual_groups,
+    }
+    if CMA_FROM_SCRAPER:
+        cma_jobs = pd.read_excel(CMA_JOBS)
+        if "indexador" in cma_jobs.columns:
+            cma_jobs["indexador"] = normalize_indexador_series(cma_jobs["indexador"])
+        ctx["cma_jobs"] = cma_jobs
+    return ctx
 
-routes_base = routes_base.merge(dest_flags, on="indexador", how="left")
-for col in [USA_FLAG_COL_INTERNAL]:
-    routes_base[col] = (
-        pd.to_numeric(routes_base[col], errors="coerce")
-        .fillna(0)
-        .astype(int)
-        .clip(0, 1)
-    )
 
 # ----------------------------------------------------------------------
-# 2) Ler dados por carrier e trazer o indexador
+# 1b) Prefetch (--prefetch): entradas estaticas lidas durante os scrapers
 # ----------------------------------------------------------------------
+PREFETCH_CACHE_VERSION = 1
 
-# --- COTAÇÕES MANUAIS (preco final direto das planilhas dedicadas) ---
-manual_prices = {
-    carrier: load_manual_carrier_prices(path, carrier)
-    for carrier, path in MANUAL_COTATION_FILES.items()
-}
 
-# --- HAPAG ---
-hapag_df = pd.read_csv(HAPAG_BREAKDOWNS)
+def static_input_files() -> list[Path]:
+    extra = [CMA_JOBS] if CMA_FROM_SCRAPER else []
+    return [MAERSK_JOBS, HAPAG_JOBS, DESTINATION_CHARGES_FILE, *MANUAL_COTATION_FILES.values(), *extra]
 
-# monta o HAPAG_MAP automaticamente pelas colunas reais do CSV
-HAPAG_MAP = build_hapag_map_from_columns(hapag_df.columns)
 
-hapag_jobs = pd.read_excel(HAPAG_JOBS)
-if "indexador" in hapag_jobs.columns:
-    hapag_jobs["indexador"] = normalize_indexador_series(hapag_jobs["indexador"])
+def _source_signatures() -> dict:
+    out = {}
+    for path in static_input_files():
+        try:
+            st = path.stat()
+            out[str(path)] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            out[str(path)] = None
+    return out
 
-hapag_jobs2 = hapag_jobs.rename(columns={"ORIGEM": "ORIGEM_CODE", "PORTO DE DESTINO": "DEST_CODE"})
 
-hapag_merged = hapag_df.merge(
-    hapag_jobs2,
-    left_on=["origin", "destination"],
-    right_on=["ORIGEM_CODE", "DEST_CODE"],
-    how="left",
-)
+def run_prefetch(cache_file: Path) -> dict:
+    """
+    Sincroniza e le as entradas estaticas e grava o contexto (DataFrames com
+    dtypes preservados, via pickle) para a comparacao reaproveitar.
+    """
+    cache_file.unlink(missing_ok=True)
+    started = time.perf_counter()
+    signatures = _source_signatures()
+    ctx = load_static_inputs()
+    payload = {
+        "version": PREFETCH_CACHE_VERSION,
+        "run_id": RUN_ID,
+        "sources": signatures,
+        "ctx": ctx,
+    }
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.tmp")
+    with tmp_file.open("wb") as f:
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    print(f"[prefetch] entradas estaticas prontas em {time.perf_counter() - started:.1f}s: {cache_file}")
+    return ctx
 
-if "indexador" in hapag_merged.columns:
-    hapag_merged["indexador"] = normalize_indexador_series(hapag_merged["indexador"])
 
-hapag_merged = hapag_merged.merge(dest_flags, on="indexador", how="left")
-for col in [USA_FLAG_COL_INTERNAL]:
-    hapag_merged[col] = (
-        pd.to_numeric(hapag_merged[col], errors="coerce")
-        .fillna(0)
-        .astype(int)
-        .clip(0, 1)
+def load_prefetch_cache(cache_file: Path) -> dict | None:
+    """
+    Contexto gravado pelo prefetch deste run, ou None (e a comparacao le tudo de
+    novo) se o arquivo faltar, for de outro run ou alguma entrada mudou depois.
+    """
+    try:
+        with cache_file.open("rb") as f:
+            payload = pickle.load(f)
+    except FileNotFoundError:
+        print(f"[prefetch] cache ausente ({cache_file}); lendo entradas.")
+        return None
+    except Exception as e:
+        print(f"[prefetch] aviso: cache ilegivel ({e!r}); lendo entradas.")
+        return None
+
+    if payload.get("version") != PREFETCH_CACHE_VERSION or payload.get("run_id") != RUN_ID:
+        print("[prefetch] cache de outro run/versao; lendo entradas.")
+        return None
+    current = _source_signatures()
+    changed = [path for path, sig in current.items() if payload.get("sources", {}).get(path) != sig]
+    if changed:
+        print(f"[prefetch] entradas alteradas apos o prefetch {changed}; lendo entradas.")
+        return None
+
+    print(f"[prefetch] reaproveitando entradas estaticas de {cache_file}")
+    return payload["ctx"]
+
+
+# ----------------------------------------------------------------------
+# 2) Ler dados por carrier e trazer o indexador
+# ----------------------------------------------------------------------
+def merge_hapag_with_jobs(hapag_df: pd.DataFrame, ctx: dict) -> pd.DataFrame:
+    hapag_merged = hapag_df.merge(
+        ctx["hapag_jobs"],
+        left_on=["origin", "destination"],
+        right_on=["ORIGEM_CODE", "DEST_CODE"],
+        how="left",
     )
 
-# --- MAERSK ---
-maersk_df = pd.read_csv(MAERSK_BREAKDOWNS)
+    if "indexador" in hapag_merged.columns:
+        hapag_merged["indexador"] = normalize_indexador_series(hapag_merged["indexador"])
 
-maersk_merged = maersk_df.merge(
-    maersk_jobs,
-    left_on=["origin", "destination"],
-    right_on=["ORIGEM", "PORTO DE DESTINO"],
-    how="left",
-)
+    hapag_merged = hapag_merged.merge(ctx["dest_flags"], on="indexador", how="left")
+    hapag_merged[USA_FLAG_COL_INTERNAL] = _clip_flag(hapag_merged[USA_FLAG_COL_INTERNAL])
+    return hapag_merged
 
-if "indexador" in maersk_merged.columns:
-    maersk_merged["indexador"] = normalize_indexador_series(maersk_merged["indexador"])
 
-maersk_merged = maersk_merged.merge(dest_flags, on="indexador", how="left")
-for col in [USA_FLAG_COL_INTERNAL]:
-    maersk_merged[col] = (
-        pd.to_numeric(maersk_merged[col], errors="coerce")
-        .fillna(0)
-        .astype(int)
-        .clip(0, 1)
+def merge_maersk_with_jobs(maersk_df: pd.DataFrame, ctx: dict) -> pd.DataFrame:
+    maersk_merged = maersk_df.merge(
+        ctx["maersk_jobs"],
+        left_on=["origin", "destination"],
+        right_on=["ORIGEM", "PORTO DE DESTINO"],
+        how="left",
+    )
+
+    if "indexador" in maersk_merged.columns:
+        maersk_merged["indexador"] = normalize_indexador_series(maersk_merged["indexador"])
+
+    maersk_merged = maersk_merged.merge(ctx["dest_flags"], on="indexador", how="left")
+    maersk_merged[USA_FLAG_COL_INTERNAL] = _clip_flag(maersk_merged[USA_FLAG_COL_INTERNAL])
+    return maersk_merged
+
+
+def merge_cma_with_jobs(cma_df: pd.DataFrame, ctx: dict) -> pd.DataFrame:
+    cma_merged = cma_df.merge(
+        ctx["cma_jobs"],
+        left_on=["origin", "destination"],
+        right_on=["ORIGEM", "PORTO DE DESTINO"],
+        how="left",
     )
 
+    if "indexador" in cma_merged.columns:
+        cma_merged["indexador"] = normalize_indexador_series(cma_merged["indexador"])
+    return cma_merged
+
+
 # ----------------------------------------------------------------------
 # 3) Calcular total dinâmico para cada carrier
 #    + invalidar cotações antigas
@@ -812,30 +949,6 @@ for col in [USA_FLAG_COL_INTERNAL]:
 # HAPAG: excluir DTHC da soma comparada
 HAPAG_DTHC_EXCLUDE = ["Import Surcharges | Terminal Handling Charge Dest. | 20STD"]
 
-hapag_merged["hapag"] = compute_carrier_total(
-    hapag_merged,
-    HAPAG_MAP,
-    usa_flag_col=USA_FLAG_COL_INTERNAL,
-    dthc_exclude_cols=HAPAG_DTHC_EXCLUDE,
-)
-invalidate_old_quotes(hapag_merged, "hapag")
-if "Estimated Transportation Days" not in hapag_merged.columns:
-    hapag_merged["Estimated Transportation Days"] = pd.NA
-hapag_group = hapag_merged.groupby("indexador", as_index=False).agg(
-    hapag=("hapag", "max"),
-    hapag_transit_time=("Estimated Transportation Days", first_non_empty),
-)
-
-manual_groups = {}
-for carrier, frame in manual_prices.items():
-    manual_groups[carrier] = frame.groupby("indexador", as_index=False).agg(
-        **{
-            carrier: (carrier, "max"),
-            f"{carrier}_transit_time": (f"{carrier}_transit_time", first_non_empty),
-            f"{carrier}_free_time": (f"{carrier}_free_time", first_non_empty),
-        }
-    )
-
 # MAERSK: excluir DTHC da soma comparada
 MAERSK_DTHC_EXCLUDE = [
     c
@@ -843,76 +956,507 @@ MAERSK_DTHC_EXCLUDE = [
     if "Terminal Handling Service - Destination" in c
 ]
 
-maersk_merged["maersk"] = compute_carrier_total(
-    maersk_merged,
-    MAERSK_MAP,
-    usa_flag_col=USA_FLAG_COL_INTERNAL,
-    dthc_exclude_cols=MAERSK_DTHC_EXCLUDE,
-)
-invalidate_old_quotes(maersk_merged, "maersk")
-if "offer_transit_time" not in maersk_merged.columns:
-    maersk_merged["offer_transit_time"] = pd.NA
-maersk_group = maersk_merged.groupby("indexador", as_index=False).agg(
-    maersk=("maersk", "max"),
-    maersk_transit_time=("offer_transit_time", first_non_empty),
-)
 
-# ----------------------------------------------------------------------
-# 4) Juntar tudo pela base canônica (rotas da Maersk)
-# ----------------------------------------------------------------------
-base = routes_base.copy()  # indexador, ORIGEM, PORTO DE DESTINO, flags
+def group_hapag(hapag_merged: pd.DataFrame, hapag_map: dict) -> pd.DataFrame:
+    hapag_merged = hapag_merged.copy()
+    hapag_merged["hapag"] = compute_carrier_total(
+        hapag_merged,
+        hapag_map,
+        usa_flag_col=USA_FLAG_COL_INTERNAL,
+        dthc_exclude_cols=HAPAG_DTHC_EXCLUDE,
+    )
+    invalidate_old_quotes(hapag_merged, "hapag")
+    if "Estimated Transportation Days" not in hapag_merged.columns:
+        hapag_merged["Estimated Transportation Days"] = pd.NA
+    return hapag_merged.groupby("indexador", as_index=False).agg(
+        hapag=("hapag", "max"),
+        hapag_transit_time=("Estimated Transportation Days", first_non_empty),
+    )
 
-base = base.merge(hapag_group, on="indexador", how="left")
-for carrier in ["cma", "one", "zim"]:
-    base = base.merge(manual_groups[carrier], on="indexador", how="left")
-base = base.merge(maersk_group, on="indexador", how="left")
 
-for col in PRICE_CARRIERS:
-    base[col] = pd.to_numeric(base[col], errors="coerce")
+def group_maersk(maersk_merged: pd.DataFrame) -> pd.DataFrame:
+    maersk_merged = maersk_merged.copy()
+    maersk_merged["maersk"] = compute_carrier_total(
+        maersk_merged,
+        MAERSK_MAP,
+        usa_flag_col=USA_FLAG_COL_INTERNAL,
+        dthc_exclude_cols=MAERSK_DTHC_EXCLUDE,
+    )
+    invalidate_old_quotes(maersk_merged, "maersk")
+    if "offer_transit_time" not in maersk_merged.columns:
+        maersk_merged["offer_transit_time"] = pd.NA
+    return maersk_merged.groupby("indexador", as_index=False).agg(
+        maersk=("maersk", "max"),
+        maersk_transit_time=("offer_transit_time", first_non_empty),
+    )
+
+
+def group_cma(cma_merged: pd.DataFrame) -> pd.DataFrame:
+    """
+    CMA do scraper: o preco e o total all-in da tabela de rate (ja e o valor
+    final da cotacao, como o PRECO FINAL da planilha manual). O scraper grava o
+    total convertido para USD; total que ficou em outra moeda (cambio
+    indisponivel na hora) fica vazio e e contado no log.
+    """
+    cma_merged = cma_merged.copy()
+    for col in ["total_all_in", "total_currency", "transit_time_days"]:
+        if col not in cma_merged.columns:
+            cma_merged[col] = pd.NA
+    total = pd.to_numeric(cma_merged["total_all_in"], errors="coerce")
+    currency = cma_merged["total_currency"].astype("string").str.strip().str.upper()
+    is_usd = (currency == "USD").fillna(False)
+    dropped = total.notna() & ~is_usd
+    if dropped.any():
+        by_currency = currency[dropped].fillna("?").value_counts()
+        print(
+            f"[cma] {int(dropped.sum())} rotas sem preco por moeda fora de USD: "
+            + ", ".join(f"{code}={n}" for code, n in by_currency.items())
+        )
+    cma_merged["cma"] = total.where(is_usd)
+    invalidate_old_quotes(cma_merged, "cma")
+    cma_merged["cma_free_time"] = pd.NA
+    return cma_merged.groupby("indexador", as_index=False).agg(
+        cma=("cma", "max"),
+        cma_transit_time=("transit_time_days", first_non_empty),
+        cma_free_time=("cma_free_time", first_non_empty),
+    )
+
 
 # ----------------------------------------------------------------------
+# 4) Juntar tudo pela base canônica (rotas da Maersk)
 # 5) Calcular menor valor (ignorando 0 e vazio) e empresa vencedora
 # ----------------------------------------------------------------------
-best = base.apply(best_price_and_carrier, axis=1)
-base["best_price"] = best["best_price"]
-base["best_carrier"] = best["best_carrier"]
-base["transit_time"] = base.apply(winner_transit_time, axis=1)
-base["free_time"] = base.apply(winner_free_time, axis=1)
-base["free_time"] = base["free_time"].map(normalize_free_time_value)
-
-base["key"] = base["ORIGEM"].astype(str) + "-" + base["PORTO DE DESTINO"].astype(str)
-
-# Reordenar colunas (incluí as flags pra auditar)
-base = base[
-    [
-        "key",
-        "ORIGEM",
-        "PORTO DE DESTINO",
-        USA_FLAG_COL_INTERNAL,
-        "hapag",
-        "cma",
-        "one",
-        "zim",
-        "maersk",
-        "best_price",
-        "best_carrier",
-        "transit_time",
-        "free_time",
-        "indexador",
-    ]
+OUTPUT_COLUMNS = [
+    "key",
+    "ORIGEM",
+    "PORTO DE DESTINO",
+    USA_FLAG_COL_INTERNAL,
+    "hapag",
+    "cma",
+    "one",
+    "zim",
+    "maersk",
+    "best_price",
+    "best_carrier",
+    "transit_time",
+    "free_time",
+    "indexador",
 ]
 
+# Schema explicito da copia tipada. transit_time/free_time misturam numero e
+# texto descritivo, entao seguem como texto (o export converte o que for numero).
+OUTPUT_SCHEMA = {
+    "key": "string",
+    "ORIGEM": "string",
+    "PORTO DE DESTINO": "string",
+    USA_FLAG_COL_INTERNAL: "Int64",
+    "hapag": "float64",
+    "cma": "float64",
+    "one": "float64",
+    "zim": "float64",
+    "maersk": "float64",
+    "best_price": "float64",
+    "best_carrier": "string",
+    "transit_time": "string",
+    "free_time": "string",
+    "indexador": "string",
+}
+
+
+def assemble_comparison(
+    ctx: dict,
+    hapag_group: pd.DataFrame,
+    maersk_group: pd.DataFrame,
+    only_indexadores: set | None = None,
+    cma_group: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """
+    Junta todos os carriers na base canonica e escolhe o vencedor por rota.
+    Com only_indexadores, calcula apenas as rotas desses indexadores.
+    cma_group (CMA_PRICE_SOURCE=scraper) substitui a planilha manual da CMA.
+    """
+    base = ctx["routes_base"].copy()  # indexador, ORIGEM, PORTO DE DESTINO, flags
+
+    base = base.merge(hapag_group, on="indexador", how="left")
+    for carrier in ["cma", "one", "zim"]:
+        group = cma_group if carrier == "cma" and cma_group is not None else ctx["manual_groups"].get(carrier)
+        if group is None:
+            group = _empty_group(carrier)
+        base = base.merge(group, on="indexador", how="left")
+    base = base.merge(maersk_group, on="indexador", how="left")
+
+    for col in PRICE_CARRIERS:
+        base[col] = pd.to_numeric(base[col], errors="coerce")
+
+    # Filtra depois dos merges para manter os mesmos dtypes da passada completa.
+    if only_indexadores is not None:
+        base = base[base["indexador"].isin(only_indexadores)].copy()
+
+    if base.empty:
+        for col in ["best_price", "best_carrier", "transit_time", "free_time", "key"]:
+            base[col] = pd.Series(dtype="object")
+        return base[OUTPUT_COLUMNS]
+
+    best = base.apply(best_price_and_carrier, axis=1)
+    base["best_price"] = best["best_price"]
+    base["best_carrier"] = best["best_carrier"]
+    base["transit_time"] = base.apply(winner_transit_time, axis=1)
+    base["free_time"] = base.apply(winner_free_time, axis=1)
+    base["free_time"] = base["free_time"].map(normalize_free_time_value)
+
+    base["key"] = base["ORIGEM"].astype(str) + "-" + base["PORTO DE DESTINO"].astype(str)
+
+    # Reordenar colunas (incluí as flags pra auditar)
+    return base[OUTPUT_COLUMNS]
+
+
 # ----------------------------------------------------------------------
 # 6) Salvar CSV final
 # ----------------------------------------------------------------------
-OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
-base.to_csv(
-    OUTPUT_FILE,
-    index=False,
-    encoding="utf-8-sig",
-    sep=";",
-    decimal=",",
-)
+def typed_output_format() -> str:
+    try:
+        import pyarrow  # noqa: F401
+    except ModuleNotFoundError:
+        return "pickle"
+    return "parquet"
+
+
+def _typed_text(value):
+    if pd.isna(value):
+        return pd.NA
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip() or pd.NA
+
+
+def to_typed_frame(base: pd.DataFrame) -> pd.DataFrame:
+    """Aplica OUTPUT_SCHEMA (valores de texto sem sufixo '.0' nem espacos)."""
+    typed = pd.DataFrame(index=base.index)
+    for col, dtype in OUTPUT_SCHEMA.items():
+        values = base[col] if col in base.columns else pd.Series(pd.NA, index=base.index)
+        if dtype == "string":
+            values = values.map(_typed_text)
+        else:
+            values = pd.to_numeric(values, errors="coerce")
+        typed[col] = values.astype(dtype)
+    return typed.reset_index(drop=True)
+
+
+def write_typed_output(base: pd.DataFrame, output_file: Path = OUTPUT_FILE) -> Path:
+    """
+    Grava a copia tipada ao lado do CSV (depois dele, entao fica no minimo tao
+    nova quanto o CSV) e remove a do outro formato para o export nao pegar
+    uma versao antiga.
+    """
+    fmt = typed_output_format()
+    typed_file = output_file.with_suffix(TYPED_OUTPUT_SUFFIXES[fmt])
+    typed = to_typed_frame(base)
+    tmp_file = typed_file.with_name(f"{typed_file.name}.tmp")
+    if fmt == "parquet":
+        typed.to_parquet(tmp_file, index=False)
+    else:
+        typed.to_pickle(tmp_file)
+    os.replace(tmp_file, typed_file)
+    for suffix in TYPED_OUTPUT_SUFFIXES.values():
+        if suffix != typed_file.suffix:
+            output_file.with_suffix(suffix).unlink(missing_ok=True)
+    return typed_file
+
+
+def write_comparison_output(base: pd.DataFrame, output_file: Path = OUTPUT_FILE) -> None:
+    """
+    Grava o CSV final (lado humano, locale BR) e a copia tipada que o export le
+    sem parse, ambos com replace atomico (tmp + os.replace), para que o export
+    nunca leia um arquivo pela metade.
+    """
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = output_file.with_name(f"{output_file.name}.tmp")
+    base.to_csv(
+        tmp_file,
+        index=False,
+        encoding="utf-8-sig",
+        sep=";",
+        decimal=",",
+    )
+    os.replace(tmp_file, output_file)
+    write_typed_output(base, output_file)
+
+
+def run_full_comparison(prefetch_cache: Path | None = None) -> pd.DataFrame:
+    ctx = load_prefetch_cache(prefetch_cache) if prefetch_cache is not None else None
+    if ctx is None:
+        ctx = load_static_inputs()
+
+    hapag_df = pd.read_csv(HAPAG_BREAKDOWNS)
+    # monta o HAPAG_MAP automaticamente pelas colunas reais do CSV
+    hapag_map = build_hapag_map_from_columns(hapag_df.columns)
+    hapag_group = group_hapag(merge_hapag_with_jobs(hapag_df, ctx), hapag_map)
+
+    maersk_df = pd.read_csv(MAERSK_BREAKDOWNS)
+    maersk_group = group_maersk(merge_maersk_with_jobs(maersk_df, ctx))
+
+    cma_group = None
+    if CMA_FROM_SCRAPER:
+        if CMA_BREAKDOWNS.exists():
+            cma_group = group_cma(merge_cma_with_jobs(pd.read_csv(CMA_BREAKDOWNS), ctx))
+        else:
+            print(f"[cma] aviso: {CMA_BREAKDOWNS} ausente; CMA fica vazia nesta comparacao.")
+            cma_group = _empty_group("cma")
+
+    base = assemble_comparison(ctx, hapag_group, maersk_group, cma_group=cma_group)
+    write_comparison_output(base)
+    print(f"Arquivo gerado em: {OUTPUT_FILE}")
+    return base
+
+
+# ----------------------------------------------------------------------
+# 7) Modo incremental (--watch): recalcula so as rotas afetadas
+# ----------------------------------------------------------------------
+WATCH_POLL_SEC = float(os.getenv("COMPARISON_WATCH_POLL_SEC", "3"))
+WATCH_MAX_HOURS = float(os.getenv("COMPARISON_WATCH_MAX_HOURS", "12"))
+
+# Breakdowns observados no --watch (CMA so quando vem do scraper)
+BREAKDOWN_FILES = {"hapag": HAPAG_BREAKDOWNS, "maersk": MAERSK_BREAKDOWNS}
+if CMA_FROM_SCRAPER:
+    BREAKDOWN_FILES["cma"] = CMA_BREAKDOWNS
+
+
+def _file_signature(path: Path):
+    try:
+        st = path.stat()
+        return (st.st_size, st.st_mtime_ns)
+    except OSError:
+        return None
+
+
+def _row_signatures(df: pd.DataFrame) -> dict:
+    """
+    Assinatura por rota (origin|destination) para detectar linhas alteradas.
+    Considera so as celulas preenchidas: coluna nova (sobretaxa nova em uma
+    rota) nao invalida a assinatura das outras rotas.
+    """
+    if df.empty or "origin" not in df.columns or "destination" not in df.columns:
+        return {}
+
+    out = {}
+    for record in df.to_dict("records"):
+        route_key = f"{record.get('origin')}|{record.get('destination')}"
+        filled = tuple(sorted((str(k), str(v)) for k, v in record.items() if not pd.isna(v)))
+        out[route_key] = hash(filled)
+    return out
+
+
+def _route_indexadores(merged: pd.DataFrame) -> dict:
+    if merged.empty or "indexador" not in merged.columns:
+        return {}
+
+    route_keys = merged["origin"].astype(str) + "|" + merged["destination"].astype(str)
+    out: dict = {}
+    for route_key, idx in zip(route_keys, merged["indexador"]):
+        if pd.isna(idx):
+            continue
+        out.setdefault(route_key, set()).add(idx)
+    return out
+
+
+def _replace_group_rows(group: pd.DataFrame | None, fresh: pd.DataFrame, indexadores: set) -> pd.DataFrame:
+    if group is None:
+        return fresh
+    kept = group[~group["indexador"].isin(indexadores)]
+    return pd.concat([kept, fresh], ignore_index=True)
+
+
+def refresh_carrier_state(carrier: str, state: dict, ctx: dict) -> set | None:
+    """
+    Rele o breakdown do carrier e recalcula apenas os indexadores cujas linhas
+    mudaram. Devolve o conjunto de indexadores afetados (None = sem mudanca).
+    """
+    path = BREAKDOWN_FILES[carrier]
+    sig = _file_signature(path)
+    if sig is None or sig == state.get("file_sig"):
+        return None
+
+    # O scraper reescreve o CSV inteiro a cada job: so le quando a assinatura
+    # se repetir entre dois polls (arquivo estavel).
+    if sig != state.get("pending_sig"):
+        state["pending_sig"] = sig
+        return None
+
+    try:
+        df = pd.read_csv(path)
+    except Exception as e:
+        print(f"[watch] aviso: falha ao ler {path.name}: {e}", flush=True)
+        return None
+    state["file_sig"] = sig
+
+    if carrier == "hapag":
+        merged = merge_hapag_with_jobs(df, ctx)
+        hapag_map = build_hapag_map_from_columns(df.columns)
+        full_recompute = hapag_map != state.get("hapag_map")
+        state["hapag_map"] = hapag_map
+    elif carrier == "cma":
+        merged = merge_cma_with_jobs(df, ctx)
+        full_recompute = state.get("group") is None
+    else:
+        merged = merge_maersk_with_jobs(df, ctx)
+        full_recompute = state.get("group") is None
+
+    row_sigs = _row_signatures(df)
+    prev_sigs = state.get("row_sigs", {})
+    changed_routes = {k for k, v in row_sigs.items() if prev_sigs.get(k) != v}
+    changed_routes |= set(prev_sigs) - set(row_sigs)
+
+    route_idx = _route_indexadores(merged)
+    prev_route_idx = state.get("route_idx", {})
+    affected: set = set()
+    for route_key in changed_routes:
+        affected |= route_idx.get(route_key, set())
+        affected |= prev_route_idx.get(route_key, set())
+
+    state["row_sigs"] = row_sigs
+    state["route_idx"] = route_idx
+
+    if full_recompute:
+        merged_subset = merged
+        affected = set(merged["indexador"].dropna()) | affected
+    else:
+        if not affected:
+            return set()
+        merged_subset = merged[merged["indexador"].isin(affected)]
+
+    if carrier == "hapag":
+        fresh = group_hapag(merged_subset, state["hapag_map"])
+    elif carrier == "cma":
+        fresh = group_cma(merged_subset)
+    else:
+        fresh = group_maersk(merged_subset)
+
+    state["group"] = fresh if full_recompute else _replace_group_rows(state.get("group"), fresh, affected)
+    return affected
+
+
+def _empty_group(carrier: str) -> pd.DataFrame:
+    columns = ["indexador", carrier, f"{carrier}_transit_time"]
+    if carrier in {"cma", "one", "zim"}:
+        columns.append(f"{carrier}_free_time")
+    return pd.DataFrame(columns=columns)
+
+
+def run_watch(stop_file: Path | None = None, poll_sec: float = WATCH_POLL_SEC) -> pd.DataFrame | None:
+    """
+    Observa hapag_breakdowns.csv e maersk_breakdowns.csv (e cma_breakdowns.csv
+    com CMA_PRICE_SOURCE=scraper) enquanto os scrapers rodam, recalcula so os indexadores afetados e mantem o CSV final
+    atualizado (replace atomico). Encerra apos a passada final quando o
+    stop_file aparece (criado pelo runner) ou apos COMPARISON_WATCH_MAX_HOURS.
+    """
+    ctx = load_static_inputs()
+    states = {carrier: {} for carrier in BREAKDOWN_FILES}
+    base: pd.DataFrame | None = None
+    deadline = time.time() + max(0.0, WATCH_MAX_HOURS) * 3600
+    stopping = False
+
+    print(f"[watch] iniciado (poll={poll_sec}s, stop_file={stop_file})", flush=True)
+
+    while True:
+        if stop_file is not None and stop_file.exists():
+            stopping = True
+        if time.time() > deadline:
+            print("[watch] aviso: limite COMPARISON_WATCH_MAX_HOURS atingido.", flush=True)
+            stopping = True
+
+        affected: set = set()
+        changed = False
+        for carrier, state in states.items():
+            if stopping:
+                # Passada final: aceita o arquivo sem esperar segunda leitura estavel.
+                state["pending_sig"] = _file_signature(BREAKDOWN_FILES[carrier])
+            result = refresh_carrier_state(carrier, state, ctx)
+            if result is not None:
+                changed = True
+                affected |= result
+
+        if changed and all(state.get("group") is not None for state in states.values()):
+            hapag_group = states["hapag"]["group"]
+            maersk_group = states["maersk"]["group"]
+            cma_group = states.get("cma", {}).get("group")
+            if base is None:
+                base = assemble_comparison(ctx, hapag_group, maersk_group, cma_group=cma_group)
+                refreshed = len(base)
+            elif affected:
+                fresh = assemble_comparison(
+                    ctx, hapag_group, maersk_group, only_indexadores=affected, cma_group=cma_group
+                )
+                kept = base[~base["indexador"].isin(affected)]
+                base = pd.concat([kept, fresh], ignore_index=True)
+                order = ctx["routes_base"]["indexador"].reset_index(drop=True)
+                rank = {idx: pos for pos, idx in enumerate(order)}
+                base = base.sort_values(
+                    "indexador", key=lambda s: s.map(rank), kind="stable"
+                ).reset_index(drop=True)
+                refreshed = len(fresh)
+            else:
+                refreshed = 0
+
+            if refreshed:
+                write_comparison_output(base)
+                print(f"[watch] {refreshed} rota(s) recalculada(s); arquivo atualizado: {OUTPUT_FILE}", flush=True)
+
+        if stopping:
+            break
+        time.sleep(poll_sec)
+
+    if base is None:
+        # Algum breakdown ausente/ilegivel durante todo o watch: passada completa.
+        for carrier, state in states.items():
+            if state.get("group") is None:
+                state["group"] = _empty_group(carrier)
+        base = assemble_comparison(
+            ctx,
+            states["hapag"]["group"],
+            states["maersk"]["group"],
+            cma_group=states.get("cma", {}).get("group"),
+        )
+        write_comparison_output(base)
+
+    print(f"Arquivo gerado em: {OUTPUT_FILE}")
+    return base
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compara cotacoes entre carriers.")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Modo incremental: recalcula as rotas afetadas a cada atualizacao dos breakdowns.",
+    )
+    parser.add_argument(
+        "--stop-file",
+        default=None,
+        help="No modo --watch, encerra apos a passada final quando este arquivo existir.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="So sincroniza/le as entradas estaticas e grava em --prefetch-cache (roda junto com os scrapers).",
+    )
+    parser.add_argument(
+        "--prefetch-cache",
+        default=None,
+        help="Arquivo do contexto pre-carregado (gravado com --prefetch, lido na comparacao).",
+    )
+    args = parser.parse_args()
+    prefetch_cache = Path(args.prefetch_cache) if args.prefetch_cache else None
+
+    if args.prefetch:
+        if prefetch_cache is None:
+            parser.error("--prefetch exige --prefetch-cache")
+        run_prefetch(prefetch_cache)
+    elif args.watch:
+        run_watch(stop_file=Path(args.stop_file) if args.stop_file else None)
+    else:
+        run_full_comparison(prefetch_cache=prefetch_cache)
+    return 0
 
-print(f"Arquivo gerado em: {OUTPUT_FILE}")
 
+if __name__ == "__main__":
+    raise SystemExit(main())
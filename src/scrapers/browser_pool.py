@@ -0,0 +1,341 @@
+"""
+Browser pool opcional: daemon local que mantem um browser logado e aquecido
+entre execucoes dos scrapers (evita subir browser + login a cada etapa).
+
+Um processo por carrier:
+- maersk: Chromium persistente com `--remote-debugging-port`; o scraper conecta
+  via CDP (`connect_over_cdp`) e abre uma aba nova no contexto ja logado.
+- hapag: servidor Camoufox (Playwright `launch_server`); o daemon mantem um
+  contexto logado e exporta o `storage_state` periodicamente; o scraper conecta
+  por websocket e cria um contexto proprio com esses cookies.
+
+O daemon faz health check a cada `BROWSER_POOL_HEALTH_SEC` (re-login se a
+sessao caiu) e re-login proativo a cada `BROWSER_POOL_RELOGIN_MIN`. O estado
+vai para `artifacts/runtime/browser_pool/<carrier>.json`; os scrapers so usam o
+pool com `BROWSER_POOL_ENABLED=1` e heartbeat recente, senao seguem com browser
+proprio como antes.
+
+O daemon pega uma conta do pool de contas (src/orchestration/account_pool.py)
+e grava o `account_id` no estado; o scraper que usa o pool segue nessa conta.
+
+Uso:
+  python src/scrapers/browser_pool.py --carrier maersk
+  python src/scrapers/browser_pool.py --carrier hapag
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "orchestration"))
+import account_pool  # noqa: E402
+from sqlite_state import parse_env_bool  # noqa: E402
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+POOL_DIR = PROJECT_ROOT / "artifacts" / "runtime" / "browser_pool"
+CARRIERS = ("hapag", "maersk")
+
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def log(carrier: str, msg: str) -> None:
+    print(f"[{now_iso()}] [pool:{carrier}] {msg}", flush=True)
+
+
+def state_path(carrier: str) -> Path:
+    return POOL_DIR / f"{carrier}.json"
+
+
+def storage_state_path(carrier: str) -> Path:
+    return POOL_DIR / f"{carrier}_storage_state.json"
+
+
+def write_pool_state(carrier: str, state: dict) -> None:
+    POOL_DIR.mkdir(parents=True, exist_ok=True)
+    path = state_path(carrier)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def clear_pool_state(carrier: str) -> None:
+    try:
+        state_path(carrier).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def read_pool_state(carrier: str) -> Optional[dict]:
+    """
+    Estado do pool para o scraper. Retorna None se o daemon nao esta rodando,
+    se a ultima checagem falhou ou se o heartbeat passou de BROWSER_POOL_STALE_SEC.
+    """
+    path = state_path(carrier)
+    try:
+        state = json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+    if not state.get("healthy") or not state.get("endpoint"):
+        return None
+    stale_sec = float(os.getenv("BROWSER_POOL_STALE_SEC", "120"))
+    try:
+        heartbeat = datetime.fromisoformat(str(state.get("heartbeat_at")))
+    except ValueError:
+        return None
+    if (datetime.now() - heartbeat).total_seconds() > stale_sec:
+        return None
+    storage_state = state.get("storage_state")
+    if storage_state and not Path(storage_state).exists():
+        return None
+    return state
+
+
+def _sleep_until_next_check(health_sec: float, stop_file: Optional[Path]) -> bool:
+    """Dorme ate o proximo health check; retorna False se pediram parada."""
+    deadline = time.monotonic() + health_sec
+    while time.monotonic() < deadline:
+        if stop_file is not None and stop_file.exists():
+            return False
+        time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+    return not (stop_file is not None and stop_file.exists())
+
+
+def keep_session_warm(carrier: str, endpoint: str, login, session_alive, after_check=None,
+                      stop_file: Optional[Path] = None, account: Optional[dict] = None) -> None:
+    """
+    Loop comum do daemon: login inicial, health check periodico, re-login quando
+    a sessao cai ou quando passa de BROWSER_POOL_RELOGIN_MIN, e heartbeat no estado.
+    """
+    health_sec = max(5.0, float(os.getenv("BROWSER_POOL_HEALTH_SEC", "30")))
+    relogin_sec = max(60.0, float(os.getenv("BROWSER_POOL_RELOGIN_MIN", "45")) * 60)
+    state = {
+        "carrier": carrier,
+        "endpoint": endpoint,
+        "pid": os.getpid(),
+        "healthy": False,
+        "started_at": now_iso(),
+        "last_login_at": None,
+        "last_check_at": None,
+        "heartbeat_at": now_iso(),
+        "consecutive_failures": 0,
+        "account_id": account["id"] if account else None,
+    }
+    if carrier == "hapag":
+        state["storage_state"] = str(storage_state_path(carrier))
+    last_login_mono = None
+
+    while True:
+        healthy = False
+        try:
+            if last_login_mono is None or time.monotonic() - last_login_mono >= relogin_sec:
+                reason = "login inicial" if last_login_mono is None else "re-login proativo"
+                log(carrier, f"{reason}...")
+                login()
+                healthy = session_alive()
+                if healthy:
+                    last_login_mono = time.monotonic()
+                    state["last_login_at"] = now_iso()
+            else:
+                healthy = session_alive()
+                if not healthy:
+                    log(carrier, "sessao caiu no health check; refazendo login...")
+                    login()
+                    healthy = session_alive()
+                    if healthy:
+                        last_login_mono = time.monotonic()
+                        state["last_login_at"] = now_iso()
+            if healthy and after_check is not None:
+                after_check()
+        except Exception as e:
+            log(carrier, f"erro no health check: {e!r}")
+            healthy = False
+
+        state["healthy"] = healthy
+        state["last_check_at"] = now_iso()
+        state["heartbeat_at"] = now_iso()
+        state["consecutive_failures"] = 0 if healthy else state["consecutive_failures"] + 1
+        write_pool_state(carrier, state)
+        account_pool.heartbeat(account)
+        if not healthy:
+            log(carrier, f"sessao indisponivel (falhas seguidas={state['consecutive_failures']})")
+
+        if not _sleep_until_next_check(health_sec, stop_file):
+            log(carrier, "stop file encontrado; encerrando.")
+            return
+
+
+def serve_maersk(stop_file: Optional[Path]) -> None:
+    import maersk_instant_quote as mq
+
+    port = int(os.getenv("BROWSER_POOL_MAERSK_CDP_PORT", "9333"))
+    account = account_pool.acquire("maersk", log_fn=lambda msg: log("maersk", msg), holder=f"pool:{os.getpid()}")
+    try:
+        login_timeout_ms = int(os.getenv("MAERSK_LOGIN_TIMEOUT_MS", "60000"))
+        # perfil proprio do pool: o scraper pode cair no browser proprio (USER_DATA_DIR)
+        # se o pool ficar indisponivel, e o Chrome nao divide perfil entre processos.
+        user_data_dir = account_pool.profile_dir(mq.USER_DATA_DIR.parent / f"{mq.USER_DATA_DIR.name}_pool", account)
+        user_data_dir.mkdir(parents=True, exist_ok=True)
+
+        with mq.sync_playwright() as p:
+            context = p.chromium.launch_persistent_context(
+                **mq.build_context_kwargs(user_data_dir, extra_args=[f"--remote-debugging-port={port}"]),
+            )
+            if parse_env_bool("MAERSK_STEALTH", default=True):
+                context.add_init_script(mq.STEALTH_INIT_SCRIPT)
+            page = context.new_page()
+            page.set_default_navigation_timeout(login_timeout_ms)
+
+            def login():
+                if not mq.login_maersk(page, account["user"], account["password"], timeout_ms=login_timeout_ms):
+                    raise RuntimeError("login Maersk falhou")
+
+            try:
+                keep_session_warm(
+                    "maersk",
+                    f"http://127.0.0.1:{port}",
+                    login=login,
+                    session_alive=lambda: mq.maersk_session_alive(page, timeout_ms=login_timeout_ms),
+                    stop_file=stop_file,
+                    account=account,
+                )
+            finally:
+                clear_pool_state("maersk")
+                context.close()
+    finally:
+        account_pool.release(account)
+
+
+def _connect_with_retry(p, endpoint: str, timeout_sec: float = 90.0):
+    deadline = time.monotonic() + timeout_sec
+    while True:
+        try:
+            return p.firefox.connect(endpoint)
+        except Exception:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(2.0)
+
+
+def serve_hapag(stop_file: Optional[Path]) -> None:
+    import hapag_instant_quote as hq
+
+    port = int(os.getenv("BROWSER_POOL_HAPAG_WS_PORT", "9334"))
+    ws_path = os.getenv("BROWSER_POOL_HAPAG_WS_PATH", "hapag-pool").strip("/") or "hapag-pool"
+    executable = hq.prepare_camoufox_runtime_executable(hq.resolve_camoufox_executable())
+    hq.validate_camoufox_executable(executable)
+
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            str(Path(__file__).resolve()),
+            "--camoufox-server",
+            "--port",
+            str(port),
+            "--ws-path",
+            ws_path,
+            "--executable-path",
+            executable,
+        ],
+        cwd=str(PROJECT_ROOT),
+    )
+    endpoint = f"ws://127.0.0.1:{port}/{ws_path}"
+    storage_file = storage_state_path("hapag")
+    account = None
+    try:
+        account = account_pool.acquire("hapag", log_fn=lambda msg: log("hapag", msg), holder=f"pool:{os.getpid()}")
+        hq.use_account(account)
+        with hq.sync_playwright() as p:
+            browser = _connect_with_retry(p, endpoint)
+            context = browser.new_context(
+                locale=os.getenv("HAPAG_LOCALE", "pt-BR"),
+                ignore_https_errors=parse_env_bool("HAPAG_CAMOUFOX_IGNORE_HTTPS_ERRORS", default=True),
+            )
+            page = context.new_page()
+            page.set_default_timeout(max(int(os.getenv("HAPAG_ACTION_TIMEOUT_MS", "30000")), 30000))
+            page.set_default_navigation_timeout(int(os.getenv("HAPAG_LOGIN_TIMEOUT_MS", "60000")))
+
+            def export_storage_state():
+                POOL_DIR.mkdir(parents=True, exist_ok=True)
+                tmp = storage_file.with_name(storage_file.name + ".tmp")
+                context.storage_state(path=str(tmp))
+                os.replace(tmp, storage_file)
+
+            try:
+                keep_session_warm(
+                    "hapag",
+                    endpoint,
+                    login=lambda: hq.login_hapag(page),
+                    session_alive=lambda: hq.hapag_session_alive(page),
+                    after_check=export_storage_state,
+                    stop_file=stop_file,
+                    account=account,
+                )
+            finally:
+                clear_pool_state("hapag")
+                browser.close()
+    finally:
+        account_pool.release(account)
+        server.terminate()
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def run_camoufox_server(port: int, ws_path: str, executable_path: str) -> None:
+    """Processo filho do daemon Hapag: bloqueia servindo o Camoufox por websocket."""
+    from camoufox.server import launch_server
+
+    launch_server(
+        headless=parse_env_bool("HAPAG_HEADLESS", default=False),
+        humanize=parse_env_bool("HAPAG_CAMOUFOX_HUMANIZE", default=True),
+        locale=os.getenv("HAPAG_LOCALE", "pt-BR"),
+        executable_path=executable_path,
+        port=port,
+        ws_path=ws_path,
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Daemon de browser logado para os scrapers.")
+    parser.add_argument("--carrier", choices=CARRIERS)
+    parser.add_argument("--stop-file", default=None, help="Encerra o daemon quando este arquivo existir.")
+    parser.add_argument("--camoufox-server", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--ws-path", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--executable-path", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.camoufox_server:
+        run_camoufox_server(args.port, args.ws_path, args.executable_path)
+        return 0
+    if not args.carrier:
+        parser.error("--carrier e obrigatorio")
+
+    from dotenv import load_dotenv
+
+    load_dotenv(PROJECT_ROOT / ".env", override=False)
+    stop_file = Path(args.stop_file) if args.stop_file else None
+    log(args.carrier, f"iniciando daemon (estado em {state_path(args.carrier)})")
+    try:
+        if args.carrier == "maersk":
+            serve_maersk(stop_file)
+        else:
+            serve_hapag(stop_file)
+    except KeyboardInterrupt:
+        log(args.carrier, "interrompido; encerrando.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
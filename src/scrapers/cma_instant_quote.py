@@ -1,7 +1,11 @@
 # cma_instant_quote_batch.py
 import os
+import re
 import csv
+import sys
+import time
 from datetime import date, timedelta, datetime
+from functools import partial
 from pathlib import Path
 
 import pandas as pd
@@ -11,6 +15,21 @@ from playwright.sync_api import (
     TimeoutError as PWTimeout,
 )
 
+import fx_rates
+import job_watchdog
+import route_scheduler
+
+# store de cotacoes fica em src/orchestration
+sys.path.append(str(Path(__file__).resolve().parents[1] / "orchestration"))
+import account_pool  # noqa: E402
+import charge_store  # noqa: E402
+import job_queue  # noqa: E402
+import progress_events  # noqa: E402
+import quote_store  # noqa: E402
+import rate_control  # noqa: E402
+import run_history  # noqa: E402
+from sqlite_state import parse_env_bool  # noqa: E402
+
 # ----------------------------------------------------------------------
 # Caminhos
 # ----------------------------------------------------------------------
@@ -24,9 +43,25 @@ CSV_OUT_DIR = PROJECT_ROOT / "artifacts" / "output"
 CSV_OUT_DIR.mkdir(parents=True, exist_ok=True)
 CSV_FILE = CSV_OUT_DIR / "cma_breakdowns.csv"
 
-# Pasta fixa de cache/perfil do Playwright
-USER_DATA_DIR = BROWSER_PROFILES_DIR / "cma"
-USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
+# Pasta fixa de cache/perfil do Playwright (a sessao logada fica nela entre runs)
+USER_DATA_DIR = Path(os.getenv("CMA_USER_DATA_DIR") or (BROWSER_PROFILES_DIR / "cma"))
+
+# Shards (runner --shards): cada processo pega uma fatia deterministica da fila
+# priorizada, com perfil e CSV proprios; o runner mescla no CSV_FILE depois
+# (mesma convencao de nome de src/orchestration/shard_merge.py).
+SHARD_INDEX = int(os.getenv("SCRAPER_SHARD_INDEX", "0"))
+SHARD_COUNT = max(1, int(os.getenv("SCRAPER_SHARD_COUNT", "1")))
+if SHARD_COUNT > 1:
+    SHARD_CSV_FILE = CSV_OUT_DIR / "shards" / f"{CSV_FILE.stem}.shard{SHARD_INDEX}{CSV_FILE.suffix}"
+    SHARD_CSV_FILE.parent.mkdir(parents=True, exist_ok=True)
+    if SHARD_INDEX > 0:
+        USER_DATA_DIR = USER_DATA_DIR.with_name(f"{USER_DATA_DIR.name}_shard{SHARD_INDEX}")
+else:
+    SHARD_CSV_FILE = CSV_FILE
+
+# conta da sessao (src/orchestration/account_pool.py): CMA_USER/CMA_PASS ou uma
+# conta de CMA_ACCOUNTS, com perfil proprio; definida no run_batch
+ACCOUNT: dict | None = None
 
 # ----------------------------------------------------------------------
 # Login CMA
@@ -45,6 +80,7 @@ LOGIN_URL = (
     "&x-client-SKU=ID_NET472"
     "&x-client-ver=6.27.0.0"
 )
+AUTH_HOST = "auth.cma-cgm.com"
 
 INSTANT_URL = "https://www.cma-cgm.com/ebusiness/pricing/instant-Quoting"
 
@@ -56,11 +92,13 @@ SEL_SUBMIT = 'button[type="submit"]'
 # Selectors da tela de Instant Quoting
 # ----------------------------------------------------------------------
 # ORIGEM / DESTINO
-SEL_ORIGIN_INPUT   = '#sortedAutocompleteWrapper-origin-field input[name="Origin"]'
-SEL_ORIGIN_OPTION1 = '#sortedAutocompletePopup-origin-field li.place-suggestion:first-child'
+SEL_ORIGIN_INPUT       = '#sortedAutocompleteWrapper-origin-field input[name="Origin"]'
+SEL_ORIGIN_SUGGESTIONS = '#sortedAutocompletePopup-origin-field li.place-suggestion'
+SEL_ORIGIN_OPTION1     = f"{SEL_ORIGIN_SUGGESTIONS}:first-child"
 
-SEL_DEST_INPUT     = '#sortedAutocompleteWrapper-destination-field input[name="Origin"]'
-SEL_DEST_OPTION1   = '#sortedAutocompletePopup-destination-field li.place-suggestion:first-child'
+SEL_DEST_INPUT         = '#sortedAutocompleteWrapper-destination-field input[name="Origin"]'
+SEL_DEST_SUGGESTIONS   = '#sortedAutocompletePopup-destination-field li.place-suggestion'
+SEL_DEST_OPTION1       = f"{SEL_DEST_SUGGESTIONS}:first-child"
 
 # DATA
 SEL_DEPARTURE_INPUT = "#DepartureFrom"
@@ -68,19 +106,25 @@ SEL_DEPARTURE_INPUT = "#DepartureFrom"
 # CONTAINER 20' DRY STANDARD - botão "Adicionar"
 SEL_ADD_20DRY = "li:has(.ico-20st) button.add-button"
 
-# PESO POR CONTAINER
+# PESO POR CONTAINER (so aparece com container adicionado)
 SEL_WEIGHT_INPUT = "#TxtWeight span[name='weightPerContainer'] input"
 
 # MERCADORIA (campo visível)
 SEL_COMMODITY_INPUT = "#DdlCommodity"
+SEL_COMMODITY_OPTIONS = "div.el-select__popper[aria-hidden='false'] li.el-select-dropdown__item"
 
 # BOTÃO OBTER COTAÇÃO
 SEL_SEARCH_QUOTE = "#SearchQuote"
 
-# RESULTADOS: primeiro botão "Detalhes"
+# RESULTADOS
+SEL_RESULTS_LIST = "ul.results-list"
+SEL_RESULT_CARD = "article.card-route-horizontal"
+SEL_NO_RESULTS = "div.no-result, div.no-results, .results-empty"
+# primeiro botão "Detalhes"
 SEL_DETAILS_FIRST = (
     "article.card-route-horizontal label.o-button.primary-ghost:has-text('Detalhes')"
 )
+TRANSIT_DAYS_RE = re.compile(r"(\d+)\s*(?:days?|dias?|jours?)", re.I)
 
 # TABELA DE RATE
 SEL_RATE_TABLE_ROWS = (
@@ -89,6 +133,13 @@ SEL_RATE_TABLE_ROWS = (
 SEL_RATE_TOTAL_PRICE = "div.rate-wrapper table.footer div.price.current"
 SEL_RATE_TOTAL_CURRENCY = "div.rate-wrapper table.footer div.price.current span.currency"
 
+# Colunas fixas do CSV (mesmo layout base dos outros carriers + total all-in)
+FIXED_COLS = list(quote_store.BASE_FIELDS) + ["total_all_in", "total_currency", "transit_time_days"]
+
+
+def log(msg: str) -> None:
+    print(f"[CMA] {msg}", flush=True)
+
 
 # ----------------------------------------------------------------------
 # Utilidades de CSV
@@ -108,11 +159,11 @@ def load_previous_records() -> dict:
     return records
 
 
-def write_all_records(records: dict):
+def write_all_records(records: dict, path: Path = SHARD_CSV_FILE):
     """
-    Escreve todos os records no CSV, substituindo o arquivo.
+    Escreve todos os records no CSV, substituindo o arquivo (tmp + replace).
     Garante ordem: colunas fixas + dinâmicas.
-    Chamado após CADA job, pra manter o CSV sempre atualizado.
+    Usado quando o CSV nao sai do store (ver export_records).
     """
     if not records:
         return
@@ -122,25 +173,61 @@ def write_all_records(records: dict):
     for row in records.values():
         all_fields.update(row.keys())
 
-    fixed_cols = [
-        "key",
-        "origin",
-        "destination",
-        "last_attempt_at",
-        "quoted_at",
-        "status",
-        "message",
-        "total_all_in",
-        "total_currency",
-    ]
-    dynamic_cols = [c for c in all_fields if c not in fixed_cols]
-    fieldnames = fixed_cols + sorted(dynamic_cols)
+    dynamic_cols = [c for c in all_fields if c not in FIXED_COLS]
+    fieldnames = FIXED_COLS + sorted(dynamic_cols)
+
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open("w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for key in sorted(records.keys()):
+                writer.writerow(records[key])
+
+    quote_store.replace_file(path, write)
+
+
+def export_records(records: dict, csv_export: dict, path: Path = SHARD_CSV_FILE):
+    """
+    CSV de breakdown pela visao de exportacao do store; com o store desligado
+    (ou depois de uma tentativa que nao entrou no store) sai dos records em memoria.
+    """
+    if not csv_export["from_store"] or quote_store.export_view("cma", path) is None:
+        write_all_records(records, path)
+
 
-    with CSV_FILE.open("w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for key in sorted(records.keys()):
-            writer.writerow(records[key])
+def persist_job(records: dict, key: str, job_number: int, export_every: int, csv_export: dict):
+    """
+    Grava a tentativa do job no store de cotacoes. O CSV e reexportado a cada
+    `export_every` jobs, ou a cada job se o store estiver desligado/falhar.
+    """
+    if not quote_store.record_attempt("cma", records[key]):
+        csv_export["from_store"] = False
+    if not csv_export["from_store"] or (export_every and job_number % export_every == 0):
+        export_records(records, csv_export)
+
+
+def upsert_record(records: dict, job: dict, status: str, message: str, charges: dict | None = None):
+    """
+    Atualiza a linha da rota com a tentativa (mesma regra da Hapag): status e
+    last_attempt_at sempre; em sucesso, quoted_at e o breakdown novo, que
+    substitui o anterior (cobrancas que sumiram da cotacao nao ficam na linha).
+    """
+    now_iso = datetime.now().isoformat()
+    key = job["key"]
+    row = records.get(key) or {field: "" for field in quote_store.BASE_FIELDS}
+
+    if status == "success":
+        row = {field: row.get(field, "") for field in quote_store.BASE_FIELDS}
+        row.update(charges or {})
+        row["quoted_at"] = now_iso
+
+    row["key"] = key
+    row["origin"] = job["origin"]
+    row["destination"] = job["destination"]
+    row["last_attempt_at"] = now_iso
+    row["status"] = status
+    row["message"] = message
+    records[key] = row
 
 
 def parse_iso(dt_str: str):
@@ -215,22 +302,48 @@ def build_sorted_jobs_from_excel_and_records(df: pd.DataFrame, records: dict):
 
 
 # ----------------------------------------------------------------------
-# Login / navegação
+# Login / navegação (esperas por elemento, sem networkidle)
 # ----------------------------------------------------------------------
-def login_cma(page):
+def _visible(page, selector: str) -> bool:
+    try:
+        loc = page.locator(selector).first
+        return loc.count() > 0 and loc.is_visible()
+    except Exception:
+        return False
+
+
+def wait_instant_form(page, timeout_ms: int) -> bool:
+    """Formulario pronto = campo de origem visivel."""
+    try:
+        page.wait_for_selector(SEL_ORIGIN_INPUT, state="visible", timeout=timeout_ms)
+        return True
+    except PWTimeout:
+        return False
+
+
+def open_instant_form(page, nav_timeout_ms: int) -> bool:
+    """Abre a tela de Instant Quoting e espera so o formulario (nao a rede toda)."""
+    page.goto(INSTANT_URL, wait_until="domcontentloaded", timeout=nav_timeout_ms)
+    return wait_instant_form(page, nav_timeout_ms)
+
+
+def login_cma(page, nav_timeout_ms: int = 30_000):
     """
     Faz login na CMA no próprio page e, ao final, vai para a tela de Instant Quoting.
     Se já estiver logado e o formulário não aparecer, apenas segue para a tela de cotação.
     """
     load_dotenv(PROJECT_ROOT / ".env", override=False)
-    email = os.getenv("CMA_USER")
-    password = os.getenv("CMA_PASS")
+    if ACCOUNT is not None:
+        email, password = ACCOUNT["user"], ACCOUNT["password"]
+    else:
+        email = os.getenv("CMA_USER")
+        password = os.getenv("CMA_PASS")
 
     if not email or not password:
         raise RuntimeError("CMA_USER e/ou CMA_PASS não definidos no .env")
 
     print("[CMA] Abrindo página de login...")
-    page.goto(LOGIN_URL, timeout=90_000)
+    page.goto(LOGIN_URL, wait_until="domcontentloaded", timeout=nav_timeout_ms)
 
     try:
         # tenta achar o formulário de login; se não achar, assume que já está logado
@@ -240,50 +353,201 @@ def login_cma(page):
         print("[CMA] Enviando formulário de login...")
         page.click(SEL_SUBMIT)
 
-        page.wait_for_load_state("networkidle")
-        page.wait_for_timeout(5_000)
-        print("[CMA] Login efetuado. Indo para Instant Quoting...")
+        # login concluido = saiu do dominio de autenticacao
+        try:
+            page.wait_for_url(lambda url: AUTH_HOST not in url, timeout=nav_timeout_ms)
+        except PWTimeout:
+            # credenciais recusadas/conta travada: a pagina fica no dominio de autenticacao
+            account_pool.report_lockout(ACCOUNT, "login nao saiu da tela de autenticacao", log_fn=log)
+            print("[CMA] Login nao concluido (ainda na tela de autenticacao).")
+        else:
+            print("[CMA] Login efetuado. Indo para Instant Quoting...")
     except PWTimeout:
         print("[CMA] Campo de login não apareceu; possivelmente já logado. Indo direto para Instant Quoting...")
 
-    page.goto(INSTANT_URL, timeout=90_000)
-    page.wait_for_load_state("networkidle")
+    open_instant_form(page, nav_timeout_ms)
 
 
-def ensure_instant_form(page) -> bool:
+def open_session(page, nav_timeout_ms: int) -> None:
+    """
+    Reaproveita a sessao do perfil persistente: abre direto o Instant Quoting
+    e so faz login se o formulario nao aparecer.
+    """
+    page.goto(INSTANT_URL, wait_until="domcontentloaded", timeout=nav_timeout_ms)
+    deadline = time.time() + min(nav_timeout_ms, 15_000) / 1000
+    while time.time() < deadline:
+        if _visible(page, SEL_ORIGIN_INPUT):
+            log(f"Sessao reaproveitada do perfil {USER_DATA_DIR}.")
+            return
+        if AUTH_HOST in (page.url or ""):
+            break  # sessao expirada: o site mandou para o login
+        time.sleep(0.25)
+    login_cma(page, nav_timeout_ms)
+
+
+def ensure_instant_form(page, nav_timeout_ms: int = 30_000) -> bool:
     """
     Garante que estamos na tela de Instant Quoting.
-    Se não achar o campo de origem, tenta refazer login.
+    Se não achar o campo de origem, tenta recarregar e depois refazer login.
     Retorna True se conseguiu, False se falhou.
     """
-    try:
-        page.wait_for_selector(SEL_ORIGIN_INPUT, timeout=5_000)
+    if wait_instant_form(page, 2_000):
         return True
-    except PWTimeout:
-        # tenta login de novo
-        try:
-            print("[CMA] Formulário não encontrado. Refazendo login...")
-            login_cma(page)
-            page.wait_for_selector(SEL_ORIGIN_INPUT, timeout=10_000)
+    try:
+        if open_instant_form(page, nav_timeout_ms):
+            return True
+        print("[CMA] Formulário não encontrado. Refazendo login...")
+        login_cma(page, nav_timeout_ms)
+        return wait_instant_form(page, 10_000)
+    except Exception as e:
+        print(f"[CMA] Erro ao tentar garantir formulário: {e}")
+        return False
+
+
+def reload_form(page, nav_timeout_ms: int) -> bool:
+    """Recarrega a tela de cotacao (formulario limpo); refaz login se precisar."""
+    try:
+        if open_instant_form(page, nav_timeout_ms):
             return True
-        except Exception as e:
-            print(f"[CMA] Erro ao tentar garantir formulário: {e}")
-            return False
+    except Exception as e:
+        print(f"[CMA] Erro ao recarregar formulário: {e}")
+    return ensure_instant_form(page, nav_timeout_ms)
 
 
-def try_open_first_details(page) -> bool:
+def reset_quote_form(page) -> bool:
     """
-    Após clicar em 'Obter minha cotação', tenta abrir o primeiro Detalhes.
-    Retorna True se conseguiu, False se não havia detalhes (sem cotação).
-    Timeouts mais curtos pra não travar quando não tem rota.
+    Volta ao formulario sem recarregar a pagina: fecha o detalhe da cotacao
+    anterior e confere se o formulario esta utilizavel. False = recarregar.
     """
     try:
-        # tenta esperar a lista de resultados
-        page.wait_for_selector("ul.results-list", timeout=10_000)
-    except PWTimeout:
-        # nem lista de resultados apareceu -> provavelmente sem cotação
+        page.keyboard.press("Escape")
+        if _visible(page, SEL_RATE_TABLE_ROWS):
+            page.locator(SEL_RATE_TABLE_ROWS).first.wait_for(state="hidden", timeout=2_000)
+        origin = page.locator(SEL_ORIGIN_INPUT).first
+        origin.scroll_into_view_if_needed(timeout=2_000)
+        return origin.is_visible()
+    except Exception:
         return False
 
+
+# ----------------------------------------------------------------------
+# Preenchimento e busca
+# ----------------------------------------------------------------------
+def fill_place(page, input_sel: str, suggestions_sel: str, option1_sel: str, text: str, timeout_ms: int) -> None:
+    """
+    Preenche origem/destino e escolhe a sugestao. Com o formulario reaproveitado
+    a lista da rota anterior pode estar na tela: espera uma sugestao com o texto
+    digitado e so cai na primeira da lista se nenhuma casar.
+    """
+    page.fill(input_sel, "")
+    page.click(input_sel)
+    page.fill(input_sel, text)
+    matching = page.locator(suggestions_sel, has_text=re.compile(re.escape(text), re.I)).first
+    try:
+        matching.wait_for(state="visible", timeout=timeout_ms)
+        matching.click()
+        return
+    except PWTimeout:
+        pass
+    page.wait_for_selector(option1_sel, state="visible", timeout=timeout_ms)
+    page.click(option1_sel)
+
+
+def fill_quote_form(page, origin: str, dest: str, date_str: str, weight_kg: str, commodity: str, timeout_ms: int) -> None:
+    job_watchdog.check(page, "origem")
+    fill_place(page, SEL_ORIGIN_INPUT, SEL_ORIGIN_SUGGESTIONS, SEL_ORIGIN_OPTION1, origin, timeout_ms)
+    job_watchdog.check(page, "destino")
+    fill_place(page, SEL_DEST_INPUT, SEL_DEST_SUGGESTIONS, SEL_DEST_OPTION1, dest, timeout_ms)
+    print(f"[CMA] Origem/Destino preenchidos: {origin} -> {dest}")
+
+    job_watchdog.check(page, "data")
+    page.wait_for_selector(SEL_DEPARTURE_INPUT, state="visible", timeout=timeout_ms)
+    page.click(SEL_DEPARTURE_INPUT)
+    page.fill(SEL_DEPARTURE_INPUT, date_str)
+    page.keyboard.press("Tab")
+    print(f"[CMA] Data de partida = {date_str}")
+
+    # CONTAINER: 20ST Adicionar (no formulario reaproveitado ele ja esta la:
+    # o campo de peso so aparece com container adicionado)
+    job_watchdog.check(page, "container")
+    if _visible(page, SEL_WEIGHT_INPUT):
+        print("[CMA] Container 20ST ja presente no formulario.")
+    else:
+        page.wait_for_selector(SEL_ADD_20DRY, state="visible", timeout=timeout_ms)
+        page.click(SEL_ADD_20DRY)
+        print("[CMA] Container 20ST adicionado.")
+
+    page.wait_for_selector(SEL_WEIGHT_INPUT, state="visible", timeout=timeout_ms)
+    page.fill(SEL_WEIGHT_INPUT, weight_kg)
+    print(f"[CMA] Peso = {weight_kg} KGM.")
+
+    job_watchdog.check(page, "mercadoria")
+    page.wait_for_selector(SEL_COMMODITY_INPUT, state="visible", timeout=timeout_ms)
+    page.click(SEL_COMMODITY_INPUT)
+    option = page.locator(SEL_COMMODITY_OPTIONS, has_text=commodity).first
+    option.wait_for(state="visible", timeout=timeout_ms)
+    option.click()
+    print(f"[CMA] Mercadoria {commodity} selecionada.")
+
+
+NO_RESULTS_SIGNATURE = "__sem_resultado__"
+
+
+def _results_signature(page) -> str:
+    """
+    Estado da area de resultados: texto do primeiro card, marcador de "sem
+    resultado" ou "" (vazia/carregando). Distingue a busca nova da anterior.
+    """
+    if _visible(page, SEL_NO_RESULTS):
+        return NO_RESULTS_SIGNATURE
+    try:
+        card = page.locator(SEL_RESULT_CARD).first
+        if card.count() == 0:
+            return ""
+        return card.inner_text(timeout=1_000).strip()
+    except Exception:
+        return ""
+
+
+def wait_search_outcome(page, previous_signature: str, timeout_ms: int, empty_grace_ms: int = 1_500) -> str:
+    """
+    Espera o resultado da busca por elementos, nao por networkidle. O que
+    estava na tela antes da busca so conta depois que a area muda ou esvazia
+    (carregando):
+    - "results": card novo com Detalhes;
+    - "empty": aviso de sem resultado, lista nova sem Detalhes por `empty_grace_ms`,
+      ou nenhuma lista ate o prazo (mesma regra de antes: sem lista = sem cotacao);
+    - "stale": os cards da rota anterior continuaram na tela ate o prazo.
+    """
+    deadline = job_watchdog.cap_deadline(time.time() + timeout_ms / 1000)
+    fresh = not previous_signature
+    list_without_details_since = None
+    while time.time() < deadline:
+        job_watchdog.check(page, "resultados")
+        signature = _results_signature(page)
+        if signature != previous_signature:
+            fresh = True
+        if fresh and signature == NO_RESULTS_SIGNATURE:
+            return "empty"
+        if fresh and signature and _visible(page, SEL_DETAILS_FIRST):
+            return "results"
+        if fresh and _visible(page, SEL_RESULTS_LIST):
+            list_without_details_since = list_without_details_since or time.time()
+            if (time.time() - list_without_details_since) * 1000 >= empty_grace_ms:
+                return "empty"
+        else:
+            list_without_details_since = None
+        time.sleep(0.25)
+    if not fresh and previous_signature != NO_RESULTS_SIGNATURE:
+        return "stale"
+    return "empty"
+
+
+def try_open_first_details(page, timeout_ms: int) -> bool:
+    """
+    Com resultados na tela, abre o primeiro Detalhes e espera a tabela de rate.
+    Retorna False se o clique ou a tabela falharem.
+    """
     details_loc = page.locator(SEL_DETAILS_FIRST)
     if details_loc.count() == 0:
         return False
@@ -292,19 +556,49 @@ def try_open_first_details(page) -> bool:
     details_btn.scroll_into_view_if_needed()
     try:
         details_btn.click(timeout=4_000)
+        page.wait_for_selector(SEL_RATE_TABLE_ROWS, state="visible", timeout=timeout_ms)
     except PWTimeout:
         return False
 
     return True
 
 
-def parse_rate_table(page, base_record: dict) -> dict:
+def read_first_offer_transit_days(page) -> str:
+    """Transit time do primeiro card (ex.: "25 days"), em dias; "" se nao achar."""
+    try:
+        text = page.locator(SEL_RESULT_CARD).first.inner_text(timeout=1_000)
+    except Exception:
+        return ""
+    match = TRANSIT_DAYS_RE.search(text or "")
+    return match.group(1) if match else ""
+
+
+def total_to_usd(record: dict) -> None:
+    """
+    A comparacao so usa o total em USD: converte total_all_in de outra moeda
+    (original fica em total_original). Sem cambio, o total segue na moeda
+    original e a comparacao deixa a rota sem preco.
     """
-    Lê a tabela de rate (aba 'rate') e devolve o record atualizado com:
-      - colunas de cada tipo de cobrança (Frete Marítimo, etc.)
+    value, currency = record.get("total_all_in"), (record.get("total_currency") or "").strip().upper()
+    if not isinstance(value, float) or not currency or currency == "USD":
+        return
+    usd = fx_rates.amount_to_usd(value, currency, log_fn=log)
+    if usd is None:
+        log(f"Total em {currency} sem cambio para USD; rota fica sem preco na comparacao.")
+        return
+    record["total_original"] = f"{value:.2f} {currency}"
+    record["total_all_in"] = round(usd, 2)
+    record["total_currency"] = "USD"
+
+
+def parse_rate_table(page) -> dict:
+    """
+    Lê a tabela de rate (aba 'rate') e devolve o breakdown:
+      - uma coluna por cobrança (Frete Marítimo, etc.) com a gêmea `<cobrança> | Curr`
+        (moeda da cobrança, mesmo padrão da Hapag);
       - total_all_in, total_currency
     """
-    record = base_record.copy()
+    record = {}
 
     rows = page.locator(SEL_RATE_TABLE_ROWS)
     try:
@@ -343,7 +637,7 @@ def parse_rate_table(page, base_record: dict) -> dict:
 
         # nome da coluna = texto da cobrança
         record[charge_name] = amount_value
-        # (se quiser moeda por cobrança, pode criar colunas extras aqui)
+        record[f"{charge_name} | Curr"] = currency_text
 
     # total all in
     try:
@@ -370,14 +664,71 @@ def parse_rate_table(page, base_record: dict) -> dict:
         # se não achar, deixa como está
         pass
 
+    total_to_usd(record)
     return record
 
 
+def quote_route(page, job: dict, settings: dict) -> tuple[str, str, dict]:
+    """
+    Uma rota no formulario ja aberto: preenche, busca e le o breakdown.
+    Devolve (status, message, charges) no esquema de status da Hapag.
+    """
+    date_str = (date.today() + timedelta(days=settings["date_plus_days"])).strftime("%d/%m/%Y")
+    previous_signature = _results_signature(page)
+
+    fill_quote_form(
+        page,
+        job["origin"],
+        job["destination"],
+        date_str,
+        settings["weight_kg"],
+        settings["commodity"],
+        settings["action_timeout_ms"],
+    )
+
+    job_watchdog.check(page, "busca")
+    page.wait_for_selector(SEL_SEARCH_QUOTE, state="visible", timeout=settings["action_timeout_ms"])
+    page.click(SEL_SEARCH_QUOTE)
+    print("[CMA] 'Obter minha cotação' clicado.")
+
+    outcome = wait_search_outcome(page, previous_signature, settings["results_timeout_ms"])
+    if outcome == "stale":
+        return "error", "Lista de resultados nao atualizou apos a busca.", {}
+    if outcome == "empty":
+        return "no_quote", "Nenhuma cotação SPOT encontrada (sem botão Detalhes).", {}
+
+    transit_days = read_first_offer_transit_days(page)
+    if not try_open_first_details(page, settings["results_timeout_ms"]):
+        return "no_quote", "Nenhuma cotação SPOT encontrada (sem botão Detalhes).", {}
+
+    print("[CMA] Detalhes da rota abertos. Lendo tabela de rate...")
+    charges = parse_rate_table(page)
+    charges["transit_time_days"] = transit_days
+    return "success", "", charges
+
+
 # ----------------------------------------------------------------------
 # Fluxo principal
 # ----------------------------------------------------------------------
-def run_batch(headless: bool = False):
-    # Lê registros anteriores (pra saber prioridade e manter histórico)
+def run_batch(headless: bool | None = None):
+    global ACCOUNT, USER_DATA_DIR
+    load_dotenv(PROJECT_ROOT / ".env", override=False)
+    if headless is None:
+        headless = parse_env_bool("CMA_HEADLESS", default=True)
+    settings = {
+        "action_timeout_ms": int(os.getenv("CMA_ACTION_TIMEOUT_MS", "15000")),
+        "results_timeout_ms": int(os.getenv("CMA_RESULTS_TIMEOUT_MS", "30000")),
+        "date_plus_days": int(os.getenv("CMA_DATE_PLUS_DAYS", "7")),
+        "weight_kg": os.getenv("CMA_WEIGHT_KG", "26000"),
+        "commodity": os.getenv("CMA_COMMODITY", "FAK"),
+    }
+    nav_timeout_ms = int(os.getenv("CMA_NAV_TIMEOUT_MS", "30000"))
+    reload_every = max(0, int(os.getenv("CMA_RELOAD_EVERY", "25")))
+    keep_open_secs = float(os.getenv("CMA_KEEP_OPEN_SECS", "0"))
+
+    # Lê registros anteriores (pra saber prioridade e manter histórico);
+    # o store de cotacoes reexporta o CSV antes, se um run anterior caiu sem exportar
+    quote_store.sync_csv("cma", CSV_FILE, log_fn=log)
     records = load_previous_records()
 
     # Lê jobs do Excel
@@ -388,166 +739,194 @@ def run_batch(headless: bool = False):
         raise ValueError("Excel precisa ter colunas 'ORIGEM' e 'PORTO DE DESTINO'.")
 
     # Ordena jobs com base no CSV de saída (prioridade)
-    jobs = build_sorted_jobs_from_excel_and_records(df, records)
+    jobs = [
+        {"origin": origin, "destination": dest, "key": f"{origin}-{dest}"}
+        for origin, dest in build_sorted_jobs_from_excel_and_records(df, records)
+    ]
     print(f"[CMA] Total de jobs carregados do Excel: {len(jobs)}")
-
-    with sync_playwright() as p:
-        # Contexto persistente com user_data_dir fixo (.pw-user-data-cma)
-        context = p.chromium.launch_persistent_context(
-            user_data_dir=str(USER_DATA_DIR),
-            headless=headless,
+    jobs = route_scheduler.restrict_to_routes_file(jobs, log_fn=log)
+    use_queue = job_queue.queue_enabled()
+    if SHARD_COUNT > 1 and not use_queue:
+        # round-robin sobre a fila ja ordenada (com SCRAPER_JOB_QUEUE os shards
+        # dividem a fila inteira dinamicamente).
+        jobs = [job for pos, job in enumerate(jobs) if pos % SHARD_COUNT == SHARD_INDEX]
+        log(f"[shard] {SHARD_INDEX + 1}/{SHARD_COUNT}: {len(jobs)} jobs nesta fatia; saida em {SHARD_CSV_FILE}")
+    # na fila compartilhada os shards executam o mesmo plano em paralelo
+    schedule = route_scheduler.plan_routes(
+        "cma", jobs, key_fn=lambda j: j["key"], log_fn=log, processes=SHARD_COUNT if use_queue else 1
+    )
+    jobs = schedule["jobs"]
+    # na fila compartilhada o total por processo e uma estimativa (fila / shards)
+    expected_jobs = -(-len(jobs) // SHARD_COUNT) if use_queue else len(jobs)
+    if use_queue:
+        added = job_queue.enqueue("cma", jobs, key_fn=lambda j: j["key"])
+        log(
+            f"[fila] {job_queue.queue_name()}: {added} rotas publicadas (demais ja estavam na fila); "
+            f"worker {job_queue.worker_id()}."
         )
-        page = context.new_page()
-
-        # login inicial
-        login_cma(page)
-
-        for idx, (origin, dest) in enumerate(jobs, start=1):
-            print(f"\n[CMA] ==== Job {idx}/{len(jobs)}: {origin} -> {dest} ====")
-
-            # chave única por lead (origem-destino)
-            now_iso = datetime.utcnow().isoformat()
-            key = f"{origin}-{dest}"
-
-            # Record base: se já existir, começamos dele (pra manter valores antigos em caso de erro)
-            base_record = records.get(key, {}).copy()
-            base_record.setdefault("key", key)
-            base_record["origin"] = origin
-            base_record["destination"] = dest
-            base_record["last_attempt_at"] = now_iso
-            # quoted_at só será atualizado em caso de sucesso
-            base_record.setdefault("quoted_at", "")
-
-            # Data-alvo: hoje + 7
-            target_date = date.today() + timedelta(days=7)
-            date_str = target_date.strftime("%d/%m/%Y")
-
-            # Garante que estamos na tela de instant quoting
-            if not ensure_instant_form(page):
-                # erro de login / form indisponível
-                base_record["status"] = "error"
-                base_record["message"] = "Não foi possível carregar formulário de cotação (login falhou)."
-                records[key] = base_record
-                print("[CMA] Erro: formulário não disponível, seguindo para próximo job.")
-
-                # atualiza CSV imediatamente
-                write_all_records(records)
-                continue
+    progress_events.emit(
+        "batch_start",
+        carrier="cma",
+        total=expected_jobs,
+        deferred=len(schedule["deferred"]),
+        shard_index=SHARD_INDEX,
+        shard_count=SHARD_COUNT,
+    )
+
+    # conta do pool (CMA_ACCOUNTS), com perfil de navegador proprio
+    ACCOUNT = account_pool.acquire("cma", log_fn=log)
+    # daqui em diante qualquer falha (launch, login, batch) devolve a conta
+    try:
+        USER_DATA_DIR = account_pool.profile_dir(USER_DATA_DIR, ACCOUNT)
+        USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+        with sync_playwright() as p:
+            # Contexto persistente com user_data_dir fixo: cookies de login valem entre runs
+            context = p.chromium.launch_persistent_context(
+                user_data_dir=str(USER_DATA_DIR),
+                headless=headless,
+            )
 
+            def setup_page(new_page):
+                new_page.set_default_timeout(settings["action_timeout_ms"])
+                new_page.set_default_navigation_timeout(nav_timeout_ms)
+
+            page = context.pages[0] if context.pages else context.new_page()
+            setup_page(page)
+            log(f"Modo {'headless' if headless else 'com janela'}; perfil {USER_DATA_DIR}.")
+
+            # sessao do perfil (login so se ela expirou)
+            open_session(page, nav_timeout_ms)
+
+            watchdog_on = job_watchdog.watchdog_enabled()
+            export_every = quote_store.export_every()
+            csv_export = {"from_store": True}
+            # o formulario e reaproveitado entre rotas; recarrega so quando ele quebra,
+            # a cada CMA_RELOAD_EVERY rotas ou com aba nova
+            form_dirty = False
+            since_reload = 0
+            rate_on = rate_control.control_enabled()
+            if rate_on:
+                log(rate_control.describe("cma"))
+            in_flight = None
             try:
-                # Limpa e preenche origem
-                page.fill(SEL_ORIGIN_INPUT, "")
-                page.click(SEL_ORIGIN_INPUT)
-                page.fill(SEL_ORIGIN_INPUT, origin)
-                page.wait_for_selector(SEL_ORIGIN_OPTION1, timeout=30_000)
-                page.click(SEL_ORIGIN_OPTION1)
-
-                # Limpa e preenche destino
-                page.fill(SEL_DEST_INPUT, "")
-                page.click(SEL_DEST_INPUT)
-                page.fill(SEL_DEST_INPUT, dest)
-                page.wait_for_selector(SEL_DEST_OPTION1, timeout=30_000)
-                page.click(SEL_DEST_OPTION1)
-
-                print(f"[CMA] Origem/Destino preenchidos: {origin} -> {dest}")
-
-                # DATA: hoje + 7 dias
-                page.wait_for_selector(SEL_DEPARTURE_INPUT, timeout=30_000)
-                page.click(SEL_DEPARTURE_INPUT)
-                page.fill(SEL_DEPARTURE_INPUT, date_str)
-                page.keyboard.press("Tab")
-                print(f"[CMA] Data de partida = {date_str}")
-
-                # CONTAINER: 20ST Adicionar
-                page.wait_for_selector(SEL_ADD_20DRY, timeout=30_000)
-                page.click(SEL_ADD_20DRY)
-                print("[CMA] Container 20ST adicionado.")
-
-                # PESO: 26000
-                page.wait_for_selector(SEL_WEIGHT_INPUT, timeout=30_000)
-                page.fill(SEL_WEIGHT_INPUT, "26000")
-                print("[CMA] Peso = 26000 KGM.")
-
-                # MERCADORIA: FAK
-                page.wait_for_selector(SEL_COMMODITY_INPUT, timeout=30_000)
-                page.click(SEL_COMMODITY_INPUT)
-                page.wait_for_timeout(500)
-                fak_option = page.locator(
-                    "div.el-select__popper[aria-hidden='false'] "
-                    "li.el-select-dropdown__item",
-                    has_text="FAK",
+                # com a fila, a conta bloqueada para de pegar rotas e as demais ficam para as outras contas
+                job_source = (
+                    account_pool.until_locked(job_queue.leased_jobs("cma", log_fn=log), ACCOUNT, log_fn=log)
+                    if use_queue
+                    else jobs
                 )
-                fak_option.first.wait_for(state="visible", timeout=30_000)
-                fak_option.first.click()
-                print("[CMA] Mercadoria FAK selecionada.")
-
-                # Obter cotação
-                page.wait_for_selector(SEL_SEARCH_QUOTE, timeout=30_000)
-                page.click(SEL_SEARCH_QUOTE)
-                print("[CMA] 'Obter minha cotação' clicado.")
-
-                page.wait_for_load_state("networkidle")
-
-                # Tentar abrir primeiros detalhes
-                has_details = try_open_first_details(page)
-                if not has_details:
-                    # sem cotação
-                    base_record["status"] = "no_quote"
-                    base_record["message"] = "Nenhuma cotação SPOT encontrada (sem botão Detalhes)."
-                    records[key] = base_record
-                    print("[CMA] Nenhuma cotação encontrada para este par. Indo para próximo job.")
-
-                    # volta para tela principal
+                for idx, job in enumerate(job_source, start=1):
+                    if route_scheduler.defer_if_late(schedule, job, key_fn=lambda j: j["key"], log_fn=log):
+                        if use_queue:
+                            job_queue.ack("cma", job["key"], "deferred")
+                        continue
+                    origin, dest, key = job["origin"], job["destination"], job["key"]
+                    in_flight = key
+                    if rate_on:
+                        # com shards, a vaga/token e dividida com os outros processos da CMA
+                        rate_control.wait_start("cma", 0, log_fn=log)
+                        if use_queue and not job_queue.renew("cma", key):
+                            # a espera pela vaga venceu o lease: outro processo ja pegou a rota
+                            log(f"[fila] {key}: lease perdido na espera do ritmo; pulando a rota.")
+                            in_flight = None
+                            rate_control.cancel("cma", 0)
+                            continue
+                    print(f"\n[CMA] ==== Job {idx}/{expected_jobs}: {origin} -> {dest} ====")
+                    started_at = datetime.now().isoformat(timespec="seconds")
+                    t0 = time.monotonic()
+                    progress_events.emit("job_start", carrier="cma", idx=idx, total=expected_jobs, key=key)
+                    if watchdog_on:
+                        budget_sec, budget_source = job_watchdog.route_budget_sec("cma", key)
+                        job_watchdog.start_job(budget_sec, page, settings["action_timeout_ms"], nav_timeout_ms)
+                        log(f"[watchdog] orcamento do job: {budget_sec:.0f}s ({budget_source})")
+
+                    status, message, charges = "error", "", {}
                     try:
-                        page.goto(INSTANT_URL, timeout=90_000)
-                        page.wait_for_load_state("networkidle")
-                    except Exception:
-                        pass
-
-                    # atualiza CSV imediatamente
-                    write_all_records(records)
-                    continue
-
-                print("[CMA] Detalhes da rota abertos. Lendo tabela de rate...")
-
-                # Espera tabela de rate e parseia
-                page.wait_for_selector(SEL_RATE_TABLE_ROWS, timeout=60_000)
-                record_ok = parse_rate_table(page, base_record)
-                record_ok["status"] = "success"
-                record_ok["message"] = ""
-                record_ok["quoted_at"] = now_iso
-
-                records[key] = record_ok
-                print("[CMA] Cotação lida e registrada com sucesso.")
-
-                # Volta para tela principal para próximo job
-                try:
-                    page.goto(INSTANT_URL, timeout=90_000)
-                    page.wait_for_load_state("networkidle")
-                except Exception:
-                    pass
-
-            except Exception as e:
-                # qualquer erro nessa rota -> marca como error, mantendo valores antigos se houver
-                base_record["status"] = "error"
-                base_record["message"] = f"Erro durante cotação: {e}"
-                records[key] = base_record
-                print(f"[CMA] Erro durante job {origin}->{dest}: {e}")
-
-                # tenta voltar para tela principal pra não travar próximo job
-                try:
-                    page.goto(INSTANT_URL, timeout=90_000)
-                    page.wait_for_load_state("networkidle")
-                except Exception:
-                    pass
-
-            # >>> AQUI: após CADA job, escreve o CSV atualizado <<<
-            write_all_records(records)
-
-        context.close()
-
-    print(f"\n[CMA] Processamento concluído. CSV atualizado em: {CSV_FILE}")
+                        if reload_every and since_reload >= reload_every:
+                            form_dirty = True
+                        if idx > 1 and not form_dirty and not reset_quote_form(page):
+                            form_dirty = True
+                        if form_dirty:
+                            since_reload = 0
+                            if not reload_form(page, nav_timeout_ms):
+                                raise RuntimeError("Não foi possível carregar formulário de cotação (login falhou).")
+                            form_dirty = False
+                        since_reload += 1
+                        status, message, charges = quote_route(page, job, settings)
+                    except Exception as e:
+                        # qualquer erro nessa rota -> marca como error, mantendo valores antigos se houver
+                        status, message, charges = "error", f"Erro durante cotação: {e}", {}
+                        print(f"[CMA] Erro durante job {origin}->{dest}: {e}")
+                    if status == "error":
+                        # estado do formulario desconhecido: a proxima rota recarrega a tela
+                        form_dirty = True
+
+                    if status == "error" and job_watchdog.expired():
+                        status = job_watchdog.TIMEOUT_STATUS
+                        message = (
+                            f"Job excedeu o orcamento de {job_watchdog.budget_sec():.0f}s "
+                            f"(ultimo erro: {message or '-'})."
+                        )
+                        page = job_watchdog.recycle_page(context, page, setup_page)
+                        log("[watchdog] aba recriada para o proximo job.")
+                    job_watchdog.finish_job()
+
+                    upsert_record(records, job, status, message, charges)
+                    if status == "success":
+                        print("[CMA] Cotação lida e registrada com sucesso.")
+                    elif status == "no_quote":
+                        print("[CMA] Nenhuma cotação encontrada para este par. Indo para próximo job.")
+
+                    # >>> AQUI: após CADA job, grava a tentativa (store + CSV periódico) <<<
+                    persist_job(records, key, idx, export_every, csv_export)
+                    latency_sec = time.monotonic() - t0
+                    run_history.record_route_attempt(
+                        carrier="cma",
+                        route_key=key,
+                        origin=origin,
+                        destination=dest,
+                        status=status,
+                        latency_sec=latency_sec,
+                        message=message,
+                        started_at=started_at,
+                    )
+                    progress_events.emit(
+                        "job_end", carrier="cma", idx=idx, key=key, status=status, duration_sec=round(latency_sec, 3)
+                    )
+                    # ack so depois da tentativa gravada: processo que cai antes disso devolve a rota a fila
+                    if use_queue and not job_queue.ack("cma", key, status):
+                        log(f"[fila] {key}: lease perdido antes do fim (outro processo pode refazer a rota).")
+                    in_flight = None
+                    lock_reason = account_pool.record_job(ACCOUNT, status, message)
+                    if lock_reason:
+                        log(f"[contas] cma/{ACCOUNT['id']} bloqueada: {lock_reason}.")
+                    if rate_on:
+                        rate_control.finish(
+                            "cma", 0, status, latency_sec, pressure=status == job_watchdog.TIMEOUT_STATUS, log_fn=log
+                        )
+            finally:
+                # CSV final com todos os jobs (tambem se o batch quebrar no meio)
+                export_records(records, csv_export)
+                if use_queue and in_flight is not None:
+                    # rota em curso volta para a fila para outro processo
+                    job_queue.release("cma", in_flight)
+                if rate_on:
+                    rate_control.release_holder("cma")
+
+            # tabela longa de charges (particoes por data)
+            charge_store.export_partitions("cma", to_usd=partial(fx_rates.amount_to_usd, log_fn=log), log_fn=log)
+            progress_events.emit("batch_end", carrier="cma", deferred=len(schedule["deferred"]))
+            deferred_report = route_scheduler.write_deferred_report(schedule)
+            if deferred_report is not None:
+                log(f"[deadline] {len(schedule['deferred'])} rotas adiadas; relatorio em {deferred_report}")
+            time.sleep(max(0.0, keep_open_secs))
+            context.close()
+    finally:
+        account_pool.release(ACCOUNT)
+
+    print(f"\n[CMA] Processamento concluído. CSV atualizado em: {SHARD_CSV_FILE}")
 
 
 if __name__ == "__main__":
-    run_batch(headless=False)
+    run_batch()
@@ -0,0 +1,65 @@
+"""
+Cambio para USD usado pelos scrapers Maersk e CMA (API Frankfurter, `FX_API_BASE`).
+
+A taxa de cada moeda e buscada uma vez por processo (cache por moeda e funcao
+de log). Sem resposta da API, usa a taxa aproximada de `APPROX_RATES_TO_USD`
+quando houver; senao devolve None e o valor fica sem conversao.
+"""
+
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+from typing import Callable, Optional
+
+import requests
+
+DEFAULT_FX_API_BASE = "https://api.frankfurter.dev/v1/latest"
+
+# Taxas aproximadas quando a API nao tem a moeda (ajuste conforme quiser)
+APPROX_RATES_TO_USD = {
+    "COP": 0.00025,  # COP 1 = 0.00025 USD
+}
+
+
+def fx_rate_to_usd(from_currency: Optional[str], log_fn: Callable[[str], None] = print) -> Optional[float]:
+    code = (from_currency or "").strip().upper()
+    if not code:
+        return None
+    if code == "USD":
+        return 1.0
+    return _fetch_rate_to_usd(code, log_fn)
+
+
+@lru_cache(maxsize=64)
+def _fetch_rate_to_usd(code: str, log_fn: Callable[[str], None]) -> Optional[float]:
+    # lido na chamada: os scrapers carregam o .env depois dos imports
+    api_base = os.getenv("FX_API_BASE", DEFAULT_FX_API_BASE)
+    try:
+        resp = requests.get(api_base, params={"base": code, "symbols": "USD"}, timeout=5)
+        resp.raise_for_status()
+        data = resp.json()
+        rate = (data.get("rates") or {}).get("USD")
+        if rate is not None:
+            return float(rate)
+        log_fn(f"FX: resposta sem rate para {code}->USD. payload={data}")
+    except Exception as e:
+        log_fn(f"FX: erro ao buscar {code}->USD ({type(e).__name__}: {e})")
+
+    if code in APPROX_RATES_TO_USD:
+        log_fn(f"FX: usando taxa aproximada para {code} -> USD.")
+        return APPROX_RATES_TO_USD[code]
+    return None
+
+
+def amount_to_usd(
+    amount: Optional[float],
+    from_currency: Optional[str],
+    log_fn: Callable[[str], None] = print,
+) -> Optional[float]:
+    if amount is None:
+        return None
+    rate = fx_rate_to_usd(from_currency, log_fn)
+    if rate is None:
+        return None
+    return float(amount) * rate
@@ -2,6 +2,7 @@
 
 import os
 import csv
+import sys
 import time
 import subprocess
 import shutil
@@ -10,10 +11,25 @@ from pathlib import Path
 from datetime import datetime, timedelta
 import re
 import unicodedata
+from contextlib import contextmanager
 
 import pandas as pd
 from dotenv import load_dotenv
-from playwright.sync_api import TimeoutError as PWTimeout
+from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
+
+import browser_pool
+import job_watchdog
+import route_scheduler
+
+# historico de runs (SQLite) fica em src/orchestration
+sys.path.append(str(Path(__file__).resolve().parents[1] / "orchestration"))
+import account_pool  # noqa: E402
+import charge_store  # noqa: E402
+import job_queue  # noqa: E402
+import progress_events  # noqa: E402
+import quote_store  # noqa: E402
+import rate_control  # noqa: E402
+import run_history  # noqa: E402
 
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 PROJECT_RUNTIME_DIR = PROJECT_ROOT / "artifacts" / "runtime"
@@ -65,6 +81,17 @@ NEW_QUOTE_URL = "https://www.hapag-lloyd.com/solutions/new-quote/#/simple?langua
 JOBS_XLSX = PROJECT_ROOT / "artifacts" / "input" / "hapag_jobs.xlsx"
 OUTPUT_CSV = PROJECT_ROOT / "artifacts" / "output" / "hapag_breakdowns.csv"
 LOGS_DIR = PROJECT_ROOT / "artifacts" / "logs"
+
+# Shards (runner --shards): cada processo pega uma fatia deterministica da fila
+# priorizada e grava em arquivo proprio; o runner mescla no OUTPUT_CSV depois
+# (mesma convencao de nome de src/orchestration/shard_merge.py).
+SHARD_INDEX = int(os.getenv("SCRAPER_SHARD_INDEX", "0"))
+SHARD_COUNT = max(1, int(os.getenv("SCRAPER_SHARD_COUNT", "1")))
+SHARD_OUTPUT_CSV = (
+    OUTPUT_CSV.parent / "shards" / f"{OUTPUT_CSV.stem}.shard{SHARD_INDEX}{OUTPUT_CSV.suffix}"
+    if SHARD_COUNT > 1
+    else OUTPUT_CSV
+)
 for _path in [
     PROJECT_RUNTIME_DIR,
     HAPAG_LOCAL_RUNTIME_DIR,
@@ -245,8 +272,14 @@ _LOG_CTX = {
     "job_total": 0,
     "last_stage_status": None,
     "last_stage": "ETAPA",
+    "tab": 0,
 }
 _CURRENT_ROUTE = {"origin": "NA", "destination": "NA"}
+# Pool de abas (HAPAG_TABS > 1): abas de cotacao ativas e a aba dona do contexto de log atual.
+_TAB_POOL_PAGES: list = []
+# Security Checks vistos no processo (sinal de pressao para src/orchestration/rate_control.py)
+SECURITY_CHECKS = {"n": 0}
+_ACTIVE_TAB = {"tab": None}
 _DEBUG_LOG_FILE: Path | None = None
 
 
@@ -262,9 +295,27 @@ def _normalize_for_match(text: str) -> str:
 def _counter_label() -> str:
     idx = int(_LOG_CTX.get("job_idx") or 0)
     total = int(_LOG_CTX.get("job_total") or 0)
+    tab = f" aba{_LOG_CTX['tab']}" if _LOG_CTX.get("tab") else ""
     if total > 0:
-        return f"({idx}/{total})"
-    return f"({idx}/?)"
+        return f"({idx}/{total}{tab})"
+    return f"({idx}/?{tab})"
+
+
+def _switch_to_tab(tab: dict) -> None:
+    """
+    Pool de abas: guarda o contexto de log/rota (contador, etapa, origem/destino)
+    da aba anterior e carrega o desta, para logs e screenshots sairem com a rota certa.
+    """
+    current = _ACTIVE_TAB["tab"]
+    if current is tab:
+        return
+    if current is not None:
+        current["log_ctx"] = dict(_LOG_CTX)
+        current["route"] = dict(_CURRENT_ROUTE)
+    _LOG_CTX.update(tab.get("log_ctx") or {"job_idx": 0, "job_total": 0, "last_stage_status": None, "last_stage": "ETAPA"})
+    _LOG_CTX["tab"] = tab["n"] if _TAB_POOL_PAGES else 0
+    _CURRENT_ROUTE.update(tab.get("route") or {"origin": "NA", "destination": "NA"})
+    _ACTIVE_TAB["tab"] = tab
 
 
 def _infer_stage(msg_text: str, current_stage: str = "ETAPA") -> str:
@@ -405,6 +456,7 @@ def _to_structured_terminal_line(msg: str) -> str | None:
     if event_key == _LOG_CTX["last_stage_status"]:
         return None
     _LOG_CTX["last_stage_status"] = event_key
+    progress_events.emit("step", carrier="hapag", idx=_LOG_CTX["job_idx"], step=stage, status=status)
 
     return f"{_counter_label()} | {stage} | {status}"
 
@@ -422,6 +474,12 @@ def log(msg: str) -> None:
     debug_log(f"[TERMINAL] {structured}")
 
 
+def log_plain(msg: str) -> None:
+    """Mensagem operacional fora do formato estruturado (ex.: plano por deadline)."""
+    print(f"{_timestamp_prefix()} {msg}")
+    debug_log(f"[TERMINAL] {msg}")
+
+
 def parse_env_bool(name: str, default: bool = False) -> bool:
     raw = os.getenv(name)
     if raw is None:
@@ -552,7 +610,8 @@ def _ensure_debug_log_file() -> Path | None:
         return None
     if _DEBUG_LOG_FILE is None:
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        _DEBUG_LOG_FILE = LOGS_DIR / f"{ts}_hapag_headless_debug.log"
+        shard_suffix = f"_shard{SHARD_INDEX}" if SHARD_COUNT > 1 else ""
+        _DEBUG_LOG_FILE = LOGS_DIR / f"{ts}_hapag_headless_debug{shard_suffix}.log"
         with _DEBUG_LOG_FILE.open("a", encoding="utf-8") as f:
             f.write(f"{_timestamp_prefix()} [DEBUG] session_start\n")
     return _DEBUG_LOG_FILE
@@ -610,9 +669,13 @@ def _is_security_check_page(page) -> bool:
     return any(m in body_norm for m in text_markers)
 
 
-def _security_check_pages(context):
+def _security_check_pages(context, page=None):
+    # pool de abas: Security Check em outra aba de cotacao e tratado pela propria aba
+    others = [t for t in _TAB_POOL_PAGES if t is not page] if page is not None else []
     pages = []
     for p in list(context.pages):
+        if any(p is t for t in others):
+            continue
         try:
             if _is_security_check_page(p):
                 pages.append(p)
@@ -626,11 +689,15 @@ def _security_check_pages(context):
 # ----------------------------------------------------------------------
 
 load_dotenv(PROJECT_ROOT / ".env", override=False)
-HL_USER = os.getenv("HL_USER")
-HL_PASS = os.getenv("HL_PASS")
+# conta da sessao: HL_USER/HL_PASS ou uma conta de HL_ACCOUNTS (use_account)
+HL_USER = None
+HL_PASS = None
+
 
-if not HL_USER or not HL_PASS:
-    raise RuntimeError("Defina HL_USER e HL_PASS no .env")
+def use_account(account: dict) -> None:
+    """Credenciais usadas pelo login_hapag (conta do src/orchestration/account_pool.py)."""
+    global HL_USER, HL_PASS
+    HL_USER, HL_PASS = account["user"], account["password"]
 
 
 # ----------------------------------------------------------------------
@@ -722,22 +789,56 @@ def upsert_charges_in_cache(rows_cache, charges, origin, destination, status, me
 
 
 def flush_rows_cache_to_csv(rows_cache, csv_path: Path, emit_log: bool = True):
-    csv_path.parent.mkdir(parents=True, exist_ok=True)
-
     fieldnames = _all_fieldnames_from_cache(rows_cache)
 
-    with csv_path.open("w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for key in sorted(rows_cache.keys()):
-            row = rows_cache[key]
-            out_row = {field: row.get(field, "") for field in fieldnames}
-            writer.writerow(out_row)
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open("w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for key in sorted(rows_cache.keys()):
+                row = rows_cache[key]
+                out_row = {field: row.get(field, "") for field in fieldnames}
+                writer.writerow(out_row)
+
+    # escreve num tmp e troca: queda no meio da escrita nao corrompe o CSV
+    quote_store.replace_file(csv_path, write)
 
     if emit_log:
         log(f"CSV atualizado em {csv_path} com {len(rows_cache)} linhas (1 por key).")
 
 
+def export_breakdowns_csv(rows_cache, csv_path: Path, csv_export: dict, emit_log: bool = True):
+    """
+    Reescreve o CSV de breakdown a partir da visao de exportacao do store e
+    converte as colunas com Curr para USD. Com o store desligado (ou depois de
+    uma tentativa que nao entrou no store) o CSV sai do cache de linhas.
+    As taxas ficam em `csv_export["rates"]` (uma busca por batch); se a busca
+    falhar, o CSV fica nas moedas originais e a conversao so e tentada de novo
+    no fim do scraper.
+    """
+    exported = quote_store.export_view("hapag", csv_path) if csv_export["from_store"] else None
+    if exported is None:
+        flush_rows_cache_to_csv(rows_cache, csv_path, emit_log=emit_log)
+    elif emit_log:
+        log(f"CSV exportado do store em {csv_path} com {exported} linhas (1 por key).")
+
+    if csv_export["rates"] is None and csv_export["fx_failed"]:
+        return
+    try:
+        csv_export["rates"] = convert_currency_columns_in_csv_to_usd(
+            csv_path=csv_path,
+            out_path=csv_path,
+            round_decimals=2,
+            keep_original=False,
+            timeout=20,
+            rates=csv_export["rates"],
+            emit_log=emit_log,
+        )
+    except Exception as e:
+        csv_export["fx_failed"] = True
+        log_plain(f"[FX] Conversao para USD adiada (CSV nas moedas originais): {e!r}")
+
+
 def _parse_iso_or_none(value):
     if not value:
         return None
@@ -792,11 +893,12 @@ def build_history_from_rows_cache(rows_cache):
 # ----------------------------------------------------------------------
 def wait_cloudflare_if_needed(page, max_wait_sec=120):
     """
-    Detecta Security Check em QUALQUER aba do contexto e aguarda liberação.
+    Detecta Security Check em QUALQUER aba do contexto e aguarda liberação
+    (com pool de abas, menos as outras abas de cotacao).
     Retorna True quando não há challenge ativo; False em timeout.
     """
     try:
-        sec_pages = _security_check_pages(page.context)
+        sec_pages = _security_check_pages(page.context, page)
     except Exception:
         sec_pages = []
 
@@ -811,6 +913,7 @@ def wait_cloudflare_if_needed(page, max_wait_sec=120):
             pass
 
     log("Cloudflare Security Check detectado.")
+    SECURITY_CHECKS["n"] += 1
     if _headless_enabled():
         log(f"Security Check em headless; aguardando liberacao automatica ({max_wait_sec}s).")
     else:
@@ -823,11 +926,11 @@ def wait_cloudflare_if_needed(page, max_wait_sec=120):
         "security_check_detected",
     )
 
-    deadline = time.time() + float(max_wait_sec)
+    deadline = job_watchdog.cap_deadline(time.time() + float(max_wait_sec))
     while time.time() < deadline:
         time.sleep(1.0)
         try:
-            sec_pages = _security_check_pages(page.context)
+            sec_pages = _security_check_pages(page.context, page)
         except Exception:
             sec_pages = []
         if not sec_pages:
@@ -898,6 +1001,18 @@ def login_hapag(page):
     log("Login Hapag: tentativa concluida.")
 
 
+def hapag_session_alive(page) -> bool:
+    """Abre a pagina de cotacao e confere se a sessao nao caiu de volta no login."""
+    nav_timeout_ms = int(os.getenv("HAPAG_NAV_TIMEOUT_MS", "60000"))
+    page.goto(NEW_QUOTE_URL, wait_until="domcontentloaded", timeout=nav_timeout_ms)
+    try:
+        page.wait_for_load_state("networkidle", timeout=5000)
+    except Exception:
+        pass
+    url = page.url or ""
+    return "signup_signin" not in url and "identity.hapag-lloyd.com" not in url
+
+
 # ----------------------------------------------------------------------
 # PÁGINA DE COTAÇÃO / PREENCHIMENTO
 # ----------------------------------------------------------------------
@@ -1304,10 +1419,12 @@ def _offers_no_quote_visible(page) -> bool:
     return False
 
 
-def wait_offers_ready(page, timeout_ms: int = 45000) -> tuple[bool, str]:
+def wait_offers_ready(page, timeout_ms: int = 45000, searched_at: float | None = None) -> tuple[bool, str]:
     """
     Aguarda os cards de oferta ficarem visiveis apos a busca.
     Se a pagina estiver claramente carregando, estende a espera.
+    `searched_at` (time.time() da busca; pool de abas) desconta dos prazos o
+    tempo que a aba ja esperou em segundo plano.
     Retorna (ok, reason), onde reason pode ser:
       - ready
       - no_quote
@@ -1322,16 +1439,21 @@ def wait_offers_ready(page, timeout_ms: int = 45000) -> tuple[bool, str]:
         )
     )
     poll_ms = int(os.getenv("HAPAG_OFFERS_READY_POLL_MS", "400"))
-    soft_deadline = time.time() + (timeout_ms / 1000.0)
-    hard_deadline = time.time() + (max(timeout_ms, max_wait_ms) / 1000.0)
+    started = searched_at if searched_at is not None else time.time()
+    soft_deadline = started + (timeout_ms / 1000.0)
+    hard_deadline = started + (max(timeout_ms, max_wait_ms) / 1000.0)
     saw_loading = False
     extended_wait_logged = False
     stable_hits = 0
     security_wait_sec = int(os.getenv("HAPAG_SECURITY_MAX_WAIT_SEC", "180"))
+    if searched_at is not None:
+        security_wait_sec = max(0, int(security_wait_sec - (time.time() - started)))
 
-    while time.time() < hard_deadline:
+    # ao menos uma leitura: no pool de abas o prazo pode ter vencido em segundo plano
+    while True:
+        job_watchdog.check(page, "wait_offers_ready")
         try:
-            sec_pages = _security_check_pages(page.context)
+            sec_pages = _security_check_pages(page.context, page)
         except Exception:
             sec_pages = []
         if sec_pages:
@@ -1342,6 +1464,8 @@ def wait_offers_ready(page, timeout_ms: int = 45000) -> tuple[bool, str]:
             if not cleared:
                 return False, "security_check"
             # liberou: volta para o loop e reavalia ofertas
+            if time.time() >= hard_deadline:
+                break
             continue
 
         cards_visible = False
@@ -1379,6 +1503,8 @@ def wait_offers_ready(page, timeout_ms: int = 45000) -> tuple[bool, str]:
             else:
                 return False, "timeout_no_offer"
 
+        if time.time() >= hard_deadline:
+            break
         page.wait_for_timeout(poll_ms)
 
     if saw_loading:
@@ -1398,8 +1524,9 @@ def wait_price_breakdown_ready(page, timeout_ms: int = 45000, poll_ms: int = 300
     stable_hits = 0
 
     while time.time() < deadline:
+        job_watchdog.check(page, "wait_price_breakdown_ready")
         try:
-            sec_pages = _security_check_pages(page.context)
+            sec_pages = _security_check_pages(page.context, page)
         except Exception:
             sec_pages = []
         if sec_pages:
@@ -1881,14 +2008,20 @@ def extract_charge_items(page):
 # ----------------------------------------------------------------------
 # PIPELINE DE UMA ÚNICA COTAÇÃO (1 linha do Excel)
 # ----------------------------------------------------------------------
-def run_single_quote_flow(page, origin: str, destination: str):
+def _flow_error(page, origin: str, destination: str, e: Exception):
+    message = f"Erro inesperado durante cotação: {e!r}"
+    log(message)
+    debug_log(f"[FLOW] exception err={e!r} url={page.url}")
+    save_quote_screenshot(page, origin, destination, "flow_error")
+    debug_log(f"[FLOW] end status=error message={message!r}")
+    return {}, "error", message
+
+
+def start_quote_flow(page, origin: str, destination: str):
     """
-    Executa o fluxo completo para uma origem/destino.
-    Retorna (charges, status, message).
+    Primeira metade do fluxo: abre a pagina, preenche o formulario e dispara a
+    busca. Retorna None com a busca em andamento; senao (charges, status, message).
     """
-    status = "success"
-    message = ""
-    charges = {}
     _CURRENT_ROUTE["origin"] = origin
     _CURRENT_ROUTE["destination"] = destination
     debug_log(f"[FLOW] start origin={origin} destination={destination} url={page.url}")
@@ -1897,15 +2030,32 @@ def run_single_quote_flow(page, origin: str, destination: str):
         debug_log("[FLOW] step=open_quote_page start")
         open_quote_page(page)
         debug_log("[FLOW] step=open_quote_page ok")
+        job_watchdog.check(page, "fill_origin_destination_and_date")
         debug_log("[FLOW] step=fill_origin_destination_and_date start")
         fill_origin_destination_and_date(page, origin, destination)
         debug_log("[FLOW] step=fill_origin_destination_and_date ok")
+        job_watchdog.check(page, "select_container_and_weight")
         debug_log("[FLOW] step=select_container_and_weight start")
         select_container_and_weight(page, weight_kg=26000)
         debug_log("[FLOW] step=select_container_and_weight ok")
+    except Exception as e:
+        return _flow_error(page, origin, destination, e)
+    return None
+
+
+def finish_quote_flow(page, origin: str, destination: str, searched_at: float | None = None):
+    """
+    Segunda metade do fluxo: espera as ofertas, abre o Spot e extrai as charges.
+    Retorna (charges, status, message).
+    """
+    status = "success"
+    message = ""
+    charges = {}
+
+    try:
         offers_timeout_ms = int(os.getenv("HAPAG_OFFERS_READY_TIMEOUT_MS", "45000"))
         debug_log(f"[FLOW] step=wait_offers_ready start timeout_ms={offers_timeout_ms}")
-        offers_ready, offers_reason = wait_offers_ready(page, timeout_ms=offers_timeout_ms)
+        offers_ready, offers_reason = wait_offers_ready(page, timeout_ms=offers_timeout_ms, searched_at=searched_at)
         if not offers_ready:
             debug_log(f"[FLOW] step=wait_offers_ready not_ready reason={offers_reason}")
             if offers_reason == "no_quote":
@@ -1932,6 +2082,7 @@ def run_single_quote_flow(page, origin: str, destination: str):
             return {}, status, message
 
         # tenta achar o Spot; se nao tiver, considera no_quote e sai
+        job_watchdog.check(page, "select_spot_offer")
         try:
             debug_log("[FLOW] step=select_spot_offer start")
             select_spot_offer(page)
@@ -1945,25 +2096,108 @@ def run_single_quote_flow(page, origin: str, destination: str):
             return {}, status, message
 
         # se conseguiu selecionar o Spot, extrai charges
+        job_watchdog.check(page, "extract_charge_items")
         debug_log("[FLOW] step=extract_charge_items start")
         charges = extract_charge_items(page)
         debug_log(f"[FLOW] step=extract_charge_items ok fields={len(charges)}")
         save_quote_screenshot(page, origin, destination, "quote_success")
 
     except Exception as e:
-        status = "error"
-        message = f"Erro inesperado durante cotação: {e!r}"
-        log(message)
-        debug_log(f"[FLOW] exception err={e!r} url={page.url}")
-        save_quote_screenshot(page, origin, destination, "flow_error")
+        return _flow_error(page, origin, destination, e)
 
     debug_log(f"[FLOW] end status={status} message={message!r}")
     return charges, status, message
 
 
+def run_single_quote_flow(page, origin: str, destination: str):
+    """
+    Executa o fluxo completo para uma origem/destino.
+    Retorna (charges, status, message).
+    """
+    result = start_quote_flow(page, origin, destination)
+    if result is None:
+        result = finish_quote_flow(page, origin, destination)
+    return result
+
+
+def probe_offers_state(page) -> str:
+    """
+    Leitura rapida (sem espera) de uma aba com busca em andamento: "ready"
+    (ofertas ou aviso de sem cotacao na tela), "loading", "security" (Security
+    Check nesta aba) ou "idle".
+    """
+    try:
+        if _is_security_check_page(page):
+            return "security"
+        if _count_loading_indicators(page) > 0:
+            return "loading"
+        if page.locator(".offer-card").count() > 0 or _offers_no_quote_visible(page):
+            return "ready"
+    except Exception:
+        # aba quebrada: o finish_quote_flow registra o erro
+        return "ready"
+    return "idle"
+
+
+def pick_ready_tab(busy: list, offers_timeout_ms: int) -> dict:
+    """
+    Pool de abas: escolhe a proxima aba a concluir sem travar nas demais.
+    Sai primeiro a que tem ofertas na tela; as outras so quando vencem o prazo
+    do estado em que estao (contado da busca): parada `HAPAG_OFFERS_READY_TIMEOUT_MS`,
+    carregando `HAPAG_OFFERS_MAX_WAIT_MS`, Security Check `HAPAG_SECURITY_MAX_WAIT_SEC`,
+    ou orcamento do watchdog estourado.
+    """
+    if len(busy) == 1:
+        return busy[0]
+    max_wait_ms = int(os.getenv("HAPAG_OFFERS_MAX_WAIT_MS", str(max(180000, offers_timeout_ms * 3))))
+    limits_sec = {
+        "idle": offers_timeout_ms / 1000.0,
+        "loading": max(offers_timeout_ms, max_wait_ms) / 1000.0,
+        "security": float(os.getenv("HAPAG_SECURITY_MAX_WAIT_SEC", "180")),
+    }
+    poll_ms = int(os.getenv("HAPAG_OFFERS_READY_POLL_MS", "400"))
+    ordered = sorted(busy, key=lambda t: t["searched_at"])
+    while True:
+        for tab in ordered:
+            state = probe_offers_state(tab["page"])
+            waited = time.time() - tab["searched_at"]
+            deadline = tab["watchdog"].get("deadline")
+            expired = deadline is not None and time.monotonic() >= deadline
+            if state == "ready" or expired or waited >= limits_sec[state]:
+                _switch_to_tab(tab)
+                debug_log(f"[TABS] aba={tab['n']} key={tab['job']['key']} estado={state} espera={waited:.1f}s")
+                return tab
+        ordered[0]["page"].wait_for_timeout(poll_ms)
+
+
 # ----------------------------------------------------------------------
 # MAIN – LOOP LENDO O EXCEL, COM PRIORIDADE E UPSERT NO CSV
 # ----------------------------------------------------------------------
+@contextmanager
+def open_hapag_context(camoufox_kwargs: dict, pool_state: dict | None = None):
+    """
+    Contexto do browser: Camoufox proprio (padrao) ou um contexto novo no servidor
+    do browser pool, carregando os cookies da sessao ja logada pelo daemon.
+    """
+    if pool_state is None:
+        with Camoufox(**camoufox_kwargs) as context:
+            yield context
+        return
+
+    with sync_playwright() as p:
+        browser = p.firefox.connect(pool_state["endpoint"])
+        try:
+            context = browser.new_context(
+                storage_state=pool_state.get("storage_state") or None,
+                locale=camoufox_kwargs.get("locale"),
+                ignore_https_errors=camoufox_kwargs.get("ignore_https_errors", True),
+            )
+            yield context
+        finally:
+            # browser conectado: fecha so os contextos desta conexao, o servidor continua vivo
+            browser.close()
+
+
 def main():
     if not JOBS_XLSX.exists():
         raise FileNotFoundError(f"Arquivo de jobs não encontrado: {JOBS_XLSX}")
@@ -1971,8 +2205,11 @@ def main():
     df = pd.read_excel(JOBS_XLSX)
 
     # carrega cache de linhas e histórico para definir prioridades
+    # (o store de cotacoes reexporta o CSV antes, se um run anterior caiu sem exportar)
+    quote_store.sync_csv("hapag", OUTPUT_CSV, log_fn=log_plain)
     rows_cache = load_rows_cache(OUTPUT_CSV)
     history = build_history_from_rows_cache(rows_cache)
+    csv_export = {"from_store": True, "rates": None, "fx_failed": False}
 
     # monta lista de jobs com prioridade
     jobs = []
@@ -2042,6 +2279,18 @@ def main():
             for j in jobs
         )
     )
+    jobs = route_scheduler.restrict_to_routes_file(jobs, log_fn=log_plain)
+    use_queue = job_queue.queue_enabled()
+    if SHARD_COUNT > 1 and not use_queue:
+        # round-robin sobre a fila ja ordenada: cada shard recebe uma mistura
+        # equilibrada dos grupos de prioridade (com SCRAPER_JOB_QUEUE os shards
+        # dividem a fila inteira dinamicamente).
+        jobs = [j for pos, j in enumerate(jobs) if pos % SHARD_COUNT == SHARD_INDEX]
+        log(
+            f"[shard] {SHARD_INDEX + 1}/{SHARD_COUNT}: {len(jobs)} jobs nesta fatia; "
+            f"saida em {SHARD_OUTPUT_CSV}"
+        )
+
     debug_first_job_only = parse_env_bool("HAPAG_DEBUG_FIRST_JOB_ONLY", default=False)
     if debug_first_job_only and jobs:
         first = jobs[0]
@@ -2052,6 +2301,36 @@ def main():
             f"key={first['key']} group={first['priority_group']} ts={first['priority_ts']}"
         )
 
+    tab_count = max(1, int(os.getenv("HAPAG_TABS", "1")))
+    # na fila compartilhada os shards executam o mesmo plano em paralelo; as abas
+    # (HAPAG_TABS) correm rotas em paralelo dentro do processo
+    schedule = route_scheduler.plan_routes(
+        "hapag",
+        jobs,
+        key_fn=lambda j: j["key"],
+        log_fn=log_plain,
+        processes=SHARD_COUNT if use_queue else 1,
+        concurrency=tab_count,
+    )
+    jobs = schedule["jobs"]
+    # na fila compartilhada o total por processo e uma estimativa (fila / shards)
+    expected_jobs = -(-len(jobs) // SHARD_COUNT) if use_queue else len(jobs)
+    if use_queue:
+        added = job_queue.enqueue("hapag", jobs, key_fn=lambda j: j["key"])
+        log_plain(
+            f"[fila] {job_queue.queue_name()}: {added} rotas publicadas (demais ja estavam na fila); "
+            f"worker {job_queue.worker_id()}."
+        )
+
+    progress_events.emit(
+        "batch_start",
+        carrier="hapag",
+        total=expected_jobs,
+        deferred=len(schedule["deferred"]),
+        shard_index=SHARD_INDEX,
+        shard_count=SHARD_COUNT,
+    )
+
     hapag_headless = parse_env_bool("HAPAG_HEADLESS", default=False)
     action_timeout_ms = max(int(os.getenv("HAPAG_ACTION_TIMEOUT_MS", "30000")), 30000)
     login_timeout_ms = int(os.getenv("HAPAG_LOGIN_TIMEOUT_MS", "60000"))
@@ -2063,139 +2342,318 @@ def main():
     accept_language = os.getenv("HAPAG_ACCEPT_LANGUAGE", "pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7")
     after_login_sleep_sec = float(os.getenv("HAPAG_AFTER_LOGIN_SLEEP_SEC", "2"))
     keep_open_secs = float(os.getenv("HAPAG_KEEP_OPEN_SECS", "3"))
-    user_data_dir = os.getenv("HAPAG_USER_DATA_DIR", str(HAPAG_PROFILE_DIR))
-    Path(user_data_dir).mkdir(parents=True, exist_ok=True)
     camoufox_humanize = parse_env_bool("HAPAG_CAMOUFOX_HUMANIZE", default=True)
     camoufox_ignore_https_errors = parse_env_bool("HAPAG_CAMOUFOX_IGNORE_HTTPS_ERRORS", default=True)
-    camoufox_executable_source = resolve_camoufox_executable()
-    camoufox_executable = prepare_camoufox_runtime_executable(camoufox_executable_source)
-    validate_camoufox_executable(camoufox_executable)
 
-    log(
-        f"[cfg] engine=camoufox headless={hapag_headless} action_timeout_ms={action_timeout_ms} "
-        f"login_timeout_ms={login_timeout_ms} nav_timeout_ms={nav_timeout_ms} "
-        f"viewport={viewport_width}x{viewport_height}"
-    )
-    debug_log(
-        "[CFG] "
-        f"engine=camoufox headless={hapag_headless} action_timeout_ms={action_timeout_ms} "
-        f"login_timeout_ms={login_timeout_ms} nav_timeout_ms={nav_timeout_ms} "
-        f"dropdown_wait_ms={max(int(os.getenv('HAPAG_DROPDOWN_WAIT_MS', '8000')), 8000)} "
-        f"offers_timeout_ms={int(os.getenv('HAPAG_OFFERS_READY_TIMEOUT_MS', '45000'))} "
-        f"user_data_dir={user_data_dir} humanize={camoufox_humanize} "
-        f"ignore_https_errors={camoufox_ignore_https_errors} "
-        f"camoufox_executable_source={camoufox_executable_source} "
-        f"camoufox_executable={camoufox_executable} "
-        f"win_pd_override_local_appdata={os.getenv('WIN_PD_OVERRIDE_LOCAL_APPDATA', '')}"
+    pool_state = None
+    if parse_env_bool("BROWSER_POOL_ENABLED", default=False):
+        pool_state = browser_pool.read_pool_state("hapag")
+        if pool_state is None:
+            log("[pool] browser pool indisponivel/desatualizado; seguindo com browser proprio.")
+
+    # conta do pool (HL_ACCOUNTS); com browser pool segue na conta ja logada pelo daemon
+    account = account_pool.acquire(
+        "hapag", log_fn=log_plain, prefer=(pool_state or {}).get("account_id")
     )
+    # daqui em diante qualquer falha (launch, login, batch) devolve a conta
+    try:
+        use_account(account)
+        user_data_dir = os.getenv("HAPAG_USER_DATA_DIR", str(HAPAG_PROFILE_DIR))
+        if SHARD_COUNT > 1 and SHARD_INDEX > 0:
+            # perfil proprio por shard (o shard 0 reaproveita o perfil padrao)
+            user_data_dir = f"{user_data_dir}_shard{SHARD_INDEX}"
+        user_data_dir = str(account_pool.profile_dir(Path(user_data_dir), account))
+        Path(user_data_dir).mkdir(parents=True, exist_ok=True)
+        if pool_state is None:
+            camoufox_executable_source = resolve_camoufox_executable()
+            camoufox_executable = prepare_camoufox_runtime_executable(camoufox_executable_source)
+            validate_camoufox_executable(camoufox_executable)
+        else:
+            camoufox_executable_source = camoufox_executable = f"pool:{pool_state['endpoint']}"
 
-    if Camoufox is None:
-        raise RuntimeError(
-            "Camoufox nao esta instalado. Rode: pip install -U camoufox && camoufox fetch"
+        log(
+            f"[cfg] engine=camoufox headless={hapag_headless} action_timeout_ms={action_timeout_ms} "
+            f"login_timeout_ms={login_timeout_ms} nav_timeout_ms={nav_timeout_ms} "
+            f"viewport={viewport_width}x{viewport_height}"
+        )
+        debug_log(
+            "[CFG] "
+            f"engine=camoufox headless={hapag_headless} action_timeout_ms={action_timeout_ms} "
+            f"login_timeout_ms={login_timeout_ms} nav_timeout_ms={nav_timeout_ms} "
+            f"dropdown_wait_ms={max(int(os.getenv('HAPAG_DROPDOWN_WAIT_MS', '8000')), 8000)} "
+            f"offers_timeout_ms={int(os.getenv('HAPAG_OFFERS_READY_TIMEOUT_MS', '45000'))} "
+            f"user_data_dir={user_data_dir} humanize={camoufox_humanize} "
+            f"ignore_https_errors={camoufox_ignore_https_errors} "
+            f"camoufox_executable_source={camoufox_executable_source} "
+            f"camoufox_executable={camoufox_executable} "
+            f"win_pd_override_local_appdata={os.getenv('WIN_PD_OVERRIDE_LOCAL_APPDATA', '')}"
         )
 
-    camoufox_kwargs = {
-        "headless": hapag_headless,
-        "persistent_context": True,
-        "user_data_dir": user_data_dir,
-        "humanize": camoufox_humanize,
-        "locale": locale,
-        "ignore_https_errors": camoufox_ignore_https_errors,
-        "executable_path": camoufox_executable,
-        "args": [
-            "--disable-dev-shm-usage",
-            "--no-first-run",
-        ],
-    }
-
-    with Camoufox(**camoufox_kwargs) as context:
-        try:
-            context.set_extra_http_headers({"Accept-Language": accept_language})
-        except Exception:
-            pass
-
-        # LOGIN (apenas 1 vez)
-        login_page = context.new_page()
-        try:
-            login_page.set_viewport_size({"width": viewport_width, "height": viewport_height})
-        except Exception:
-            pass
-        login_page.set_default_timeout(action_timeout_ms)
-        login_page.set_default_navigation_timeout(login_timeout_ms)
-        login_hapag(login_page)
-
-        time.sleep(max(0.0, after_login_sleep_sec))
-
-        # Página reutilizada para todas as cotações
-        quote_page = context.new_page()
-        try:
-            quote_page.set_viewport_size({"width": viewport_width, "height": viewport_height})
-        except Exception:
-            pass
-        quote_page.set_default_timeout(action_timeout_ms)
-        quote_page.set_default_navigation_timeout(nav_timeout_ms)
+        if Camoufox is None and pool_state is None:
+            raise RuntimeError(
+                "Camoufox nao esta instalado. Rode: pip install -U camoufox && camoufox fetch"
+            )
 
-        total_jobs = len(jobs)
-        for idx, j in enumerate(jobs, start=1):
-            origin = j["origin"]
-            destination = j["destination"]
-            key = j["key"]
+        camoufox_kwargs = {
+            "headless": hapag_headless,
+            "persistent_context": True,
+            "user_data_dir": user_data_dir,
+            "humanize": camoufox_humanize,
+            "locale": locale,
+            "ignore_https_errors": camoufox_ignore_https_errors,
+            "executable_path": camoufox_executable,
+            "args": [
+                "--disable-dev-shm-usage",
+                "--no-first-run",
+            ],
+        }
 
-            log(f"=== Processando ({idx}/{total_jobs}) {origin} -> {destination} ===")
-            debug_log(f"[JOB] start idx={idx}/{total_jobs} key={key} origin={origin} destination={destination}")
+        with open_hapag_context(camoufox_kwargs, pool_state) as context:
+            try:
+                context.set_extra_http_headers({"Accept-Language": accept_language})
+            except Exception:
+                pass
 
+            # LOGIN (apenas 1 vez; com browser pool a sessao ja vem no storage_state)
+            login_page = context.new_page()
             try:
-                charges, status, message = run_single_quote_flow(
-                    quote_page, origin, destination
-                )
-            except Exception as e:
-                charges = {}
-                status = "error"
-                message = f"Erro não tratado no fluxo: {e!r}"
-                save_quote_screenshot(quote_page, origin, destination, "job_exception")
-                debug_log(f"[JOB] exception idx={idx}/{total_jobs} err={e!r}")
-
-            if status == "success":
-                log("Job finalizado com sucesso.")
-            elif status == "no_quote":
-                log("Job finalizado sem cotacao.")
+                login_page.set_viewport_size({"width": viewport_width, "height": viewport_height})
+            except Exception:
+                pass
+            login_page.set_default_timeout(action_timeout_ms)
+            login_page.set_default_navigation_timeout(login_timeout_ms)
+            if pool_state is not None and hapag_session_alive(login_page):
+                log(f"[pool] sessao reaproveitada do browser pool (login em {pool_state.get('last_login_at')}).")
             else:
-                log("Job finalizado com erro.")
-
-            upsert_charges_in_cache(
-                rows_cache=rows_cache,
-                charges=charges,
-                origin=origin,
-                destination=destination,
-                status=status,
-                message=message,
-                key=key,
-            )
-            flush_rows_cache_to_csv(rows_cache, OUTPUT_CSV, emit_log=False)
-            debug_log(
-                f"[JOB] end idx={idx}/{total_jobs} status={status} "
-                f"message={message!r} charges_count={len(charges)}"
-            )
+                login_hapag(login_page)
+                if "signup_signin" in (login_page.url or ""):
+                    account_pool.report_lockout(account, "login nao saiu da tela de login", log_fn=log_plain)
 
-        # grava o CSV final com 1 linha por key
-        flush_rows_cache_to_csv(rows_cache, OUTPUT_CSV)
+            time.sleep(max(0.0, after_login_sleep_sec))
 
-        log(f"Processamento concluído. Fechando contexto em {keep_open_secs}s...")
-        time.sleep(max(0.0, keep_open_secs))
-        context.close()
+            def setup_quote_page(page):
+                try:
+                    page.set_viewport_size({"width": viewport_width, "height": viewport_height})
+                except Exception:
+                    pass
+                page.set_default_timeout(action_timeout_ms)
+                page.set_default_navigation_timeout(nav_timeout_ms)
+
+            # Abas reutilizadas para todas as cotacoes (trocadas so quando o watchdog estoura).
+            # Com HAPAG_TABS > 1 as buscas correm em paralelo no mesmo contexto logado:
+            # enquanto uma aba espera ofertas, as outras preenchem e disparam a proxima rota.
+            tabs = []
+            for n in range(1, tab_count + 1):
+                page = context.new_page()
+                setup_quote_page(page)
+                tabs.append({"n": n, "page": page, "job": None})
+            if tab_count > 1:
+                _TAB_POOL_PAGES[:] = [t["page"] for t in tabs]
+                log_plain(f"[abas] {tab_count} abas de cotacao no mesmo contexto logado.")
+            watchdog_on = job_watchdog.watchdog_enabled()
+            export_every = quote_store.export_every()
+            offers_timeout_ms = int(os.getenv("HAPAG_OFFERS_READY_TIMEOUT_MS", "45000"))
+            rate_on = rate_control.control_enabled()
+            if rate_on:
+                log_plain(rate_control.describe("hapag"))
+
+            total_jobs = expected_jobs
+            # com a fila, a conta bloqueada para de pegar rotas e as demais ficam para as outras contas;
+            # aba livre nao espera pelos leases das abas ocupadas deste processo
+            feed = route_scheduler.open_job_feed(
+                schedule,
+                jobs,
+                key_fn=lambda job: job["key"],
+                log_fn=log_plain,
+                use_queue=use_queue,
+                account=account,
+                busy_fn=lambda: any(t["job"] is not None for t in tabs),
+            )
 
-        # grava o CSV final com 1 linha por key
-    flush_rows_cache_to_csv(rows_cache, OUTPUT_CSV)
+            def begin_job(tab, j):
+                idx = feed["idx"]
+                tab.update(
+                    job=j,
+                    idx=idx,
+                    started_at=datetime.now().isoformat(timespec="seconds"),
+                    t0=time.monotonic(),
+                    leased_at=time.time(),
+                    security_checks=SECURITY_CHECKS["n"],
+                )
+                _switch_to_tab(tab)
+                log(f"=== Processando ({idx}/{total_jobs}) {j['origin']} -> {j['destination']} ===")
+                debug_log(
+                    f"[JOB] start idx={idx}/{total_jobs} key={j['key']} origin={j['origin']} "
+                    f"destination={j['destination']} tab={tab['n']}"
+                )
+                progress_events.emit("job_start", carrier="hapag", idx=idx, total=total_jobs, key=j["key"])
+                if watchdog_on:
+                    budget_sec, budget_source = job_watchdog.route_budget_sec("hapag", j["key"])
+                    job_watchdog.start_job(budget_sec, tab["page"], action_timeout_ms, nav_timeout_ms)
+                    debug_log(f"[WATCHDOG] budget_sec={budget_sec:.0f} source={budget_source}")
+                tab["watchdog"] = job_watchdog.current_job()
+
+            def run_phase(tab, phase, **kwargs):
+                _switch_to_tab(tab)
+                job_watchdog.resume_job(tab["watchdog"])
+                j = tab["job"]
+                try:
+                    return phase(tab["page"], j["origin"], j["destination"], **kwargs)
+                except Exception as e:
+                    save_quote_screenshot(tab["page"], j["origin"], j["destination"], "job_exception")
+                    debug_log(f"[JOB] exception idx={tab['idx']}/{total_jobs} err={e!r}")
+                    return {}, "error", f"Erro não tratado no fluxo: {e!r}"
+
+            def complete_job(tab, result):
+                # escritor unico: todas as abas gravam por aqui, na ordem em que terminam
+                page = tab["page"]
+                j, idx = tab["job"], tab["idx"]
+                origin, destination, key = j["origin"], j["destination"], j["key"]
+                charges, status, message = result
+                _switch_to_tab(tab)
+                job_watchdog.resume_job(tab["watchdog"])
+
+                if status == "error" and job_watchdog.expired():
+                    charges = {}
+                    status = job_watchdog.TIMEOUT_STATUS
+                    message = (
+                        f"Job excedeu o orcamento de {job_watchdog.budget_sec():.0f}s "
+                        f"(ultimo erro: {message or '-'})."
+                    )
+                    debug_log(f"[WATCHDOG] timeout idx={idx}/{total_jobs} key={key}; reciclando aba")
+                    save_quote_screenshot(page, origin, destination, "watchdog_timeout")
+                    tab["page"] = job_watchdog.recycle_page(context, page, setup_quote_page)
+                    if tab_count > 1:
+                        _TAB_POOL_PAGES[:] = [t["page"] for t in tabs]
+                job_watchdog.finish_job()
+
+                if status == "success":
+                    log("Job finalizado com sucesso.")
+                elif status == "no_quote":
+                    log("Job finalizado sem cotacao.")
+                elif status == job_watchdog.TIMEOUT_STATUS:
+                    log("Job finalizado por timeout do watchdog; aba recriada.")
+                else:
+                    log("Job finalizado com erro.")
+
+                upsert_charges_in_cache(
+                    rows_cache=rows_cache,
+                    charges=charges,
+                    origin=origin,
+                    destination=destination,
+                    status=status,
+                    message=message,
+                    key=key,
+                )
+                # tentativa vai para o store; o CSV e reexportado a cada N jobs (ou a cada job sem store)
+                if not quote_store.record_attempt("hapag", rows_cache[key]):
+                    csv_export["from_store"] = False
+                if not csv_export["from_store"] or (export_every and idx % export_every == 0):
+                    export_breakdowns_csv(rows_cache, SHARD_OUTPUT_CSV, csv_export, emit_log=False)
+                run_history.record_route_attempt(
+                    carrier="hapag",
+                    route_key=key,
+                    origin=origin,
+                    destination=destination,
+                    status=status,
+                    latency_sec=time.monotonic() - tab["t0"],
+                    message=message,
+                    started_at=tab["started_at"],
+                )
+                progress_events.emit(
+                    "job_end",
+                    carrier="hapag",
+                    idx=idx,
+                    key=key,
+                    status=status,
+                    duration_sec=round(time.monotonic() - tab["t0"], 3),
+                )
+                if use_queue and not job_queue.ack("hapag", key, status):
+                    log_plain(f"[fila] {key}: lease perdido antes do fim (outro processo pode refazer a rota).")
+                lock_reason = account_pool.record_job(account, status, message)
+                if lock_reason:
+                    log_plain(f"[contas] hapag/{account['id']} bloqueada: {lock_reason}.")
+                if rate_on:
+                    pressure = status == job_watchdog.TIMEOUT_STATUS or SECURITY_CHECKS["n"] > tab["security_checks"]
+                    rate_control.finish(
+                        "hapag", tab["n"], status, time.monotonic() - tab["t0"], pressure=pressure, log_fn=log_plain
+                    )
+                debug_log(
+                    f"[JOB] end idx={idx}/{total_jobs} status={status} "
+                    f"message={message!r} charges_count={len(charges)}"
+                )
+                tab["job"] = None
 
-    # CONVERTE TUDO PRA USD (sobrescreve o CSV)
-    convert_currency_columns_in_csv_to_usd(
-        csv_path=OUTPUT_CSV,
-        out_path=OUTPUT_CSV,        # ou troque pra um novo caminho pra não sobrescrever
+            try:
+                while True:
+                    # abas livres pegam a proxima rota e disparam a busca
+                    for tab in tabs:
+                        while tab["job"] is None and not feed["exhausted"]:
+                            # controle de ritmo: sem vaga/token, conclui as abas ocupadas antes
+                            if rate_on and rate_control.try_start("hapag", tab["n"]) > 0:
+                                if any(t["job"] is not None for t in tabs):
+                                    break
+                                rate_control.wait_start("hapag", tab["n"], log_fn=log_plain)
+                            j = route_scheduler.next_feed_job(feed)
+                            if j is None:
+                                # fim da fonte, ou fila sem rota agora: conclui as abas ocupadas antes
+                                if rate_on:
+                                    rate_control.cancel("hapag", tab["n"])
+                                break
+                            begin_job(tab, j)
+                            result = run_phase(tab, start_quote_flow)
+                            if result is not None:
+                                complete_job(tab, result)
+                            else:
+                                tab["searched_at"] = time.time()
+                    busy = [t for t in tabs if t["job"] is not None]
+                    if not busy:
+                        break
+                    if use_queue:
+                        # abas esperando enquanto outras sao atendidas nao perdem o lease
+                        for t in busy:
+                            t["leased_at"] = job_queue.renew_if_due("hapag", t["job"]["key"], t["leased_at"], log_plain)
+                    # conclui a aba cujas ofertas ficaram prontas primeiro
+                    tab = pick_ready_tab(busy, offers_timeout_ms)
+                    searched_at = tab["searched_at"] if tab_count > 1 else None
+                    complete_job(tab, run_phase(tab, finish_quote_flow, searched_at=searched_at))
+            finally:
+                # grava o CSV final com 1 linha por key (tambem se o batch quebrar no meio)
+                export_breakdowns_csv(rows_cache, SHARD_OUTPUT_CSV, csv_export)
+                if use_queue:
+                    # rotas em curso voltam para a fila para outro processo
+                    for t in tabs:
+                        if t["job"] is not None:
+                            job_queue.release("hapag", t["job"]["key"])
+                if rate_on:
+                    rate_control.release_holder("hapag")
+            progress_events.emit("batch_end", carrier="hapag", deferred=len(schedule["deferred"]))
+            deferred_report = route_scheduler.write_deferred_report(schedule)
+            if deferred_report is not None:
+                log_plain(f"[deadline] {len(schedule['deferred'])} rotas adiadas; relatorio em {deferred_report}")
+
+            log(f"Processamento concluído. Fechando contexto em {keep_open_secs}s...")
+            time.sleep(max(0.0, keep_open_secs))
+            context.close()
+    finally:
+        account_pool.release(account)
+
+    # o export final ja converteu para USD; sem cambio ate aqui, tenta de novo (e falha o scraper, como antes)
+    rates = csv_export["rates"] or convert_currency_columns_in_csv_to_usd(
+        csv_path=SHARD_OUTPUT_CSV,
+        out_path=SHARD_OUTPUT_CSV,        # ou troque pra um novo caminho pra não sobrescrever
         round_decimals=2,
         keep_original=False,        # True se quiser manter colunas "* | Orig"
         timeout=20,
     )
 
+    # tabela longa de charges (particoes por data); rates base USD: 1 USD = rate CUR
+    charge_store.export_partitions(
+        "hapag",
+        to_usd=lambda amount, cur: amount / rates[cur] if rates.get(cur) else None,
+        log_fn=log_plain,
+    )
+
 
 # ----------------------------------------------------------------------
 # FUÇÕES PARA CONVERSÃO DE MOEDAS
@@ -2396,15 +2854,20 @@ def convert_currency_columns_in_csv_to_usd(
     round_decimals: Optional[int] = 2,
     keep_original: bool = False,
     timeout: int = 20,
-) -> None:
+    rates: Optional[Dict[str, float]] = None,
+    emit_log: bool = True,
+) -> Dict[str, float]:
     """
     Lê um CSV (o seu output final), converte todas as colunas com Curr para USD e grava de volta.
-    - out_path=None -> sobrescreve o próprio csv_path
+    - out_path=None -> sobrescreve o próprio csv_path (tmp + replace)
+    - rates=None -> busca as taxas (senão reaproveita as já buscadas no batch)
+    Retorna as taxas usadas (base USD).
     """
     csv_path = str(csv_path)
     out_path = str(out_path) if out_path is not None else csv_path
 
-    rates = fetch_fx_rates_usd_base(timeout=timeout)
+    if rates is None:
+        rates = fetch_fx_rates_usd_base(timeout=timeout)
 
     df = pd.read_csv(csv_path, low_memory=False)
 
@@ -2415,8 +2878,10 @@ def convert_currency_columns_in_csv_to_usd(
         keep_original=keep_original,
     )
 
-    df2.to_csv(out_path, index=False, encoding="utf-8")
+    quote_store.replace_file(Path(out_path), lambda tmp_path: df2.to_csv(tmp_path, index=False, encoding="utf-8"))
 
+    if not emit_log:
+        return rates
     try:
         log(f"Conversão para USD concluída. Células convertidas: {n}. Arquivo: {out_path}")
     except Exception:
@@ -2424,6 +2889,7 @@ def convert_currency_columns_in_csv_to_usd(
             f"{_timestamp_prefix()} [FX] Conversão para USD concluída. "
             f"Células convertidas: {n}. Arquivo: {out_path}"
         )
+    return rates
 
 
 if __name__ == "__main__":
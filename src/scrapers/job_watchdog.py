@@ -0,0 +1,171 @@
+"""
+Watchdog por job dos scrapers: orcamento de tempo de parede por rota.
+
+O orcamento vem do historico de latencia (run_history): p90 das ultimas
+execucoes concluidas da rota (ou do carrier, com pouco historico da rota)
+vezes `SCRAPER_JOB_BUDGET_FACTOR`, limitado a
+[`SCRAPER_JOB_BUDGET_MIN_SEC`, `SCRAPER_JOB_BUDGET_MAX_SEC`]. Sem historico,
+vale o maximo.
+
+O objeto `page` do Playwright sync so pode ser usado pela thread que o criou,
+entao o watchdog e cooperativo:
+- os loops longos (espera de ofertas/resultados, Security Check, retries)
+  chamam `check(page, onde)`, que levanta `TimeoutError` com o orcamento
+  estourado;
+- a cada `check` os timeouts padrao da aba sao reduzidos ao tempo restante,
+  entao nenhuma chamada isolada passa muito do prazo.
+No fim do job o scraper consulta `expired()`: grava status `timeout` e troca a
+aba por uma nova (`recycle_page`) antes da proxima rota.
+
+Com varias abas na mesma thread (pool de abas da Hapag), cada aba guarda o
+estado do seu job (`current_job`) e o reativa (`resume_job`) antes de cada
+trecho do fluxo.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "orchestration"))
+import run_history  # noqa: E402
+from sqlite_state import parse_env_bool  # noqa: E402
+
+TIMEOUT_STATUS = "timeout"
+ROUTE_MIN_SAMPLES = 3
+MIN_CALL_TIMEOUT_MS = 1000
+
+_JOB = {
+    "active": False,
+    "deadline": None,
+    "budget_sec": None,
+    "action_timeout_ms": None,
+    "nav_timeout_ms": None,
+}
+
+
+def watchdog_enabled() -> bool:
+    return parse_env_bool("SCRAPER_JOB_WATCHDOG", default=True)
+
+
+def route_budget_sec(carrier: str, route_key: str) -> Tuple[float, str]:
+    """Devolve (orcamento em segundos, origem do calculo para log)."""
+    factor = float(os.getenv("SCRAPER_JOB_BUDGET_FACTOR", "3"))
+    min_sec = float(os.getenv("SCRAPER_JOB_BUDGET_MIN_SEC", "120"))
+    max_sec = max(min_sec, float(os.getenv("SCRAPER_JOB_BUDGET_MAX_SEC", "600")))
+
+    samples = run_history.recent_route_latencies(carrier, route_key, limit=20)
+    source = f"rota, {len(samples)} execucoes"
+    if len(samples) < ROUTE_MIN_SAMPLES:
+        samples = run_history.recent_route_latencies(carrier, None, limit=200)
+        source = f"carrier, {len(samples)} execucoes"
+    p90 = run_history.percentile(samples, 90)
+    if p90 is None:
+        return max_sec, "sem historico"
+    budget = min(max_sec, max(min_sec, p90 * factor))
+    return budget, f"p90={p90:.0f}s x{factor:g} ({source})"
+
+
+def start_job(budget_sec: Optional[float], page=None, action_timeout_ms: int = 0, nav_timeout_ms: int = 0) -> None:
+    """
+    Arma o prazo do job. `action_timeout_ms`/`nav_timeout_ms` sao os timeouts
+    padrao da aba: restaurados aqui (um `check` anterior pode ter reduzido).
+    """
+    _JOB["active"] = budget_sec is not None
+    _JOB["budget_sec"] = budget_sec
+    _JOB["deadline"] = time.monotonic() + budget_sec if budget_sec is not None else None
+    _JOB["action_timeout_ms"] = action_timeout_ms or None
+    _JOB["nav_timeout_ms"] = nav_timeout_ms or None
+    if page is not None:
+        _set_page_timeouts(page, action_timeout_ms, nav_timeout_ms)
+
+
+def current_job() -> dict:
+    """Copia do estado do job armado (para alternar jobs na mesma thread)."""
+    return dict(_JOB)
+
+
+def resume_job(state: dict) -> None:
+    """Reativa um estado salvo por `current_job`; o prazo continua correndo."""
+    _JOB.update(state)
+
+
+def finish_job() -> None:
+    _JOB["active"] = False
+    _JOB["deadline"] = None
+
+
+def remaining_sec() -> Optional[float]:
+    if not _JOB["active"] or _JOB["deadline"] is None:
+        return None
+    return _JOB["deadline"] - time.monotonic()
+
+
+def expired() -> bool:
+    remaining = remaining_sec()
+    return remaining is not None and remaining <= 0
+
+
+def budget_sec() -> Optional[float]:
+    return _JOB["budget_sec"]
+
+
+def _set_page_timeouts(page, action_timeout_ms: Optional[int], nav_timeout_ms: Optional[int]) -> None:
+    try:
+        if action_timeout_ms:
+            page.set_default_timeout(action_timeout_ms)
+        if nav_timeout_ms:
+            page.set_default_navigation_timeout(nav_timeout_ms)
+    except Exception:
+        pass
+
+
+def check(page=None, where: str = "") -> None:
+    """
+    Ponto de verificacao: levanta TimeoutError se o orcamento acabou; senao
+    limita os timeouts da aba ao tempo restante.
+    """
+    remaining = remaining_sec()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        raise TimeoutError(
+            f"watchdog: job excedeu o orcamento de {_JOB['budget_sec']:.0f}s"
+            + (f" em {where}" if where else "")
+        )
+    if page is not None:
+        remaining_ms = max(MIN_CALL_TIMEOUT_MS, int(remaining * 1000))
+        action_ms = _JOB["action_timeout_ms"]
+        nav_ms = _JOB["nav_timeout_ms"]
+        _set_page_timeouts(
+            page,
+            min(action_ms, remaining_ms) if action_ms else None,
+            min(nav_ms, remaining_ms) if nav_ms else None,
+        )
+
+
+def cap_deadline(deadline_wall: float) -> float:
+    """Limita um prazo em `time.time()` (loops de espera) ao fim do orcamento do job."""
+    remaining = remaining_sec()
+    if remaining is None:
+        return deadline_wall
+    return min(deadline_wall, time.time() + max(0.0, remaining))
+
+
+def recycle_page(context, page, setup: Optional[Callable] = None):
+    """
+    Fecha a aba (possivelmente travada) e devolve uma nova no mesmo contexto;
+    `setup(new_page)` reaplica viewport/timeouts. Erro ao criar a aba sobe
+    para o chamador (contexto morto encerra o batch).
+    """
+    try:
+        page.close()
+    except Exception:
+        pass
+    new_page = context.new_page()
+    if setup is not None:
+        setup(new_page)
+    return new_page
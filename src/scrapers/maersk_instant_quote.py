@@ -9,8 +9,23 @@ import pandas as pd
 from dotenv import load_dotenv
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
 
-import requests
-from functools import lru_cache
+from functools import partial
+
+import browser_pool
+import fx_rates
+import job_watchdog
+import route_scheduler
+
+# historico de runs (SQLite) fica em src/orchestration
+sys.path.append(str(Path(__file__).resolve().parents[1] / "orchestration"))
+import account_pool  # noqa: E402
+import charge_store  # noqa: E402
+import job_queue  # noqa: E402
+import progress_events  # noqa: E402
+import quote_store  # noqa: E402
+import rate_control  # noqa: E402
+import run_history  # noqa: E402
+import run_logs  # noqa: E402
 
 # ----------------------------------------------------------------------
 # Configs e caminhos
@@ -40,23 +55,36 @@ ARTIFACTS        = PROJECT_ROOT / "artifacts"
 INPUT_XLSX       = ARTIFACTS / "input" / "maersk_jobs.xlsx"
 OUT_DIR          = ARTIFACTS / "output"
 OUT_CSV          = OUT_DIR / "maersk_breakdowns.csv"   # formato "wide"
-RUN_LOG_CSV      = OUT_DIR / "maersk_run_log.csv"
-USER_DATA_DIR    = BROWSER_PROFILES_DIR / "maersk"
+RUN_LOG_CSV      = OUT_DIR / "maersk_run_log.csv"   # append-only (src/orchestration/run_logs.py)
+RUN_LOG_FIELDS   = ["when", "origin", "destination", "status", "message"]
+USER_DATA_DIR    = Path(os.getenv("MAERSK_USER_DATA_DIR") or (BROWSER_PROFILES_DIR / "maersk"))
 LOG_DIR          = ARTIFACTS / "logs"
 SCREENS          = RUNTIME_DIR / "screens"
 
-for p in [ARTIFACTS, ARTIFACTS/"input", OUT_DIR, LOG_DIR, RUNTIME_DIR, BROWSER_PROFILES_DIR, USER_DATA_DIR, SCREENS]:
+# Shards (runner --shards): cada processo pega uma fatia deterministica da fila
+# priorizada, com perfil e arquivos proprios; o runner mescla no OUT_CSV e no
+# RUN_LOG_CSV depois (mesma convencao de nome de src/orchestration/shard_merge.py).
+SHARD_INDEX      = int(os.getenv("SCRAPER_SHARD_INDEX", "0"))
+SHARD_COUNT      = max(1, int(os.getenv("SCRAPER_SHARD_COUNT", "1")))
+if SHARD_COUNT > 1:
+    SHARD_OUT_CSV     = OUT_DIR / "shards" / f"{OUT_CSV.stem}.shard{SHARD_INDEX}{OUT_CSV.suffix}"
+    SHARD_RUN_LOG_CSV = OUT_DIR / "shards" / f"{RUN_LOG_CSV.stem}.shard{SHARD_INDEX}{RUN_LOG_CSV.suffix}"
+    if SHARD_INDEX > 0:
+        USER_DATA_DIR = USER_DATA_DIR.with_name(f"{USER_DATA_DIR.name}_shard{SHARD_INDEX}")
+else:
+    SHARD_OUT_CSV     = OUT_CSV
+    SHARD_RUN_LOG_CSV = RUN_LOG_CSV
+
+for p in [ARTIFACTS, ARTIFACTS/"input", OUT_DIR, SHARD_OUT_CSV.parent, LOG_DIR, RUNTIME_DIR, BROWSER_PROFILES_DIR, USER_DATA_DIR, SCREENS]:
     p.mkdir(parents=True, exist_ok=True)
 
 # Timeout maior para esperar os cards de resultado (ajustÃ¡vel via .env)
 RESULTS_TIMEOUT_SEC = int(os.getenv("MAERSK_RESULTS_TIMEOUT_SEC", "45"))
+MAX_RETRY_CLICKS = 10
 LOG_ASCII_ONLY = os.getenv("LOG_ASCII_ONLY", "1").strip().lower() in {
     "1", "true", "t", "yes", "y", "on"
 }
 
-# Taxa aproximada COP â†’ USD (ajuste conforme quiser)
-COP_TO_USD_APPROX = 0.00025   # COP 1 = 0.00025 USD  (exemplo realista)
-
 DEFAULT_MAERSK_USER_AGENT = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
     "AppleWebKit/537.36 (KHTML, like Gecko) "
@@ -191,7 +219,10 @@ _LOG_CTX = {
     "job_total": 0,
     "last_stage_status": None,
     "last_stage": "ETAPA",
+    "tab": 0,
 }
+# Varias abas (MAERSK_PAGES > 1): aba dona do contexto de log atual.
+_ACTIVE_TAB = {"tab": None}
 
 
 def _normalize_for_match(text: str) -> str:
@@ -315,9 +346,10 @@ def _to_structured_terminal_line(msg: str) -> str | None:
     def _counter_label() -> str:
         idx = int(_LOG_CTX.get("job_idx") or 0)
         total = int(_LOG_CTX.get("job_total") or 0)
+        tab = f" aba{_LOG_CTX['tab']}" if _LOG_CTX.get("tab") else ""
         if total > 0:
-            return f"({idx}/{total})"
-        return f"({idx}/?)"
+            return f"({idx}/{total}{tab})"
+        return f"({idx}/?{tab})"
 
     # Primeira linha do job: rota completa.
     m = _ROUTE_HEADER_RE.match(raw)
@@ -362,10 +394,26 @@ def _to_structured_terminal_line(msg: str) -> str | None:
     if event_key == _LOG_CTX["last_stage_status"]:
         return None
     _LOG_CTX["last_stage_status"] = event_key
+    progress_events.emit("step", carrier="maersk", idx=_LOG_CTX["job_idx"], step=stage, status=status)
 
     return f"{_counter_label()} | {stage} | {status}"
 
 
+def _switch_to_tab(tab: dict, pooled: bool) -> None:
+    """
+    Varias abas: guarda o contexto de log (contador/etapa) da aba anterior e
+    carrega o desta, para as linhas sairem com a rota certa.
+    """
+    current = _ACTIVE_TAB["tab"]
+    if current is tab:
+        return
+    if current is not None:
+        current["log_ctx"] = dict(_LOG_CTX)
+    _LOG_CTX.update(tab.get("log_ctx") or {"job_idx": 0, "job_total": 0, "last_stage_status": None, "last_stage": "ETAPA"})
+    _LOG_CTX["tab"] = tab["n"] if pooled else 0
+    _ACTIVE_TAB["tab"] = tab
+
+
 def _timestamp_prefix() -> str:
     return datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
 
@@ -385,6 +433,10 @@ def log(msg: str) -> None:
         )
         print(safe_line)
 
+def log_plain(msg: str) -> None:
+    """Mensagem operacional fora do formato estruturado (ex.: plano por deadline)."""
+    print(_to_console_text(f"{_timestamp_prefix()} {msg}"))
+
 def dd_mmm_yyyy_en(dt: datetime) -> str:
     return f"{dt.day:02d} {calendar.month_abbr[dt.month]} {dt.year}"
 
@@ -506,6 +558,7 @@ def wait_for_booking_form_ready(page, job: dict, timeout_ms: int) -> tuple[bool,
     last_state = collect_booking_page_state(page)
 
     while time.time() < deadline:
+        job_watchdog.check(page, "wait_for_booking_form_ready")
         state = collect_booking_page_state(page)
         last_state = state
 
@@ -859,6 +912,19 @@ def login_maersk(page, username: str, password: str, timeout_ms: int = 30000) ->
         log(f"âš ï¸ Login: aparentemente nÃ£o saiu da tela de login (URL: {page.url}).")
         return False
 
+def maersk_session_alive(page, timeout_ms: int = 30000) -> bool:
+    """
+    Abre o Book e confere se a sessao continua logada (sem redirecionar para /auth/login).
+    Usado pelo browser pool para health check.
+    """
+    page.goto(BOOK_URL, wait_until="domcontentloaded", timeout=timeout_ms)
+    try:
+        page.wait_for_load_state("networkidle", timeout=5000)
+    except Exception:
+        pass
+    url = page.url or ""
+    return "/auth/login" not in url and "accounts.maersk.com" not in url
+
 # ----------------------------------------------------------------------
 # AÃ§Ãµes de preenchimento
 # ----------------------------------------------------------------------
@@ -1267,6 +1333,7 @@ def wait_for_results_cards(page, timeout_sec: int = RESULTS_TIMEOUT_SEC) -> bool
     """
     deadline = time.time() + timeout_sec
     while time.time() < deadline:
+        job_watchdog.check(page, "wait_for_results_cards")
         try:
             if page.locator('[data-test="offer-cards"]:visible').count() > 0:
                 return True
@@ -1456,18 +1523,42 @@ def _click_retry(page) -> bool:
     debug_retry_state(page, "after_click_all_failed")
     return False
 
+def _retry_visible(page) -> bool:
+    retry_inner = page.locator(SEL_RETRY_INNER).first
+    retry_role  = page.get_by_role("button", name=re.compile(r"^\s*Retry\s*$", re.I)).first
+    retry_host  = page.locator(SEL_RETRY_HOST).first
+    return _safe_visible(retry_inner) or _safe_visible(retry_role) or _safe_visible(retry_host)
+
+def retry_backoff_sec(retry_clicks: int) -> float:
+    return min(2.0, 0.6 * (1.5 ** (retry_clicks - 1)))
+
 def wait_for_results_or_retry(
     page,
     timeout_sec: int,
     max_retry_clicks: int = 10,
     poll_sec: float = 0.25,
+    started_at: float | None = None,
+    retry_clicks: int = 0,
 ) -> tuple[bool, int]:
+    """
+    `started_at`/`retry_clicks` (varias abas): retoma a espera iniciada em
+    segundo plano, com o prazo contado da busca e os Retry ja clicados.
+    """
 
-    start = time.time()
-    retry_clicks = 0
+    start = started_at if started_at is not None else time.time()
     last_debug = 0.0
 
+    if started_at is not None:
+        # espera retomada: o prazo pode ter vencido em segundo plano, le a tela uma vez
+        if _results_visible(page):
+            log(f"Resultados visÃ­veis. Retry clicado {retry_clicks}x.")
+            return True, retry_clicks
+        if retry_clicks >= max_retry_clicks:
+            log("[retry] atingiu limite de tentativas sem resultado.")
+            return False, retry_clicks
+
     while time.time() - start < timeout_sec:
+        job_watchdog.check(page, "wait_for_results_or_retry")
         close_unexpected_modal(page, "aguardando resultados")
 
         if DEBUG_RETRY and (time.time() - last_debug) > 2.0:
@@ -1478,13 +1569,7 @@ def wait_for_results_or_retry(
             log(f"Resultados visÃ­veis. Retry clicado {retry_clicks}x.")
             return True, retry_clicks
 
-        retry_inner = page.locator(SEL_RETRY_INNER).first
-        retry_role  = page.get_by_role("button", name=re.compile(r"^\s*Retry\s*$", re.I)).first
-        retry_host  = page.locator(SEL_RETRY_HOST).first
-
-        retry_is_visible = _safe_visible(retry_inner) or _safe_visible(retry_role) or _safe_visible(retry_host)
-
-        if retry_is_visible:
+        if _retry_visible(page):
             retry_clicks += 1
             log(f"Retry apareceu! tentativa #{retry_clicks}/{max_retry_clicks}")
 
@@ -1495,7 +1580,7 @@ def wait_for_results_or_retry(
                 log("[retry] atingiu limite de tentativas sem resultado.")
                 return False, retry_clicks
 
-            time.sleep(min(2.0, 0.6 * (1.5 ** (retry_clicks - 1))))
+            time.sleep(retry_backoff_sec(retry_clicks))
             try:
                 page.wait_for_load_state("networkidle", timeout=2500)
             except Exception:
@@ -2339,104 +2424,57 @@ def extract_breakdown_table(page) -> dict:
         },
     }
 
-# ----------------------------------------------------------------------
-# ConversÃ£o de moedas para USD (via API Frankfurter)
-# ----------------------------------------------------------------------
-FX_API_BASE = os.getenv("FX_API_BASE", "https://api.frankfurter.dev/v1/latest")
-
-@lru_cache(maxsize=64)
-def fx_rate_to_usd(from_currency: str | None) -> float | None:
-    code = (from_currency or "").strip().upper()
-    if not code:
-        return None
-    if code == "USD":
-        return 1.0
-
-    try:
-        resp = requests.get(
-            FX_API_BASE,
-            params={"base": code, "symbols": "USD"},
-            timeout=5,
-        )
-        resp.raise_for_status()
-
-        data = resp.json()
-        rate = (data.get("rates") or {}).get("USD")
-
-        if rate is not None:
-            return float(rate)
-
-        log(f"âš ï¸ FX: resposta sem rate para {code}->USD. payload={data}")
-
-    except Exception as e:
-        log(f"âš ï¸ FX: erro ao buscar {code}->USD ({type(e).__name__}: {e})")
-
-    if code == "COP":
-        log("âš ï¸ FX: usando taxa aproximada para COP -> USD.")
-        return COP_TO_USD_APPROX
-
-    return None
-
-def amount_to_usd(amount: float | None, from_currency: str | None) -> float | None:
-    if amount is None:
-        return None
-    rate = fx_rate_to_usd(from_currency)
-    if rate is None:
-        return None
-    return float(amount) * rate
-
 # ----------------------------------------------------------------------
 # CSV WIDE (dinÃ¢mico por charge_name, prefixado por moeda)
 # ----------------------------------------------------------------------
 def canonical_key(job: dict) -> str:
     return f"{job['origin'].strip()}|{job['destination'].strip()}"
 
-def ensure_wide_columns(df: pd.DataFrame, charges: list[dict]) -> pd.DataFrame:
-    cols_needed = []
-    for c in charges:
-        cur = c.get("currency") or "UNK"
-        name = c.get("charge_name") or "Unknown"
-        col = f"{cur} {name}"
-        cols_needed.append(col)
-    for col in cols_needed:
-        if col not in df.columns:
-            df[col] = pd.NA
-    return df
-
-def write_wide_row(df: pd.DataFrame, job: dict, breakdown: dict | None) -> pd.DataFrame:
-    THC_DEST_NAME_RE = re.compile(
-        r"^\s*Terminal\s+Handling\s+Service\s*-\s*Destination\s*$", re.I
-    )
+# Tabela wide em memoria: {"columns": [...], "col_set": {...}, "rows": {key: {coluna: valor}}}.
+# Cada linha guarda so os campos preenchidos; o DataFrame so e montado na hora
+# de gravar o CSV (atualizar uma rota custa O(charges), sem varrer a tabela).
+WIDE_BASE_COLS = [
+    "key",
+    "origin",
+    "destination",
+    "last_attempt_at",
+    "quoted_at",
+    "status",
+    "message",
+    "offer_departure_date",
+    "offer_arrival_date",
+    "offer_transit_time",
+    "offer_transit_time_hours",
+]
+
+THC_DEST_NAME_RE = re.compile(
+    r"^\s*Terminal\s+Handling\s+Service\s*-\s*Destination\s*$", re.I
+)
 
+def ensure_wide_columns(wide: dict, cols: list[str]):
+    known = wide["col_set"]
+    for col in cols:
+        if col not in known:
+            known.add(col)
+            wide["columns"].append(col)
+
+def write_wide_row(wide: dict, job: dict, breakdown: dict | None):
     key = canonical_key(job)
-    row_idx = df.index[df["key"] == key].tolist()
-    if row_idx:
-        i = row_idx[0]
-    else:
-        i = len(df)
-        df.loc[i, "key"] = key
-        df.loc[i, "origin"] = job["origin"]
-        df.loc[i, "destination"] = job["destination"]
+    row = wide["rows"].get(key)
+    if row is None:
+        row = {"key": key, "origin": job["origin"], "destination": job["destination"]}
+        wide["rows"][key] = row
 
-    df.loc[i, "last_attempt_at"] = job.get("_started_at") or datetime.now().isoformat(
+    row["last_attempt_at"] = job.get("_started_at") or datetime.now().isoformat(
         timespec="seconds"
     )
 
     if breakdown is None:
-        df.loc[i, "status"] = job.get("status", "error")
-        df.loc[i, "message"] = sanitize_message_for_reports(job.get("message", "Falha"))
-        return df
-
-    df.loc[i, "status"] = "ok"
-    df.loc[i, "message"] = ""
-    df.loc[i, "quoted_at"] = datetime.now().isoformat(timespec="seconds")
+        row["status"] = job.get("status", "error")
+        row["message"] = sanitize_message_for_reports(job.get("message", "Falha"))
+        return
 
     offer_header = breakdown.get("offer_header") or {}
-    df.loc[i, "offer_departure_date"] = offer_header.get("departure_date")
-    df.loc[i, "offer_arrival_date"] = offer_header.get("arrival_date")
-    df.loc[i, "offer_transit_time"] = offer_header.get("transit_time")
-    df.loc[i, "offer_transit_time_hours"] = offer_header.get("transit_time_hours")
-
     charges = breakdown.get("charges", [])
 
     charges_for_csv: list[dict] = []
@@ -2449,7 +2487,7 @@ def write_wide_row(df: pd.DataFrame, job: dict, breakdown: dict | None) -> pd.Da
             charges_for_csv.append(c)
             continue
 
-        usd_val = amount_to_usd(total_val, cur_original)
+        usd_val = fx_rates.amount_to_usd(total_val, cur_original, log_fn=log)
         if usd_val is not None:
             c2 = dict(c)
             c2["currency"] = "USD"
@@ -2457,38 +2495,32 @@ def write_wide_row(df: pd.DataFrame, job: dict, breakdown: dict | None) -> pd.Da
             charges_for_csv.append(c2)
         else:
             log(
-                f"âš ï¸ FX: nÃ£o foi possÃ­vel converter {cur_original} -> USD; mantendo valor original no CSV."
+                f"âš ï¸ FX: nÃ£o foi possÃ­vel converter {cur_original} -> USD; mantendo valor original no CSV."
             )
             charges_for_csv.append(c)
 
-    df = ensure_wide_columns(df, charges_for_csv)
-
-    for col in df.columns:
-        if col not in {
-            "key",
-            "origin",
-            "destination",
-            "last_attempt_at",
-            "quoted_at",
-            "status",
-            "message",
-            "offer_departure_date",
-            "offer_arrival_date",
-            "offer_transit_time",
-            "offer_transit_time_hours",
-        }:
-            df.loc[i, col] = pd.NA
-
+    # sucesso substitui a linha inteira: charges antigas que nao vieram agora ficam vazias
+    row = {
+        "key": row["key"],
+        "origin": row.get("origin"),
+        "destination": row.get("destination"),
+        "last_attempt_at": row["last_attempt_at"],
+        "quoted_at": datetime.now().isoformat(timespec="seconds"),
+        "status": "ok",
+        "message": "",
+        "offer_departure_date": offer_header.get("departure_date"),
+        "offer_arrival_date": offer_header.get("arrival_date"),
+        "offer_transit_time": offer_header.get("transit_time"),
+        "offer_transit_time_hours": offer_header.get("transit_time_hours"),
+    }
     for c in charges_for_csv:
         cur = c.get("currency") or "UNK"
         name = c.get("charge_name") or "Unknown"
-        col = f"{cur} {name}"
-        val = c.get("total_price")
-        df.loc[i, col] = val
+        row[f"{cur} {name}"] = c.get("total_price")
+    ensure_wide_columns(wide, list(row))
+    wide["rows"][key] = row
 
-    return df
-
-def load_wide_csv(path: Path) -> pd.DataFrame:
+def load_wide_csv(path: Path) -> dict:
     if path.exists():
         try:
             df = pd.read_csv(path)
@@ -2497,25 +2529,43 @@ def load_wide_csv(path: Path) -> pd.DataFrame:
     else:
         df = pd.DataFrame()
 
-    for base_col in [
-        "key",
-        "origin",
-        "destination",
-        "last_attempt_at",
-        "quoted_at",
-        "status",
-        "message",
-        "offer_departure_date",
-        "offer_arrival_date",
-        "offer_transit_time",
-        "offer_transit_time_hours",
-    ]:
-        if base_col not in df.columns:
-            df[base_col] = pd.Series(dtype="string")
-    return df
-
-def save_wide_csv(df: pd.DataFrame, path: Path):
-    df.to_csv(path, index=False, encoding="utf-8-sig")
+    wide = {"columns": [], "col_set": set(), "rows": {}}
+    ensure_wide_columns(wide, [str(c) for c in df.columns] + WIDE_BASE_COLS)
+    for rec in df.to_dict("records"):
+        key = rec.get("key")
+        if pd.isna(key):
+            continue
+        # primeira linha de cada key vale (mesma regra da busca por key de antes)
+        wide["rows"].setdefault(
+            str(key), {str(c): v for c, v in rec.items() if not pd.isna(v)}
+        )
+    return wide
+
+def wide_to_df(wide: dict) -> pd.DataFrame:
+    return pd.DataFrame.from_records(list(wide["rows"].values()), columns=wide["columns"])
+
+def save_wide_csv(wide: dict, path: Path):
+    # escreve num tmp e troca: queda no meio da escrita nao corrompe o CSV
+    quote_store.replace_file(path, lambda tmp_path: wide_to_df(wide).to_csv(tmp_path, index=False, encoding="utf-8-sig"))
+
+def export_wide_csv(wide: dict, path: Path, csv_export: dict):
+    """
+    CSV de breakdown pela visao de exportacao do store; com o store desligado
+    (ou depois de uma tentativa que nao entrou no store) sai das linhas em memoria.
+    """
+    if not csv_export["from_store"] or quote_store.export_view("maersk", path) is None:
+        save_wide_csv(wide, path)
+
+def persist_quote_attempt(wide: dict, job: dict, idx: int, export_every: int, csv_export: dict):
+    """
+    Grava a linha atual da rota no store de cotacoes. O CSV e reexportado a cada
+    `export_every` jobs, ou a cada job se o store estiver desligado/falhar.
+    """
+    row = wide["rows"].get(canonical_key(job))
+    if row is None or not quote_store.record_attempt("maersk", row):
+        csv_export["from_store"] = False
+    if not csv_export["from_store"] or (export_every and idx % export_every == 0):
+        export_wide_csv(wide, SHARD_OUT_CSV, csv_export)
 
 def append_run_log(status: str, job: dict, message: str = ""):
     rec = {
@@ -2525,36 +2575,43 @@ def append_run_log(status: str, job: dict, message: str = ""):
         "status": status,
         "message": sanitize_message_for_reports(message),
     }
-    if RUN_LOG_CSV.exists():
-        try:
-            old = pd.read_csv(RUN_LOG_CSV)
-        except Exception:
-            old = pd.DataFrame()
-        new = pd.concat([old, pd.DataFrame([rec])], ignore_index=True)
-    else:
-        new = pd.DataFrame([rec])
-    new.to_csv(RUN_LOG_CSV, index=False, encoding="utf-8-sig")
+    # so acrescenta a linha: custo constante, sem reler o historico
+    run_logs.append_row(SHARD_RUN_LOG_CSV, RUN_LOG_FIELDS, rec)
+
+    t0 = job.get("_t0")
+    run_history.record_route_attempt(
+        carrier="maersk",
+        route_key=canonical_key(job),
+        origin=job.get("origin"),
+        destination=job.get("destination"),
+        status=status,
+        latency_sec=(time.monotonic() - t0) if t0 is not None else None,
+        retries=job.get("_retries"),
+        message=rec["message"],
+        started_at=job.get("_started_at"),
+    )
+    progress_events.emit(
+        "job_end",
+        carrier="maersk",
+        key=canonical_key(job),
+        status=status,
+        duration_sec=round(time.monotonic() - t0, 3) if t0 is not None else None,
+        retries=job.get("_retries"),
+    )
 
 # ----------------------------------------------------------------------
 # Prioridade dos jobs com base em tentativas e cotaÃ§Ãµes anteriores
 # ----------------------------------------------------------------------
-def _build_status_map(wide_df: pd.DataFrame) -> dict:
+def _build_status_map(wide: dict) -> dict:
     status_map: dict[str, dict] = {}
-    if wide_df.empty:
-        return status_map
-
-    for _, row in wide_df.iterrows():
-        key = row.get("key")
-        if pd.isna(key):
-            continue
-
+    for key, row in wide["rows"].items():
         last_attempt_raw = row.get("last_attempt_at")
         quoted_raw = row.get("quoted_at")
 
         last_attempt_dt = pd.to_datetime(last_attempt_raw, errors="coerce")
         quoted_dt = pd.to_datetime(quoted_raw, errors="coerce")
 
-        status_map[str(key)] = {
+        status_map[key] = {
             "quoted_at": quoted_dt,
             "last_attempt_at": last_attempt_dt,
         }
@@ -2585,8 +2642,8 @@ def _job_sort_key(job: dict, original_idx: int, status_map: dict) -> tuple:
 
     return (group, ts_sort_key, original_idx)
 
-def prioritize_jobs(jobs: list[dict], wide_df: pd.DataFrame) -> list[dict]:
-    status_map = _build_status_map(wide_df)
+def prioritize_jobs(jobs: list[dict], wide: dict) -> list[dict]:
+    status_map = _build_status_map(wide)
 
     indexed = list(enumerate(jobs))
     ordered = sorted(
@@ -2628,10 +2685,11 @@ def read_jobs_xlsx(xlsx_path: Path) -> list[dict]:
 # ----------------------------------------------------------------------
 # Orquestra um job (uma linha do Excel) com tolerÃ¢ncia a erro
 # ----------------------------------------------------------------------
-def run_one_job(page, job: dict) -> dict | None:
+def submit_job(page, job: dict) -> dict | None:
     """
-    Executa o fluxo para 1 job. Retorna o breakdown (dict) em sucesso,
-    ou {"__error": "..."} em falha (para logar motivo especÃ­fico).
+    Primeira metade do fluxo: abre o BOOK, preenche o formulario e dispara a
+    busca. Retorna None com a busca em andamento (data alvo em job["_target_dt"])
+    ou {"__error": "..."} em falha.
     """
     try:
         nav_timeout_ms = int(os.getenv("MAERSK_NAV_TIMEOUT_MS", "60000"))
@@ -2713,6 +2771,7 @@ def run_one_job(page, job: dict) -> dict | None:
                     )
                 }
 
+        job_watchdog.check(page, "preenchimento do formulario")
         close_unexpected_modal(page, "inicio do job")
         ok = fill_autocomplete(page, SEL_ORIGIN, job["origin"], "Origem")
         if not ok:
@@ -2742,19 +2801,36 @@ def run_one_job(page, job: dict) -> dict | None:
         close_unexpected_modal(page, "apos peso")
         set_price_owner(page, owner=job["price_owner"])
 
-        target_dt = set_date_plus(
+        job["_target_dt"] = set_date_plus(
             page,
             days=job["date_plus_days"],
             label_for_log="Data (Earliest departure)",
         )
 
         close_unexpected_modal(page, "apos data")
+        return None
+
+    except Exception as e:
+        save_quote_screenshot(page, job, "unexpected_exception")
+        return {"__error": f"{type(e).__name__}: {e}"}
+
+
+def collect_job(page, job: dict, searched_at: float | None = None, retry_clicks: int = 0) -> dict | None:
+    """
+    Segunda metade do fluxo: espera os resultados (com Retry), abre o Price
+    details do offer mais proximo da data alvo e extrai o breakdown.
+    """
+    try:
+        target_dt = job["_target_dt"]
         ok, retry_clicks = wait_for_results_or_retry(
             page,
             timeout_sec=RESULTS_TIMEOUT_SEC,
-            max_retry_clicks=10,
+            max_retry_clicks=MAX_RETRY_CLICKS,
             poll_sec=0.25,
+            started_at=searched_at,
+            retry_clicks=retry_clicks,
         )
+        job["_retries"] = retry_clicks
 
         if not ok:
             # âœ… Se nÃ£o achou nada (ou timeout/retry), tira print da tela "sem ter achado nada"
@@ -2769,6 +2845,7 @@ def run_one_job(page, job: dict) -> dict | None:
 
         log("[offers] resultados visiveis; escolhendo offer-card e abrindo Price details.")
 
+        job_watchdog.check(page, "escolha do offer-card")
         close_unexpected_modal(page, "antes de escolher offer")
         if not open_price_details_closest_to_target(
             page, target_dt=target_dt, job=job, timeout_ms=RESULTS_TIMEOUT_SEC * 1000
@@ -2780,6 +2857,7 @@ def run_one_job(page, job: dict) -> dict | None:
         offer_header = extract_offer_modal_header(page, timeout_ms=10000)
         log(f"Card details: partida={offer_header.get('departure_date')} | chegada={offer_header.get('arrival_date')} | tempo={offer_header.get('transit_time')} (horas={offer_header.get('transit_time_hours')})")
 
+        job_watchdog.check(page, "breakdown")
         if not ensure_breakdown_tab(page):
             save_quote_screenshot(page, job, "breakdown_tab_missing")
             return {"__error": "Aba 'Breakdown' indisponÃ­vel."}
@@ -2801,131 +2879,401 @@ def run_one_job(page, job: dict) -> dict | None:
         save_quote_screenshot(page, job, "unexpected_exception")
         return {"__error": f"{type(e).__name__}: {e}"}
 
+
+def run_one_job(page, job: dict) -> dict | None:
+    """
+    Executa o fluxo para 1 job. Retorna o breakdown (dict) em sucesso,
+    ou {"__error": "..."} em falha (para logar motivo especÃ­fico).
+    """
+    failed = submit_job(page, job)
+    if failed is not None:
+        return failed
+    return collect_job(page, job)
+
+
+def probe_results_state(page) -> str:
+    """Leitura rapida (sem espera) de uma aba com busca em andamento: "ready", "retry" ou "waiting"."""
+    try:
+        if _results_visible(page):
+            return "ready"
+        if _retry_visible(page):
+            return "retry"
+    except Exception:
+        # aba quebrada: o collect_job registra o erro
+        return "ready"
+    return "waiting"
+
+
+def pick_ready_tab(busy: list) -> dict:
+    """
+    Varias abas: escolhe a proxima aba a concluir sem travar nas demais.
+    Sai primeiro a que tem resultados na tela. Retry e clicado aqui mesmo, com
+    o backoff contado por aba (as outras seguem enquanto isso); a aba so e
+    concluida sem resultados ao atingir o limite de Retry, `MAERSK_RESULTS_TIMEOUT_SEC`
+    desde a busca ou o orcamento do watchdog.
+    """
+    if len(busy) == 1:
+        return busy[0]
+    ordered = sorted(busy, key=lambda t: t["searched_at"])
+    while True:
+        for tab in ordered:
+            _switch_to_tab(tab, pooled=True)
+            state = probe_results_state(tab["page"])
+            now = time.time()
+            deadline = tab["watchdog"].get("deadline")
+            expired = bool(tab["watchdog"].get("active")) and deadline is not None and time.monotonic() >= deadline
+            if state == "retry" and tab["retries"] < MAX_RETRY_CLICKS and now >= tab["retry_after"]:
+                tab["retries"] += 1
+                log(f"Retry apareceu! tentativa #{tab['retries']}/{MAX_RETRY_CLICKS}")
+                ok_click = _click_retry(tab["page"])
+                log(f"Retry click result: {'OK' if ok_click else 'FAIL'}")
+                tab["retry_after"] = time.time() + retry_backoff_sec(tab["retries"])
+                continue
+            if state == "waiting":
+                close_unexpected_modal(tab["page"], "aguardando resultados")
+            if (
+                state == "ready"
+                or expired
+                or tab["retries"] >= MAX_RETRY_CLICKS
+                or now - tab["searched_at"] >= RESULTS_TIMEOUT_SEC
+            ):
+                return tab
+        time.sleep(0.25)
+
 # ----------------------------------------------------------------------
 # MAIN (batch)
 # ----------------------------------------------------------------------
+def build_context_kwargs(user_data_dir: Path, extra_args: list[str] | None = None) -> dict:
+    """
+    kwargs do launch_persistent_context a partir das envs MAERSK_*.
+    Compartilhado com o browser pool (src/scrapers/browser_pool.py).
+    """
+    maersk_headless = parse_env_bool("MAERSK_HEADLESS", default=False)
+    maersk_viewport_width = int(os.getenv("MAERSK_VIEWPORT_WIDTH", "1366"))
+    maersk_viewport_height = int(os.getenv("MAERSK_VIEWPORT_HEIGHT", "768"))
+    maersk_locale = os.getenv("MAERSK_LOCALE", "en-US")
+    maersk_timezone = os.getenv("MAERSK_TIMEZONE", "America/Sao_Paulo")
+    maersk_accept_language = os.getenv("MAERSK_ACCEPT_LANGUAGE", "en-US,en;q=0.9,pt-BR;q=0.8")
+    maersk_user_agent = os.getenv("MAERSK_USER_AGENT", DEFAULT_MAERSK_USER_AGENT)
+    maersk_ignore_enable_automation = parse_env_bool("MAERSK_IGNORE_ENABLE_AUTOMATION", default=True)
+    maersk_browser_channel = parse_browser_channel("MAERSK_BROWSER_CHANNEL", default="chrome")
+
+    context_kwargs = {
+        "user_data_dir": str(user_data_dir),
+        "headless": maersk_headless,
+        "viewport": {"width": maersk_viewport_width, "height": maersk_viewport_height},
+        "locale": maersk_locale,
+        "timezone_id": maersk_timezone,
+        "user_agent": maersk_user_agent,
+        "extra_http_headers": {"Accept-Language": maersk_accept_language},
+        "args": [
+            "--disable-blink-features=AutomationControlled",
+            "--disable-infobars",
+            f"--window-size={maersk_viewport_width},{maersk_viewport_height}",
+            "--disable-dev-shm-usage",
+            "--no-first-run",
+            "--no-default-browser-check",
+            *(extra_args or []),
+        ],
+    }
+    if maersk_browser_channel:
+        context_kwargs["channel"] = maersk_browser_channel
+    else:
+        log("[cfg] MAERSK_BROWSER_CHANNEL=bundled/playwright: usando Chromium bundled do Playwright.")
+    if maersk_ignore_enable_automation:
+        context_kwargs["ignore_default_args"] = ["--enable-automation"]
+    return context_kwargs
+
+
 def main():
     load_dotenv(PROJECT_ROOT / ".env", override=True)
 
-    maersk_user = os.getenv("MAERSK_USER")
-    maersk_pass = os.getenv("MAERSK_PASS")
-    if not maersk_user or not maersk_pass:
-        raise RuntimeError("MAERSK_USER e/ou MAERSK_PASS nÃ£o configurados no .env")
-
     default_commodity   = os.getenv("MAERSK_COMMODITY",   "Ceramics, stoneware")
     default_container   = os.getenv("MAERSK_CONTAINER",   "20 Dry")
     default_weight_kg   = int(os.getenv("MAERSK_WEIGHT_KG", "26000"))
     default_price_owner = os.getenv("MAERSK_PRICE_OWNER", "I am the price owner")
     default_date_plus   = int(os.getenv("MAERSK_DATE_PLUS_DAYS", "14"))
     keep_open           = int(os.getenv("KEEP_OPEN_SECS", "30"))
-    maersk_headless     = parse_env_bool("MAERSK_HEADLESS", default=False)
     maersk_login_timeout_ms = int(os.getenv("MAERSK_LOGIN_TIMEOUT_MS", "60000"))
     maersk_action_timeout_ms = int(os.getenv("MAERSK_ACTION_TIMEOUT_MS", "15000"))
-    maersk_viewport_width = int(os.getenv("MAERSK_VIEWPORT_WIDTH", "1366"))
-    maersk_viewport_height = int(os.getenv("MAERSK_VIEWPORT_HEIGHT", "768"))
-    maersk_locale = os.getenv("MAERSK_LOCALE", "en-US")
-    maersk_timezone = os.getenv("MAERSK_TIMEZONE", "America/Sao_Paulo")
-    maersk_accept_language = os.getenv("MAERSK_ACCEPT_LANGUAGE", "en-US,en;q=0.9,pt-BR;q=0.8")
-    maersk_user_agent = os.getenv("MAERSK_USER_AGENT", DEFAULT_MAERSK_USER_AGENT)
     maersk_stealth_enabled = parse_env_bool("MAERSK_STEALTH", default=True)
-    maersk_ignore_enable_automation = parse_env_bool("MAERSK_IGNORE_ENABLE_AUTOMATION", default=True)
-    maersk_browser_channel = parse_browser_channel("MAERSK_BROWSER_CHANNEL", default="chrome")
 
     jobs = read_jobs_xlsx(INPUT_XLSX)
     if not jobs:
         log("Nenhum job no XLSX de entrada.")
         return
 
-    wide_df = load_wide_csv(OUT_CSV)
+    # o store de cotacoes reexporta o CSV antes, se um run anterior caiu sem exportar
+    quote_store.sync_csv("maersk", OUT_CSV, log_fn=log_plain)
+    if SHARD_COUNT == 1:
+        # com shards quem rotaciona o run log canonico e o merge de shards
+        run_logs.rotate_if_needed(RUN_LOG_CSV, log_fn=log_plain)
+    wide = load_wide_csv(OUT_CSV)
 
-    jobs = prioritize_jobs(jobs, wide_df)
+    jobs = prioritize_jobs(jobs, wide)
     log(f"Total de jobs carregados: {len(jobs)} (ordenados por prioridade).")
-
-    with sync_playwright() as p:
-        context_kwargs = {
-            "user_data_dir": str(USER_DATA_DIR),
-            "headless": maersk_headless,
-            "viewport": {"width": maersk_viewport_width, "height": maersk_viewport_height},
-            "locale": maersk_locale,
-            "timezone_id": maersk_timezone,
-            "user_agent": maersk_user_agent,
-            "extra_http_headers": {"Accept-Language": maersk_accept_language},
-            "args": [
-                "--disable-blink-features=AutomationControlled",
-                "--disable-infobars",
-                f"--window-size={maersk_viewport_width},{maersk_viewport_height}",
-                "--disable-dev-shm-usage",
-                "--no-first-run",
-                "--no-default-browser-check",
-            ],
-        }
-        if maersk_browser_channel:
-            context_kwargs["channel"] = maersk_browser_channel
-        else:
-            log("[cfg] MAERSK_BROWSER_CHANNEL=bundled/playwright: usando Chromium bundled do Playwright.")
-        if maersk_ignore_enable_automation:
-            context_kwargs["ignore_default_args"] = ["--enable-automation"]
-
-        context = p.chromium.launch_persistent_context(
-            **context_kwargs,
-        )
-        if maersk_stealth_enabled:
-            context.add_init_script(STEALTH_INIT_SCRIPT)
-        page = context.new_page()
-        page.set_default_timeout(maersk_action_timeout_ms)
-        page.set_default_navigation_timeout(maersk_login_timeout_ms)
-
-        ok_login = login_maersk(
-            page,
-            maersk_user,
-            maersk_pass,
-            timeout_ms=maersk_login_timeout_ms,
+    jobs = route_scheduler.restrict_to_routes_file(jobs, log_fn=log_plain)
+    use_queue = job_queue.queue_enabled()
+    if SHARD_COUNT > 1 and not use_queue:
+        # round-robin sobre a fila ja ordenada: cada shard recebe uma mistura
+        # equilibrada dos grupos de prioridade (com SCRAPER_JOB_QUEUE os shards
+        # dividem a fila inteira dinamicamente).
+        jobs = [job for pos, job in enumerate(jobs) if pos % SHARD_COUNT == SHARD_INDEX]
+        log(f"[shard] {SHARD_INDEX + 1}/{SHARD_COUNT}: {len(jobs)} jobs nesta fatia; saida em {SHARD_OUT_CSV}")
+    page_count = max(1, int(os.getenv("MAERSK_PAGES", "1")))
+    # na fila compartilhada os shards executam o mesmo plano em paralelo; as abas
+    # (MAERSK_PAGES) correm rotas em paralelo dentro do processo
+    schedule = route_scheduler.plan_routes(
+        "maersk",
+        jobs,
+        key_fn=canonical_key,
+        log_fn=log_plain,
+        processes=SHARD_COUNT if use_queue else 1,
+        concurrency=page_count,
+    )
+    jobs = schedule["jobs"]
+    # na fila compartilhada o total por processo e uma estimativa (fila / shards)
+    expected_jobs = -(-len(jobs) // SHARD_COUNT) if use_queue else len(jobs)
+    if use_queue:
+        added = job_queue.enqueue("maersk", jobs, key_fn=canonical_key)
+        log_plain(
+            f"[fila] {job_queue.queue_name()}: {added} rotas publicadas (demais ja estavam na fila); "
+            f"worker {job_queue.worker_id()}."
         )
-        if not ok_login:
-            log("Login falhou; encerrando execucao.")
-            return
+    progress_events.emit(
+        "batch_start",
+        carrier="maersk",
+        total=expected_jobs,
+        deferred=len(schedule["deferred"]),
+        shard_index=SHARD_INDEX,
+        shard_count=SHARD_COUNT,
+    )
 
-        for idx, job in enumerate(jobs, start=1):
-            job.setdefault("commodity", default_commodity)
-            job.setdefault("container", default_container)
-            job.setdefault("weight_kg", default_weight_kg)
-            job.setdefault("price_owner", default_price_owner)
-            job.setdefault("date_plus_days", default_date_plus)
-            job["_started_at"] = datetime.now().isoformat(timespec="seconds")
-
-            log(f"--- ({idx}/{len(jobs)}) {job['origin']} -> {job['destination']} ---")
-
-            if is_blank(job["origin"]) or is_blank(job["destination"]):
-                # aqui nÃ£o tem tela Ãºtil, mas se quiser:
-                # save_quote_screenshot(page, job, "blank_origin_or_destination")
-                job["status"] = "error"
-                job["message"] = "Origem/Destino vazios no Excel."
-                wide_df = write_wide_row(wide_df, job, breakdown=None)
-                append_run_log("error", job, job["message"])
-                save_wide_csv(wide_df, OUT_CSV)
-                continue
+    pool_state = None
+    if parse_env_bool("BROWSER_POOL_ENABLED", default=False):
+        pool_state = browser_pool.read_pool_state("maersk")
+        if pool_state is None:
+            log("[pool] browser pool indisponivel/desatualizado; seguindo com browser proprio.")
 
-            bd = run_one_job(page, job)
+    # conta do pool (MAERSK_ACCOUNTS); com browser pool segue na conta ja logada pelo daemon
+    account = account_pool.acquire("maersk", log_fn=log_plain, prefer=(pool_state or {}).get("account_id"))
 
-            if not bd or ("__error" in bd):
-                job["status"] = "error"
-                job["message"] = sanitize_message_for_reports(
-                    (bd or {}).get("__error", "Falha no fluxo/Breakdown indisponÃ­vel")
-                )
-                wide_df = write_wide_row(wide_df, job, breakdown=None)
-                append_run_log("error", job, job["message"])
-                log(f"JOB ERRO: {job['origin']} -> {job['destination']} | {job['message']}")
+    # daqui em diante qualquer falha (launch, login, batch) devolve a conta
+    try:
+        with sync_playwright() as p:
+            if pool_state is not None:
+                # Contexto ja logado mantido pelo daemon (src/scrapers/browser_pool.py).
+                browser = p.chromium.connect_over_cdp(pool_state["endpoint"])
+                context = browser.contexts[0]
+                log(f"[pool] conectado ao browser pool: {pool_state['endpoint']} (login em {pool_state.get('last_login_at')})")
             else:
-                job["status"] = "ok"
-                job["message"] = ""
-                wide_df = write_wide_row(wide_df, job, breakdown=bd)
-                append_run_log("ok", job, "")
+                context = p.chromium.launch_persistent_context(
+                    **build_context_kwargs(account_pool.profile_dir(USER_DATA_DIR, account)),
+                )
+                if maersk_stealth_enabled:
+                    context.add_init_script(STEALTH_INIT_SCRIPT)
+            def setup_page(new_page):
+                new_page.set_default_timeout(maersk_action_timeout_ms)
+                new_page.set_default_navigation_timeout(maersk_login_timeout_ms)
+
+            page = context.new_page()
+            setup_page(page)
+            watchdog_on = job_watchdog.watchdog_enabled()
+            export_every = quote_store.export_every()
+            csv_export = {"from_store": True}
+
+            if pool_state is None:
+                ok_login = login_maersk(
+                    page,
+                    account["user"],
+                    account["password"],
+                    timeout_ms=maersk_login_timeout_ms,
+                )
+                if not ok_login:
+                    log("Login falhou; encerrando execucao.")
+                    account_pool.report_lockout(account, "login falhou", log_fn=log_plain)
+                    return
+
+            # Com MAERSK_PAGES > 1 as buscas correm em paralelo no mesmo contexto logado:
+            # enquanto uma aba espera os cards (e clica Retry), as outras preenchem a proxima rota.
+            tabs = [{"n": 1, "page": page, "job": None, "free_at": 0.0}]
+            for n in range(2, page_count + 1):
+                extra = context.new_page()
+                setup_page(extra)
+                tabs.append({"n": n, "page": extra, "job": None, "free_at": 0.0})
+            if page_count > 1:
+                log_plain(f"[abas] {page_count} abas de cotacao no mesmo contexto logado.")
+            rate_on = rate_control.control_enabled()
+            if rate_on:
+                log_plain(rate_control.describe("maersk"))
+
+            # com a fila, a conta bloqueada para de pegar rotas e as demais ficam para as outras contas;
+            # aba livre nao espera pelos leases das abas ocupadas deste processo
+            feed = route_scheduler.open_job_feed(
+                schedule,
+                jobs,
+                key_fn=canonical_key,
+                log_fn=log_plain,
+                use_queue=use_queue,
+                account=account,
+                busy_fn=lambda: any(t["job"] is not None for t in tabs),
+            )
 
-            save_wide_csv(wide_df, OUT_CSV)
-            time.sleep(1.0)
+            def begin_job(tab, job):
+                idx = feed["idx"]
+                job.setdefault("commodity", default_commodity)
+                job.setdefault("container", default_container)
+                job.setdefault("weight_kg", default_weight_kg)
+                job.setdefault("price_owner", default_price_owner)
+                job.setdefault("date_plus_days", default_date_plus)
+                job["_started_at"] = datetime.now().isoformat(timespec="seconds")
+                job["_t0"] = time.monotonic()
+                tab.update(job=job, idx=idx, retries=0, retry_after=0.0, leased_at=time.time())
+                _switch_to_tab(tab, pooled=page_count > 1)
+                progress_events.emit("job_start", carrier="maersk", idx=idx, total=expected_jobs, key=canonical_key(job))
+
+                log(f"--- ({idx}/{expected_jobs}) {job['origin']} -> {job['destination']} ---")
+                tab["watchdog"] = job_watchdog.current_job()
+
+                if is_blank(job["origin"]) or is_blank(job["destination"]):
+                    # aqui nÃ£o tem tela Ãºtil, mas se quiser:
+                    # save_quote_screenshot(page, job, "blank_origin_or_destination")
+                    job["status"] = "error"
+                    job["message"] = "Origem/Destino vazios no Excel."
+                    write_wide_row(wide, job, breakdown=None)
+                    append_run_log("error", job, job["message"])
+                    persist_quote_attempt(wide, job, idx, export_every, csv_export)
+                    if use_queue:
+                        job_queue.ack("maersk", canonical_key(job), job["status"])
+                    if rate_on:
+                        # nenhuma busca aconteceu: devolve vaga e token
+                        rate_control.cancel("maersk", tab["n"])
+                    tab["job"] = None
+                    return
+
+                if watchdog_on:
+                    budget_sec, budget_source = job_watchdog.route_budget_sec("maersk", canonical_key(job))
+                    job_watchdog.start_job(budget_sec, tab["page"], maersk_action_timeout_ms, maersk_login_timeout_ms)
+                    log(f"[watchdog] orcamento do job: {budget_sec:.0f}s ({budget_source})")
+                    tab["watchdog"] = job_watchdog.current_job()
+
+                failed = submit_job(tab["page"], job)
+                tab["searched_at"] = time.time()
+                if failed is not None:
+                    complete_job(tab, failed)
+
+            def complete_job(tab, bd):
+                # escritor unico: todas as abas gravam por aqui, na ordem em que terminam
+                job, idx = tab["job"], tab["idx"]
+                _switch_to_tab(tab, pooled=page_count > 1)
+                job_watchdog.resume_job(tab["watchdog"])
+
+                if job_watchdog.expired() and (not bd or "__error" in bd):
+                    job["status"] = job_watchdog.TIMEOUT_STATUS
+                    job["message"] = sanitize_message_for_reports(
+                        f"Job excedeu o orcamento de {job_watchdog.budget_sec():.0f}s "
+                        f"(ultimo erro: {(bd or {}).get('__error') or '-'})."
+                    )
+                    write_wide_row(wide, job, breakdown=None)
+                    append_run_log(job_watchdog.TIMEOUT_STATUS, job, job["message"])
+                    log(f"JOB TIMEOUT: {job['origin']} -> {job['destination']} | {job['message']}")
+                    save_quote_screenshot(tab["page"], job, "watchdog_timeout")
+                    tab["page"] = job_watchdog.recycle_page(context, tab["page"], setup_page)
+                    log("[watchdog] aba recriada para o proximo job.")
+                elif not bd or ("__error" in bd):
+                    job["status"] = "error"
+                    job["message"] = sanitize_message_for_reports(
+                        (bd or {}).get("__error", "Falha no fluxo/Breakdown indisponÃ­vel")
+                    )
+                    write_wide_row(wide, job, breakdown=None)
+                    append_run_log("error", job, job["message"])
+                    log(f"JOB ERRO: {job['origin']} -> {job['destination']} | {job['message']}")
+                else:
+                    job["status"] = "ok"
+                    job["message"] = ""
+                    write_wide_row(wide, job, breakdown=bd)
+                    append_run_log("ok", job, "")
+                job_watchdog.finish_job()
+
+                # tentativa vai para o store; o CSV e reexportado a cada N jobs (ou a cada job sem store)
+                persist_quote_attempt(wide, job, idx, export_every, csv_export)
+                # ack so depois da tentativa gravada: processo que cai antes disso devolve a rota a fila
+                if use_queue and not job_queue.ack("maersk", canonical_key(job), job["status"]):
+                    log_plain(f"[fila] {canonical_key(job)}: lease perdido antes do fim (outro processo pode refazer a rota).")
+                lock_reason = account_pool.record_job(account, job["status"], job["message"])
+                if lock_reason:
+                    log_plain(f"[contas] maersk/{account['id']} bloqueada: {lock_reason}.")
+                if rate_on:
+                    # Retry clicado ou timeout = pressao do site
+                    pressure = job["status"] == job_watchdog.TIMEOUT_STATUS or (job.get("_retries") or 0) > 0
+                    rate_control.finish(
+                        "maersk", tab["n"], job["status"], time.monotonic() - job["_t0"], pressure=pressure, log_fn=log_plain
+                    )
+                tab["job"] = None
+                # pausa de 1s entre jobs da mesma aba (as outras abas nao esperam)
+                tab["free_at"] = time.time() + 1.0
 
-        log(f"Batch concluido. Mantendo aberto por {keep_open}s.")
-        time.sleep(keep_open)
+            try:
+                while True:
+                    # abas livres pegam a proxima rota e disparam a busca
+                    for tab in tabs:
+                        while tab["job"] is None and not feed["exhausted"]:
+                            # controle de ritmo: sem vaga/token, conclui as abas ocupadas antes
+                            if rate_on and rate_control.try_start("maersk", tab["n"]) > 0:
+                                if any(t["job"] is not None for t in tabs):
+                                    break
+                                rate_control.wait_start("maersk", tab["n"], log_fn=log_plain)
+                            job = route_scheduler.next_feed_job(feed)
+                            if job is None:
+                                # fim da fonte, ou fila sem rota agora: conclui as abas ocupadas antes
+                                if rate_on:
+                                    rate_control.cancel("maersk", tab["n"])
+                                break
+                            time.sleep(max(0.0, tab["free_at"] - time.time()))
+                            begin_job(tab, job)
+                    busy = [t for t in tabs if t["job"] is not None]
+                    if not busy:
+                        break
+                    if use_queue:
+                        # abas esperando enquanto outras sao atendidas nao perdem o lease
+                        for t in busy:
+                            t["leased_at"] = job_queue.renew_if_due("maersk", canonical_key(t["job"]), t["leased_at"], log_plain)
+                    # conclui a aba cujos resultados ficaram prontos primeiro
+                    tab = pick_ready_tab(busy)
+                    _switch_to_tab(tab, pooled=page_count > 1)
+                    job_watchdog.resume_job(tab["watchdog"])
+                    if page_count > 1:
+                        bd = collect_job(tab["page"], tab["job"], searched_at=tab["searched_at"], retry_clicks=tab["retries"])
+                    else:
+                        bd = collect_job(tab["page"], tab["job"])
+                    complete_job(tab, bd)
+            finally:
+                # grava o CSV final (tambem se o batch quebrar no meio)
+                export_wide_csv(wide, SHARD_OUT_CSV, csv_export)
+                if use_queue:
+                    # rotas em curso voltam para a fila para outro processo
+                    for t in tabs:
+                        if t["job"] is not None:
+                            job_queue.release("maersk", canonical_key(t["job"]))
+                if rate_on:
+                    rate_control.release_holder("maersk")
+
+            # tabela longa de charges (particoes por data)
+            charge_store.export_partitions("maersk", to_usd=partial(fx_rates.amount_to_usd, log_fn=log), log_fn=log_plain)
+            progress_events.emit("batch_end", carrier="maersk", deferred=len(schedule["deferred"]))
+            deferred_report = route_scheduler.write_deferred_report(schedule)
+            if deferred_report is not None:
+                log_plain(f"[deadline] {len(schedule['deferred'])} rotas adiadas; relatorio em {deferred_report}")
+            if pool_state is not None:
+                # Contexto pertence ao daemon: fecha so a aba desta execucao.
+                log("Batch concluido. Devolvendo contexto ao browser pool.")
+                for tab in tabs:
+                    tab["page"].close()
+                return
+            log(f"Batch concluido. Mantendo aberto por {keep_open}s.")
+            time.sleep(keep_open)
+    finally:
+        account_pool.release(account)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,306 @@
+"""
+Agendamento de rotas por deadline (`PIPELINE_DEADLINE`).
+
+Sem deadline os scrapers seguem a fila priorizada ate o fim, como antes. Com
+deadline, cada rota ganha um modelo de custo a partir do historico
+(run_history):
+- duracao esperada: mediana da latencia das ultimas tentativas da rota (inclui
+  erros/timeouts, que tambem gastam tempo); sem historico da rota, mediana do
+  carrier; sem nada, `SCRAPER_DEFAULT_ROUTE_SEC`;
+- probabilidade de sucesso: (sucessos + 1) / (tentativas + 2) da rota
+  (suavizada), ou a taxa do carrier para rota sem historico.
+
+O tempo disponivel e `deadline - agora - PIPELINE_DEADLINE_RESERVE_MIN` (folga
+para merge/comparacao/upload), multiplicado pelas buscas em paralelo: abas do
+processo (`HAPAG_TABS`/`MAERSK_PAGES`) vezes os processos que dividem a fila
+(`SCRAPER_JOB_QUEUE` com shards/replicas: todos planejam o catalogo inteiro),
+limitado pela concorrencia atual do controle de ritmo (`RATE_CONTROL_ENABLED`).
+A duracao historica de uma rota com abas e tempo de parede (inclui a espera
+enquanto as outras abas sao atendidas), entao cada rota ocupa
+duracao / abas do tempo do processo. As rotas sao escolhidas gulosamente por cotacoes
+esperadas por segundo (p / duracao; empate pela prioridade original) ate
+encher o tempo, e executadas nessa ordem. Durante o batch, uma rota que nao
+cabe mais no tempo restante tambem e adiada. Rotas adiadas nao sao tocadas (a
+cotacao anterior continua no CSV) e vao para o log e para
+`artifacts/logs/<run_id>_<etapa>_deferred.json`.
+
+`SCRAPER_ROUTES_FILE` (gravado pelo refresh_daemon) restringe o batch a uma
+lista de rotas antes do planejamento.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import statistics
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Optional
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "orchestration"))
+import account_pool  # noqa: E402
+import job_queue  # noqa: E402
+import progress_events  # noqa: E402
+import rate_control  # noqa: E402
+import run_history  # noqa: E402
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+LOGS_DIR = PROJECT_ROOT / "artifacts" / "logs"
+
+
+ROUTES_FILE_ENV = "SCRAPER_ROUTES_FILE"
+DEADLINE_ROLLOVER_HOURS = 12
+
+
+def restrict_to_routes_file(jobs: list, log_fn: Callable[[str], None]) -> list:
+    """
+    Com `SCRAPER_ROUTES_FILE` (lista JSON de {origin, destination}), mantem so
+    essas rotas, na ordem da fila priorizada. Sem a env devolve `jobs` intacto.
+    """
+    raw = (os.getenv(ROUTES_FILE_ENV) or "").strip()
+    if not raw:
+        return jobs
+    items = json.loads(Path(raw).read_text(encoding="utf-8"))
+    wanted = {(str(item["origin"]).strip(), str(item["destination"]).strip()) for item in items}
+    kept = [job for job in jobs if (job["origin"].strip(), job["destination"].strip()) in wanted]
+    log_fn(f"[rotas] {ROUTES_FILE_ENV}: {len(kept)}/{len(jobs)} rotas da fila selecionadas ({len(wanted)} pedidas).")
+    return kept
+
+
+def parse_deadline(
+    raw: Optional[str],
+    now: Optional[datetime] = None,
+    log_fn: Optional[Callable[[str], None]] = None,
+) -> Optional[datetime]:
+    """
+    `HH:MM` ou data/hora ISO. Vazio = sem deadline. `HH:MM` e o horario de hoje;
+    so vira amanha quando ja passou ha mais de DEADLINE_ROLLOVER_HOURS (run da
+    noite para o deadline da manha). Run atrasado (retry as 07:40 contra 07:30)
+    fica com o deadline vencido e adia tudo. ISO com fuso vira hora local; valor
+    invalido e avisado e o run segue sem deadline.
+    """
+    raw = (raw or "").strip()
+    if not raw:
+        return None
+    now = now or datetime.now()
+    try:
+        hour, minute = (int(part) for part in raw.split(":", 1))
+        deadline = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if now - deadline > timedelta(hours=DEADLINE_ROLLOVER_HOURS):
+            deadline += timedelta(days=1)
+        return deadline
+    except ValueError:
+        pass
+    try:
+        deadline = datetime.fromisoformat(raw)
+    except ValueError:
+        if log_fn:
+            log_fn(f"[deadline] PIPELINE_DEADLINE invalido ({raw!r}); seguindo sem deadline.")
+        return None
+    if deadline.tzinfo is not None:
+        deadline = deadline.astimezone().replace(tzinfo=None)
+    return deadline
+
+
+def _route_estimate(attempts: list, carrier_sec: float, carrier_p: float) -> dict:
+    latencies = [float(lat) for _, lat in attempts if lat]
+    successes = sum(1 for status, _ in attempts if status in run_history.SUCCESS_STATUSES)
+    if not attempts:
+        return {"expected_sec": carrier_sec, "p_success": carrier_p, "samples": 0}
+    return {
+        "expected_sec": statistics.median(latencies) if latencies else carrier_sec,
+        "p_success": (successes + 1) / (len(attempts) + 2),
+        "samples": len(attempts),
+    }
+
+
+def build_cost_model(carrier: str) -> tuple[dict, float, float]:
+    """Devolve (estimativa por rota, duracao tipica do carrier, taxa de sucesso do carrier)."""
+    outcomes = run_history.recent_route_outcomes(carrier)
+    all_attempts = [a for attempts in outcomes.values() for a in attempts]
+    latencies = [float(lat) for _, lat in all_attempts if lat]
+    carrier_sec = (
+        statistics.median(latencies) if latencies else float(os.getenv("SCRAPER_DEFAULT_ROUTE_SEC", "90"))
+    )
+    successes = sum(1 for status, _ in all_attempts if status in run_history.SUCCESS_STATUSES)
+    carrier_p = (successes + 1) / (len(all_attempts) + 2)
+    routes = {key: _route_estimate(attempts, carrier_sec, carrier_p) for key, attempts in outcomes.items()}
+    return routes, carrier_sec, carrier_p
+
+
+def plan_routes(
+    carrier: str,
+    jobs: list,
+    key_fn: Callable[[dict], str],
+    log_fn: Callable[[str], None],
+    processes: int = 1,
+    concurrency: int = 1,
+) -> dict:
+    """
+    Escolhe/ordena as rotas que cabem ate o deadline. Sem `PIPELINE_DEADLINE`,
+    devolve a fila original. `processes`: processos que executam este plano em
+    paralelo (shards na fila compartilhada); `concurrency`: buscas em paralelo
+    por processo (abas). O dict devolvido acompanha o batch (`defer_if_late`).
+    """
+    deadline = parse_deadline(os.getenv("PIPELINE_DEADLINE"), log_fn=log_fn)
+    schedule = {"carrier": carrier, "deadline": deadline, "jobs": jobs, "deferred": [], "estimates": {}}
+    if deadline is None or not jobs:
+        return schedule
+
+    reserve_sec = float(os.getenv("PIPELINE_DEADLINE_RESERVE_MIN", "15")) * 60
+    routes, carrier_sec, carrier_p = build_cost_model(carrier)
+    estimates = {}
+    for job in jobs:
+        key = key_fn(job)
+        estimates[key] = routes.get(key) or _route_estimate([], carrier_sec, carrier_p)
+    schedule["estimates"] = estimates
+    schedule["reserve_sec"] = reserve_sec
+
+    processes = max(1, int(processes))
+    concurrency = max(1, int(concurrency))
+    parallel = processes * concurrency
+    if rate_control.control_enabled():
+        # o controle de ritmo limita as buscas simultaneas do carrier inteiro
+        parallel = min(parallel, rate_control.current_concurrency(carrier))
+        concurrency = min(concurrency, parallel)
+    schedule["concurrency"] = concurrency
+    available_sec = (deadline - datetime.now()).total_seconds() - reserve_sec
+    # tempo de processo ate o deadline, somado sobre os processos em paralelo
+    capacity_sec = max(0.0, available_sec) * parallel / concurrency
+    ranked = sorted(
+        enumerate(jobs),
+        key=lambda item: (
+            -estimates[key_fn(item[1])]["p_success"] / max(1.0, estimates[key_fn(item[1])]["expected_sec"]),
+            item[0],
+        ),
+    )
+    chosen, deferred, used_sec = [], [], 0.0
+    for _, job in ranked:
+        # as abas do processo dividem o tempo: cada rota ocupa duracao / abas
+        cost = estimates[key_fn(job)]["expected_sec"] / concurrency
+        if used_sec + cost <= capacity_sec:
+            chosen.append(job)
+            used_sec += cost
+        else:
+            deferred.append(_deferred_item(job, key_fn, estimates, "nao cabe no plano"))
+
+    schedule["jobs"] = chosen
+    schedule["deferred"] = deferred
+    expected_quotes = sum(estimates[key_fn(j)]["p_success"] for j in chosen)
+    spread = f" ({parallel} buscas em paralelo)" if parallel > 1 else ""
+    log_fn(
+        f"[deadline] {deadline:%Y-%m-%d %H:%M} (folga {reserve_sec / 60:.0f}min): "
+        f"{len(chosen)}/{len(jobs)} rotas no plano, ~{used_sec / 60:.0f}min de {capacity_sec / 60:.0f}min{spread}, "
+        f"~{expected_quotes:.1f} cotacoes esperadas; {len(deferred)} adiadas."
+    )
+    if deferred:
+        log_fn("[deadline] adiadas: " + ", ".join(item["key"] for item in deferred))
+    return schedule
+
+
+def _deferred_item(job: dict, key_fn: Callable[[dict], str], estimates: dict, reason: str) -> dict:
+    key = key_fn(job)
+    estimate = estimates.get(key, {})
+    return {
+        "key": key,
+        "origin": job.get("origin"),
+        "destination": job.get("destination"),
+        "expected_sec": round(float(estimate.get("expected_sec", 0.0)), 1),
+        "p_success": round(float(estimate.get("p_success", 0.0)), 3),
+        "reason": reason,
+    }
+
+
+def defer_if_late(schedule: dict, job: dict, key_fn: Callable[[dict], str], log_fn: Callable[[str], None]) -> bool:
+    """True se a rota nao cabe mais ate o deadline (ja registrada como adiada)."""
+    deadline = schedule.get("deadline")
+    if deadline is None:
+        return False
+    key = key_fn(job)
+    # com abas a duracao historica inclui a espera pelas outras abas
+    expected_sec = schedule["estimates"].get(key, {}).get("expected_sec", 0.0) / schedule.get("concurrency", 1)
+    left_sec = (deadline - datetime.now()).total_seconds() - schedule.get("reserve_sec", 0.0)
+    if expected_sec <= left_sec:
+        return False
+    schedule["deferred"].append(_deferred_item(job, key_fn, schedule["estimates"], "sem tempo durante o batch"))
+    progress_events.emit("job_deferred", carrier=schedule["carrier"], key=key)
+    log_fn(f"[deadline] {key} adiada: esperado {expected_sec:.0f}s, restam {max(0.0, left_sec):.0f}s.")
+    return True
+
+
+def open_job_feed(
+    schedule: dict,
+    jobs: list,
+    key_fn: Callable[[dict], str],
+    log_fn: Callable[[str], None],
+    use_queue: bool = False,
+    account: Optional[dict] = None,
+    busy_fn: Optional[Callable[[], bool]] = None,
+) -> dict:
+    """
+    Fonte de rotas dos loops de abas/paginas: a lista planejada ou, com a fila,
+    as rotas reservadas por este processo enquanto a conta nao for bloqueada.
+    `busy_fn` diz se alguma aba do processo tem rota em curso; com ela, a fila
+    nao espera pelos leases das proprias abas (`next_feed_job` devolve None).
+    """
+    carrier = schedule["carrier"]
+    source = (
+        account_pool.until_locked(
+            job_queue.leased_jobs(carrier, log_fn=log_fn, busy_fn=busy_fn), account, log_fn=log_fn
+        )
+        if use_queue
+        else jobs
+    )
+    return {
+        "schedule": schedule,
+        "source": iter(source),
+        "key_fn": key_fn,
+        "log_fn": log_fn,
+        "use_queue": use_queue,
+        "idx": 0,
+        "exhausted": False,
+    }
+
+
+def next_feed_job(feed: dict) -> Optional[dict]:
+    """
+    Proxima rota a iniciar, pulando (e registrando) as que nao cabem mais no
+    deadline. None quando a fonte acabou (`feed["exhausted"]`) ou, com a fila,
+    quando nao ha rota pendente agora mas abas do processo ainda estao ocupadas:
+    o loop conclui essas abas e pede de novo.
+    """
+    schedule, key_fn = feed["schedule"], feed["key_fn"]
+    for job in feed["source"]:
+        if job is None:
+            return None
+        feed["idx"] += 1
+        if defer_if_late(schedule, job, key_fn=key_fn, log_fn=feed["log_fn"]):
+            if feed["use_queue"]:
+                job_queue.ack(schedule["carrier"], key_fn(job), "deferred")
+            continue
+        return job
+    feed["exhausted"] = True
+    return None
+
+
+def write_deferred_report(schedule: dict) -> Optional[Path]:
+    """Grava as rotas adiadas (so quando ha deadline)."""
+    if schedule.get("deadline") is None:
+        return None
+    run_id = (os.getenv("RUN_ID") or "").strip() or datetime.now().strftime("%Y%m%d_%H%M%S")
+    stage = (os.getenv("PIPELINE_STAGE") or "").strip() or schedule["carrier"]
+    path = LOGS_DIR / f"{run_id}_{stage}_deferred.json"
+    payload = {
+        "carrier": schedule["carrier"],
+        "stage": stage,
+        "deadline": schedule["deadline"].isoformat(timespec="minutes"),
+        "written_at": datetime.now().isoformat(timespec="seconds"),
+        "deferred": schedule["deferred"],
+    }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    except OSError:
+        return None
+    return path
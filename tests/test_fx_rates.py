@@ -0,0 +1,52 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src" / "scrapers"))
+import fx_rates  # noqa: E402
+
+
+class Response:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def api(monkeypatch):
+    calls = []
+
+    def get(url, params=None, timeout=None):
+        calls.append(params["base"])
+        if params["base"] == "EUR":
+            return Response({"rates": {"USD": 1.1}})
+        raise OSError("sem rede")
+
+    monkeypatch.setenv("FX_API_BASE", "http://fx.teste/latest")
+    monkeypatch.setattr(fx_rates.requests, "get", get)
+    fx_rates._fetch_rate_to_usd.cache_clear()
+    yield calls
+    fx_rates._fetch_rate_to_usd.cache_clear()
+
+
+def test_rate_is_fetched_once_per_currency(api):
+    logs = []
+    assert fx_rates.amount_to_usd(100, "eur", log_fn=logs.append) == pytest.approx(110)
+    assert fx_rates.amount_to_usd(50, "EUR", log_fn=logs.append) == pytest.approx(55)
+    assert fx_rates.amount_to_usd(7, "USD", log_fn=logs.append) == 7
+    assert api == ["EUR"]
+    assert logs == []
+
+
+def test_api_failure_uses_approx_rate_or_none(api):
+    logs = []
+    assert fx_rates.amount_to_usd(1000, "COP", log_fn=logs.append) == pytest.approx(0.25)
+    assert fx_rates.amount_to_usd(10, "BRL", log_fn=logs.append) is None
+    assert fx_rates.amount_to_usd(None, "EUR", log_fn=logs.append) is None
+    assert any("aproximada" in msg for msg in logs)
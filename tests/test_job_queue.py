@@ -0,0 +1,124 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src" / "orchestration"))
+import job_queue  # noqa: E402
+
+QUEUE = "teste"
+
+
+class Clock:
+    def __init__(self, start: float = 1_000_000.0):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(tmp_path, monkeypatch):
+    monkeypatch.setenv("SCRAPER_QUEUE_DB", str(tmp_path / "job_queue.sqlite"))
+    monkeypatch.setenv("SCRAPER_QUEUE_NAME", QUEUE)
+    monkeypatch.setenv("SCRAPER_QUEUE_LEASE_SEC", "60")
+    monkeypatch.setenv("SCRAPER_QUEUE_MAX_ATTEMPTS", "2")
+    fake = Clock()
+    monkeypatch.setattr(job_queue.time, "time", fake.time)
+    return fake
+
+
+def publish(*keys):
+    return job_queue.enqueue("hapag", [{"key": k} for k in keys], key_fn=lambda j: j["key"])
+
+
+def test_enqueue_is_idempotent(clock):
+    assert publish("A", "B") == 2
+    assert publish("A", "B", "C") == 1
+    assert job_queue.queue_stats("hapag") == {job_queue.STATUS_PENDING: 3}
+
+
+def test_lease_follows_priority_and_ack_closes_route(clock):
+    publish("A", "B")
+    first = job_queue.lease("hapag", worker="w1")
+    second = job_queue.lease("hapag", worker="w2")
+    assert (first["key"], second["key"]) == ("A", "B")
+    assert first["attempts"] == 1
+    assert job_queue.lease("hapag", worker="w3") is None
+
+    assert job_queue.ack("hapag", "A", "success", worker="w1")
+    # so o dono do lease confirma
+    assert not job_queue.ack("hapag", "B", "success", worker="w1")
+    assert job_queue.queue_stats("hapag") == {job_queue.STATUS_DONE: 1, job_queue.STATUS_LEASED: 1}
+
+
+def test_expired_lease_is_leased_again_and_old_ack_is_ignored(clock):
+    publish("A")
+    assert job_queue.lease("hapag", worker="w1")["key"] == "A"
+
+    clock.now += 30
+    assert job_queue.lease("hapag", worker="w2") is None
+
+    clock.now += 31
+    item = job_queue.lease("hapag", worker="w2")
+    assert item["key"] == "A"
+    assert item["attempts"] == 2
+    assert not job_queue.ack("hapag", "A", "success", worker="w1")
+    assert job_queue.ack("hapag", "A", "no_quote", worker="w2")
+
+
+def test_renew_keeps_lease_alive(clock):
+    publish("A")
+    job_queue.lease("hapag", worker="w1")
+    clock.now += 50
+    assert job_queue.renew("hapag", "A", worker="w1")
+    clock.now += 50
+    assert job_queue.lease("hapag", worker="w2") is None
+    assert job_queue.ack("hapag", "A", "success", worker="w1")
+
+
+def test_route_fails_after_max_attempts(clock):
+    publish("A")
+    job_queue.lease("hapag", worker="w1")
+    clock.now += 61
+    job_queue.lease("hapag", worker="w2")
+    clock.now += 61
+    assert job_queue.lease("hapag", worker="w3") is None
+    assert job_queue.queue_stats("hapag") == {job_queue.STATUS_FAILED: 1}
+
+
+def test_release_returns_route_without_counting_attempt(clock):
+    publish("A")
+    job_queue.lease("hapag", worker="w1")
+    assert job_queue.release("hapag", "A", worker="w1")
+    item = job_queue.lease("hapag", worker="w2")
+    assert item["attempts"] == 1
+
+
+def test_leased_jobs_does_not_wait_on_own_leases(clock, monkeypatch):
+    publish("A", "B")
+    assert job_queue.lease("hapag", worker="w1")["key"] == "A"
+    monkeypatch.setattr(job_queue.time, "sleep", lambda sec: pytest.fail("esperou pelo proprio lease"))
+
+    got = [j["key"] for j in job_queue.leased_jobs("hapag", log_fn=lambda msg: None, worker="w1")]
+    assert got == ["B"]
+    assert job_queue.leased_by_others("hapag", worker="w1") == 0
+
+
+def test_leased_jobs_waits_for_other_worker_lease(clock, monkeypatch):
+    publish("A", "B")
+    job_queue.lease("hapag", worker="w2")
+    sleeps = []
+
+    def sleep(sec):
+        # o lease do outro worker expira enquanto este espera
+        sleeps.append(sec)
+        clock.now += 61
+
+    monkeypatch.setattr(job_queue.time, "sleep", sleep)
+    got = []
+    for job in job_queue.leased_jobs("hapag", log_fn=lambda msg: None, worker="w1"):
+        got.append(job["key"])
+        job_queue.ack("hapag", job["key"], "success", worker="w1")
+    assert got == ["B", "A"]
+    assert len(sleeps) == 1
@@ -0,0 +1,59 @@
+import csv
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src" / "orchestration"))
+import quote_store  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setenv("QUOTE_STORE_DB", str(tmp_path / "quotes.sqlite"))
+    monkeypatch.setenv("QUOTE_STORE_ENABLED", "1")
+    return tmp_path
+
+
+def read_rows(path: Path) -> list:
+    with path.open(encoding="utf-8-sig", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_export_view_keeps_last_success_charges(store):
+    base = {"key": "SSZ-HAM", "origin": "SSZ", "destination": "HAM", "message": ""}
+    quote_store.record_attempt(
+        "hapag",
+        {**base, "last_attempt_at": "2026-01-01T10:00:00", "quoted_at": "2026-01-01T10:00:00",
+         "status": "success", "Ocean Freight | 20STD": "1000", "Ocean Freight | 20STD | Curr": "EUR"},
+    )
+    quote_store.record_attempt("hapag", {**base, "last_attempt_at": "2026-01-02T10:00:00", "status": "error"})
+
+    path = store / "hapag_breakdowns.csv"
+    assert quote_store.export_view("hapag", path) == 1
+    (row,) = read_rows(path)
+    assert row["status"] == "error"
+    assert row["last_attempt_at"] == "2026-01-02T10:00:00"
+    assert row["quoted_at"] == "2026-01-01T10:00:00"
+    assert row["Ocean Freight | 20STD"] == "1000"
+    assert list(row)[: len(quote_store.BASE_FIELDS)] == list(quote_store.BASE_FIELDS)
+
+
+def test_export_view_is_none_with_store_disabled(store, monkeypatch):
+    monkeypatch.setenv("QUOTE_STORE_ENABLED", "0")
+    assert quote_store.export_view("cma", store / "cma_breakdowns.csv") is None
+    assert not (store / "cma_breakdowns.csv").exists()
+
+
+def test_replace_file_keeps_previous_file_when_write_fails(tmp_path):
+    path = tmp_path / "out.csv"
+    path.write_text("antigo\n", encoding="utf-8")
+
+    def broken(tmp: Path) -> None:
+        tmp.write_text("pela metade", encoding="utf-8")
+        raise OSError("disco cheio")
+
+    with pytest.raises(OSError):
+        quote_store.replace_file(path, broken)
+    assert path.read_text(encoding="utf-8") == "antigo\n"
+    assert list(tmp_path.iterdir()) == [path]
@@ -0,0 +1,106 @@
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src" / "scrapers"))
+import route_scheduler  # noqa: E402
+import job_queue  # noqa: E402
+
+KEY_FN = lambda job: job["key"]  # noqa: E731
+
+
+@pytest.fixture
+def queue_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("SCRAPER_QUEUE_DB", str(tmp_path / "job_queue.sqlite"))
+    monkeypatch.setenv("SCRAPER_QUEUE_NAME", "teste")
+    monkeypatch.delenv("PIPELINE_DEADLINE", raising=False)
+    # aba livre nunca deve dormir esperando pelos leases das abas do proprio processo
+    monkeypatch.setattr(job_queue.time, "sleep", lambda sec: pytest.fail("loop de abas esperou pela fila"))
+
+
+def tab_feed(carrier, keys, tabs):
+    jobs = [{"key": k} for k in keys]
+    job_queue.enqueue(carrier, jobs, key_fn=KEY_FN)
+    schedule = route_scheduler.plan_routes(carrier, jobs, key_fn=KEY_FN, log_fn=lambda msg: None)
+    return route_scheduler.open_job_feed(
+        schedule,
+        jobs,
+        key_fn=KEY_FN,
+        log_fn=lambda msg: None,
+        use_queue=True,
+        busy_fn=lambda: any(t["job"] is not None for t in tabs),
+    )
+
+
+@pytest.mark.parametrize("carrier", ["hapag", "maersk"])
+def test_free_tab_does_not_block_on_sibling_leases(queue_env, carrier):
+    tabs = [{"job": None}, {"job": None}, {"job": None}]
+    feed = tab_feed(carrier, ["A", "B"], tabs)
+    tabs[0]["job"] = route_scheduler.next_feed_job(feed)
+    tabs[1]["job"] = route_scheduler.next_feed_job(feed)
+
+    assert route_scheduler.next_feed_job(feed) is None
+    assert not feed["exhausted"]
+    assert job_queue.queue_stats(carrier) == {job_queue.STATUS_LEASED: 2}
+
+
+@pytest.mark.parametrize("carrier", ["hapag", "maersk"])
+def test_tab_loop_with_queue_runs_each_route_once(queue_env, carrier):
+    tabs = [{"job": None}, {"job": None}]
+    feed = tab_feed(carrier, ["A", "B", "C"], tabs)
+    done = []
+    # mesmo formato do loop de abas da Hapag/Maersk
+    while True:
+        for tab in tabs:
+            while tab["job"] is None and not feed["exhausted"]:
+                job = route_scheduler.next_feed_job(feed)
+                if job is None:
+                    break
+                tab["job"] = job
+        busy = [t for t in tabs if t["job"] is not None]
+        if not busy:
+            break
+        tab = busy[0]
+        assert job_queue.ack(carrier, tab["job"]["key"], "success")
+        done.append(tab["job"]["key"])
+        tab["job"] = None
+
+    assert sorted(done) == ["A", "B", "C"]
+    assert feed["exhausted"]
+    assert job_queue.queue_stats(carrier) == {job_queue.STATUS_DONE: 3}
+
+
+NOW = datetime(2026, 3, 10, 6, 0)
+
+
+def test_parse_deadline_hhmm_is_today_or_tomorrow():
+    assert route_scheduler.parse_deadline("07:30", now=NOW) == datetime(2026, 3, 10, 7, 30)
+    assert route_scheduler.parse_deadline("07:30", now=datetime(2026, 3, 10, 22, 0)) == datetime(2026, 3, 11, 7, 30)
+    assert route_scheduler.parse_deadline("", now=NOW) is None
+
+
+@pytest.mark.parametrize("raw", ["7", "7h30", "25:00", "amanha"])
+def test_parse_deadline_invalid_value_means_no_deadline(raw):
+    logs = []
+    assert route_scheduler.parse_deadline(raw, now=NOW, log_fn=logs.append) is None
+    assert len(logs) == 1 and "PIPELINE_DEADLINE" in logs[0]
+
+
+def test_parse_deadline_with_timezone_becomes_local_naive():
+    aware = datetime(2026, 3, 10, 10, 30, tzinfo=timezone(timedelta(hours=-3)))
+    deadline = route_scheduler.parse_deadline(aware.isoformat(), now=NOW)
+    assert deadline.tzinfo is None
+    assert deadline == aware.astimezone().replace(tzinfo=None)
+    assert deadline < NOW + timedelta(days=1)  # comparavel com o relogio local
+
+
+def test_plan_routes_ignores_invalid_deadline(monkeypatch):
+    monkeypatch.setenv("PIPELINE_DEADLINE", "7h30")
+    jobs = [{"key": "A"}, {"key": "B"}]
+    logs = []
+    schedule = route_scheduler.plan_routes("hapag", jobs, key_fn=KEY_FN, log_fn=logs.append)
+    assert schedule["deadline"] is None
+    assert schedule["jobs"] == jobs
+    assert any("PIPELINE_DEADLINE" in msg for msg in logs)